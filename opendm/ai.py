@@ -1,56 +1,413 @@
 import os
-from opendm.net import download
+import json
+import shutil
+from opendm.net import download, sha256sum
 from opendm import log
 import zipfile
 import time
 import sys
+import threading
+from contextlib import contextmanager
+try:
+    import Queue as queue
+except:
+    import queue
 
-def get_model(namespace, url, version, name = "model.onnx"):
-    version = version.replace(".", "_")
+MANIFEST_FILE = "manifest.json"
 
+def models_dir():
     base_dir = os.path.join(os.path.dirname(__file__), "..")
     if sys.platform == 'win32':
         base_dir = os.path.join(os.getenv('PROGRAMDATA'),"ODM")
-    base_dir = os.path.join(os.path.abspath(base_dir), "storage", "models")
-    
-    namespace_dir = os.path.join(base_dir, namespace)
-    versioned_dir = os.path.join(namespace_dir, version)
+    return os.path.join(os.path.abspath(base_dir), "storage", "models")
 
-    if not os.path.isdir(versioned_dir):
-        os.makedirs(versioned_dir, exist_ok=True)
-    
-    # Check if we need to download it
-    model_file = os.path.join(versioned_dir, name)
-    if not os.path.isfile(model_file):
-        log.ODM_INFO("Downloading AI model from %s ..." % url)
+def model_url(namespace, default=None):
+    """
+    :return download location of a model, which can be overridden
+        with the ODM_MODEL_URL_<NAMESPACE> environment variable (URL or local path)
+    """
+    return os.environ.get("ODM_MODEL_URL_%s" % namespace.upper(), default)
+
+@contextmanager
+def file_lock(path):
+    """
+    Exclusive lock on a file for the duration of the with block. Processes
+    (and threads) that need the same model wait for each other this way.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        if sys.platform == 'win32':
+            import msvcrt
+            while True:
+                try:
+                    msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # Gave up after 10 seconds, keep waiting
+                    pass
+        else:
+            import fcntl
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        if sys.platform == 'win32':
+            import msvcrt
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        os.close(fd)
 
-        last_update = 0
+def hash_model_files(model_dir):
+    """
+    :return dictionary of relative path --> [size, mtime_ns, SHA-256] of the files of a model
+    """
+    files = {}
+    for root, dirs, filenames in os.walk(model_dir):
+        for f in filenames:
+            path = os.path.join(root, f)
+            rel = os.path.relpath(path, model_dir).replace(os.sep, "/")
+            # Skip files created locally (optimized models, locks)
+            if rel == MANIFEST_FILE or rel.endswith((".ort", ".lock", ".tmp")):
+                continue
+            st = os.stat(path)
+            files[rel] = [st.st_size, st.st_mtime_ns, sha256sum(path)]
+    return files
 
-        def callback(progress):
-            nonlocal last_update
+def read_manifest(model_dir):
+    try:
+        with open(os.path.join(model_dir, MANIFEST_FILE), 'r') as f:
+            return json.loads(f.read())
+    except (IOError, OSError, ValueError):
+        return None
 
-            time_has_elapsed = time.time() - last_update >= 2
+def write_manifest(model_dir, manifest):
+    path = os.path.join(model_dir, MANIFEST_FILE)
+    with open(path + ".tmp", 'w') as f:
+        f.write(json.dumps(manifest, indent=2))
+    os.replace(path + ".tmp", path)
 
-            if time_has_elapsed or int(progress) == 100:
-                log.ODM_INFO("Downloading: %s%%" % int(progress))
-                last_update = time.time()
+def verify_model_dir(model_dir):
+    """
+    Check the files of a model against the checksums in its manifest.
+    Files whose size and modification time haven't changed are not hashed again.
+    Models downloaded before manifests existed get one.
+    :return True if the files are intact
+    """
+    manifest = read_manifest(model_dir)
+    if manifest is None:
+        log.ODM_INFO("Creating manifest for %s" % model_dir)
+        write_manifest(model_dir, {'url': None, 'sha256': None, 'files': hash_model_files(model_dir)})
+        return True
 
+    changed = False
+    for rel, (size, mtime_ns, checksum) in manifest['files'].items():
+        path = os.path.join(model_dir, rel)
         try:
-            downloaded_file = download(url, versioned_dir, progress_callback=callback)
-        except Exception as e:
-            log.ODM_WARNING("Cannot download %s: %s" % (url, str(e)))
+            st = os.stat(path)
+        except OSError:
+            log.ODM_WARNING("%s is missing" % path)
+            return False
+        if st.st_size != size:
+            log.ODM_WARNING("%s has the wrong size" % path)
+            return False
+        if st.st_mtime_ns != mtime_ns:
+            if sha256sum(path) != checksum:
+                log.ODM_WARNING("%s is corrupted (checksum mismatch)" % path)
+                return False
+            manifest['files'][rel][1] = st.st_mtime_ns
+            changed = True
+
+    if changed:
+        write_manifest(model_dir, manifest)
+    return True
+
+def get_model(namespace, url, version, name = "model.onnx", sha256 = None):
+    """
+    Get a model from storage/models/<namespace>/<version>, downloading it if needed.
+    The files of a model are verified against the checksums recorded in its manifest
+    when it was downloaded, and downloaded again if they don't match.
+    :param namespace model name
+    :param url location of the model (.zip archive or single file). Overridden by ODM_MODEL_URL_<NAMESPACE>
+    :param version model version
+    :param name file name of the model
+    :param sha256 expected SHA-256 of the downloaded file (optional)
+    :return path to the model, or None if it's not available
+    """
+    version = version.replace(".", "_")
+
+    namespace_dir = os.path.join(models_dir(), namespace)
+    versioned_dir = os.path.join(namespace_dir, version)
+    if not os.path.isdir(namespace_dir):
+        os.makedirs(namespace_dir, exist_ok=True)
+
+    url = model_url(namespace, url)
+    model_file = os.path.join(versioned_dir, name)
+
+    with file_lock(versioned_dir + ".lock"):
+        if os.path.isfile(model_file):
+            if verify_model_dir(versioned_dir):
+                return model_file
+            log.ODM_WARNING("Downloading %s model %s again" % (namespace, version))
+
+        if not url:
+            log.ODM_WARNING("No download location for the %s model, set ODM_MODEL_URL_%s" % (namespace, namespace.upper()))
             return None
 
+        # Download to a temporary directory (kept on failure so that the download can resume)
+        download_dir = versioned_dir + ".download"
+        if not os.path.isdir(download_dir):
+            os.makedirs(download_dir, exist_ok=True)
+
+        if os.path.isfile(url):
+            log.ODM_INFO("Copying AI model from %s ..." % url)
+            downloaded_file = os.path.join(download_dir, os.path.basename(url))
+            shutil.copyfile(url, downloaded_file)
+            if sha256 is not None and sha256sum(downloaded_file) != sha256.lower():
+                log.ODM_WARNING("Checksum mismatch for %s" % url)
+                shutil.rmtree(download_dir)
+                return None
+        else:
+            log.ODM_INFO("Downloading AI model from %s ..." % url)
+
+            last_update = 0
+
+            def callback(progress):
+                nonlocal last_update
+
+                time_has_elapsed = time.time() - last_update >= 2
+
+                if time_has_elapsed or int(progress) == 100:
+                    log.ODM_INFO("Downloading: %s%%" % int(progress))
+                    last_update = time.time()
+
+            try:
+                downloaded_file = download(url, download_dir, progress_callback=callback, sha256=sha256)
+            except Exception as e:
+                log.ODM_WARNING("Cannot download %s: %s" % (url, str(e)))
+                return None
+
         if os.path.basename(downloaded_file).lower().endswith(".zip"):
             log.ODM_INFO("Extracting %s ..." % downloaded_file)
             with zipfile.ZipFile(downloaded_file, 'r') as z:
-                z.extractall(versioned_dir)
+                z.extractall(download_dir)
             os.remove(downloaded_file)
-        
-        if not os.path.isfile(model_file):
+
+        if not os.path.isfile(os.path.join(download_dir, name)):
             log.ODM_WARNING("Cannot find %s (is the URL to the AI model correct?)" % model_file)
+            shutil.rmtree(download_dir)
             return None
-        else:
-            return model_file
-    else:
-        return model_file
\ No newline at end of file
+
+        write_manifest(download_dir, {'url': url, 'sha256': sha256, 'files': hash_model_files(download_dir)})
+        if os.path.isdir(versioned_dir):
+            shutil.rmtree(versioned_dir)
+        os.rename(download_dir, versioned_dir)
+        return model_file
+
+def optimized_model(model):
+    """
+    ORT format copy of an ONNX model with graph optimizations already applied,
+    which is faster to load. It's created (once) next to the model.
+    :return path to the ORT model, or to the original model if it cannot be created
+    """
+    if not model.lower().endswith(".onnx"):
+        return model
+
+    ort_model = model[:-len(".onnx")] + ".ort"
+
+    def is_current():
+        return os.path.isfile(ort_model) and os.path.getmtime(ort_model) >= os.path.getmtime(model)
+
+    if is_current():
+        return ort_model
+
+    with file_lock(ort_model + ".lock"):
+        if is_current():
+            return ort_model
+
+        tmp = "%s.%s.tmp" % (ort_model, os.getpid())
+        try:
+            import onnxruntime as ort
+            opts = ort.SessionOptions()
+            # Extended (not all) optimizations, the result doesn't depend on the CPU
+            opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+            opts.optimized_model_filepath = tmp
+            opts.add_session_config_entry("session.save_model_format", "ORT")
+            ort.InferenceSession(model, sess_options=opts, providers=["CPUExecutionProvider"])
+            os.replace(tmp, ort_model)
+            log.ODM_INFO("Saved optimized model %s" % ort_model)
+        except Exception as e:
+            log.ODM_WARNING("Cannot create optimized model for %s: %s" % (model, str(e)))
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+            return model
+
+    return ort_model
+
+def cpu_only(providers):
+    return providers is None or all(p == "CPUExecutionProvider" for p in providers)
+
+def create_session(model, sess_options=None, providers=None, model_bytes=None):
+    """
+    Create an onnxruntime.InferenceSession, from the optimized ORT model if there's one
+    and the session runs on the CPU (optimizations for other providers differ).
+    :param model path to the ONNX model
+    :param sess_options onnxruntime.SessionOptions
+    :param providers list of execution providers
+    :param model_bytes contents of the ORT model. Sessions created from the same bytes share the weights
+    """
+    import onnxruntime as ort
+
+    if cpu_only(providers):
+        source = model_bytes if model_bytes is not None else optimized_model(model)
+        if source is not model:
+            opts = sess_options or ort.SessionOptions()
+            opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+            if model_bytes is not None:
+                opts.add_session_config_entry("session.use_ort_model_bytes_directly", "1")
+                opts.add_session_config_entry("session.use_ort_model_bytes_for_initializers", "1")
+            try:
+                return ort.InferenceSession(source, sess_options=opts, providers=providers)
+            except Exception as e:
+                log.ODM_WARNING("Cannot load optimized model for %s, using the original: %s" % (model, str(e)))
+                opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+                sess_options = opts
+
+    return ort.InferenceSession(model, sess_options=sess_options, providers=providers)
+
+class SessionPool:
+    """
+    A pool of onnxruntime.InferenceSession instances for the same model,
+    leased to worker threads so that inference on different images can
+    run concurrently instead of being serialized on a single session.
+    """
+
+    def __init__(self, model, providers=None, max_sessions=1, intra_op_num_threads=None, memory_per_session=None):
+        """
+        :param model path to the ONNX model
+        :param providers list of onnxruntime execution providers
+        :param max_sessions upper bound on the number of sessions to create
+        :param intra_op_num_threads threads used by each session. If None,
+            the available cores are split among the sessions
+        :param memory_per_session estimated memory (in bytes) used by each session.
+            If None, it's estimated from the size of the model
+        """
+        import onnxruntime as ort
+        from opendm.planner import get_available_cpus
+
+        self.model = model
+        self.providers = providers
+
+        if memory_per_session is None:
+            memory_per_session = estimate_session_memory(model)
+
+        self.size = get_session_pool_size(max_sessions, memory_per_session, 
+                                          intra_op_num_threads=intra_op_num_threads or 1,
+                                          gpu=providers is not None and "CUDAExecutionProvider" in providers)
+        if intra_op_num_threads is None:
+            intra_op_num_threads = max(1, get_available_cpus() // self.size)
+        self.intra_op_num_threads = intra_op_num_threads
+
+        self._ort = ort
+        self._model_bytes = None
+        if cpu_only(providers):
+            # Sessions share the weights of the optimized model
+            ort_model = optimized_model(model)
+            if ort_model != model:
+                with open(ort_model, 'rb') as f:
+                    self._model_bytes = f.read()
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._created = 0
+
+        # Create the first session right away, so that
+        # errors in the model surface early
+        self._idle.put(self._create_session())
+        self._created = 1
+
+        log.ODM_INFO("Session pool for %s: up to %s sessions with %s threads each" % (os.path.basename(model), self.size, self.intra_op_num_threads))
+
+    def _create_session(self):
+        opts = self._ort.SessionOptions()
+        opts.intra_op_num_threads = self.intra_op_num_threads
+        opts.inter_op_num_threads = 1
+        return create_session(self.model, sess_options=opts, providers=self.providers, model_bytes=self._model_bytes)
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        # Grow the pool lazily
+        with self._lock:
+            grow = self._created < self.size
+            if grow:
+                # Reserve the slot
+                self._created += 1
+        
+        if grow:
+            try:
+                return self._create_session()
+            except:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        return self._idle.get()
+
+    def _release(self, session):
+        self._idle.put(session)
+
+    @contextmanager
+    def session(self):
+        """
+        Lease a session for the duration of the with block.
+        Blocks until a session is available.
+        """
+        s = self._acquire()
+        try:
+            yield s
+        finally:
+            self._release(s)
+
+    def run(self, output_names, input_feed):
+        """Run inference on a leased session"""
+        with self.session() as s:
+            return s.run(output_names, input_feed)
+
+    def get_inputs(self):
+        with self.session() as s:
+            return s.get_inputs()
+
+    def get_outputs(self):
+        with self.session() as s:
+            return s.get_outputs()
+
+
+def estimate_session_memory(model):
+    """
+    Rough estimate of the memory (in bytes) needed by an inference session,
+    weights plus intermediate buffers
+    """
+    try:
+        return max(os.path.getsize(model) * 4, 256 * 1024 * 1024)
+    except OSError:
+        return 512 * 1024 * 1024
+
+def get_session_pool_size(max_sessions, memory_per_session, intra_op_num_threads=1, gpu=False, use_at_most=0.5):
+    """
+    :param max_sessions upper bound on the number of sessions
+    :param memory_per_session estimated memory (in bytes) used by each session
+    :param intra_op_num_threads threads used by each session
+    :param gpu whether sessions run on a GPU (a single session is used in that case)
+    :param use_at_most use at most this fraction of the available memory
+    :return number of sessions that can run concurrently
+    """
+    from opendm.planner import ConcurrencyPlanner
+
+    if gpu:
+        # GPU memory is the limiting factor, and a single
+        # session already keeps the device busy
+        return 1
+
+    planner = ConcurrencyPlanner(max_sessions, use_at_most=use_at_most)
+    return planner.plan(memory_per_session / 1024.0 / 1024.0, cpus_per_task=intra_op_num_threads)
@@ -5,9 +5,7 @@ import cv2
 import os
 import onnxruntime as ort
 from opendm import log
-from threading import Lock
-
-mutex = Lock()
+from opendm.ai import SessionPool
 
 # Implementation based on https://github.com/danielgatis/rembg by Daniel Gatis
 
@@ -15,8 +13,9 @@ mutex = Lock()
 provider = "CUDAExecutionProvider" if "CUDAExecutionProvider" in ort.get_available_providers() else "CPUExecutionProvider"
 
 class BgFilter():
-    def __init__(self, model):
+    def __init__(self, model, max_sessions = 1):
         self.model = model
+        self.max_sessions = max_sessions
 
         log.ODM_INFO(' ?> Using provider %s' % provider)
         self.load_model()
@@ -25,7 +24,8 @@ class BgFilter():
     def load_model(self):
         log.ODM_INFO(' -> Loading the model')
 
-        self.session = ort.InferenceSession(self.model, providers=[provider])
+        self.session = SessionPool(self.model, providers=[provider], max_sessions=self.max_sessions)
+        self.input_name = self.session.get_inputs()[0].name
 
     def normalize(self, img, mean, std, size):
         im = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
@@ -40,21 +40,19 @@ class BgFilter():
         tmpImg = tmpImg.transpose((2, 0, 1))
 
         return {
-            self.session.get_inputs()[0]
-            .name: np.expand_dims(tmpImg, 0)
+            self.input_name: np.expand_dims(tmpImg, 0)
             .astype(np.float32)
         }
 
     def get_mask(self, img):
         height, width, c = img.shape
 
-        with mutex:
-            ort_outs = self.session.run(
-                None,
-                self.normalize(
-                    img, (0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320) # <-- image size
-                ),
-            )
+        ort_outs = self.session.run(
+            None,
+            self.normalize(
+                img, (0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320) # <-- image size
+            ),
+        )
 
         pred = ort_outs[0][:, 0, :, :]
 
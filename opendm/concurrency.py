@@ -1,13 +1,14 @@
-from vmem import virtual_memory
 import os
 import sys
-try:
-    import Queue as queue
-except:
-    import queue
 import threading
-import time
+import multiprocessing
+import numpy as np
+from collections import deque
+from concurrent.futures import CancelledError, ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory, resource_tracker
 from opendm import log
+from opendm.planner import get_memory_info
 
 def get_max_memory(minimum = 5, use_at_most = 0.5):
     """
@@ -15,7 +16,8 @@ def get_max_memory(minimum = 5, use_at_most = 0.5):
     :param use_at_most use at most this fraction of the available memory. 0.5 = use at most 50% of available memory
     :return percentage value of memory to use (75 = 75%).
     """
-    return max(minimum, (100 - virtual_memory().percent) * use_at_most)
+    total, available = get_memory_info()
+    return max(minimum, (available * 100.0 / total) * use_at_most)
 
 def get_max_memory_mb(minimum = 100, use_at_most = 0.5):
     """
@@ -23,81 +25,642 @@ def get_max_memory_mb(minimum = 100, use_at_most = 0.5):
     :param use_at_most use at most this fraction of the available memory. 0.5 = use at most 50% of available memory
     :return value of memory to use in megabytes.
     """
-    return max(minimum, (virtual_memory().available / 1024 / 1024) * use_at_most)
+    _, available = get_memory_info()
+    return max(minimum, (available / 1024 / 1024) * use_at_most)
 
 def get_total_memory():
-    return virtual_memory().total
+    total, _ = get_memory_info()
+    return total
 
-def parallel_map(func, items, max_workers=1, single_thread_fallback=True):
+class TaskError(Exception):
     """
-    Our own implementation for parallel processing
-    which handles gracefully CTRL+C and reverts to 
-    single thread processing in case of errors
-    :param items list of objects
-    :param func function to execute on each object
+    Raised by parallel_imap when an item keeps failing after all retries
+    """
+    def __init__(self, index, item, error):
+        super(TaskError, self).__init__("Item %s (%s) failed: %s" % (index, item, str(error)))
+        self.index = index
+        self.item = item
+        self.error = error
+
+class CancelToken(object):
+    """
+    Cancels one or more running parallel_imap calls from any thread.
+    Items that are already running are allowed to finish,
+    no new items are started.
     """
-    global error
-    error = None
+    def __init__(self):
+        self._cancelled = False
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            callbacks = list(self._callbacks)
+
+        for cb in callbacks:
+            cb()
+
+    def cancelled(self):
+        return self._cancelled
+
+    def _register(self, callback):
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def _unregister(self, callback):
+        with self._lock:
+            self._callbacks.remove(callback)
+
+class _ParallelMap(object):
+    def __init__(self, func, items, max_workers, ordered, memory_cost, max_memory_mb,
+                 max_in_flight, retries, return_exceptions, cancel_token):
+        self.func = func
+        self.source = enumerate(items)
+        self.max_workers = max_workers
+        self.ordered = ordered
+        self.memory_cost = memory_cost
+        self.max_memory_mb = max_memory_mb
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.return_exceptions = return_exceptions
+        self.cancel_token = cancel_token
+        self.log_stage = log.logger.current_stage()
+
+        self.cond = threading.Condition()
+        self.peeked = None
+        self.exhausted = False
+        self.stopped = False
+        self.source_error = None
+
+        # Items taken from the source whose result has not been consumed yet
+        self.pending = 0
+        self.memory = 0
+        self.running = 0
+
+        self.retry_queue = deque()
+        self.done = {}
+        self.done_order = deque()
 
-    def process_one(q):
-        func(q)
+    def _cancelled(self):
+        return self.cancel_token is not None and self.cancel_token.cancelled()
 
-    def worker():
-        global error
+    def _wake(self):
+        with self.cond:
+            self.cond.notify_all()
 
+    def _acquire(self):
+        # Called with self.cond held
         while True:
-            (num, q) = pq.get()
-            if q is None or error is not None:
-                pq.task_done()
-                break
+            if self.stopped or self._cancelled():
+                return None
+
+            if self.retry_queue:
+                self.running += 1
+                return self.retry_queue.popleft()
+
+            if self.peeked is None and not self.exhausted:
+                try:
+                    index, item = next(self.source)
+                    cost = self.memory_cost(item) if self.memory_cost is not None else 0
+                    self.peeked = (index, item, cost, 0)
+                except StopIteration:
+                    self.exhausted = True
+                    self.cond.notify_all()
+                except Exception as e:
+                    self.source_error = e
+                    self.exhausted = True
+                    self.cond.notify_all()
+
+            if self.peeked is not None:
+                cost = self.peeked[2]
+                # Always let one item through, even if it's larger than the budget
+                if self.pending == 0 or (self.pending < self.max_in_flight and
+                   (self.max_memory_mb is None or self.memory + cost <= self.max_memory_mb)):
+                    task = self.peeked
+                    self.peeked = None
+                    self.pending += 1
+                    self.memory += cost
+                    self.running += 1
+                    return task
+            elif self.running == 0:
+                # Nothing left to do and nobody can add retries
+                return None
+
+            self.cond.wait()
+
+    def _worker(self):
+        log.logger.set_stage(self.log_stage)
+        while True:
+            with self.cond:
+                task = self._acquire()
+            if task is None:
+                return
 
+            index, item, cost, attempt = task
+            result = None
+            error = None
             try:
-                process_one(q)
-            except Exception as e:
+                result = self.func(item)
+            except BaseException as e:
                 error = e
-            finally:
-                pq.task_done()
 
-    if max_workers > 1:
-        use_single_thread = False
-        pq = queue.PriorityQueue()
+            with self.cond:
+                self.running -= 1
+                if error is not None and attempt < self.retries and not self.stopped:
+                    log.ODM_WARNING("Item %s failed (%s), retrying (%s/%s)" % (index, str(error), attempt + 1, self.retries))
+                    self.retry_queue.append((index, item, cost, attempt + 1))
+                else:
+                    self.done[index] = (item, result, error, cost)
+                    self.done_order.append(index)
+                self.cond.notify_all()
+
+    def _take(self, index):
+        item, result, error, cost = self.done.pop(index)
+        self.pending -= 1
+        self.memory -= cost
+        self.cond.notify_all()
+
+        if error is not None and not self.return_exceptions:
+            self.stopped = True
+            raise TaskError(index, item, error)
+        return error if error is not None else result
+
+    def __iter__(self):
+        if self.cancel_token is not None:
+            self.cancel_token._register(self._wake)
+
         threads = []
-        for i in range(max_workers):
-            t = threading.Thread(target=worker)
-            t.start()
-            threads.append(t)
-
-        i = 1
-        for t in items:
-            pq.put((i, t))
-            i += 1
-
-        def stop_workers():
-            for i in range(len(threads)):
-                pq.put((-1, None))
+        try:
+            for i in range(self.max_workers):
+                t = threading.Thread(target=self._worker)
+                t.daemon = True
+                t.start()
+                threads.append(t)
+
+            next_index = 0
+            while True:
+                with self.cond:
+                    while True:
+                        if self._cancelled():
+                            raise CancelledError()
+
+                        if self.ordered:
+                            if next_index in self.done:
+                                value = self._take(next_index)
+                                next_index += 1
+                                break
+                        else:
+                            if self.done_order:
+                                value = self._take(self.done_order.popleft())
+                                break
+
+                        if self.exhausted and self.peeked is None and self.pending == 0:
+                            if self.source_error is not None:
+                                raise self.source_error
+                            return
+
+                        self.cond.wait()
+
+                yield value
+        finally:
+            with self.cond:
+                self.stopped = True
+                self.cond.notify_all()
             for t in threads:
                 t.join()
+            if self.cancel_token is not None:
+                self.cancel_token._unregister(self._wake)
 
-        # block until all tasks are done
+def _serial_imap(func, items, retries, return_exceptions, cancel_token):
+    for index, item in enumerate(items):
+        attempt = 0
+        while True:
+            if cancel_token is not None and cancel_token.cancelled():
+                raise CancelledError()
+            try:
+                value = func(item)
+                break
+            except Exception as e:
+                if attempt < retries:
+                    attempt += 1
+                    log.ODM_WARNING("Item %s failed (%s), retrying (%s/%s)" % (index, str(e), attempt, retries))
+                elif return_exceptions:
+                    value = e
+                    break
+                else:
+                    raise TaskError(index, item, e)
+        yield value
+
+def parallel_imap(func, items, max_workers=1, ordered=True, memory_cost=None, max_memory_mb=None,
+                  max_in_flight=None, retries=0, return_exceptions=False, cancel_token=None):
+    """
+    Apply func to each item using a pool of threads and yield the results
+    as they become available. Workers and consumer wake up on events, nothing is polled.
+    Closing the generator (or breaking out of a for loop) stops the workers.
+    :param func function to execute on each item
+    :param items iterable of objects, consumed lazily
+    :param max_workers number of threads. 1 runs everything in the calling thread
+    :param ordered yield results in the same order as items (otherwise in completion order)
+    :param memory_cost function returning the estimated memory (MB) needed to process an item
+    :param max_memory_mb memory budget for items that are running or whose results haven't been consumed.
+        Defaults to get_max_memory_mb() when memory_cost is set
+    :param max_in_flight maximum number of items that are running or whose results haven't been consumed.
+        Defaults to 4 * max_workers
+    :param retries number of times a failing item is retried before giving up
+    :param return_exceptions yield the exception of items that keep failing instead of raising TaskError
+    :param cancel_token CancelToken to stop processing from another thread (raises CancelledError)
+    """
+    if max_workers <= 1:
+        return _serial_imap(func, items, retries, return_exceptions, cancel_token)
+
+    if memory_cost is not None and max_memory_mb is None:
+        max_memory_mb = get_max_memory_mb()
+    if max_in_flight is None:
+        max_in_flight = max_workers * 4
+
+    return iter(_ParallelMap(func, items, max_workers, ordered, memory_cost, max_memory_mb,
+                             max(1, max_in_flight), retries, return_exceptions, cancel_token))
+
+def _map(imap, func, items, max_workers, single_thread_fallback, **kwargs):
+    items = list(items)
+    if max_workers <= 1:
         try:
-            while pq.unfinished_tasks > 0:
-                time.sleep(0.5)
-        except KeyboardInterrupt:
-            print("CTRL+C terminating...")
-            stop_workers()
-            sys.exit(1)
+            return list(imap(func, items, max_workers=1, **kwargs))
+        except TaskError as e:
+            # Same as calling func directly (callers rely on the exception type, e.g. SubprocessException)
+            raise e.error
 
-        stop_workers()
+    try:
+        results = list(imap(func, items, max_workers=max_workers, return_exceptions=True, **kwargs))
+    except KeyboardInterrupt:
+        print("CTRL+C terminating...")
+        sys.exit(1)
 
-        if error is not None and single_thread_fallback:
+    failed = [i for i, r in enumerate(results) if isinstance(r, BaseException)]
+    if failed:
+        if single_thread_fallback:
             # Try to reprocess using a single thread
             # in case this was a memory error
-            log.ODM_WARNING("Failed to run process in parallel, retrying with a single thread...")
-            use_single_thread = True
-    else:
-        use_single_thread = True
-
-    if use_single_thread:
-        # Boring, single thread processing
-        for q in items:
-            process_one(q)
\ No newline at end of file
+            log.ODM_WARNING("Failed to process %s items in parallel, retrying with a single thread..." % len(failed))
+            for i in failed:
+                results[i] = func(items[i])
+        else:
+            for i in failed:
+                log.ODM_WARNING("Failed to process %s: %s" % (items[i], str(results[i])))
+                results[i] = None
+
+    return results
+
+def parallel_map(func, items, max_workers=1, single_thread_fallback=True, **kwargs):
+    """
+    Our own implementation for parallel processing
+    which handles gracefully CTRL+C and retries failed
+    items using a single thread
+    :param items list of objects
+    :param func function to execute on each object
+    :param single_thread_fallback retry failed items one at a time after the parallel run
+        (errors are ignored when False)
+    :param kwargs additional arguments for parallel_imap (memory_cost, retries, ...)
+    :return list of results, in the same order as items
+    """
+    return _map(parallel_imap, func, items, max_workers, single_thread_fallback, **kwargs)
+
+# Arrays smaller than this are simply pickled
+SHARED_ARRAY_MIN_BYTES = 1024 * 1024
+
+class SharedArray(object):
+    """
+    Numpy array stored in shared memory. When pickled (e.g. sent
+    to a worker process) only its name, shape and dtype are transferred.
+    process_imap wraps large arrays automatically, but an array
+    that is passed to many items can be shared once with SharedArray.create
+    (the caller is then responsible for calling unlink())
+    """
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self._shm = None
+
+    @staticmethod
+    def create(array):
+        array = np.ascontiguousarray(array)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        sa = SharedArray(shm.name, array.shape, array.dtype)
+        sa._shm = shm
+        view = sa.array
+        view[...] = array
+        del view
+        return sa
+
+    @property
+    def array(self):
+        """
+        :return numpy view of the shared memory (valid until close() is called)
+        """
+        if self._shm is None:
+            self._shm = shared_memory.SharedMemory(name=self.name)
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+
+    def copy(self):
+        return np.array(self.array)
+
+    def close(self):
+        if self._shm is not None:
+            try:
+                self._shm.close()
+                self._shm = None
+            except BufferError:
+                # Views are still alive, the mapping
+                # is released with the process
+                pass
+
+    def unlink(self):
+        self.close()
+        try:
+            shared_memory.SharedMemory(name=self.name).unlink()
+        except FileNotFoundError:
+            pass
+
+    def __getstate__(self):
+        return (self.name, self.shape, self.dtype.str)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+def _share(obj, created):
+    """
+    Replace large numpy arrays in obj (recursively in lists, tuples and dicts)
+    with SharedArray objects, which are appended to created
+    """
+    if isinstance(obj, np.ndarray):
+        if obj.nbytes >= SHARED_ARRAY_MIN_BYTES and obj.dtype != object:
+            sa = SharedArray.create(obj)
+            created.append(sa)
+            return sa
+        return obj
+    elif isinstance(obj, tuple) and not hasattr(obj, '_fields'):
+        return tuple(_share(o, created) for o in obj)
+    elif isinstance(obj, list):
+        return [_share(o, created) for o in obj]
+    elif isinstance(obj, dict):
+        return {k: _share(v, created) for k, v in obj.items()}
+    return obj
+
+def _unshare(obj, attached, copy=False):
+    """
+    Inverse of _share. Without copy, the returned arrays are views
+    on the shared memory, valid until the SharedArray objects in attached are closed
+    """
+    if isinstance(obj, SharedArray):
+        attached.append(obj)
+        return obj.copy() if copy else obj.array
+    elif isinstance(obj, tuple) and not hasattr(obj, '_fields'):
+        return tuple(_unshare(o, attached, copy) for o in obj)
+    elif isinstance(obj, list):
+        return [_unshare(o, attached, copy) for o in obj]
+    elif isinstance(obj, dict):
+        return {k: _unshare(v, attached, copy) for k, v in obj.items()}
+    return obj
+
+_process_func = None
+
+def _process_init(func):
+    global _process_func
+    _process_func = func
+
+def _process_call(item):
+    attached = []
+    created = []
+    try:
+        try:
+            result = _process_func(_unshare(item, attached))
+        except Exception as e:
+            return {'error': e, 'log': log.logger.take_forwarded()}
+        item = None
+        return {'result': _share(result, created), 'log': log.logger.take_forwarded()}
+    finally:
+        for sa in created + attached:
+            # Created arrays are unlinked by the parent, after copying them
+            sa.close()
+
+def _collect(future):
+    r = future.result()
+    # Log records of the worker go to our log.json/log.jsonl
+    log.logger.replay(r['log'])
+    if 'error' in r:
+        raise r['error']
+
+    attached = []
+    result = _unshare(r['result'], attached, copy=True)
+    for sa in attached:
+        sa.unlink()
+    return result
+
+def _process_context():
+    # Fork lets workers run closures and
+    # functions that cannot be pickled
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+def _process_imap(func, items, max_workers, ordered, memory_cost, max_memory_mb,
+                  max_in_flight, retries, return_exceptions, cancel_token):
+    ctx = _process_context()
+    source = enumerate(items)
+    peeked = None
+    exhausted = False
+
+    executor = None
+    generation = 0
+    running = {}
+    done = {}
+    done_order = deque()
+    pending = 0
+    memory = 0
+    next_index = 0
+
+    wake = Future()
+    def on_cancel():
+        if not wake.done():
+            wake.set_result(None)
+
+    def new_executor():
+        # Workers must share our resource tracker, otherwise
+        # they would try to clean up shared memory that we own
+        resource_tracker.ensure_running()
+        return ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx,
+                                   initializer=_process_init, initargs=(func,))
+
+    def submit(index, item, cost, attempt, shared):
+        future = executor.submit(_process_call, shared['item'])
+        running[future] = (index, item, cost, attempt, shared, generation)
+
+    def release(shared):
+        for sa in shared['arrays']:
+            sa.unlink()
+
+    if cancel_token is not None:
+        cancel_token._register(on_cancel)
+
+    try:
+        executor = new_executor()
+
+        while True:
+            if cancel_token is not None and cancel_token.cancelled():
+                raise CancelledError()
+
+            # Schedule as many items as the limits allow
+            while not exhausted:
+                if peeked is None:
+                    try:
+                        index, item = next(source)
+                        peeked = (index, item, memory_cost(item) if memory_cost is not None else 0)
+                    except StopIteration:
+                        exhausted = True
+                        break
+
+                index, item, cost = peeked
+                if pending == 0 or (pending < max_in_flight and
+                   (max_memory_mb is None or memory + cost <= max_memory_mb)):
+                    arrays = []
+                    shared = {'item': _share(item, arrays), 'arrays': arrays}
+                    submit(index, item, cost, 0, shared)
+                    pending += 1
+                    memory += cost
+                    peeked = None
+                else:
+                    break
+
+            ready = None
+            if ordered:
+                if next_index in done:
+                    ready = next_index
+                    next_index += 1
+            elif done_order:
+                ready = done_order.popleft()
+
+            if ready is not None:
+                item, result, error, cost = done.pop(ready)
+                pending -= 1
+                memory -= cost
+
+                if error is not None:
+                    if not return_exceptions:
+                        raise TaskError(ready, item, error)
+                    yield error
+                else:
+                    yield result
+                continue
+
+            if exhausted and pending == 0:
+                return
+
+            finished, _ = wait(list(running) + [wake], return_when=FIRST_COMPLETED)
+
+            broken = False
+            resubmit = []
+            for future in finished:
+                if future is wake:
+                    continue
+
+                index, item, cost, attempt, shared, gen = running.pop(future)
+                result = None
+                error = None
+                try:
+                    result = _collect(future)
+                except BrokenProcessPool as e:
+                    error = e
+                    if gen == generation:
+                        broken = True
+                except BaseException as e:
+                    error = e
+
+                if error is not None and attempt < retries:
+                    log.ODM_WARNING("Item %s failed (%s), retrying (%s/%s)" % (index, str(error), attempt + 1, retries))
+                    resubmit.append((index, item, cost, attempt + 1, shared))
+                else:
+                    release(shared)
+                    done[index] = (item, result, error, cost)
+                    done_order.append(index)
+
+            if broken:
+                log.ODM_WARNING("A worker process terminated abruptly, restarting the process pool")
+                executor.shutdown(wait=False)
+                executor = new_executor()
+                generation += 1
+
+            for r in resubmit:
+                submit(*r)
+    finally:
+        if cancel_token is not None:
+            cancel_token._unregister(on_cancel)
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+        for future, (index, item, cost, attempt, shared, gen) in running.items():
+            if not future.cancelled() and future.exception() is None:
+                _collect(future)
+            release(shared)
+
+def process_imap(func, items, max_workers=1, ordered=True, memory_cost=None, max_memory_mb=None,
+                 max_in_flight=None, retries=0, return_exceptions=False, cancel_token=None):
+    """
+    Same as parallel_imap, but runs func in a pool of worker processes,
+    which avoids contention on the GIL for Python-heavy tasks.
+    func's side effects are not visible to the caller: results must be returned.
+    Numpy arrays larger than SHARED_ARRAY_MIN_BYTES found in items and in
+    results (also inside lists, tuples and dicts) are transferred via shared memory
+    instead of being pickled.
+    """
+    if max_workers <= 1:
+        return _serial_imap(func, items, retries, return_exceptions, cancel_token)
+
+    if memory_cost is not None and max_memory_mb is None:
+        max_memory_mb = get_max_memory_mb()
+    if max_in_flight is None:
+        max_in_flight = max_workers * 2
+
+    return _process_imap(func, items, max_workers, ordered, memory_cost, max_memory_mb,
+                         max(1, max_in_flight), retries, return_exceptions, cancel_token)
+
+def process_map(func, items, max_workers=1, single_thread_fallback=True, **kwargs):
+    """
+    Same as parallel_map, but using a pool of worker processes (see process_imap)
+    """
+    return _map(process_imap, func, items, max_workers, single_thread_fallback, **kwargs)
+
+# Which backend to use for each kind of task:
+#  io: waits on files, network or external processes
+#  native: heavy lifting done in native code that releases the GIL (OpenCV, numpy, ONNX)
+#  python: pure Python or many small numpy/OpenCV calls, GIL bound
+TASK_BACKENDS = {
+    'io': 'thread',
+    'native': 'thread',
+    'python': 'process',
+}
+
+def get_backend(task_type):
+    if task_type not in TASK_BACKENDS:
+        raise ValueError("Invalid task type: %s" % task_type)
+
+    backend = TASK_BACKENDS[task_type]
+    if backend == 'process' and not hasattr(os, 'fork'):
+        # Without fork, functions must be picklable,
+        # which is not the case for most of our callbacks
+        backend = 'thread'
+    return backend
+
+def get_parallel_map(task_type='io'):
+    """
+    :param task_type one of TASK_BACKENDS
+    :return parallel_map or process_map
+    """
+    return process_map if get_backend(task_type) == 'process' else parallel_map
+
+def get_parallel_imap(task_type='io'):
+    """
+    :param task_type one of TASK_BACKENDS
+    :return parallel_imap or process_imap
+    """
+    return process_imap if get_backend(task_type) == 'process' else parallel_imap
@@ -18,6 +18,7 @@ rerun_stages = {
     'align': 'odm_georeferencing',
     'auto_boundary': 'odm_filterpoints',
     'auto_boundary_distance': 'odm_filterpoints',
+    'band_alignment': 'opensfm',
     'bg_removal': 'dataset',
     'boundary': 'odm_filterpoints',
     'build_overviews': 'odm_orthophoto',
@@ -43,6 +44,7 @@ rerun_stages = {
     'gps_accuracy': 'dataset',
     'help': None,
     'ignore_gsd': 'opensfm',
+    'incremental_rerun': None,
     'matcher_neighbors': 'opensfm',
     'matcher_order': 'opensfm',
     'matcher_type': 'opensfm',
@@ -60,6 +62,7 @@ rerun_stages = {
     'orthophoto_no_tiled': 'odm_orthophoto',
     'orthophoto_png': 'odm_orthophoto',
     'orthophoto_resolution': 'odm_orthophoto',
+    'parallel_stages': None,
     'pc_classify': 'odm_georeferencing',
     'pc_copc': 'odm_georeferencing',
     'pc_csv': 'odm_georeferencing',
@@ -71,6 +74,7 @@ rerun_stages = {
     'pc_sample': 'odm_filterpoints',
     'pc_skip_geometric': 'openmvs',
     'primary_band': 'dataset',
+    'profile': None,
     'project_path': None,
     'radiometric_calibration': 'opensfm',
     'rerun': None,
@@ -79,6 +83,7 @@ rerun_stages = {
     'rolling_shutter': 'opensfm',
     'rolling_shutter_readout': 'opensfm',
     'sfm_algorithm': 'opensfm',
+    'sfm_metadata_archive': 'opensfm',
     'sfm_no_partial': 'opensfm',
     'skip_3dmodel': 'odm_meshing',
     'skip_band_alignment': 'opensfm',
@@ -87,6 +92,8 @@ rerun_stages = {
     'sky_removal': 'dataset',
     'sm_cluster': 'split',
     'sm_no_align': 'split',
+    'sm_parallel': None,
+    'sm_seed_compression': None,
     'smrf_scalar': 'odm_dem',
     'smrf_slope': 'odm_dem',
     'smrf_threshold': 'odm_dem',
@@ -94,6 +101,7 @@ rerun_stages = {
     'split': 'split',
     'split_image_groups': 'split',
     'split_overlap': 'split',
+    'stain_batch_size': None,
     'texturing_keep_unseen_faces': 'mvs_texturing',
     'texturing_single_material': 'mvs_texturing',
     'texturing_skip_global_seam_leveling': 'mvs_texturing',
@@ -304,6 +312,23 @@ def config(argv=None, parser=None):
                               'processes. Peak memory requirement is ~1GB per '
                               'thread and 2 megapixel image resolution. Default: %(default)s'))
 
+    parser.add_argument('--incremental-rerun',
+                        action=StoreTrue,
+                        nargs=0,
+                        default=False,
+                        help=('Keep a manifest of the content hashes of the inputs (images, GCPs, options, '
+                              'results of previous stages) and outputs of each stage (manifest.json) and use it '
+                              'to decide what to rerun: a stage reruns only when something it depends on has changed. '
+                              'Default: %(default)s'))
+
+    parser.add_argument('--parallel-stages',
+                        action=StoreTrue,
+                        nargs=0,
+                        default=False,
+                        help=('Run independent stages and steps (for example the DEM and orthophoto stages, '
+                              'or the DSM and DTM) at the same time, sharing --max-concurrency between them. '
+                              'Default: %(default)s'))
+
     parser.add_argument('--use-hybrid-bundle-adjustment',
                         action=StoreTrue,
                         nargs=0,
@@ -320,6 +345,13 @@ def config(argv=None, parser=None):
                         'Can be one of: %(choices)s. Default: '
                         '%(default)s'))
 
+    parser.add_argument('--sfm-metadata-archive',
+                action=StoreTrue,
+                nargs=0,
+                default=False,
+                help='Store the metadata of all images in a single indexed archive in the OpenSfM dataset instead of one file per image. '
+                     'Reduces the number of files created on large datasets, which can be slow on network file systems. Default: %(default)s')
+
     parser.add_argument('--sfm-no-partial',
                 action=StoreTrue,
                 nargs=0,
@@ -338,6 +370,15 @@ def config(argv=None, parser=None):
                 default=False,
                 help='Automatically compute image masks using AI to remove the background. Experimental. Default: %(default)s')
 
+    parser.add_argument('--stain-batch-size',
+                        metavar='<positive integer>',
+                        action=StoreValue,
+                        default=8,
+                        type=int,
+                        help=('Number of images to run through the stain detection model at once. '
+                              'Images are decoded ahead of time and batched together, which improves throughput on CPUs. '
+                              'Set to 1 to process one image at a time. Default: %(default)s'))
+
     parser.add_argument('--use-3dmesh',
                     action=StoreTrue,
                     nargs=0,
@@ -806,6 +847,17 @@ def config(argv=None, parser=None):
                     default=False,
                     help='Skip alignment of submodels in split-merge. Useful if GPS is good enough on very large datasets. Default: %(default)s')
 
+    parser.add_argument('--sm-parallel',
+                        metavar='<integer>',
+                        action=StoreValue,
+                        default=1,
+                        type=int,
+                        help=('Maximum number of submodels to reconstruct and process at the same time '
+                              'in the local split-merge workflow. --max-concurrency is split among them '
+                              'and fewer submodels run at once if there isn\'t enough memory for them. '
+                              'With --sm-cluster, number of submodels processed locally while the others run on the cluster. '
+                              'Set to 0 to let ODM decide based on memory and CPUs. Default: %(default)s'))
+
     parser.add_argument('--sm-cluster',
                         metavar='<string>',
                         action=StoreValue,
@@ -816,6 +868,16 @@ def config(argv=None, parser=None):
                             'multiple nodes in parallel. '
                             'Default: %(default)s')
 
+    parser.add_argument('--sm-seed-compression',
+                        metavar='<integer>',
+                        action=StoreValue,
+                        default=6,
+                        type=int,
+                        choices=range(10),
+                        help='Compression level of the files sent to the --sm-cluster nodes along with the images. '
+                              '0 sends them without compressing them. Files that are already compressed '
+                              '(such as JPEGs) are never compressed again. Default: %(default)s')
+
     parser.add_argument('--merge',
                     metavar='<string>',
                     action=StoreValue,
@@ -862,6 +924,15 @@ def config(argv=None, parser=None):
                           'points will be re-classified and gaps will be filled. Useful for generating DTMs. '
                           'Default: %(default)s'))
 
+    parser.add_argument('--profile',
+                    action=StoreTrue,
+                    nargs=0,
+                    default=False,
+                    help=('Record the time, CPU, memory, disk I/O and threads used by each stage, step and external program. '
+                          'Results are written to the profile directory of the project as a Chrome trace (trace.json, '
+                          'open it with chrome://tracing or https://ui.perfetto.dev) and a summary table (summary.txt). '
+                          'Default: %(default)s'))
+
     parser.add_argument('--primary-band',
                         metavar='<string>',
                         action=StoreValue,
@@ -879,6 +950,17 @@ def config(argv=None, parser=None):
                           'If the images have been postprocessed and are already aligned, use this option. '
                           'Default: %(default)s'))
 
+    parser.add_argument('--band-alignment',
+                    metavar='<string>',
+                    action=StoreValue,
+                    default='fixed',
+                    choices=['fixed', 'adaptive'],
+                    help=('Method used to align the bands of multispectral datasets. '
+                          '[fixed] estimates homographies at full resolution on a fixed number of captures per band. '
+                          '[adaptive] estimates them on an image pyramid, stops sampling captures once the estimates agree '
+                          'and computes a separate homography for the captures that are not well aligned by the band\'s one. '
+                          'Can be one of: %(choices)s. Default: %(default)s'))
+
     args, unknown = parser.parse_known_args(argv)
     DEPRECATED = ["--verbose", "--debug", "--time", "--resize-to", "--depthmap-resolution", "--pc-geometric", "--texturing-data-term", "--texturing-outlier-removal-type", "--texturing-tone-mapping", "--texturing-skip-local-seam-leveling"]
     unknown_e = [p for p in unknown if p not in DEPRECATED]
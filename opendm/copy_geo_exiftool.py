@@ -1,39 +1,223 @@
 import os
 import subprocess
 import json
+import threading
+from concurrent.futures import Future
+
+try:
+    import Queue as queue
+except:
+    import queue
+
+
+GEO_TAGS = [
+    "GPSLatitude",
+    "GPSLongitude",
+    "GPSAltitude",
+    "GPSLatitudeRef",
+    "GPSLongitudeRef",
+]
+
+
+class ExifToolError(Exception):
+    pass
+
+
+class ExifToolSession:
+    """
+    A long-lived exiftool process running in -stay_open mode.
+    Commands can be submitted from any thread; a single I/O thread
+    writes them to exiftool in batches (pipelined -execute blocks)
+    and hands back the output of each command. If exiftool crashes,
+    the process is restarted and the pending commands are retried.
+    """
+
+    def __init__(self, exiftool_path="exiftool", max_batch=64, max_restarts=3):
+        self.exiftool_path = exiftool_path
+        self.max_batch = max_batch
+        self.max_restarts = max_restarts
+
+        self.process = None
+        self.restarts = 0
+        self.closed = False
+        self.close_lock = threading.Lock()
+        self.commands = queue.Queue()
+        self.sequence = 0
+
+        self._start_process()
+
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _start_process(self):
+        self.process = subprocess.Popen(
+            [self.exiftool_path, "-stay_open", "True", "-@", "-"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+            encoding="utf-8",
+        )
+
+    def _stop_process(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.write("-stay_open\nFalse\n")
+            self.process.stdin.flush()
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except Exception:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def execute(self, *args):
+        """
+        Run exiftool with the given arguments and return its output.
+        Blocks until the command has completed; safe to call from multiple threads.
+        """
+        return self.submit(*args).result()
+
+    def submit(self, *args):
+        """
+        Queue a command for execution.
+        :return a Future resolving to the output of the command
+        """
+        for a in args:
+            if "\n" in str(a):
+                raise ValueError("exiftool arguments cannot contain newlines: %s" % a)
+
+        future = Future()
+        with self.close_lock:
+            if self.closed:
+                raise ExifToolError("exiftool session is closed")
+            self.commands.put((args, future))
+        return future
+
+    def _run_batch(self, batch):
+        """Pipeline all commands in batch and collect their outputs in order"""
+        ids = []
+        for args, _ in batch:
+            self.sequence += 1
+            ids.append(self.sequence)
+            for a in args:
+                self.process.stdin.write("%s\n" % a)
+            self.process.stdin.write("-execute%s\n" % self.sequence)
+        self.process.stdin.flush()
+
+        outputs = []
+        for num in ids:
+            ready = "{ready%s}" % num
+            lines = []
+            while True:
+                line = self.process.stdout.readline()
+                if line == "":
+                    raise ExifToolError("exiftool exited unexpectedly (code: %s)" % self.process.poll())
+                if line.rstrip("\r\n") == ready:
+                    break
+                lines.append(line)
+            outputs.append("".join(lines))
+        return outputs
+
+    def _worker(self):
+        while True:
+            item = self.commands.get()
+            if item is None:
+                break
+
+            batch = [item]
+            while len(batch) < self.max_batch:
+                try:
+                    item = self.commands.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.commands.put(None)
+                    break
+                batch.append(item)
+
+            batch = [b for b in batch if b[1].set_running_or_notify_cancel()]
+
+            while batch:
+                try:
+                    if self.process is None or self.process.poll() is not None:
+                        raise ExifToolError("exiftool is not running")
+                    outputs = self._run_batch(batch)
+                    for (_, future), out in zip(batch, outputs):
+                        future.set_result(out)
+                    batch = []
+                except (ExifToolError, OSError, ValueError) as e:
+                    # Crash recovery: restart exiftool and retry the batch
+                    if self.restarts < self.max_restarts:
+                        self.restarts += 1
+                        try:
+                            self._stop_process()
+                        except Exception:
+                            pass
+                        try:
+                            self._start_process()
+                            continue
+                        except Exception as se:
+                            e = se
+
+                    for _, future in batch:
+                        future.set_exception(ExifToolError(str(e)))
+                    batch = []
+
+    def close(self):
+        with self.close_lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.commands.put(None)
+        self.thread.join()
+        self._stop_process()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 class GeolocationProcessor:
     def __init__(
-        self, exiftool_path="exiftool"
+        self, exiftool_path="exiftool", stay_open=True
     ):  # Allow customization of exiftool path
         self.exiftool_path = exiftool_path
+        self.session = None
+        self.lock = threading.Lock()
+
+        if stay_open:
+            try:
+                self.session = ExifToolSession(exiftool_path)
+            except Exception as e:
+                print(f"Cannot start exiftool session, falling back to per-call mode: {str(e)}")
+
+    def _run(self, args):
+        """Run an exiftool command through the session if available, per-call otherwise."""
+        # Other threads can close the session at any time
+        session = self.session
+        if session is not None:
+            try:
+                return session.execute(*args)
+            except ExifToolError as e:
+                print(f"exiftool session failed, falling back to per-call mode: {str(e)}")
+                self.close()
 
-    def get_geolocation(self, image_path):
-        """Extracts geolocation data (latitude, longitude, altitude, references) from an image using exiftool."""
-        command = [
-            self.exiftool_path,
-            "-json",
-            "-GPSLatitude",
-            "-GPSLongitude",
-            "-GPSAltitude",
-            "-GPSLatitudeRef",
-            "-GPSLongitudeRef",
-            image_path,
-        ]
         process = subprocess.run(
-            command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+            [self.exiftool_path] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
         )
+        return process.stdout
+
+    def get_geolocation(self, image_path):
+        """Extracts geolocation data (latitude, longitude, altitude, references) from an image using exiftool."""
+        output = self._run(["-json"] + ["-" + t for t in GEO_TAGS] + [image_path])
 
         try:
-            data = json.loads(process.stdout)[0]
-            return (
-                data.get("GPSLatitude"),
-                data.get("GPSLongitude"),
-                data.get("GPSAltitude"),
-                data.get("GPSLatitudeRef"),
-                data.get("GPSLongitudeRef"),
-            )
+            data = json.loads(output)[0]
+            return tuple(data.get(t) for t in GEO_TAGS)
         except (json.JSONDecodeError, IndexError):  # Catch potential errors
             return None, None, None, None, None
 
@@ -41,8 +225,7 @@ class GeolocationProcessor:
         self, dest_image, latitude, longitude, altitude, lat_ref, lon_ref
     ):
         """Writes geolocation data to an image using exiftool."""
-        command = [
-            self.exiftool_path,
+        self._run([
             "-overwrite_original",
             f"-GPSLatitude={latitude}",
             f"-GPSLongitude={longitude}",
@@ -50,10 +233,7 @@ class GeolocationProcessor:
             f"-GPSLatitudeRef={lat_ref}",
             f"-GPSLongitudeRef={lon_ref}",
             dest_image,
-        ]
-        subprocess.run(
-            command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
-        )
+        ])
 
     def process_image(self, raw_image_path, mask_image_path):
         """Copies geolocation information from the raw image to the mask image."""
@@ -65,6 +245,13 @@ class GeolocationProcessor:
         else:
             print(f"No geolocation found in {raw_image_path}")
 
+    def close(self):
+        with self.lock:
+            session = self.session
+            self.session = None
+        if session is not None:
+            session.close()
+
 
 # if __name__ == "__main__":
 #     processor = GeolocationProcessor()
@@ -0,0 +1,218 @@
+import threading
+from opendm import log
+from opendm.planner import get_available_cpus, ConcurrencyPlanner
+
+# Resources granted to the DAG task running in the current thread
+_granted = threading.local()
+
+def task_cpus(default):
+    """
+    :param default number of CPUs to use outside of a DAG task (usually args.max_concurrency)
+    :return number of CPUs granted to the DAG task running in the current thread,
+        or default when not running inside a (parallel) DAG task
+    """
+    cpus = getattr(_granted, "cpus", None)
+    if cpus is None:
+        return default
+    return max(1, min(default, cpus))
+
+class Task(object):
+    def __init__(self, name, func, requires=None, provides=None, cpus=1, min_cpus=1, memory_mb=0):
+        """
+        :param name task name (used for logging)
+        :param func function to call (without arguments)
+        :param requires names of the things the task reads. None means
+            the task can depend on anything: it runs after all previous tasks
+            and all following tasks run after it
+        :param provides names of the things the task writes
+        :param cpus number of CPUs the task can make use of
+        :param min_cpus minimum number of CPUs the task needs
+        :param memory_mb estimated memory needed by the task
+        """
+        self.name = name
+        self.func = func
+        self.barrier = requires is None
+        self.requires = set(requires or [])
+        self.provides = set(provides or [])
+        self.cpus = max(1, cpus)
+        self.min_cpus = max(1, min(min_cpus, self.cpus))
+        self.memory_mb = memory_mb
+        self.depends = set()
+        self.granted_cpus = None
+
+    def __repr__(self):
+        return self.name
+
+class DAGScheduler(object):
+    """
+    Runs tasks that declare what they read (requires) and write (provides)
+    concurrently when their dependencies allow, within a CPU and memory budget.
+    A task depends on every previously added task that writes something
+    it reads or writes, or that reads something it writes, so the results
+    are the same as running the tasks in the order they were added.
+    Tasks started at the same time share the available CPUs
+    (see task_cpus). When nested (a task running its own scheduler),
+    the budget is the one granted to the parent task.
+    """
+    def __init__(self, parallel=True, max_cpus=None, max_memory_mb=None):
+        """
+        :param parallel when False, tasks run one after the other in the calling thread
+        :param max_cpus CPU budget (defaults to the CPUs available to the current task or process)
+        :param max_memory_mb memory budget (defaults to the memory available to the current task
+            or half of the memory available to the process)
+        """
+        self.parallel = parallel
+        self.max_cpus = max_cpus or getattr(_granted, "cpus", None) or get_available_cpus()
+        if max_memory_mb is None:
+            max_memory_mb = getattr(_granted, "memory_mb", None)
+        self.max_memory_mb = max_memory_mb
+        self.tasks = []
+
+    def add(self, name, func, requires=None, provides=None, cpus=1, min_cpus=1, memory_mb=0):
+        """
+        Add a task to the graph. Arguments are the same as Task.
+        :return the Task
+        """
+        task = Task(name, func, requires, provides, cpus, min_cpus, memory_mb)
+
+        for prev in self.tasks:
+            if task.barrier or prev.barrier or \
+               (task.requires & prev.provides) or \
+               (task.provides & prev.provides) or \
+               (task.provides & prev.requires):
+                task.depends.add(prev)
+
+        self.tasks.append(task)
+        return task
+
+    def run(self):
+        """
+        Run all tasks. If a task fails, tasks that were not started yet
+        are skipped, running tasks are waited for and the first error is raised.
+        """
+        if not self.parallel or len(self.tasks) <= 1:
+            for task in self.tasks:
+                task.func()
+            return
+
+        if self.max_memory_mb is None:
+            self.max_memory_mb = ConcurrencyPlanner().memory_budget_mb()
+
+        cond = threading.Condition()
+        pending = list(self.tasks)
+        done = set()
+        running = set()
+        errors = []
+        used = {'cpus': 0, 'memory_mb': 0}
+        log_stage = log.logger.current_stage()
+
+        def worker(task):
+            log.logger.set_stage(log_stage)
+            _granted.cpus = task.granted_cpus
+            _granted.memory_mb = task.memory_mb or None
+            error = None
+            try:
+                task.func()
+            except Exception as e:
+                error = e
+            finally:
+                _granted.cpus = None
+                _granted.memory_mb = None
+
+            with cond:
+                running.discard(task)
+                used['cpus'] -= task.granted_cpus
+                used['memory_mb'] -= task.memory_mb
+                if error is not None:
+                    errors.append(error)
+                else:
+                    done.add(task)
+                cond.notify_all()
+
+        def start_ready():
+            ready = [t for t in pending if t.depends <= done]
+            if not ready:
+                return
+
+            # Admit tasks in order while their minimum requirements fit
+            # (a task always starts if nothing else is running)
+            free_cpus = self.max_cpus - used['cpus']
+            free_memory = self.max_memory_mb - used['memory_mb']
+            admitted = []
+            for t in ready:
+                min_cpus = min(t.min_cpus, self.max_cpus)
+                if (not running and not admitted) or \
+                   (min_cpus <= free_cpus and t.memory_mb <= free_memory):
+                    admitted.append(t)
+                    free_cpus -= min_cpus
+                    free_memory -= t.memory_mb
+                else:
+                    break
+
+            if not admitted:
+                return
+
+            # Share the free CPUs among the admitted tasks
+            free_cpus = max(0, self.max_cpus - used['cpus'])
+            grants = [min(t.min_cpus, self.max_cpus) for t in admitted]
+            spare = free_cpus - sum(grants)
+            while spare > 0:
+                growable = [i for i, t in enumerate(admitted) if grants[i] < min(t.cpus, self.max_cpus)]
+                if not growable:
+                    break
+                for i in growable:
+                    if spare <= 0:
+                        break
+                    grants[i] += 1
+                    spare -= 1
+
+            for t, g in zip(admitted, grants):
+                t.granted_cpus = g
+                pending.remove(t)
+                running.add(t)
+                used['cpus'] += g
+                used['memory_mb'] += t.memory_mb
+                log.ODM_INFO("Starting %s (%s CPUs)" % (t.name, g))
+
+                th = threading.Thread(target=worker, args=(t, ))
+                th.daemon = True
+                th.start()
+
+        with cond:
+            while pending or running:
+                if not errors:
+                    start_ready()
+                elif pending:
+                    log.ODM_WARNING("Skipping %s because of a previous error" % ", ".join(t.name for t in pending))
+                    pending = []
+
+                if not running:
+                    break
+                cond.wait()
+
+        if errors:
+            raise errors[0]
+
+def run_stages(first_stage, outputs, max_cpus=None):
+    """
+    Run a pipeline of ODM_Stage objects (connected with ODM_Stage.connect)
+    as a DAG, running stages that declare independent inputs/outputs
+    concurrently. The same stages as ODM_Stage.run are executed
+    (honoring --end-with and --rerun).
+    :param first_stage first stage of the pipeline
+    :param outputs dictionary shared by all stages
+    :param max_cpus CPU budget (defaults to --max-concurrency)
+    """
+    scheduler = DAGScheduler(max_cpus=max_cpus or first_stage.args.max_concurrency)
+
+    stage = first_stage
+    while stage is not None:
+        scheduler.add(stage.name, (lambda s: lambda: s.run_stage(outputs))(stage),
+                      requires=stage.requires, provides=stage.provides,
+                      cpus=stage.args.max_concurrency, min_cpus=stage.min_cpus,
+                      memory_mb=stage.memory_mb)
+        if stage.last_to_run():
+            break
+        stage = stage.next_stage
+
+    scheduler.run()
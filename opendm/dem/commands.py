@@ -64,13 +64,21 @@ error = None
 def create_dem(input_point_cloud, dem_type, output_type='max', radiuses=['0.56'], gapfill=True,
                 outdir='', resolution=0.1, max_workers=1, max_tile_size=4096,
                 decimation=None, with_euclidean_map=False,
-                apply_smoothing=True, max_tiles=None):
-    """ Create DEM from multiple radii, and optionally gapfill """
+                apply_smoothing=True, max_tiles=None, tmpdir=None):
+    """ Create DEM from multiple radii, and optionally gapfill
+    :param tmpdir directory for intermediate files (defaults to outdir). DEMs
+        created at the same time in the same outdir need different tmpdirs
+    """
     
     start = datetime.now()
+    if tmpdir is None:
+        tmpdir = outdir
+    elif not os.path.isdir(tmpdir):
+        os.makedirs(tmpdir)
+
     kwargs = {
         'input': input_point_cloud,
-        'outdir': outdir,
+        'outdir': tmpdir,
         'outputType': output_type,
         'radiuses': ",".join(map(str, radiuses)),
         'resolution': resolution,
@@ -95,7 +103,7 @@ def create_dem(input_point_cloud, dem_type, output_type='max', radiuses=['0.56']
 
     # Fetch tiles
     tiles = []
-    for p in glob.glob(os.path.join(os.path.abspath(outdir), "*.tif")):
+    for p in glob.glob(os.path.join(os.path.abspath(tmpdir), "*.tif")):
         filename = os.path.basename(p)
         m = re.match("^r([\d\.]+)_x\d+_y\d+\.tif", filename)
         if m is not None:
@@ -110,18 +118,18 @@ def create_dem(input_point_cloud, dem_type, output_type='max', radiuses=['0.56']
     tiles.sort(key=lambda t: float(t['radius']), reverse=True)
 
     # Create virtual raster
-    tiles_vrt_path = os.path.abspath(os.path.join(outdir, "tiles.vrt"))
-    tiles_file_list = os.path.abspath(os.path.join(outdir, "tiles_list.txt"))
+    tiles_vrt_path = os.path.abspath(os.path.join(tmpdir, "tiles.vrt"))
+    tiles_file_list = os.path.abspath(os.path.join(tmpdir, "tiles_list.txt"))
     with open(tiles_file_list, 'w') as f:
         for t in tiles:
             f.write(t['filename'] + '\n')
 
     run('gdalbuildvrt -input_file_list "%s" "%s" ' % (tiles_file_list, tiles_vrt_path))
 
-    merged_vrt_path = os.path.abspath(os.path.join(outdir, "merged.vrt"))
-    geotiff_small_path = os.path.abspath(os.path.join(outdir, 'tiles.small.tif'))
-    geotiff_small_filled_path = os.path.abspath(os.path.join(outdir, 'tiles.small_filled.tif'))
-    geotiff_path = os.path.abspath(os.path.join(outdir, 'tiles.tif'))
+    merged_vrt_path = os.path.abspath(os.path.join(tmpdir, "merged.vrt"))
+    geotiff_small_path = os.path.abspath(os.path.join(tmpdir, 'tiles.small.tif'))
+    geotiff_small_filled_path = os.path.abspath(os.path.join(tmpdir, 'tiles.small_filled.tif'))
+    geotiff_path = os.path.abspath(os.path.join(tmpdir, 'tiles.tif'))
 
     # Build GeoTIFF
     kwargs = {
@@ -192,6 +200,9 @@ def create_dem(input_point_cloud, dem_type, output_type='max', radiuses=['0.56']
     for t in tiles:
         if os.path.exists(t['filename']): os.remove(t['filename'])
 
+    if tmpdir != outdir and os.path.isdir(tmpdir) and not os.listdir(tmpdir):
+        os.rmdir(tmpdir)
+
     log.ODM_INFO('Completed %s in %s' % (output_file, datetime.now() - start))
 
 
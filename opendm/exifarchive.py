@@ -0,0 +1,204 @@
+"""
+Consolidated OpenSfM metadata archive.
+
+Stores the metadata of all images of an OpenSfM dataset (what would
+otherwise be one exif/<image>.exif JSON file per image) in a single
+indexed file, exif/metadata.archive:
+
+    MAGIC | JSON blob of each image | JSON index | index offset (uint64) | MAGIC
+
+The index maps each image to the (offset, length) of its blob. The archive
+lives in the exif directory so that code checking for, copying or symlinking
+that directory (submodels, remote seeds) keeps working.
+
+install() adapts OpenSfM's DataSet so that load_exif/exif_exists read from the
+archive when there's one. OpenSfM commands run in a separate process, so they
+are started through this module, which installs the adapter first:
+
+    python -m opendm.exifarchive /path/to/opensfm_main.py <command> <dataset>
+"""
+import json
+import mmap
+import os
+import runpy
+import struct
+import sys
+import threading
+
+ARCHIVE_NAME = "metadata.archive"
+MAGIC = b"ODMEXIF1"
+FOOTER = struct.Struct("<Q")
+
+class MetadataArchiveError(Exception):
+    pass
+
+def archive_path(exif_dir):
+    return os.path.join(exif_dir, ARCHIVE_NAME)
+
+def write_archive(archive_file, entries):
+    """
+    Write an archive atomically
+    :param archive_file path of the archive
+    :param entries iterable of (image name, metadata dictionary)
+    :return number of images written
+    """
+    index = {}
+    tmp_file = archive_file + ".tmp"
+
+    with open(tmp_file, "wb") as f:
+        f.write(MAGIC)
+        offset = len(MAGIC)
+        for image, d in entries:
+            blob = json.dumps(d).encode("utf-8")
+            f.write(blob)
+            index[image] = [offset, len(blob)]
+            offset += len(blob)
+
+        f.write(json.dumps({"images": index}).encode("utf-8"))
+        f.write(FOOTER.pack(offset))
+        f.write(MAGIC)
+
+    # Release our own mapping of a previous archive before replacing it
+    invalidate(archive_file)
+    os.replace(tmp_file, archive_file)
+    return len(index)
+
+class MetadataArchive:
+    """
+    Read-only view of an archive. The file is memory mapped,
+    reads are safe from multiple threads.
+    """
+    def __init__(self, archive_file):
+        self.archive_file = archive_file
+
+        with open(archive_file, "rb") as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise MetadataArchiveError("%s is empty" % archive_file)
+
+        m = self._map
+        trailer = FOOTER.size + len(MAGIC)
+        if len(m) < len(MAGIC) + trailer or m[:len(MAGIC)] != MAGIC or m[-len(MAGIC):] != MAGIC:
+            self.close()
+            raise MetadataArchiveError("%s is not a valid metadata archive" % archive_file)
+
+        index_offset = FOOTER.unpack(m[-trailer:-len(MAGIC)])[0]
+        try:
+            self.index = json.loads(m[index_offset:-trailer].decode("utf-8"))["images"]
+        except (ValueError, KeyError) as e:
+            self.close()
+            raise MetadataArchiveError("Cannot read index of %s: %s" % (archive_file, str(e)))
+
+    def __contains__(self, image):
+        return image in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def images(self):
+        return list(self.index.keys())
+
+    def read(self, image):
+        """
+        :return the JSON encoded metadata of an image (bytes)
+        """
+        entry = self.index.get(image)
+        if entry is None:
+            raise KeyError(image)
+        offset, length = entry
+        return self._map[offset:offset + length]
+
+    def load(self, image):
+        """
+        :return the metadata dictionary of an image
+        """
+        return json.loads(self.read(image).decode("utf-8"))
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+# archive path --> MetadataArchive (None if there's no archive)
+archives = {}
+archives_lock = threading.Lock()
+
+def get_archive(exif_dir):
+    """
+    :return the MetadataArchive of an exif directory or None if it doesn't have one.
+        Archives are opened once per process (archives written by this process
+        are reopened, see write_archive)
+    """
+    archive_file = archive_path(exif_dir)
+    archive = archives.get(archive_file, False)
+    if archive is False:
+        with archives_lock:
+            archive = archives.get(archive_file, False)
+            if archive is False:
+                archive = MetadataArchive(archive_file) if os.path.isfile(archive_file) else None
+                archives[archive_file] = archive
+    return archive
+
+def invalidate(archive_file):
+    """
+    Close the archive at archive_file if it was opened by get_archive, so that it's reopened on next access
+    """
+    with archives_lock:
+        archive = archives.pop(archive_file, None)
+    if archive is not None:
+        archive.close()
+
+def install(dataset_class=None):
+    """
+    Make DataSet.load_exif and DataSet.exif_exists read from the archive of the
+    dataset's exif directory, falling back to per-image files. Safe to call more than once.
+    :param dataset_class class to adapt (default: opensfm.dataset.DataSet)
+    :return True if the class was adapted
+    """
+    if dataset_class is None:
+        from opensfm.dataset import DataSet
+        dataset_class = DataSet
+
+    if getattr(dataset_class, "_metadata_archive", False):
+        return True
+    if not all(hasattr(dataset_class, a) for a in ["_exif_path", "load_exif", "exif_exists"]):
+        return False
+
+    load_exif = dataset_class.load_exif
+    exif_exists = dataset_class.exif_exists
+
+    def archive_load_exif(self, image):
+        archive = get_archive(self._exif_path())
+        if archive is not None and image in archive:
+            return archive.load(image)
+        return load_exif(self, image)
+
+    def archive_exif_exists(self, image):
+        archive = get_archive(self._exif_path())
+        if archive is not None and image in archive:
+            return True
+        return exif_exists(self, image)
+
+    dataset_class.load_exif = archive_load_exif
+    dataset_class.exif_exists = archive_exif_exists
+    dataset_class._metadata_archive = True
+    return True
+
+def run_script(script, argv):
+    """
+    Run a Python script (e.g. OpenSfM's bin/opensfm_main.py) in this process with the adapter installed
+    :param script path to the script
+    :param argv arguments of the script
+    """
+    # The script's package (e.g. opensfm) is one level up, as when the script runs on its own
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(script), "..")))
+    install()
+    sys.argv = [script] + list(argv)
+    runpy.run_path(script, run_name="__main__")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python -m opendm.exifarchive <script> [args...]")
+        sys.exit(1)
+    run_script(sys.argv[1], sys.argv[2:])
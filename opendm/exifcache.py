@@ -0,0 +1,165 @@
+import os
+import json
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from opendm import log
+from opendm.photo import ODM_Photo, PhotoCorruptedException
+
+# Bump this whenever ODM_Photo.parse_exif_values changes
+# the attributes it extracts, so that old entries are not reused
+CACHE_VERSION = 1
+
+class ExifCache:
+    """
+    Content-addressed cache of parsed ODM_Photo attributes, keyed
+    on (path, size, mtime). Entries are invalidated when:
+     - the image changes size or modification time (the key changes)
+     - CACHE_VERSION changes
+     - the image no longer exists or is stale when the cache is saved (pruned)
+    """
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.entries = {}
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        if os.path.isfile(cache_file):
+            try:
+                with open(cache_file, "r") as f:
+                    data = json.load(f)
+                if data.get("version") == CACHE_VERSION:
+                    self.entries = data.get("entries", {})
+                else:
+                    self.dirty = True
+            except Exception as e:
+                log.ODM_WARNING("Cannot read EXIF cache %s: %s" % (cache_file, str(e)))
+                self.dirty = True
+
+    @staticmethod
+    def key(path_file):
+        path_file = os.path.abspath(path_file)
+        st = os.stat(path_file)
+        h = hashlib.sha1(("%s|%s|%s|%s" % (CACHE_VERSION, path_file, st.st_size, st.st_mtime_ns)).encode("utf-8"))
+        return h.hexdigest()
+
+    def get(self, path_file):
+        """
+        :return an ODM_Photo for path_file if a valid cache entry exists, None otherwise
+        """
+        try:
+            k = self.key(path_file)
+        except OSError:
+            return None
+
+        with self.lock:
+            entry = self.entries.get(k)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        return ODM_Photo.from_dict(entry["attrs"])
+
+    def put(self, path_file, photo):
+        try:
+            k = self.key(path_file)
+        except OSError:
+            return
+
+        with self.lock:
+            self.entries[k] = {
+                "path": os.path.abspath(path_file),
+                "attrs": photo.to_dict(),
+            }
+            self.dirty = True
+
+    def prune(self):
+        """
+        Remove entries for images that no longer exist or have changed
+        """
+        with self.lock:
+            for k in list(self.entries.keys()):
+                try:
+                    valid = self.key(self.entries[k]["path"]) == k
+                except OSError:
+                    valid = False
+
+                if not valid:
+                    del self.entries[k]
+                    self.dirty = True
+
+    def save(self):
+        self.prune()
+        if not self.dirty:
+            return
+
+        tmp_file = self.cache_file + ".tmp"
+        try:
+            with self.lock:
+                with open(tmp_file, "w") as f:
+                    f.write(json.dumps({"version": CACHE_VERSION, "entries": self.entries}))
+                self.dirty = False
+            os.replace(tmp_file, self.cache_file)
+        except Exception as e:
+            log.ODM_WARNING("Cannot write EXIF cache %s: %s" % (self.cache_file, str(e)))
+
+def _parse_photo(path_file):
+    try:
+        return ODM_Photo(path_file)
+    except PhotoCorruptedException as e:
+        return e
+
+def parse_photos(path_files, max_workers=1, cache=None):
+    """
+    Parse the EXIF/XMP values of many images, in parallel and
+    skipping images for which a cache entry is available.
+
+    :param path_files list of image paths
+    :param max_workers number of processes to use for parsing
+    :param cache optional ExifCache
+    :return list of ODM_Photo (or PhotoCorruptedException) items, in the same order as path_files
+    """
+    results = [None] * len(path_files)
+    missing = []
+
+    for i, f in enumerate(path_files):
+        p = cache.get(f) if cache is not None else None
+        if p is not None:
+            results[i] = p
+        else:
+            missing.append(i)
+
+    if cache is not None and len(path_files) > 0:
+        log.ODM_INFO("EXIF cache: %s hits, %s misses" % (len(path_files) - len(missing), len(missing)))
+
+    to_parse = [path_files[i] for i in missing]
+    parsed = None
+
+    # exifread and xmltodict are pure Python, so we
+    # use processes rather than threads to parse in parallel
+    if max_workers > 1 and len(to_parse) > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                chunksize = max(1, min(64, len(to_parse) // (max_workers * 4)))
+                parsed = list(executor.map(_parse_photo, to_parse, chunksize=chunksize))
+        except Exception as e:
+            log.ODM_WARNING("Failed to parse EXIF in parallel, retrying with a single process: %s" % str(e))
+            parsed = None
+
+    if parsed is None:
+        parsed = [_parse_photo(f) for f in to_parse]
+
+    for i, f, p in zip(missing, to_parse, parsed):
+        results[i] = p
+        if cache is not None and not isinstance(p, Exception):
+            cache.put(f, p)
+
+    if cache is not None:
+        cache.save()
+
+    return results
@@ -3,53 +3,112 @@ import os
 import tempfile
 import base64
 from rasterio.io import MemoryFile
-from opendm.system import run
+from opendm.system import run, SubprocessException
 from opendm import log
 from opendm.utils import double_quote
 
-def extract_raw_thermal_image_data(image_path):
+def read_raw_thermal_image(tags):
+    """
+    Decode the raw thermal image of a file from exiftool's JSON output (-b -j)
+    :param tags dictionary with the tags of the file. RawThermalImage is removed from it
+    :return numpy array (height, width, 1) with the raw sensor values
+    """
+    if not "RawThermalImage" in tags:
+        raise Exception("Cannot find RawThermalImage in tags")
+
+    imageBytes = base64.b64decode(tags["RawThermalImage"][len("base64:"):])
+
+    with MemoryFile(imageBytes) as memfile:
+        with memfile.open() as dataset:
+            img = dataset.read()
+            bands, h, w = img.shape
+
+            if bands != 1:
+                raise Exception("Raw thermal image has more than one band? This is not supported")
+
+            # (1, 512, 640) --> (512, 640, 1)
+            img = img[0][:,:,None]
+
+    del tags["RawThermalImage"]
+    return img
+
+def extract_raw_thermal_image_data(image_path, exiftool_path="exiftool"):
+    """
+    Extract the raw thermal image and temperature parameters of a single file
+    (see extract_raw_thermal_images_data)
+    :return (params, image) or ({}, None) if they cannot be extracted
+    """
+    result = extract_raw_thermal_images_data([image_path], exiftool_path).get(image_path)
+    if result is None:
+        return {}, None
+    params, img, _ = result
+    return params, img
+
+def extract_raw_thermal_images_data(image_paths, exiftool_path="exiftool"):
+    """
+    Extract the raw thermal images and temperature parameters of
+    multiple files with a single exiftool invocation
+    :param image_paths list of paths to thermal images
+    :param exiftool_path path to the exiftool executable
+    :return dictionary with image path --> (params, image, serial number or None).
+        Files whose data cannot be extracted are not included
+    """
+    results = {}
+    if len(image_paths) == 0:
+        return results
+
     try:
         f, tmp_file_path = tempfile.mkstemp(suffix='.json')
         os.close(f)
+    except Exception as e:
+        log.ODM_WARNING("Cannot create temporary file: %s" % str(e))
+        return results
+
+    try:
+        # Only request the tags we need, so that other binary tags (previews, thumbnails) are not dumped
+        tags = " ".join("-%s" % t for t in ["RawThermalImage"] + SERIAL_NUMBER_TAGS + list(TEMPERATURE_PARAMS))
+        files = " ".join(double_quote(p) for p in image_paths)
 
         try:
-            output = run("exiftool -b -x ThumbnailImage -x PreviewImage -j \"%s\" > \"%s\"" % (image_path, tmp_file_path), quiet=True)
-
-            with open(tmp_file_path) as f:
-                j = json.loads(f.read())
-
-                if isinstance(j, list):
-                    j = j[0] # single file
-                    
-                    if "RawThermalImage" in j:
-                        imageBytes = base64.b64decode(j["RawThermalImage"][len("base64:"):])
-
-                        with MemoryFile(imageBytes) as memfile:
-                            with memfile.open() as dataset:
-                                img = dataset.read()
-                                bands, h, w = img.shape
-
-                                if bands != 1:
-                                    raise Exception("Raw thermal image has more than one band? This is not supported")
-
-                                # (1, 512, 640) --> (512, 640, 1)
-                                img = img[0][:,:,None]
-
-                        del j["RawThermalImage"]
-                    
-                    return extract_temperature_params_from(j), img
-                else:
-                    raise Exception("Invalid JSON (not a list)")
-
-        except Exception as e:
-            log.ODM_WARNING("Cannot extract tags using exiftool: %s" % str(e))
-            return {}, None
-        finally:
-            if os.path.isfile(tmp_file_path):
-                os.remove(tmp_file_path)
+            run("%s -b -j %s %s > \"%s\"" % (double_quote(exiftool_path), tags, files, tmp_file_path), quiet=True)
+        except SubprocessException as e:
+            # exiftool returns an error code when some of the files cannot be read,
+            # but still outputs the tags of the others
+            log.ODM_WARNING("exiftool reported errors while reading thermal images: %s" % str(e))
+
+        with open(tmp_file_path) as f:
+            content = f.read()
+
+        j = json.loads(content) if content.strip() else []
+        if not isinstance(j, list):
+            raise Exception("Invalid JSON (not a list)")
+
+        paths = dict((os.path.abspath(p), p) for p in image_paths)
+        for t in j:
+            image_path = paths.get(os.path.abspath(t.get("SourceFile", "")))
+            if image_path is None:
+                continue
+
+            try:
+                img = read_raw_thermal_image(t)
+                results[image_path] = (extract_temperature_params_from(t), img, get_serial_number(t))
+            except Exception as e:
+                log.ODM_WARNING("Cannot extract raw thermal data from %s: %s" % (image_path, str(e)))
     except Exception as e:
-        log.ODM_WARNING("Cannot create temporary file: %s" % str(e))
-        return {}, None
+        log.ODM_WARNING("Cannot extract tags using exiftool: %s" % str(e))
+    finally:
+        if os.path.isfile(tmp_file_path):
+            os.remove(tmp_file_path)
+
+    return results
+
+def get_serial_number(tags):
+    """
+    :return the camera serial number from exiftool tags, or None
+    """
+    for t in SERIAL_NUMBER_TAGS:
+        if tags.get(t) not in [None, ""]:
+            return str(tags[t])
 
 def unit(unit):
     def _convert(v):
@@ -66,29 +125,31 @@ def unit(unit):
             return float(v)
     return _convert
 
-def extract_temperature_params_from(tags):
-    # Defaults
-    meta = {
-        "Emissivity": float,
-        "ObjectDistance": unit("m"),
-        "AtmosphericTemperature": unit("C"),
-        "ReflectedApparentTemperature": unit("C"),
-        "IRWindowTemperature": unit("C"),
-        "IRWindowTransmission": float,
-        "RelativeHumidity": unit("%"),
-        "PlanckR1": float,
-        "PlanckB": float,
-        "PlanckF": float,
-        "PlanckO": float,
-        "PlanckR2": float,
-    }
+# Temperature parameters (tag --> parser)
+TEMPERATURE_PARAMS = {
+    "Emissivity": float,
+    "ObjectDistance": unit("m"),
+    "AtmosphericTemperature": unit("C"),
+    "ReflectedApparentTemperature": unit("C"),
+    "IRWindowTemperature": unit("C"),
+    "IRWindowTransmission": float,
+    "RelativeHumidity": unit("%"),
+    "PlanckR1": float,
+    "PlanckB": float,
+    "PlanckF": float,
+    "PlanckO": float,
+    "PlanckR2": float,
+}
+
+SERIAL_NUMBER_TAGS = ["SerialNumber", "CameraSerialNumber"]
 
+def extract_temperature_params_from(tags):
     params = {}
 
-    for m in meta:
+    for m in TEMPERATURE_PARAMS:
         if m not in tags:
             # All or nothing
             raise Exception("Cannot find %s in tags" % m)
-        params[m] = (meta[m])(tags[m])
+        params[m] = (TEMPERATURE_PARAMS[m])(tags[m])
     
-    return params
\ No newline at end of file
+    return params
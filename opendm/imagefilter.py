@@ -0,0 +1,140 @@
+import threading
+import cv2
+import numpy as np
+from opendm import multispectral
+
+class BandPlan:
+    """
+    Steps to apply to the images of a band
+    """
+    def __init__(self, band_name, resize_to=None, alignment=None):
+        self.band_name = band_name
+        self.resize_to = resize_to # (width, height) or None
+        self.alignment = alignment # alignment info of the band or None
+
+class UndistortFilter:
+    """
+    Image filter for OSFMContext.convert_and_undistort. Applies radiometric
+    calibration, then resizes thermal images to match the other bands and aligns
+    secondary bands to the primary band. The steps are planned once per band,
+    calibration writes to a buffer reused by each thread and resizing and
+    alignment are done with a single warp when no downsampling is involved.
+    """
+    def __init__(self, get_photo, calibrate=None, resize_to=None, alignment=None):
+        """
+        :param get_photo function returning the ODM_Photo of a shot id
+        :param calibrate function (photo, image, out) returning the calibrated float32 image,
+            written to out when possible (out can be None). None to skip calibration
+        :param resize_to ODM_Photo whose dimensions thermal images are resized to. None to skip resizing
+        :param alignment function (band_name) returning the alignment info of a band
+            (from multispectral.compute_alignment_matrices) or None if the band is not aligned.
+            Called once per band
+        """
+        self.get_photo = get_photo
+        self.calibrate = calibrate
+        self.resize_to = resize_to
+        self.alignment = alignment
+        self._plans = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def plan(self, photo):
+        band_name = photo.band_name
+        plan = self._plans.get(band_name)
+        if plan is None:
+            with self._lock:
+                plan = self._plans.get(band_name)
+                if plan is None:
+                    resize_to = None
+                    if photo.is_thermal() and self.resize_to is not None:
+                        resize_to = (self.resize_to.width, self.resize_to.height)
+                    alignment = self.alignment(band_name) if self.alignment is not None else None
+                    plan = self._plans[band_name] = BandPlan(band_name, resize_to, alignment)
+        return plan
+
+    def buffer(self, shape):
+        """
+        :return float32 array of the given shape, reused by the calls made from the same thread
+        """
+        buf = getattr(self._local, 'buffer', None)
+        if buf is None or buf.shape != shape:
+            buf = self._local.buffer = np.empty(shape, dtype=np.float32)
+        return buf
+
+    def __call__(self, shot_id, image):
+        photo = self.get_photo(shot_id)
+        plan = self.plan(photo)
+        geometric = plan.resize_to is not None or plan.alignment is not None
+
+        if self.calibrate is not None:
+            # The result of calibration is only temporary if it's then warped
+            out = self.buffer(image.shape) if geometric and len(image.shape) == 3 else None
+            image = self.calibrate(photo, image, out)
+
+        if not geometric:
+            return image
+
+        warp_matrix = None
+        dimension = None
+        if plan.alignment is not None:
+            warp_matrix = multispectral.get_warp_matrix(plan.alignment, shot_id)
+            dimension = plan.alignment['dimension']
+
+        return warp_image(image, plan.resize_to, warp_matrix, dimension)
+
+def scaling_matrix(fx, fy):
+    """
+    :return homography equivalent to cv2.resize by fx, fy (pixel centers)
+    """
+    return np.array([[fx, 0, 0.5 * fx - 0.5],
+                     [0, fy, 0.5 * fy - 0.5],
+                     [0, 0, 1]], dtype=np.float64)
+
+def warp_image(image, resize_to=None, warp_matrix=None, dimension=None):
+    """
+    Resize an image to resize_to, then align it with warp_matrix (like multispectral.align_image).
+    When neither step downsamples, both are done with a single warp.
+    :param image numpy array
+    :param resize_to (width, height) or None
+    :param warp_matrix 3x3 or 2x3 matrix or None
+    :param dimension (width, height) of the aligned image (required with warp_matrix)
+    :return numpy array
+    """
+    h, w = image.shape[:2]
+    scales = []
+    M = np.eye(3, dtype=np.float64)
+
+    resize_factors = None
+    if resize_to is not None and (w != resize_to[0] or h != resize_to[1]):
+        resize_factors = (resize_to[0] / w, resize_to[1] / h)
+        scales += resize_factors
+        M = scaling_matrix(*resize_factors) @ M
+        w, h = resize_to
+
+    def resize(image):
+        # Same as thermal.resize_to_match
+        if resize_factors is None:
+            return image
+        return cv2.resize(image, None, fx=resize_factors[0], fy=resize_factors[1], interpolation=cv2.INTER_LANCZOS4)
+
+    if warp_matrix is None:
+        return resize(image)
+
+    mw, mh = dimension
+    if w != mw or h != mh:
+        # Same as multispectral.resize_match
+        f = mw / w
+        scales += [f, f]
+        M = scaling_matrix(f, f) @ M
+
+    if any(s < 1.0 for s in scales):
+        # Downsampling needs area interpolation
+        return multispectral.align_image(resize(image), warp_matrix, dimension)
+
+    warp_matrix = np.asarray(warp_matrix, dtype=np.float64)
+    if warp_matrix.shape == (2, 3):
+        warp_matrix = np.vstack([warp_matrix, [0, 0, 1]])
+
+    # Linear interpolation, also when upsampling (a Lanczos warp is an order of magnitude
+    # slower and its overshoots would create values, e.g. temperatures, that are not in the image)
+    return cv2.warpPerspective(image, warp_matrix @ M, dimension, flags=cv2.INTER_LINEAR)
@@ -0,0 +1,218 @@
+"""
+Columnar, binary images database.
+
+Photo attributes are stored one numpy array per attribute, with strings
+(and any value that is not a plain int/float/str) kept in a shared UTF-8
+string table. The file is a plain (non-pickled) .npz archive.
+Photos are only materialized into ODM_Photo objects when accessed.
+"""
+import json
+import numpy as np
+from collections.abc import Sequence
+
+from opendm.photo import ODM_Photo
+
+DB_VERSION = 1
+
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+def _column_kind(values):
+    types = set(type(v) for v in values if v is not None)
+    if types == {float}:
+        return "f8"
+    elif types == {int} and all(INT64_MIN <= v <= INT64_MAX for v in values if v is not None):
+        return "i8"
+    elif types == {str} or len(types) == 0:
+        return "str"
+    else:
+        return "json"
+
+class StringTable:
+    def __init__(self):
+        self.index = {}
+        self.chunks = []
+        self.offsets = [0]
+    
+    def add(self, s):
+        i = self.index.get(s)
+        if i is None:
+            b = s.encode("utf-8")
+            i = len(self.chunks)
+            self.index[s] = i
+            self.chunks.append(b)
+            self.offsets.append(self.offsets[-1] + len(b))
+        return i
+
+    def arrays(self):
+        return np.frombuffer(b"".join(self.chunks), dtype=np.uint8), np.array(self.offsets, dtype=np.int64)
+
+def save_images_database(photos, database_file):
+    """
+    Write photos to database_file (.npz)
+    """
+    dicts = [p.to_dict() for p in photos]
+    keys = []
+    for d in dicts:
+        for k in d:
+            if k not in keys:
+                keys.append(k)
+
+    strings = StringTable()
+    arrays = {}
+    columns = {}
+
+    for k in keys:
+        present = np.array([k in d for d in dicts], dtype=bool)
+        values = [d.get(k) for d in dicts]
+        kind = _column_kind(values)
+        columns[k] = kind
+
+        nulls = np.array([v is None for v in values], dtype=bool)
+
+        if kind == "f8":
+            arrays["c_" + k] = np.array([v if v is not None else 0.0 for v in values], dtype=np.float64)
+        elif kind == "i8":
+            arrays["c_" + k] = np.array([v if v is not None else 0 for v in values], dtype=np.int64)
+        elif kind == "str":
+            arrays["c_" + k] = np.array([strings.add(v) if v is not None else -1 for v in values], dtype=np.int32)
+            nulls = None
+        else:
+            arrays["c_" + k] = np.array([strings.add(json.dumps(v)) for v in values], dtype=np.int32)
+            nulls = None
+        
+        if nulls is not None and nulls.any():
+            arrays["n_" + k] = nulls
+        if not present.all():
+            arrays["p_" + k] = present
+
+    arrays["strings"], arrays["string_offsets"] = strings.arrays()
+    schema = {
+        'version': DB_VERSION,
+        'count': len(dicts),
+        'keys': keys,
+        'columns': columns,
+    }
+    arrays["schema"] = np.frombuffer(json.dumps(schema).encode("utf-8"), dtype=np.uint8)
+
+    with open(database_file, "wb") as f:
+        np.savez(f, **arrays)
+
+def load_images_database(database_file):
+    """
+    :return a PhotoTable for the photos stored in database_file (.npz)
+    """
+    return PhotoTable(database_file)
+
+class PhotoTable(Sequence):
+    """
+    Read-only sequence of ODM_Photo objects backed by a columnar database.
+    Photos are materialized on first access and then reused, so changes
+    made to a photo object are preserved.
+    """
+
+    def __init__(self, database_file):
+        with np.load(database_file, allow_pickle=False) as npz:
+            schema = json.loads(npz["schema"].tobytes().decode("utf-8"))
+            if schema.get("version") != DB_VERSION:
+                raise ValueError("Unsupported images database version: %s" % schema.get("version"))
+
+            self.count = schema["count"]
+            self.keys = schema["keys"]
+            self.kinds = schema["columns"]
+            self.columns = {}
+            self.nulls = {}
+            self.present = {}
+
+            for k in self.keys:
+                self.columns[k] = npz["c_" + k]
+                if ("n_" + k) in npz.files:
+                    self.nulls[k] = npz["n_" + k]
+                if ("p_" + k) in npz.files:
+                    self.present[k] = npz["p_" + k]
+            
+            self.strings = npz["strings"].tobytes()
+            self.string_offsets = npz["string_offsets"]
+        
+        self.photos = [None] * self.count
+        self.materialized = 0
+        self.values = {}
+        self.decoded = {}
+        self.accessors = None
+    
+    def _string(self, i):
+        s = self.decoded.get(i)
+        if s is None:
+            s = self.strings[self.string_offsets[i]:self.string_offsets[i + 1]].decode("utf-8")
+            self.decoded[i] = s
+        return s
+
+    def _values(self, k):
+        # Python values for a whole column are only built on first access
+        values = self.values.get(k)
+        if values is None:
+            kind = self.kinds[k]
+            values = self.columns[k].tolist()
+
+            if kind == "str":
+                values = [self._string(v) if v >= 0 else None for v in values]
+            elif kind != "json":
+                nulls = self.nulls.get(k)
+                if nulls is not None:
+                    for i in np.flatnonzero(nulls).tolist():
+                        values[i] = None
+            self.values[k] = values
+        return values
+
+    def _value(self, k, i):
+        v = self._values(k)[i]
+        if self.kinds[k] == "json":
+            # Parsed every time, since values can be mutable
+            return json.loads(self._string(v))
+        return v
+
+    def get_dict(self, i):
+        if self.accessors is None:
+            self.accessors = [(k, self._values(k), self.kinds[k] == "json", self.present.get(k)) for k in self.keys]
+
+        d = {}
+        for k, values, is_json, present in self.accessors:
+            if present is None or present[i]:
+                d[k] = json.loads(self._string(values[i])) if is_json else values[i]
+        return d
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.count))]
+        
+        if i < 0:
+            i += self.count
+        if i < 0 or i >= self.count:
+            raise IndexError("photo index out of range")
+        
+        if self.photos[i] is None:
+            self.photos[i] = ODM_Photo.from_dict(self.get_dict(i))
+            self.materialized += 1
+
+            if self.materialized == self.count:
+                # Columns are no longer needed
+                self.columns = self.nulls = self.values = self.decoded = self.accessors = None
+        return self.photos[i]
+
+    def __len__(self):
+        return self.count
+
+    def column(self, k):
+        """
+        :return all values of attribute k, without materializing the photos
+        """
+        present = self.present.get(k)
+        result = []
+        for i in range(self.count):
+            if self.photos[i] is not None:
+                result.append(getattr(self.photos[i], k, None))
+            elif present is not None and not present[i]:
+                result.append(None)
+            else:
+                result.append(self._value(k, i))
+        return result
@@ -6,6 +6,8 @@ import datetime
 import dateutil.parser
 import shutil
 import multiprocessing
+import time
+from collections import deque
 
 from opendm.arghelpers import double_quote, args_to_dict
 from vmem import virtual_memory
@@ -41,22 +43,201 @@ def memory():
         'available': round(mem.available / 1024 / 1024)
     }
 
+# Messages kept per stage in log.json (all messages are in log.jsonl)
+JSON_MAX_STAGE_MESSAGES = 1000
+
+class JsonLinesWriter:
+    """
+    Append-only, line-delimited JSON file written by a background thread.
+    Records are passed through a bounded queue (writers block when it's full),
+    the file is fsync'ed periodically and rotated when it grows too large
+    (file -> file.1 -> file.2 ...)
+    """
+    def __init__(self, path, max_queue=10000, fsync_interval=5.0, max_bytes=100 * 1024 * 1024, backup_count=5):
+        self.path = path
+        self.max_queue = max_queue
+        self.fsync_interval = fsync_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.written = 0
+        self.rotations = 0
+        self.fsyncs = 0
+        self.error = None
+
+        # A deque guarded by a condition is much cheaper than queue.Queue
+        # when the writer is busy: producers only notify it when it's idle
+        self.cond = threading.Condition()
+        self.pending = deque()
+        self.idle = False
+        self.closing = False
+        self.encoder = json.JSONEncoder(default=str)
+
+        self.file = open(self.path, "ab")
+        self.size = self.file.tell()
+        self.last_fsync = time.time()
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, record):
+        with self.cond:
+            if self.closing:
+                return
+            while len(self.pending) >= self.max_queue:
+                self.cond.wait()
+            self.pending.append(record)
+            if self.idle:
+                self.cond.notify_all()
+
+    def _rotate(self):
+        self.file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            src = "%s.%s" % (self.path, i)
+            if os.path.exists(src):
+                os.replace(src, "%s.%s" % (self.path, i + 1))
+        if self.backup_count > 0:
+            os.replace(self.path, "%s.1" % self.path)
+        else:
+            os.unlink(self.path)
+        self.file = open(self.path, "ab")
+        self.size = 0
+        self.rotations += 1
+
+    def _fsync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.fsyncs += 1
+        self.last_fsync = time.time()
+
+    def _run(self):
+        running = True
+        while running:
+            with self.cond:
+                if not self.pending and not self.closing:
+                    self.idle = True
+                    self.cond.wait(max(0, self.fsync_interval - (time.time() - self.last_fsync)))
+                    self.idle = False
+
+                # Write everything that's queued in a single batch
+                batch = self.pending
+                self.pending = deque()
+                running = not self.closing
+                self.cond.notify_all()
+
+            try:
+                lines = []
+                for r in batch:
+                    line = (self.encoder.encode(r) + "\n").encode("utf-8")
+                    if self.size > 0 and self.size + len(line) > self.max_bytes:
+                        self.file.write(b"".join(lines))
+                        lines = []
+                        self._rotate()
+                    lines.append(line)
+                    self.size += len(line)
+                self.file.write(b"".join(lines))
+                self.written += len(batch)
+
+                if not running or time.time() - self.last_fsync >= self.fsync_interval:
+                    self._fsync()
+                else:
+                    self.file.flush()
+            except Exception as e:
+                # Never take down the process because of logging
+                if self.error is None:
+                    self.error = e
+                    sys.stderr.write("Cannot write %s: %s\n" % (self.path, str(e)))
+
+        self.file.close()
+
+    def close(self):
+        with self.cond:
+            if self.closing:
+                return
+            self.closing = True
+            self.cond.notify_all()
+        self.thread.join()
+
 class ODMLogger:
     def __init__(self):
         self.json = None
         self.json_output_file = None
+        self.jsonl = None
+        self.forwarded = None
         self.start_time = datetime.datetime.now()
 
+        # Stage of log.json that the messages of each thread are filed under
+        # (stages can run concurrently with --parallel-stages)
+        self.stage = threading.local()
+
     def log(self, startc, msg, level_name):
         level = ("[" + level_name + "]").ljust(9)
+        line = "%s%s %s%s\n" % (startc, level, msg, ENDC)
         with lock:
-            print("%s%s %s%s" % (startc, level, msg, ENDC))
+            sys.stdout.write(line)
             sys.stdout.flush()
-            if self.json is not None:
-                self.json['stages'][-1]['messages'].append({
-                    'message': msg,
-                    'type': level_name.lower()
-                })
+
+        if self.forwarded is not None:
+            self.forwarded.append(('message', {'message': msg, 'type': level_name.lower()}))
+            return
+        self._log_json_message(msg, level_name.lower())
+
+    def current_stage(self):
+        """
+        :return the log.json stage that messages of the current thread are filed under,
+            to pass to set_stage in threads working on behalf of this one
+        """
+        return getattr(self.stage, 'current', None)
+
+    def set_stage(self, stage):
+        """
+        File the messages of the current thread under a stage returned by current_stage
+        """
+        self.stage.current = stage
+
+    def _log_json_message(self, msg, type):
+        if self.json is not None and self.json['stages']:
+            stage = self.current_stage()
+            if stage is not None and stage[0] is self.json:
+                messages = stage[1]['messages']
+            else:
+                # Not started by a stage (or from a previous log.json)
+                messages = self.json['stages'][-1]['messages']
+            messages.append({
+                'message': msg,
+                'type': type
+            })
+        self._log_jsonl('message', message=msg, type=type)
+
+    def after_fork_in_child(self):
+        """
+        The JSON writer thread doesn't exist in a forked process (and its state
+        may have been copied mid-update): records logged by the child are kept
+        in self.forwarded instead, for the parent to replay (see replay)
+        """
+        self.jsonl = None
+        self.json = None
+        self.forwarded = []
+
+    def take_forwarded(self):
+        """
+        :return the records logged in a forked process since the last call
+        """
+        records = self.forwarded or []
+        if self.forwarded is not None:
+            self.forwarded = []
+        return records
+
+    def replay(self, records):
+        """
+        Add records logged by a forked process to log.json and log.jsonl
+        (messages were already printed by the child)
+        """
+        for kind, d in records:
+            if kind == 'message':
+                self._log_json_message(d['message'], d['type'])
+            elif kind == 'process':
+                self.log_json_process(**d)
     
     def init_json_output(self, output_files, args):
         self.json_output_files = output_files
@@ -72,17 +253,42 @@ class ODMLogger:
         self.json['processes'] = []
         self.json['success'] = False
 
+        # Streamed as it happens, so that it survives crashes
+        try:
+            self.jsonl = JsonLinesWriter(os.path.splitext(self.json_output_file)[0] + ".jsonl")
+            self.jsonl.write({
+                'time': time.time(),
+                'event': 'start',
+                'odmVersion': self.json['odmVersion'],
+                'memory': self.json['memory'],
+                'cpus': self.json['cpus'],
+                'options': self.json['options'],
+            })
+        except Exception as e:
+            print("Cannot write log.jsonl: %s" % str(e))
+            self.jsonl = None
+
+    def _log_jsonl(self, event, **kwargs):
+        if self.jsonl is not None:
+            kwargs['time'] = time.time()
+            kwargs['event'] = event
+            self.jsonl.write(kwargs)
+
     def log_json_stage_run(self, name, start_time):
         if self.json is not None:
-            self.json['stages'].append({
+            stage = {
                 'name': name,
                 'startTime': start_time.isoformat(),
-                'messages': [],
-            })
+                'messages': deque(maxlen=JSON_MAX_STAGE_MESSAGES),
+            }
+            self.json['stages'].append(stage)
+            self.set_stage((self.json, stage))
+        self._log_jsonl('stage', name=name, startTime=start_time.isoformat())
     
     def log_json_images(self, count):
         if self.json is not None:
             self.json['images'] = count
+        self._log_jsonl('images', count=count)
     
     def log_json_stage_error(self, error, exit_code, stack_trace = ""):
         if self.json is not None:
@@ -92,22 +298,31 @@ class ODMLogger:
             }
             self.json['stackTrace'] = list(map(str.strip, stack_trace.split("\n")))
             self._log_json_end_time()
+        self._log_jsonl('error', code=exit_code, message=error, stackTrace=stack_trace)
 
     def log_json_success(self):
         if self.json is not None:
             self.json['success'] = True
             self._log_json_end_time()
+        self._log_jsonl('success')
     
-    def log_json_process(self, cmd, exit_code, output = []):
-        if self.json is not None:
-            d = {
-                'command': cmd,
-                'exitCode': exit_code,
-            }
-            if output:
-                d['output'] = output
+    def log_json_process(self, cmd, exit_code, output = [], stats = None):
+        if self.forwarded is not None:
+            self.forwarded.append(('process', {'cmd': cmd, 'exit_code': exit_code, 'output': output, 'stats': stats}))
+            return
+
+        d = {
+            'command': cmd,
+            'exitCode': exit_code,
+        }
+        if output:
+            d['output'] = output
+        if stats:
+            d.update(stats)
 
+        if self.json is not None:
             self.json['processes'].append(d)
+        self._log_jsonl('process', **d)
 
     def _log_json_end_time(self):
         if self.json is not None:
@@ -134,10 +349,14 @@ class ODMLogger:
         self.log(FAIL, msg, "EXCEPTION")
 
     def close(self):
+        if self.jsonl is not None:
+            self.jsonl.close()
+            self.jsonl = None
+
         if self.json is not None and self.json_output_file is not None:
             try:
                 with open(self.json_output_file, 'w') as f:
-                    f.write(json.dumps(self.json, indent=4))
+                    f.write(json.dumps(self.json, indent=4, default=list))
                 for f in self.json_output_files[1:]:
                     shutil.copy(self.json_output_file, f)
             except Exception as e:
@@ -145,6 +364,15 @@ class ODMLogger:
 
 logger = ODMLogger()
 
+def _after_fork_in_child():
+    # Locks may have been held by another thread at the time of the fork
+    global lock
+    lock = threading.Lock()
+    logger.after_fork_in_child()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
 ODM_INFO = logger.info
 ODM_WARNING = logger.warning
 ODM_ERROR = logger.error
@@ -0,0 +1,212 @@
+import os
+import json
+import hashlib
+import threading
+from opendm import log
+
+MANIFEST_VERSION = 1
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def hash_value(value):
+    """
+    :return SHA-256 of a JSON serializable value
+    """
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+class Manifest:
+    """
+    Records the content hashes of the inputs (files, options, state of the
+    previous stages) and outputs of each stage in manifest.json. Used by
+    --incremental-rerun to rerun a stage only when something it depends on has
+    really changed. A stage whose outputs come out identical after a rerun
+    does not cause the following stages to rerun because of an option change.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.project_path = None
+        self.rerun_stages = {}
+        self.data = None
+        self.loaded = False
+        self.states = {}
+        self.current = {}
+        self.lock = threading.RLock()
+
+    def load(self, path, project_path, rerun_stages):
+        """
+        :param path path to manifest.json
+        :param project_path project directory (files are recorded relative to it)
+        :param rerun_stages dictionary of option --> stage that uses it (config.rerun_stages)
+        :return True if a manifest from a previous run was loaded
+        """
+        self.path = path
+        self.project_path = os.path.abspath(project_path)
+        self.rerun_stages = rerun_stages
+        self.states = {}
+        self.current = {}
+        self.data = {'version': MANIFEST_VERSION, 'stages': {}, 'files': {}}
+        self.loaded = False
+        self.enabled = True
+
+        if not os.path.isfile(path):
+            return False
+
+        try:
+            with open(path, 'r') as f:
+                data = json.loads(f.read())
+            if data.get('version') == MANIFEST_VERSION:
+                self.data = data
+                self.loaded = True
+                return True
+            log.ODM_WARNING("Ignoring manifest %s (unsupported version)" % path)
+        except Exception as e:
+            log.ODM_WARNING("Cannot read manifest %s: %s" % (path, str(e)))
+        return False
+
+    def save(self):
+        with self.lock:
+            tmp = self.path + ".tmp"
+            with open(tmp, 'w') as f:
+                f.write(json.dumps(self.data))
+            os.replace(tmp, self.path)
+
+    def relpath(self, path):
+        path = os.path.abspath(path)
+        if path.startswith(self.project_path + os.sep):
+            return os.path.relpath(path, self.project_path)
+        return path
+
+    def hash_file(self, path):
+        """
+        :return SHA-256 of a file. Hashes are cached by size and modification
+            time, so unchanged files are not read again
+        """
+        st = os.stat(path)
+        key = self.relpath(path)
+        with self.lock:
+            cached = self.data['files'].get(key)
+        if cached is not None and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            return cached[2]
+
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(HASH_CHUNK_SIZE)
+                if not chunk:
+                    break
+                h.update(chunk)
+        digest = h.hexdigest()
+
+        with self.lock:
+            self.data['files'][key] = [st.st_size, st.st_mtime_ns, digest]
+        return digest
+
+    def hash_path(self, path):
+        """
+        :return SHA-256 of a file or directory (file names and contents), or None if it doesn't exist
+        """
+        if os.path.isfile(path):
+            return self.hash_file(path)
+        if not os.path.isdir(path):
+            return None
+
+        entries = []
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for f in sorted(files):
+                p = os.path.join(root, f)
+                entries.append((os.path.relpath(p, path), self.hash_file(p)))
+        return hash_value(entries)
+
+    def hash_paths(self, paths):
+        return dict((self.relpath(p), self.hash_path(p)) for p in paths if p)
+
+    def stage_options(self, name, args):
+        opts = vars(args)
+        return dict((opt, opts.get(opt)) for opt, stage in self.rerun_stages.items() if stage == name)
+
+    def state(self, name):
+        """
+        :return a hash summarizing what a stage produced, in this run
+            or (if it didn't run) in the previous run
+        """
+        with self.lock:
+            if name in self.states:
+                return self.states[name]
+            return self.data['stages'].get(name, {}).get('state')
+
+    def changed(self, stage, upstream, args, tree):
+        """
+        Compute the inputs of a stage and compare them with the ones recorded
+        the last time the stage completed.
+        :param stage ODM_Stage
+        :param upstream names of the stages this stage depends on
+        :param args arguments
+        :param tree ODM_Tree
+        :return True if the stage needs to be rerun. Without a manifest from a previous run,
+            this run only records a baseline and returns False (rerun() is then decided
+            as without --incremental-rerun: rerun options and existing outputs)
+        """
+        inputs = {
+            'files': self.hash_paths(stage.input_files(args, tree)),
+            'options': hash_value(self.stage_options(stage.name, args)),
+            'upstream': dict((name, self.state(name)) for name in upstream),
+        }
+        with self.lock:
+            self.current[stage.name] = inputs
+            record = self.data['stages'].get(stage.name)
+
+        if record is None:
+            if not self.loaded:
+                log.ODM_INFO("No manifest yet, recording the inputs and outputs of %s" % stage.name)
+                return False
+            log.ODM_INFO("%s has not completed before, running it" % stage.name)
+            return True
+
+        previous = record['inputs']
+        changes = [k for k in inputs['files'] if inputs['files'][k] != previous['files'].get(k)]
+        changes += [k for k in previous['files'] if k not in inputs['files']]
+        if inputs['options'] != previous['options']:
+            changes.append("options")
+        changes += [k for k in inputs['upstream'] if inputs['upstream'][k] != previous['upstream'].get(k)]
+
+        # Outputs modified or removed since the last run
+        outputs = self.hash_paths(stage.output_files(args, tree))
+        changes += [k for k in outputs if outputs[k] != record['outputs'].get(k)]
+
+        if changes:
+            log.ODM_INFO("%s inputs have changed: %s" % (stage.name, ", ".join(changes)))
+            return True
+
+        return False
+
+    def record(self, stage, args, tree):
+        """
+        Record the inputs and outputs of a stage that completed successfully
+        """
+        with self.lock:
+            inputs = self.current.pop(stage.name, None)
+        if inputs is None:
+            return
+
+        outputs = self.hash_paths(stage.output_files(args, tree))
+        if outputs:
+            # Option changes that don't change the outputs
+            # don't affect the following stages
+            state = hash_value([inputs['files'], inputs['upstream'], outputs])
+        else:
+            state = hash_value(inputs)
+
+        with self.lock:
+            self.states[stage.name] = state
+            self.data['stages'][stage.name] = {
+                'inputs': inputs,
+                'outputs': outputs,
+                'state': state,
+            }
+            try:
+                self.save()
+            except Exception as e:
+                log.ODM_WARNING("Cannot write manifest %s: %s" % (self.path, str(e)))
+
+manifest = Manifest()
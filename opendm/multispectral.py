@@ -2,10 +2,12 @@ import math
 import re
 import cv2
 import os
+import threading
+from collections import OrderedDict
 from opendm import dls
 import numpy as np
 from opendm import log
-from opendm.concurrency import parallel_map
+from opendm.concurrency import get_parallel_imap
 from opensfm.io import imread
 
 from skimage import exposure
@@ -14,15 +16,93 @@ from skimage.filters import rank, gaussian
 
 # Loosely based on https://github.com/micasense/imageprocessing/blob/master/micasense/utils.py
 
-def dn_to_radiance(photo, image):
+# Budget (in bytes) of the vignetting fields kept in memory
+CORRECTION_CACHE_SIZE = 256 * 1024 * 1024
+
+# Size (in bytes) of the blocks of rows that corrections are applied to,
+# so that they stay in the CPU cache between operations
+CORRECTION_CHUNK_SIZE = 256 * 1024
+
+class CorrectionFieldCache:
+    """
+    Least recently used cache of float32 correction fields (e.g. vignetting),
+    which are the same for every image of a band, bounded by memory usage.
+    """
+    def __init__(self, max_bytes=CORRECTION_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._fields = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        """
+        :param key hashable key of the field
+        :param compute function returning the field (numpy array), called on a miss
+        :return the cached field (read-only)
+        """
+        while True:
+            with self._lock:
+                field = self._fields.get(key)
+                if field is not None:
+                    self._fields.move_to_end(key)
+                    self.hits += 1
+                    return field
+
+                pending = self._pending.get(key)
+                if pending is None:
+                    # We compute it
+                    pending = self._pending[key] = threading.Event()
+                    self.misses += 1
+                    break
+
+            # Another thread is computing it
+            pending.wait()
+
+        try:
+            field = compute()
+            field.setflags(write=False)
+            with self._lock:
+                if field.nbytes <= self.max_bytes:
+                    self._fields[key] = field
+                    self.nbytes += field.nbytes
+                    while self.nbytes > self.max_bytes:
+                        _, evicted = self._fields.popitem(last=False)
+                        self.nbytes -= evicted.nbytes
+            return field
+        finally:
+            with self._lock:
+                del self._pending[key]
+            pending.set()
+
+    def clear(self):
+        with self._lock:
+            self._fields.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._fields)
+
+correction_fields = CorrectionFieldCache()
+
+def dn_to_radiance(photo, image, out=None):
     """
     Convert Digital Number values to Radiance values
     :param photo ODM_Photo
     :param image numpy array containing image data
+    :param out float32 numpy array with the same shape as image to write the result to (optional)
     :return numpy array with radiance image values
     """
 
-    image = image.astype("float32")
+    if out is not None:
+        np.copyto(out, image, casting='unsafe')
+        image = out
+    else:
+        image = image.astype("float32")
     if len(image.shape) != 3:
         raise ValueError("Image should have shape length of 3 (got: %s)" % len(image.shape))
     
@@ -46,83 +126,116 @@ def dn_to_radiance(photo, image):
     if a1 is None and photometric_exp is not None:
         a1 = photometric_exp
 
-    V, x, y = vignette_map(photo)
-    if x is None:
-        x, y = np.meshgrid(np.arange(photo.width), np.arange(photo.height))
+    V = vignette_field(photo)
+
+    R = None
+    if exposure_time and a2 is not None and a3 is not None:
+        # row gradient correction (a function of the row only)
+        y = np.arange(photo.height, dtype=np.float64)
+        R = (1.0 / (1.0 + a2 * y / exposure_time - a3 * y)).astype(np.float32)
 
-    if dark_level is not None:
-        image -= dark_level
+    # Scalar factors are positive, so they can all be
+    # applied at once after flooring negative values
+    scale = 1.0
 
     # Normalize DN to 0 - 1.0
     bit_depth_max = photo.get_bit_depth_max()
     if bit_depth_max:
-        image /= bit_depth_max
+        scale /= bit_depth_max
     else:
         log.ODM_WARNING("Cannot normalize DN for %s, bit depth is missing" % photo.filename)
-    
-    if V is not None:
-        # vignette correction
-        V = np.repeat(V[:, :, np.newaxis], image.shape[2], axis=2)
-        image *= V
 
-    if exposure_time and a2 is not None and a3 is not None:
-        # row gradient correction
-        R = 1.0 / (1.0 + a2 * y / exposure_time - a3 * y)
-        R = np.repeat(R[:, :, np.newaxis], image.shape[2], axis=2)
-        image *= R
-    
-    # Floor any negative radiances to zero (can happen due to noise around blackLevel)
-    if dark_level is not None:
-        image[image < 0] = 0
-    
     # apply the radiometric calibration - i.e. scale by the gain-exposure product and
     # multiply with the radiometric calibration coefficient
-
     if gain is not None and exposure_time is not None:
-        image /= (gain * exposure_time)
-    
-    image *= a1
+        scale /= (gain * exposure_time)
+
+    scale *= a1
 
     if gain_adjustment is not None:
-        image *= gain_adjustment
+        scale *= gain_adjustment
 
+    apply_corrections(image, dark_level, V, R, scale)
     return image
 
-def vignette_map(photo):
+def apply_corrections(image, dark_level, vignette, row_gradient, scale):
+    """
+    Apply radiometric corrections to an image in place, one block of rows at a time
+    :param image float32 numpy array (height, width, bands)
+    :param dark_level value to subtract (None to skip it, and flooring)
+    :param vignette (height, width) multiplicative field or None
+    :param row_gradient (height, ) multiplicative field or None
+    :param scale multiplicative factor, applied after flooring negative values to zero
+    """
+    height = image.shape[0]
+    row_size = max(1, image[0].nbytes)
+    rows = max(1, CORRECTION_CHUNK_SIZE // row_size)
+
+    for r in range(0, height, rows):
+        block = image[r:r + rows]
+        if dark_level is not None:
+            block -= dark_level
+        if vignette is not None:
+            block *= vignette[r:r + rows, :, np.newaxis]
+        if row_gradient is not None:
+            block *= row_gradient[r:r + rows, np.newaxis, np.newaxis]
+
+        # Floor any negative radiances to zero (can happen due to noise around blackLevel)
+        if dark_level is not None:
+            np.maximum(block, 0, out=block)
+
+        if scale != 1.0:
+            block *= scale
+
+def vignette_field(photo):
+    """
+    Vignette correction field of a photo, shared by all the photos
+    with the same camera, band and vignetting parameters
+    :param photo ODM_Photo
+    :return float32 numpy array (height, width) or None if the photo has no vignetting parameters
+    """
     x_vc, y_vc = photo.get_vignetting_center()
     polynomial = photo.get_vignetting_polynomial()
 
-    if x_vc and polynomial:
-        # append 1., so that we can call with numpy polyval
-        polynomial.append(1.0)
-        vignette_poly = np.array(polynomial)
+    if not (x_vc and polynomial):
+        return None
 
-        # perform vignette correction
-        # get coordinate grid across image
-        x, y = np.meshgrid(np.arange(photo.width), np.arange(photo.height))
+    key = (photo.camera_make, photo.camera_model, photo.band_name,
+           photo.width, photo.height, x_vc, y_vc, tuple(polynomial))
 
-        # meshgrid returns transposed arrays
-        # x = x.T
-        # y = y.T
+    # append 1., so that we can call with numpy polyval
+    vignette_poly = np.array(polynomial + [1.0])
 
-        # compute matrix of distances from image center
-        r = np.hypot((x - x_vc), (y - y_vc))
+    def compute():
+        vignette = np.empty((photo.height, photo.width), dtype=np.float32)
+        x = np.arange(photo.width, dtype=np.float64) - x_vc
+        rows = max(1, CORRECTION_CHUNK_SIZE // (photo.width * 8))
 
-        # compute the vignette polynomial for each distance - we divide by the polynomial so that the
-        # corrected image is image_corrected = image_original * vignetteCorrection
-        vignette = np.polyval(vignette_poly, r)
+        # Computed in blocks of rows, without a full-resolution coordinate grid
+        for r in range(0, photo.height, rows):
+            y = np.arange(r, min(r + rows, photo.height), dtype=np.float64)[:, np.newaxis] - y_vc
 
-        # DJI is special apparently
-        if photo.camera_make != "DJI":
-            vignette = 1.0 / vignette
+            # compute the vignette polynomial for each distance from the center - we divide by the polynomial
+            # so that the corrected image is image_corrected = image_original * vignetteCorrection
+            block = np.polyval(vignette_poly, np.hypot(x, y))
 
-        return vignette, x, y
-    
-    return None, None, None
+            # DJI is special apparently
+            if photo.camera_make != "DJI":
+                block = 1.0 / block
 
-def dn_to_reflectance(photo, image, use_sun_sensor=True):
-    radiance = dn_to_radiance(photo, image)
+            vignette[r:r + len(y)] = block
+
+        return vignette
+
+    return correction_fields.get(key, compute)
+
+def dn_to_reflectance(photo, image, use_sun_sensor=True, out=None):
+    radiance = dn_to_radiance(photo, image, out=out)
     irradiance = compute_irradiance(photo, use_sun_sensor=use_sun_sensor)
+    if out is not None:
+        radiance *= math.pi
+        radiance /= irradiance
+        return radiance
     return radiance * math.pi / irradiance
 
 def compute_irradiance(photo, use_sun_sensor=True):
@@ -284,8 +397,29 @@ def compute_band_maps(multi_camera, primary_band):
 
         return s2p, p2s
 
-def compute_alignment_matrices(multi_camera, primary_band_name, images_path, s2p, p2s, max_concurrency=1, max_samples=30):
-    log.ODM_INFO("Computing band alignment")
+# Adaptive band alignment
+ALIGNMENT_COARSE_SIZE = 512 # Size (max dimension) at which homographies are first estimated
+ALIGNMENT_REFINE_SIZE = 1024 # Size up to which they are refined
+ALIGNMENT_MIN_SAMPLES = 5 # Estimates that must agree before sampling stops
+ALIGNMENT_TOLERANCE = 1.0 # Pixels (at full resolution) within which estimates agree
+ALIGNMENT_REFINE_THRESHOLD = 0.25 # Captures with a residual this much above the band's median get their own matrix
+RESIDUAL_SIZE = 320 # Size at which alignment residuals are measured
+
+def compute_alignment_matrices(multi_camera, primary_band_name, images_path, s2p, p2s, max_concurrency=1, max_samples=30,
+                               adaptive=False, min_samples=ALIGNMENT_MIN_SAMPLES, tolerance=ALIGNMENT_TOLERANCE,
+                               refine_threshold=ALIGNMENT_REFINE_THRESHOLD):
+    """
+    Compute the homography that aligns each secondary band to the primary band
+    :param adaptive estimate homographies on an image pyramid, stop sampling captures once
+        the estimates converge and refine the alignment of captures that don't fit the band's matrix
+    :param min_samples (adaptive) number of estimates that must agree before sampling stops
+    :param tolerance (adaptive) distance in pixels within which estimates agree
+    :param refine_threshold (adaptive) captures with a residual above the band's median
+        residual * (1 + refine_threshold) get their own matrix. None to skip refinement
+    :return dict with the alignment info of each secondary band. In adaptive mode,
+        'captures' maps filenames of refined captures to their own warp matrix
+    """
+    log.ODM_INFO("Computing band alignment%s" % (" (adaptive)" if adaptive else ""))
 
     alignment_info = {}
 
@@ -296,10 +430,6 @@ def compute_alignment_matrices(multi_camera, primary_band_name, images_path, s2p
 
             def parallel_compute_homography(p):
                 try:
-                    if len(matrices) >= max_samples:
-                        # log.ODM_INFO("Got enough samples for %s (%s)" % (band['name'], max_samples))
-                        return
-
                     # Find good matrix candidates for alignment
                 
                     primary_band_photo = s2p.get(p['filename'])
@@ -308,34 +438,56 @@ def compute_alignment_matrices(multi_camera, primary_band_name, images_path, s2p
                         return
 
                     warp_matrix, dimension, algo = compute_homography(os.path.join(images_path, p['filename']),
-                                                                os.path.join(images_path, primary_band_photo.filename))
+                                                                os.path.join(images_path, primary_band_photo.filename),
+                                                                adaptive=adaptive)
                     
                     if warp_matrix is not None:
                         log.ODM_INFO("%s --> %s good match" % (p['filename'], primary_band_photo.filename))
 
-                        matrices.append({
+                        return {
+                            'filename': p['filename'],
                             'warp_matrix': warp_matrix,
                             'eigvals': np.linalg.eigvals(warp_matrix),
                             'dimension': dimension,
                             'algo': algo
-                        })
+                        }
                     else:
                         log.ODM_INFO("%s --> %s cannot be matched" % (p['filename'], primary_band_photo.filename))
                 except Exception as e:
                     log.ODM_WARNING("Failed to compute homography for %s: %s" % (p['filename'], str(e)))
 
-            parallel_map(parallel_compute_homography, [{'filename': p.filename} for p in band['photos']], max_concurrency, single_thread_fallback=False)
-
-            # Find the matrix that has the most common eigvals
-            # among all matrices. That should be the "best" alignment.
-            for m1 in matrices:
-                acc = np.array([0.0,0.0,0.0])
-                e = m1['eigvals']
+            photos = band['photos']
+            if adaptive:
+                # Spread samples across the dataset
+                photos = spread_order(photos)
+
+            # Homography search is mostly Python and many small OpenCV calls
+            imap = get_parallel_imap('python')
+            for m in imap(parallel_compute_homography, [{'filename': p.filename} for p in photos], max_concurrency, ordered=False, return_exceptions=True):
+                if isinstance(m, dict):
+                    matrices.append(m)
+                    if len(matrices) >= max_samples:
+                        # log.ODM_INFO("Got enough samples for %s (%s)" % (band['name'], max_samples))
+                        break
+                    if adaptive and alignment_converged(matrices, min_samples, tolerance):
+                        log.ODM_INFO("Alignment of %s converged after %s samples" % (band['name'], len(matrices)))
+                        break
+
+            if adaptive:
+                # Pick the matrix that agrees the most with the others
+                for m1 in matrices:
+                    m1['score'] = sum(corner_distance(m1['warp_matrix'], m2['warp_matrix'], m1['dimension']) for m2 in matrices)
+            else:
+                # Find the matrix that has the most common eigvals
+                # among all matrices. That should be the "best" alignment.
+                for m1 in matrices:
+                    acc = np.array([0.0,0.0,0.0])
+                    e = m1['eigvals']
 
-                for m2 in matrices:
-                    acc += abs(e - m2['eigvals'])
+                    for m2 in matrices:
+                        acc += abs(e - m2['eigvals'])
 
-                m1['score'] = acc.sum()
+                    m1['score'] = acc.sum()
             
             # Sort
             matrices.sort(key=lambda x: x['score'], reverse=False)
@@ -343,29 +495,142 @@ def compute_alignment_matrices(multi_camera, primary_band_name, images_path, s2p
             if len(matrices) > 0:
                 alignment_info[band['name']] = matrices[0]
                 log.ODM_INFO("%s band will be aligned using warp matrix %s (score: %s)" % (band['name'], matrices[0]['warp_matrix'], matrices[0]['score']))
+
+                if adaptive and refine_threshold is not None:
+                    matrices[0]['captures'] = refine_capture_alignment(band, matrices[0], images_path, s2p, max_concurrency, refine_threshold)
             else:
                 log.ODM_WARNING("Cannot find alignment matrix for band %s, The band might end up misaligned!" % band['name'])
 
     return alignment_info
 
-def compute_homography(image_filename, align_image_filename):
+def get_warp_matrix(alignment_info, filename):
+    """
+    :param alignment_info alignment info of a band (from compute_alignment_matrices)
+    :param filename filename of a photo of the band
+    :return the warp matrix to align the photo with
+    """
+    return alignment_info.get('captures', {}).get(filename, alignment_info['warp_matrix'])
+
+def spread_order(items):
+    """
+    Reorder items so that any prefix covers the whole list evenly
+    (e.g. a flight from start to end, instead of its beginning)
+    """
+    n = len(items)
+    golden = (math.sqrt(5) - 1) / 2
+    return [items[i] for i in sorted(range(n), key=lambda i: (i * golden) % 1.0)]
+
+def corner_distance(m1, m2, dimension):
+    """
+    :return max distance (pixels) between the image corners transformed by two homographies
+    """
+    w, h = dimension
+    corners = np.array([[[0, 0], [w, 0], [w, h], [0, h]]], dtype=np.float64)
+    c1 = cv2.perspectiveTransform(corners, np.asarray(m1, dtype=np.float64))
+    c2 = cv2.perspectiveTransform(corners, np.asarray(m2, dtype=np.float64))
+    return float(np.max(np.linalg.norm(c1 - c2, axis=2)))
+
+def alignment_converged(matrices, min_samples, tolerance):
+    """
+    :return True if the last min_samples estimates are all within tolerance
+        of the estimate that agrees the most with the others
+    """
+    if len(matrices) < min_samples:
+        return False
+
+    dimension = matrices[0]['dimension']
+    best = min(matrices, key=lambda m1: sum(corner_distance(m1['warp_matrix'], m2['warp_matrix'], dimension) for m2 in matrices))
+    return all(corner_distance(m['warp_matrix'], best['warp_matrix'], dimension) <= tolerance for m in matrices[-min_samples:])
+
+def refine_capture_alignment(band, band_alignment, images_path, s2p, max_concurrency, refine_threshold):
+    """
+    Measure how well each capture of a band is aligned by the band's matrix
+    and compute a matrix for the captures that are not aligned as well as the others
+    :return dict of filename --> warp matrix for the refined captures
+    """
+    warp_matrix = band_alignment['warp_matrix']
+
+    def load(filename):
+        primary_band_photo = s2p.get(filename)
+        if primary_band_photo is None:
+            return None, None
+        return (load_gray(os.path.join(images_path, filename)),
+                load_gray(os.path.join(images_path, primary_band_photo.filename)))
+
+    def residual(filename):
+        image_gray, align_image_gray = load(filename)
+        if image_gray is None:
+            return filename, None
+        return filename, alignment_residual(image_gray, align_image_gray, warp_matrix)
+
+    imap = get_parallel_imap('python')
+    residuals = {}
+    for r in imap(residual, [p.filename for p in band['photos']], max_concurrency, ordered=False, return_exceptions=True):
+        if isinstance(r, tuple) and r[1] is not None:
+            residuals[r[0]] = r[1]
+
+    if not residuals:
+        return {}
+
+    threshold = np.median(list(residuals.values())) * (1.0 + refine_threshold)
+    outliers = [f for f, r in residuals.items() if r > threshold]
+    if not outliers:
+        return {}
+
+    log.ODM_INFO("Refining alignment of %s/%s captures of %s band" % (len(outliers), len(residuals), band['name']))
+
+    def refine(filename):
+        image_gray, align_image_gray = load(filename)
+        h = find_pyramid_homography(image_gray, align_image_gray, warp_matrix=warp_matrix)
+        if h is None or not valid_homography(h):
+            return filename, None
+        r = alignment_residual(image_gray, align_image_gray, h)
+        if r >= residuals[filename]:
+            return filename, None
+        log.ODM_INFO("%s alignment refined (residual %.3f --> %.3f)" % (filename, residuals[filename], r))
+        return filename, h
+
+    captures = {}
+    for r in imap(refine, outliers, max_concurrency, ordered=False, return_exceptions=True):
+        if isinstance(r, tuple) and r[1] is not None:
+            captures[r[0]] = r[1]
+    return captures
+
+def load_gray(image_filename):
+    image = imread(image_filename, unchanged=True, anydepth=True)
+    if image.shape[2] == 3:
+        return to_8bit(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
+    else:
+        return to_8bit(image[:,:,0])
+
+def valid_homography(h):
+    det = np.linalg.det(h)
+            
+    # Check #1 homography's determinant will not be close to zero
+    if abs(det) < 0.25:
+        return False
+
+    # Check #2 the ratio of the first-to-last singular value is sane (not too high)
+    svd = np.linalg.svd(h, compute_uv=False)
+    if svd[-1] == 0:
+        return False
+    
+    ratio = svd[0] / svd[-1]
+    if ratio > 100000:
+        return False
+
+    return True
+
+def compute_homography(image_filename, align_image_filename, adaptive=False):
     try:
         # Convert images to grayscale if needed
-        image = imread(image_filename, unchanged=True, anydepth=True)
-        if image.shape[2] == 3:
-            image_gray = to_8bit(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
-        else:
-            image_gray = to_8bit(image[:,:,0])
+        image_gray = load_gray(image_filename)
 
         max_dim = max(image_gray.shape)
         if max_dim <= 320:
             log.ODM_WARNING("Small image for band alignment (%sx%s), this might be tough to compute." % (image_gray.shape[1], image_gray.shape[0]))
 
-        align_image = imread(align_image_filename, unchanged=True, anydepth=True)
-        if align_image.shape[2] == 3:
-            align_image_gray = to_8bit(cv2.cvtColor(align_image, cv2.COLOR_BGR2GRAY))
-        else:
-            align_image_gray = to_8bit(align_image[:,:,0])
+        align_image_gray = load_gray(align_image_filename)
 
         def compute_using(algorithm):
             try:
@@ -374,22 +639,7 @@ def compute_homography(image_filename, align_image_filename):
                 log.ODM_WARNING("Cannot compute homography: %s" % str(e))
                 return None, (None, None)
 
-            if h is None:
-                return None, (None, None)
-
-            det = np.linalg.det(h)
-            
-            # Check #1 homography's determinant will not be close to zero
-            if abs(det) < 0.25:
-                return None, (None, None)
-
-            # Check #2 the ratio of the first-to-last singular value is sane (not too high)
-            svd = np.linalg.svd(h, compute_uv=False)
-            if svd[-1] == 0:
-                return None, (None, None)
-            
-            ratio = svd[0] / svd[-1]
-            if ratio > 100000:
+            if h is None or not valid_homography(h):
                 return None, (None, None)
 
             return h, (align_image_gray.shape[1], align_image_gray.shape[0])
@@ -398,7 +648,13 @@ def compute_homography(image_filename, align_image_filename):
         dimension = None
         algo = None
 
-        if max_dim > 320:
+        if adaptive:
+            algo = 'pyramid'
+            result = compute_using(find_pyramid_homography)
+            if result[0] is None:
+                algo = None
+
+        elif max_dim > 320:
             algo = 'feat'
             result = compute_using(find_features_homography)
             
@@ -423,6 +679,104 @@ def compute_homography(image_filename, align_image_filename):
         log.ODM_WARNING("Compute homography: %s" % str(e))
         return None, (None, None), None
 
+def scale_homography(h, f):
+    """
+    :return homography h (between images scaled by f) for the original images
+    """
+    S = np.array([[f, 0, 0], [0, f, 0], [0, 0, 1]], dtype=np.float64)
+    h = np.linalg.inv(S) @ np.asarray(h, dtype=np.float64) @ S
+    return h / h[2, 2]
+
+def match_size(align_image_gray, image_gray):
+    if align_image_gray.shape[:2] != image_gray.shape[:2]:
+        align_image_gray = cv2.resize(align_image_gray, (image_gray.shape[1], image_gray.shape[0]),
+                                      interpolation=cv2.INTER_AREA if align_image_gray.shape[1] > image_gray.shape[1] else cv2.INTER_LANCZOS4)
+    return align_image_gray
+
+def fast_gradient(im):
+    """
+    Gradient magnitude, for comparing images of different bands
+    """
+    im = cv2.GaussianBlur(im.astype(np.float32), (5, 5), 0)
+    grad_x = cv2.Sobel(im, cv2.CV_32F, 1, 0, ksize=3)
+    grad_y = cv2.Sobel(im, cv2.CV_32F, 0, 1, ksize=3)
+    return cv2.addWeighted(np.absolute(grad_x), 0.5, np.absolute(grad_y), 0.5, 0)
+
+def find_pyramid_homography(image_gray, align_image_gray, warp_matrix=None, coarse_size=ALIGNMENT_COARSE_SIZE,
+                            refine_size=ALIGNMENT_REFINE_SIZE, number_of_iterations=30, termination_eps=1e-4):
+    """
+    Estimate a homography on a downscaled copy of the images and refine it up an image pyramid
+    :param warp_matrix initial estimate (at full resolution). If None, it's computed by features matching
+        at the coarsest level (falling back to ECC)
+    :return homography (at full resolution) or None
+    """
+    align_image_gray = match_size(align_image_gray, image_gray)
+    max_dim = max(image_gray.shape[:2])
+
+    # Scales of the pyramid levels, coarsest first
+    top = min(1.0, refine_size / max_dim)
+    scales = [min(1.0, coarse_size / max_dim)]
+    while scales[-1] < top:
+        scales.append(min(top, scales[-1] * 2))
+
+    def level(f):
+        if f == 1.0:
+            return image_gray, align_image_gray
+        return (cv2.resize(image_gray, None, fx=f, fy=f, interpolation=cv2.INTER_AREA),
+                cv2.resize(align_image_gray, None, fx=f, fy=f, interpolation=cv2.INTER_AREA))
+
+    h = None
+    if warp_matrix is None:
+        ig, aig = level(scales[0])
+        h = find_features_homography(ig, aig)
+        if h is None:
+            h = find_ecc_homography(ig, aig)
+        if h is None:
+            return None
+        h = scale_homography(h, scales[0])
+    else:
+        h = np.asarray(warp_matrix, dtype=np.float64)
+
+    criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, number_of_iterations, termination_eps)
+    for f in scales[1:] if warp_matrix is None else scales:
+        ig, aig = level(f)
+        try:
+            _, hs = cv2.findTransformECC(fast_gradient(ig), fast_gradient(aig),
+                                         scale_homography(h, 1.0 / f).astype(np.float32),
+                                         cv2.MOTION_HOMOGRAPHY, criteria, inputMask=None, gaussFiltSize=5)
+            h = scale_homography(hs, f)
+        except cv2.error as e:
+            log.ODM_INFO("Could not refine homography at scale %.2f: %s" % (f, str(e)))
+
+    return h
+
+def alignment_residual(image_gray, align_image_gray, warp_matrix, size=RESIDUAL_SIZE):
+    """
+    How badly an image is aligned to another by a homography,
+    measured on gradients at low resolution (so that bands can be compared)
+    :return 1 - normalized cross correlation (0 = perfectly aligned)
+    """
+    align_image_gray = match_size(align_image_gray, image_gray)
+    f = min(1.0, size / max(image_gray.shape[:2]))
+    ig = fast_gradient(cv2.resize(image_gray, None, fx=f, fy=f, interpolation=cv2.INTER_AREA))
+    aig = fast_gradient(cv2.resize(align_image_gray, None, fx=f, fy=f, interpolation=cv2.INTER_AREA))
+
+    h = scale_homography(warp_matrix, 1.0 / f)
+    dimension = (aig.shape[1], aig.shape[0])
+    warped = cv2.warpPerspective(ig, h, dimension)
+    mask = cv2.warpPerspective(np.ones(ig.shape, dtype=np.uint8), h, dimension, flags=cv2.INTER_NEAREST) > 0
+
+    a = warped[mask]
+    b = aig[mask]
+    if a.size < 16:
+        return 1.0
+    a = a - a.mean()
+    b = b - b.mean()
+    denom = math.sqrt(float((a * a).sum()) * float((b * b).sum()))
+    if denom == 0:
+        return 1.0
+    return 1.0 - float((a * b).sum()) / denom
+
 def find_ecc_homography(image_gray, align_image_gray, number_of_iterations=1000, termination_eps=1e-8, start_eps=1e-4):
     pyramid_levels = 0
     h,w = image_gray.shape
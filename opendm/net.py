@@ -1,164 +1,359 @@
 import requests
-import math
+import hashlib
+import json
 import os
 import time
-try:
-    import queue
-except ImportError:
-    import Queue as queue
 import threading
-from pyodm.utils import AtomicCounter
 from pyodm.exceptions import RangeNotAvailableError, OdmError
 from urllib3.exceptions import ReadTimeoutError
 
-def download(url, destination, progress_callback=None, parallel_downloads=16, parallel_chunks_size=10, timeout=30):
+# Parts are sized so that each takes about this many seconds to download
+TARGET_PART_SECONDS = 5.0
+MIN_PART_SIZE = 256 * 1024
+MAX_PART_SIZE = 256 * 1024 * 1024
+
+READ_SIZE = 64 * 1024
+
+# How often (seconds) the state of a download is saved
+SAVE_INTERVAL = 1.0
+
+def sha256sum(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+def add_range(ranges, start, end):
+    """
+    Add [start, end) to a sorted list of non overlapping [start, end) ranges, merging them
+    """
+    result = []
+    for s, e in ranges:
+        if e < start or s > end:
+            result.append([s, e])
+        else:
+            start = min(start, s)
+            end = max(end, e)
+    result.append([start, end])
+    result.sort()
+    return result
+
+def missing_ranges(ranges, total):
+    """
+    :return list of [start, end) ranges between 0 and total not covered by ranges
+    """
+    result = []
+    pos = 0
+    for s, e in ranges:
+        if s > pos:
+            result.append([pos, s])
+        pos = max(pos, e)
+    if pos < total:
+        result.append([pos, total])
+    return result
+
+def write_at(fd, data, offset, lock):
+    if hasattr(os, 'pwrite'):
+        while data:
+            written = os.pwrite(fd, data, offset)
+            data = data[written:]
+            offset += written
+    else:
+        with lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            while data:
+                data = data[os.write(fd, data):]
+
+class DownloadState:
+    """
+    Ranges of a file that have been downloaded so far, saved
+    next to the file so that an interrupted download can be resumed
+    """
+    def __init__(self, path, url, total, validator):
+        self.path = path
+        self.url = url
+        self.total = total
+        self.validator = validator
+        self.ranges = []
+        self.last_save = 0
+
+    def load(self):
+        """
+        :return True if the state of a previous download of the same file was loaded
+        """
+        if not os.path.isfile(self.path):
+            return False
+        try:
+            with open(self.path, 'r') as f:
+                data = json.loads(f.read())
+            if data.get('url') == self.url and data.get('total') == self.total and data.get('validator') == self.validator:
+                self.ranges = [list(r) for r in data['ranges']]
+                return True
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        return False
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as f:
+            f.write(json.dumps({
+                'url': self.url,
+                'total': self.total,
+                'validator': self.validator,
+                'ranges': self.ranges
+            }))
+        os.replace(tmp, self.path)
+        self.last_save = time.time()
+
+    def downloaded(self):
+        return sum(e - s for s, e in self.ranges)
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+class PartScheduler:
+    """
+    Hands out the parts of a file that still need to be downloaded. Part sizes
+    adapt to the observed throughput so that each part takes about TARGET_PART_SECONDS
+    """
+    def __init__(self, missing, part_size, min_part_size=MIN_PART_SIZE, max_part_size=MAX_PART_SIZE):
+        self.missing = [list(r) for r in missing]
+        self.part_size = part_size
+        self.min_part_size = min_part_size
+        self.max_part_size = max_part_size
+        self.throughput = None # bytes/s of a single connection
+
+    def observe(self, num_bytes, seconds):
+        if num_bytes <= 0 or seconds <= 0:
+            return
+        t = num_bytes / seconds
+        self.throughput = t if self.throughput is None else 0.7 * self.throughput + 0.3 * t
+        self.part_size = int(max(self.min_part_size, min(self.max_part_size, self.throughput * TARGET_PART_SECONDS)))
+
+    def next(self):
+        """
+        :return [start, end) of the next part to download, or None
+        """
+        if not self.missing:
+            return None
+        start, end = self.missing[0]
+        end = min(end, start + self.part_size)
+        if end >= self.missing[0][1]:
+            self.missing.pop(0)
+        else:
+            self.missing[0][0] = end
+        return [start, end]
+
+    def give_back(self, start, end):
+        if start < end:
+            self.missing = add_range(self.missing, start, end)
+
+def download(url, destination, progress_callback=None, parallel_downloads=16, parallel_chunks_size=10, timeout=30, sha256=None, resume=True, max_retries=5):
     """Download files in parallel (download accelerator)
 
+    Parts are written directly into the output file. If the server supports
+    HTTP ranges, the download can be resumed after an interruption
+    (its state is kept in <file>.download.json until it completes).
+
     Args:
         url (str): URL to download
         destination (str): directory where to download file. If the directory does not exist, it will be created.
         progress_callback (function): an optional callback with one parameter, the download progress percentage.
         parallel_downloads (int): maximum number of parallel downloads if the node supports http range.
-        parallel_chunks_size (int): size in MB of chunks for parallel downloads
+        parallel_chunks_size (int): size in MB of the first parts for parallel downloads (then adapted to the throughput)
         timeout (int): seconds before timing out
+        sha256 (str): expected SHA-256 of the file. If set, the file is verified once downloaded
+        resume (bool): resume a previous interrupted download of the same file
+        max_retries (int): number of times a part that keeps failing without making progress is retried
     Returns:
         str: path to file
     """
     if not os.path.exists(destination):
         os.makedirs(destination, exist_ok=True)
 
-    try:
+    output_path = os.path.join(destination, os.path.basename(url))
+    partial_path = output_path + ".partial"
+    state_path = output_path + ".download.json"
+
+    if sha256 is not None and os.path.isfile(output_path) and sha256sum(output_path) == sha256.lower():
+        return output_path
 
-        download_stream = requests.get(url, timeout=timeout, stream=True)
+    try:
+        download_stream = _get(url, timeout)
         headers = download_stream.headers
-        
-        output_path = os.path.join(destination, os.path.basename(url))
 
-        # Keep track of download progress (if possible)
-        content_length = download_stream.headers.get('content-length')
+        content_length = headers.get('content-length')
         total_length = int(content_length) if content_length is not None else None
-        downloaded = 0
-        chunk_size = int(parallel_chunks_size * 1024 * 1024)
-        use_fallback = False
         accept_ranges = headers.get('accept-ranges')
+        validator = headers.get('etag') or headers.get('last-modified')
+
+        if accept_ranges is not None and accept_ranges.lower() == 'bytes' and total_length is not None and total_length > 0:
+            download_stream.close()
+            state = DownloadState(state_path, url, total_length, validator)
+            resumed = resume and os.path.isfile(partial_path) and os.path.getsize(partial_path) == total_length and state.load()
+            if not resumed:
+                state.remove()
+                with open(partial_path, 'wb') as f:
+                    f.truncate(total_length)
+                state.save()
+
+            try:
+                _download_parts(url, partial_path, state, progress_callback, parallel_downloads,
+                                int(parallel_chunks_size * 1024 * 1024), timeout, max_retries)
+            except RangeNotAvailableError:
+                # The server sends Accept-Ranges, but doesn't honor range requests
+                state.remove()
+                state = None
+                _download_single(_get(url, timeout), partial_path, total_length, progress_callback)
+        else:
+            _download_single(download_stream, partial_path, total_length, progress_callback)
+            state = None
+
+    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, ReadTimeoutError) as e:
+        raise OdmError(e)
+
+    if sha256 is not None:
+        checksum = sha256sum(partial_path)
+        if checksum != sha256.lower():
+            os.remove(partial_path)
+            if state is not None:
+                state.remove()
+            raise OdmError("Checksum mismatch for %s (expected %s, got %s)" % (url, sha256, checksum))
+
+    os.replace(partial_path, output_path)
+    if state is not None:
+        state.remove()
+
+    return output_path
+
+def _get(url, timeout):
+    res = requests.get(url, timeout=timeout, stream=True)
+    if res.status_code != 200:
+        raise OdmError("Cannot download %s: status code %s" % (url, res.status_code))
+    return res
+
+def _download_single(download_stream, path, total_length, progress_callback):
+    # Single connection, boring download
+    downloaded = 0
+    with open(path, 'wb') as fd:
+        for chunk in download_stream.iter_content(READ_SIZE):
+            downloaded += len(chunk)
+
+            if progress_callback is not None and total_length is not None:
+                progress_callback((100.0 * float(downloaded) / total_length))
 
-        # Can we do parallel downloads?
-        if accept_ranges is not None and accept_ranges.lower() == 'bytes' and total_length is not None and total_length > chunk_size and parallel_downloads > 1:
-            num_chunks = int(math.ceil(total_length / float(chunk_size)))
-            num_workers = parallel_downloads
-
-            class nonloc:
-                completed_chunks = AtomicCounter(0)
-                merge_chunks = [False] * num_chunks
-                error = None
-
-            def merge():
-                current_chunk = 0
-
-                with open(output_path, "wb") as out_file:
-                    while current_chunk < num_chunks and nonloc.error is None:
-                        if nonloc.merge_chunks[current_chunk]:
-                            chunk_file = "%s.part%s" % (output_path, current_chunk)
-                            with open(chunk_file, "rb") as fd:
-                                out_file.write(fd.read())
-
-                            os.unlink(chunk_file)
-                            
-                            current_chunk += 1
-                        else:
-                            time.sleep(0.1)
-
-            def worker():
-                while True:
-                    task = q.get()
-                    part_num, bytes_range = task
-                    if bytes_range is None or nonloc.error is not None:
-                        q.task_done()
+            fd.write(chunk)
+
+def _download_parts(url, path, state, progress_callback, parallel_downloads, part_size, timeout, max_retries):
+    total = state.total
+    missing = missing_ranges(state.ranges, total)
+    if not missing:
+        return
+
+    # Don't use more connections than parts
+    part_size = max(MIN_PART_SIZE, min(part_size, -(-total // max(1, parallel_downloads))))
+    scheduler = PartScheduler(missing, part_size)
+    remaining = sum(e - s for s, e in missing)
+    num_workers = max(1, min(parallel_downloads, -(-remaining // part_size)))
+
+    cond = threading.Condition()
+    write_lock = threading.Lock()
+
+    class nonloc:
+        error = None
+        running = num_workers
+
+    def report():
+        # Called with the lock held
+        if time.time() - state.last_save >= SAVE_INTERVAL:
+            state.save()
+        if progress_callback is not None:
+            progress_callback(100.0 * state.downloaded() / total)
+
+    def worker(fd):
+        failures = 0
+        while True:
+            with cond:
+                if nonloc.error is not None:
+                    break
+                part = scheduler.next()
+            if part is None:
+                break
+
+            start, end = part
+            pos = start
+            started = time.time()
+            last_error = None
+            try:
+                res = requests.get(url, stream=True, timeout=timeout, headers={'Range': 'bytes=%s-%s' % (start, end - 1)})
+                if res.status_code != 206:
+                    # Ranges are not available after all, stop and let the caller fall back
+                    res.close()
+                    with cond:
+                        nonloc.error = RangeNotAvailableError()
+                    break
+                for chunk in res.iter_content(READ_SIZE):
+                    chunk = chunk[:end - pos]
+                    if not chunk:
                         break
+                    write_at(fd, chunk, pos, write_lock)
+                    with cond:
+                        state.ranges = add_range(state.ranges, pos, pos + len(chunk))
+                        report()
+                    pos += len(chunk)
+            except (requests.exceptions.RequestException, ReadTimeoutError, OdmError) as e:
+                # Disconnects, timeouts, truncated responses
+                last_error = e
+            except Exception as e:
+                with cond:
+                    nonloc.error = e
+                break
 
-                    try:
-                        # Download chunk
-                        res = requests.get(url, stream=True, timeout=timeout, headers={'Range': 'bytes=%s-%s' % bytes_range})
-                        if res.status_code == 206:
-                            with open("%s.part%s" % (output_path, part_num), 'wb') as fd:
-                                bytes_written = 0
-                                try:
-                                    for chunk in res.iter_content(4096):
-                                        bytes_written += fd.write(chunk)
-                                except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
-                                    raise OdmError(str(e))
-                                
-                                if bytes_written != (bytes_range[1] - bytes_range[0] + 1):
-                                    # Process again
-                                    q.put((part_num, bytes_range))
-                                    return
-
-                            with nonloc.completed_chunks.lock:
-                                nonloc.completed_chunks.value += 1
-
-                                if progress_callback is not None:
-                                    progress_callback(100.0 * nonloc.completed_chunks.value / num_chunks)
-                        
-                            nonloc.merge_chunks[part_num] = True
-                        else:
-                            nonloc.error = RangeNotAvailableError()
-                    except OdmError as e:
-                        time.sleep(5)
-                        q.put((part_num, bytes_range))
-                    except Exception as e:
-                        nonloc.error = e
-                    finally:
-                        q.task_done()
-
-            q = queue.PriorityQueue()
-            threads = []
-            for i in range(num_workers):
-                t = threading.Thread(target=worker)
-                t.start()
-                threads.append(t)
-
-            merge_thread = threading.Thread(target=merge)
-            merge_thread.start()
-
-            range_start = 0
-
-            for i in range(num_chunks):
-                range_end = min(range_start + chunk_size - 1, total_length - 1)
-                q.put((i, (range_start, range_end)))
-                range_start = range_end + 1
-
-            # block until all tasks are done
-            while not all(nonloc.merge_chunks) and nonloc.error is None:
-                time.sleep(0.1)
-
-            # stop workers
-            for i in range(len(threads)):
-                q.put((-1, None))
-            for t in threads:
-                t.join()
-            
-            merge_thread.join()
-
-            if nonloc.error is not None:
-                if isinstance(nonloc.error, RangeNotAvailableError):
-                    use_fallback = True
+            with cond:
+                scheduler.observe(pos - start, time.time() - started)
+                if pos < end:
+                    # Disconnected, or the server sent less than asked
+                    scheduler.give_back(pos, end)
+                    failures = 0 if pos > start else failures + 1
+                    if failures > max_retries:
+                        nonloc.error = OdmError("Cannot download %s: %s" % (url, str(last_error) if last_error is not None else "incomplete response"))
+                        break
                 else:
-                    raise nonloc.error
-        else:
-            use_fallback = True
+                    failures = 0
+            if pos < end and failures > 0:
+                time.sleep(min(5, 0.5 * failures))
+
+        with cond:
+            nonloc.running -= 1
+            cond.notify_all()
 
-        if use_fallback:
-            # Single connection, boring download
-            with open(output_path, 'wb') as fd:
-                for chunk in download_stream.iter_content(4096):
-                    downloaded += len(chunk)
+    fd = os.open(path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        threads = []
+        for i in range(num_workers):
+            t = threading.Thread(target=worker, args=(fd, ))
+            t.daemon = True
+            t.start()
+            threads.append(t)
 
-                    if progress_callback is not None and total_length is not None:
-                        progress_callback((100.0 * float(downloaded) / total_length))
+        with cond:
+            while nonloc.running > 0:
+                cond.wait()
 
-                    fd.write(chunk)
-                
-    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, ReadTimeoutError) as e:
-        raise OdmError(e)
+        for t in threads:
+            t.join()
+    finally:
+        os.close(fd)
+        with cond:
+            state.save()
+
+    if nonloc.error is not None:
+        raise nonloc.error
 
-    return output_path
\ No newline at end of file
+    if missing_ranges(state.ranges, total):
+        raise OdmError("Cannot download %s: incomplete file" % url)
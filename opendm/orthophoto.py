@@ -1,6 +1,7 @@
 import os
 from opendm import log
 from opendm import system
+from opendm import dag
 from opendm.cropper import Cropper
 from opendm.concurrency import get_max_memory
 import math
@@ -24,7 +25,7 @@ def get_orthophoto_vars(args):
         'BIGTIFF': 'IF_SAFER',
         'BLOCKXSIZE': 512,
         'BLOCKYSIZE': 512,
-        'NUM_THREADS': args.max_concurrency
+        'NUM_THREADS': dag.task_cpus(args.max_concurrency)
     }
 
 def build_overviews(orthophoto_file):
@@ -99,10 +100,10 @@ def post_orthophoto_steps(args, bounds_file_path, orthophoto_file, orthophoto_ti
         generate_kmz(orthophoto_file)
 
     if args.tiles:
-        generate_orthophoto_tiles(orthophoto_file, orthophoto_tiles_dir, args.max_concurrency, resolution)
+        generate_orthophoto_tiles(orthophoto_file, orthophoto_tiles_dir, dag.task_cpus(args.max_concurrency), resolution)
 
     if args.cog:
-        convert_to_cogeo(orthophoto_file, max_workers=args.max_concurrency, compression=args.orthophoto_compression)
+        convert_to_cogeo(orthophoto_file, max_workers=dag.task_cpus(args.max_concurrency), compression=args.orthophoto_compression)
 
 def compute_mask_raster(input_raster, vector_mask, output_raster, blend_distance=20, only_max_coords_feature=False):
     if not os.path.exists(input_raster):
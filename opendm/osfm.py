@@ -13,6 +13,7 @@ from opendm import system
 from opendm import context
 from opendm import camera
 from opendm import location
+from opendm import exifarchive
 from opendm.photo import find_largest_photo_dims, find_largest_photo
 from opensfm.large import metadataset
 from opensfm.large import tools
@@ -25,14 +26,27 @@ from opendm.gpu import has_popsift_and_can_handle_texsize, has_gpu
 from opensfm import multiview, exif
 from opensfm.actions.export_geocoords import _transform
 
+# Read image metadata from consolidated archives when present (see photos_to_metadata)
+exifarchive.install(DataSet)
+
 class OSFMContext:
     def __init__(self, opensfm_project_path):
         self.opensfm_project_path = opensfm_project_path
     
     def run(self, command):
-        osfm_bin = os.path.join(context.opensfm_path, 'bin', 'opensfm')
-        system.run('"%s" %s "%s"' %
-                    (osfm_bin, command, self.opensfm_project_path))
+        if self.has_metadata_archive():
+            # Run OpenSfM with the metadata archive adapter installed
+            osfm_main = os.path.join(context.opensfm_path, 'bin', 'opensfm_main.py')
+            system.run('"%s" -m opendm.exifarchive "%s" %s "%s"' %
+                        (sys.executable, osfm_main, command, self.opensfm_project_path),
+                        packages_paths=context.python_packages_paths + [context.root_path])
+        else:
+            osfm_bin = os.path.join(context.opensfm_path, 'bin', 'opensfm')
+            system.run('"%s" %s "%s"' %
+                        (osfm_bin, command, self.opensfm_project_path))
+
+    def has_metadata_archive(self):
+        return io.file_exists(exifarchive.archive_path(self.path("exif")))
 
     def is_reconstruction_done(self):
         tracks_file = os.path.join(self.opensfm_project_path, 'tracks.csv')
@@ -368,7 +382,11 @@ class OSFMContext:
         if not io.dir_exists(metadata_dir) or rerun:
             self.run('extract_metadata')
     
-    def photos_to_metadata(self, photos, rolling_shutter, rolling_shutter_readout, rerun=False):
+    def photos_to_metadata(self, photos, rolling_shutter, rolling_shutter_readout, rerun=False, archive=False):
+        """
+        Write the metadata of photos to the OpenSfM dataset, along with the camera models
+        :param archive write a single metadata archive (see opendm.exifarchive) instead of one .exif file per photo
+        """
         metadata_dir = self.path("exif")
 
         if io.dir_exists(metadata_dir) and not rerun:
@@ -382,17 +400,25 @@ class OSFMContext:
         
         camera_models = {}
         data = DataSet(self.opensfm_project_path)
+        metadata = []
 
         for p in photos:
             d = p.to_opensfm_exif(rolling_shutter, rolling_shutter_readout)
-            with open(os.path.join(metadata_dir, "%s.exif" % p.filename), 'w') as f:
-                f.write(json.dumps(d, indent=4))
+            if archive:
+                metadata.append((p.filename, d))
+            else:
+                with open(os.path.join(metadata_dir, "%s.exif" % p.filename), 'w') as f:
+                    f.write(json.dumps(d, indent=4))
 
             camera_id = p.camera_id()
             if camera_id not in camera_models:
                 camera = exif.camera_from_exif_metadata(d, data)
                 camera_models[camera_id] = camera
 
+        if archive:
+            count = exifarchive.write_archive(exifarchive.archive_path(metadata_dir), metadata)
+            log.ODM_INFO("Wrote metadata of %s photos to %s" % (count, exifarchive.archive_path(metadata_dir)))
+
         # Override any camera specified in the camera models overrides file.
         if data.camera_models_overrides_exists():
             overrides = data.load_camera_models_overrides()
@@ -87,9 +87,69 @@ class GPSRefMock:
         self.values = [ref]
 
 
+# Attributes that (virtually) every photo has a value for.
+# These are stored in __slots__
+CORE_ATTRIBUTES = (
+    'filename', 'mask',
+    'width', 'height', 'camera_make', 'camera_model', 'orientation',
+    'latitude', 'longitude', 'altitude',
+    'band_name', 'band_index', 'capture_uuid',
+    'utc_time',
+    'yaw', 'pitch', 'roll', 'omega', 'phi', 'kappa',
+    'exif_width', 'exif_height',
+    'gps_xy_stddev', 'gps_z_stddev',
+    'camera_projection', 'focal_ratio',
+)
+
+# Attributes that are only set for some cameras (mostly from XMP tags)
+# and only used for radiometric calibration. They default to None at
+# the class level and take space only when a photo has a value for them
+RADIOMETRIC_ATTRIBUTES = (
+    'fnumber', 'radiometric_calibration', 'black_level', 'gain', 'gain_adjustment',
+    'exposure_time', 'iso_speed', 'bits_per_sample',
+    'vignetting_center', 'vignetting_polynomial',
+    'spectral_irradiance', 'horizontal_irradiance', 'irradiance_scale_to_si',
+    'sun_sensor', 'dls_yaw', 'dls_pitch', 'dls_roll',
+)
+
+EXTENDED_ATTRIBUTES = RADIOMETRIC_ATTRIBUTES + (
+    'speed_x', 'speed_y', 'speed_z',
+)
+
 class ODM_Photo:
     """ODMPhoto - a class for ODMPhotos"""
 
+    # Other attributes are kept in __dict__
+    __slots__ = CORE_ATTRIBUTES + ('__dict__', '__weakref__')
+
+    # Multi-spectral fields
+    fnumber = None
+    radiometric_calibration = None
+    black_level = None
+    gain = None
+    gain_adjustment = None
+
+    # Capture info
+    exposure_time = None
+    iso_speed = None
+    bits_per_sample = None
+    vignetting_center = None
+    vignetting_polynomial = None
+    spectral_irradiance = None
+    horizontal_irradiance = None
+    irradiance_scale_to_si = None
+
+    # DLS
+    sun_sensor = None
+    dls_yaw = None
+    dls_pitch = None
+    dls_roll = None
+
+    # Aircraft speed
+    speed_x = None
+    speed_y = None
+    speed_z = None
+
     def __init__(self, path_file):
         self.filename = os.path.basename(path_file)
         self.mask = None
@@ -111,22 +171,7 @@ class ODM_Photo:
         self.band_index = 0
         self.capture_uuid = None
 
-        # Multi-spectral fields
-        self.fnumber = None
-        self.radiometric_calibration = None
-        self.black_level = None
-        self.gain = None
-        self.gain_adjustment = None
-
         # Capture info
-        self.exposure_time = None
-        self.iso_speed = None
-        self.bits_per_sample = None
-        self.vignetting_center = None
-        self.vignetting_polynomial = None
-        self.spectral_irradiance = None
-        self.horizontal_irradiance = None
-        self.irradiance_scale_to_si = None
         self.utc_time = None
 
         # OPK angles
@@ -137,17 +182,6 @@ class ODM_Photo:
         self.phi = None
         self.kappa = None
 
-        # DLS
-        self.sun_sensor = None
-        self.dls_yaw = None
-        self.dls_pitch = None
-        self.dls_roll = None
-
-        # Aircraft speed
-        self.speed_x = None
-        self.speed_y = None
-        self.speed_z = None
-
         # Original image width/height at capture time (before possible resizes)
         self.exif_width = None
         self.exif_height = None
@@ -166,6 +200,45 @@ class ODM_Photo:
         # parse values from metadata
         self.parse_exif_values(path_file)
 
+    @classmethod
+    def from_dict(cls, d):
+        """Create a photo from previously parsed attributes, without reading the image"""
+        p = cls.__new__(cls)
+        for k, v in d.items():
+            if v is None and k in EXTENDED_ATTRIBUTES:
+                continue
+            setattr(p, k, v)
+        return p
+
+    def to_dict(self):
+        """Attributes of the photo, as a dictionary that can be passed to from_dict"""
+        d = {}
+        for k in CORE_ATTRIBUTES:
+            try:
+                d[k] = getattr(self, k)
+            except AttributeError:
+                pass
+        for k in EXTENDED_ATTRIBUTES:
+            d[k] = getattr(self, k)
+        for k, v in self.__dict__.items():
+            if k not in d:
+                d[k] = v
+        return d
+
+    def compact(self, drop=()):
+        """
+        Release the memory used by extended attributes that hold their
+        default value, as well as the attributes listed in drop
+        (which revert to their default value)
+        """
+        for k in list(self.__dict__.keys()):
+            if k in EXTENDED_ATTRIBUTES and (k in drop or self.__dict__[k] is None):
+                del self.__dict__[k]
+
+        if not self.__dict__:
+            # Releases the dictionary's storage
+            self.__dict__.clear()
+
     def __str__(self):
         return '{} | camera: {} {} | dimensions: {} x {} | lat: {} | lon: {} | alt: {} | band: {} ({})'.format(
                             self.filename, self.camera_make, self.camera_model, self.width, self.height, 
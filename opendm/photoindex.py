@@ -0,0 +1,75 @@
+from bisect import bisect_left, bisect_right
+
+
+class PhotoIndex(object):
+    """
+    Read-only lookup structures over a list of photos.
+    Each index is built on first use, so callers only pay
+    for the queries they actually run. The index must be
+    discarded (see ODM_Reconstruction.photos) whenever the
+    underlying list changes.
+    """
+    def __init__(self, photos):
+        self.photos = photos
+        self._by_filename = None
+        self._by_band = None
+        self._by_capture_id = None
+        self._gps_lon = None
+        self._gps_photos = None
+
+    def __len__(self):
+        return len(self.photos)
+
+    def get(self, filename):
+        if self._by_filename is None:
+            by_filename = {}
+            for p in self.photos:
+                # Keep the first match, like a linear scan would
+                by_filename.setdefault(p.filename, p)
+            self._by_filename = by_filename
+
+        return self._by_filename.get(filename)
+
+    def by_band(self, band_name):
+        if self._by_band is None:
+            by_band = {}
+            for p in self.photos:
+                by_band.setdefault(p.band_name, []).append(p)
+            self._by_band = by_band
+
+        return list(self._by_band.get(band_name, []))
+
+    def band_names(self):
+        if self._by_band is None:
+            self.by_band(None)
+        return list(self._by_band)
+
+    def by_capture_id(self, capture_id):
+        if self._by_capture_id is None:
+            by_capture_id = {}
+            for p in self.photos:
+                cid = p.get_capture_id()
+                if cid is not None:
+                    by_capture_id.setdefault(cid, []).append(p)
+            self._by_capture_id = by_capture_id
+
+        return list(self._by_capture_id.get(capture_id, []))
+
+    def in_bbox(self, min_lat, min_lon, max_lat, max_lon):
+        """
+        :param min_lat minimum latitude (inclusive)
+        :param min_lon minimum longitude (inclusive)
+        :param max_lat maximum latitude (inclusive)
+        :param max_lon maximum longitude (inclusive)
+        :return photos with GPS coordinates inside the bounding box, in longitude order
+        """
+        if self._gps_lon is None:
+            geotagged = [p for p in self.photos if p.latitude is not None and p.longitude is not None]
+            geotagged.sort(key=lambda p: p.longitude)
+            self._gps_lon = [p.longitude for p in geotagged]
+            self._gps_photos = geotagged
+
+        start = bisect_left(self._gps_lon, min_lon)
+        end = bisect_right(self._gps_lon, max_lon)
+
+        return [p for p in self._gps_photos[start:end] if min_lat <= p.latitude <= max_lat]
@@ -0,0 +1,273 @@
+import math
+import os
+from vmem import virtual_memory
+from opendm import log
+
+# cgroup v1 reports "no limit" as a very large, page aligned number
+CGROUP_V1_UNLIMITED = 2 ** 60
+
+class CGroup(object):
+    """
+    Reads the memory and CPU limits that apply to the current process
+    from cgroup v1 or v2 (e.g. when running inside docker or kubernetes)
+    """
+    def __init__(self, root="/sys/fs/cgroup", proc_cgroup="/proc/self/cgroup"):
+        self.root = root
+        self.paths = {}
+        self.version = None
+
+        try:
+            with open(proc_cgroup, "r") as f:
+                lines = f.read().strip().split("\n")
+        except (IOError, OSError):
+            return
+
+        for line in lines:
+            parts = line.split(":", 2)
+            if len(parts) != 3:
+                continue
+            hid, controllers, path = parts
+            if hid == "0" and controllers == "":
+                self.paths[""] = path
+            else:
+                for c in controllers.split(","):
+                    self.paths[c] = path
+
+        if os.path.isfile(os.path.join(root, "cgroup.controllers")):
+            self.version = 2
+        elif os.path.isdir(os.path.join(root, "memory")) or os.path.isdir(os.path.join(root, "cpu")):
+            self.version = 1
+
+    def _candidates(self, controller):
+        """
+        :return directories to look into for a controller, from the
+            process' own cgroup up to the root (limits of parent groups apply too)
+        """
+        if self.version == 2:
+            base = self.root
+            path = self.paths.get("", "/")
+        else:
+            base = None
+            for name in [controller, "cpu,cpuacct", "cpuacct,cpu"] if controller == "cpu" else [controller]:
+                if os.path.isdir(os.path.join(self.root, name)):
+                    base = os.path.join(self.root, name)
+                    break
+            if base is None:
+                return []
+            path = self.paths.get(controller, "/")
+
+        dirs = []
+        parts = [p for p in path.split("/") if p]
+        while True:
+            d = os.path.join(base, *parts)
+            # Inside a container the cgroup path
+            # usually doesn't exist in the mounted namespace
+            if os.path.isdir(d):
+                dirs.append(d)
+            if not parts:
+                break
+            parts.pop()
+        return dirs
+
+    def _read(self, directory, filename):
+        try:
+            with open(os.path.join(directory, filename), "r") as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return None
+
+    def _stat(self, directory, filename, key):
+        content = self._read(directory, filename)
+        if content is not None:
+            for line in content.split("\n"):
+                k, _, v = line.partition(" ")
+                if k == key:
+                    return int(v)
+        return None
+
+    def memory_limit(self):
+        """
+        :return memory limit in bytes, or None if there's no limit
+        """
+        limit = None
+        for d in self._candidates("memory"):
+            if self.version == 2:
+                value = self._read(d, "memory.max")
+                if value is None or value == "max":
+                    continue
+            else:
+                value = self._read(d, "memory.limit_in_bytes")
+                if value is None or int(value) >= CGROUP_V1_UNLIMITED:
+                    continue
+
+            value = int(value)
+            limit = value if limit is None else min(limit, value)
+        return limit
+
+    def memory_usage(self):
+        """
+        :return memory in use in bytes (excluding page cache that can be reclaimed), or None
+        """
+        candidates = self._candidates("memory")
+        if not candidates:
+            return None
+
+        d = candidates[0]
+        if self.version == 2:
+            usage = self._read(d, "memory.current")
+            inactive_file = self._stat(d, "memory.stat", "inactive_file")
+        else:
+            usage = self._read(d, "memory.usage_in_bytes")
+            inactive_file = self._stat(d, "memory.stat", "total_inactive_file")
+
+        if usage is None:
+            return None
+        return max(0, int(usage) - (inactive_file or 0))
+
+    def cpu_limit(self):
+        """
+        :return number of CPUs allowed by the CPU quota (can be fractional), or None if there's no quota
+        """
+        limit = None
+        for d in self._candidates("cpu"):
+            if self.version == 2:
+                value = self._read(d, "cpu.max")
+                if value is None:
+                    continue
+                quota, _, period = value.partition(" ")
+                if quota == "max":
+                    continue
+            else:
+                quota = self._read(d, "cpu.cfs_quota_us")
+                period = self._read(d, "cpu.cfs_period_us")
+                if quota is None or period is None or int(quota) <= 0:
+                    continue
+
+            cpus = float(quota) / float(period or 100000)
+            limit = cpus if limit is None else min(limit, cpus)
+        return limit
+
+_cgroup = None
+
+def get_cgroup():
+    global _cgroup
+    if _cgroup is None:
+        _cgroup = CGroup()
+    return _cgroup
+
+def get_memory_info(cgroup=None):
+    """
+    :return (total, available) memory in bytes, taking into account cgroup limits
+    """
+    cgroup = cgroup or get_cgroup()
+    vm = virtual_memory()
+    total = vm.total
+    available = vm.available
+
+    limit = cgroup.memory_limit()
+    if limit is not None and limit < total:
+        total = limit
+        usage = cgroup.memory_usage()
+        if usage is not None:
+            available = min(available, max(0, limit - usage))
+        else:
+            available = min(available, limit)
+
+    return total, available
+
+def get_available_cpus(cgroup=None):
+    """
+    :return number of CPUs this process can use, taking into account affinity and cgroup quotas
+    """
+    cgroup = cgroup or get_cgroup()
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+
+    quota = cgroup.cpu_limit()
+    if quota is not None:
+        cpus = min(cpus, max(1, int(math.ceil(quota))))
+
+    return cpus
+
+def image_memory_mb(width, height, bands=3, bytes_per_pixel=1, copies=1, overhead_mb=0):
+    """
+    Memory model for a task that holds an image in memory
+    :param width image width
+    :param height image height
+    :param bands number of bands
+    :param bytes_per_pixel bytes per band value (1 for uint8, 4 for float32, ...)
+    :param copies number of full size buffers the task keeps at the same time
+    :param overhead_mb fixed cost of the task
+    :return estimated memory in megabytes
+    """
+    return float(width * height * bands * bytes_per_pixel * copies) / 1024 / 1024 + overhead_mb
+
+def photo_memory_mb(photo, bands=3, bytes_per_pixel=1, copies=1, overhead_mb=0):
+    """
+    Same as image_memory_mb, using the size of an ODM_Photo
+    (or 12 megapixels if unknown)
+    """
+    width = photo.width or 4000
+    height = photo.height or 3000
+    return image_memory_mb(width, height, bands, bytes_per_pixel, copies, overhead_mb)
+
+class ConcurrencyPlanner(object):
+    """
+    Decides how many tasks a stage should run at the same time,
+    given how much memory each task needs, the available memory and CPUs
+    (cgroup aware) and the user's --max-concurrency.
+    """
+    def __init__(self, max_concurrency=None, use_at_most=0.5, cgroup=None):
+        """
+        :param max_concurrency upper bound (usually args.max_concurrency)
+        :param use_at_most fraction of the available memory that tasks can use
+        :param cgroup CGroup instance (defaults to the one of the current process)
+        """
+        self.max_concurrency = max_concurrency
+        self.use_at_most = use_at_most
+        self.cgroup = cgroup or get_cgroup()
+
+    def memory_budget_mb(self):
+        _, available = get_memory_info(self.cgroup)
+        return available / 1024.0 / 1024.0 * self.use_at_most
+
+    def cpus(self):
+        return get_available_cpus(self.cgroup)
+
+    def plan(self, task_memory_mb, cpus_per_task=1, name=None):
+        """
+        :param task_memory_mb estimated memory needed by a single task
+        :param cpus_per_task number of CPUs used by a single task
+        :param name optional name used for logging
+        :return number of tasks to run in parallel (at least 1)
+        """
+        by_cpu = max(1, self.cpus() // max(1, cpus_per_task))
+        budget = self.memory_budget_mb()
+        by_memory = int(budget // task_memory_mb) if task_memory_mb > 0 else by_cpu
+
+        workers = min(by_cpu, by_memory)
+        if self.max_concurrency is not None:
+            workers = min(workers, self.max_concurrency)
+        workers = max(1, workers)
+
+        if name is not None:
+            log.ODM_INFO("%s: %s parallel tasks (%.0f MB each, %.0f MB available, %s CPUs)" % (name, workers, task_memory_mb, budget, by_cpu * max(1, cpus_per_task)))
+
+        return workers
+
+    def map_args(self, task_memory_mb, cpus_per_task=1, memory_cost=None, name=None):
+        """
+        Arguments for concurrency.parallel_map / parallel_imap. Besides
+        the number of workers, this passes the memory budget and a per-item
+        memory cost, so that tasks that need more memory than estimated
+        wait for others to finish instead of exhausting memory.
+        :param memory_cost function returning the memory needed for an item (defaults to task_memory_mb)
+        :return dict of keyword arguments
+        """
+        return {
+            'max_workers': self.plan(task_memory_mb, cpus_per_task, name),
+            'memory_cost': memory_cost or (lambda item: task_memory_mb),
+            'max_memory_mb': self.memory_budget_mb(),
+        }
@@ -6,6 +6,7 @@ from opendm.system import run
 from opendm import entwine
 from opendm import io
 from opendm.concurrency import parallel_map
+from opendm.dag import DAGScheduler, task_cpus
 from opendm.utils import double_quote
 from opendm.boundary import as_polygon, as_geojson
 from opendm.dem.pdal import run_pipeline
@@ -276,67 +277,89 @@ def merge_ply(input_point_cloud_files, output_file, dims=None):
     system.run(' '.join(cmd))
 
 def post_point_cloud_steps(args, tree, rerun=False):
+    # Classification and rectification modify the point cloud, the other
+    # steps only read it and can run at the same time (--parallel-stages)
+    scheduler = DAGScheduler(parallel=args.parallel_stages, max_cpus=task_cpus(args.max_concurrency))
+
     # Classify and rectify before generating derivate files
     if args.pc_classify:
-        pc_classify_marker = os.path.join(tree.odm_georeferencing, 'pc_classify_done.txt')
-
-        if not io.file_exists(pc_classify_marker) or rerun:
-            log.ODM_INFO("Classifying {} using Simple Morphological Filter (1/2)".format(tree.odm_georeferencing_model_laz))
-            commands.classify(tree.odm_georeferencing_model_laz,
-                                args.smrf_scalar, 
-                                args.smrf_slope, 
-                                args.smrf_threshold, 
-                                args.smrf_window
-                            )
-
-            log.ODM_INFO("Classifying {} using OpenPointClass (2/2)".format(tree.odm_georeferencing_model_laz))
-            classify(tree.odm_georeferencing_model_laz, args.max_concurrency)
-
-            with open(pc_classify_marker, 'w') as f:
-                f.write('Classify: smrf\n')
-                f.write('Scalar: {}\n'.format(args.smrf_scalar))
-                f.write('Slope: {}\n'.format(args.smrf_slope))
-                f.write('Threshold: {}\n'.format(args.smrf_threshold))
-                f.write('Window: {}\n'.format(args.smrf_window))
+        def classify_point_cloud():
+            pc_classify_marker = os.path.join(tree.odm_georeferencing, 'pc_classify_done.txt')
+
+            if not io.file_exists(pc_classify_marker) or rerun:
+                log.ODM_INFO("Classifying {} using Simple Morphological Filter (1/2)".format(tree.odm_georeferencing_model_laz))
+                commands.classify(tree.odm_georeferencing_model_laz,
+                                    args.smrf_scalar, 
+                                    args.smrf_slope, 
+                                    args.smrf_threshold, 
+                                    args.smrf_window
+                                )
+
+                log.ODM_INFO("Classifying {} using OpenPointClass (2/2)".format(tree.odm_georeferencing_model_laz))
+                classify(tree.odm_georeferencing_model_laz, task_cpus(args.max_concurrency))
+
+                with open(pc_classify_marker, 'w') as f:
+                    f.write('Classify: smrf\n')
+                    f.write('Scalar: {}\n'.format(args.smrf_scalar))
+                    f.write('Slope: {}\n'.format(args.smrf_slope))
+                    f.write('Threshold: {}\n'.format(args.smrf_threshold))
+                    f.write('Window: {}\n'.format(args.smrf_window))
+
+        scheduler.add("classify", classify_point_cloud, requires=['point_cloud'], provides=['point_cloud'], cpus=args.max_concurrency)
     
     if args.pc_rectify:
-        commands.rectify(tree.odm_georeferencing_model_laz)
+        scheduler.add("rectify", lambda: commands.rectify(tree.odm_georeferencing_model_laz),
+                      requires=['point_cloud'], provides=['point_cloud'])
 
     # XYZ point cloud output
     if args.pc_csv:
-        log.ODM_INFO("Creating CSV file (XYZ format)")
-        
-        if not io.file_exists(tree.odm_georeferencing_xyz_file) or rerun:
-            system.run("pdal translate -i \"{}\" "
-                "-o \"{}\" "
-                "--writers.text.format=csv "
-                "--writers.text.order=\"X,Y,Z\" "
-                "--writers.text.keep_unspecified=false ".format(
-                    tree.odm_georeferencing_model_laz,
-                    tree.odm_georeferencing_xyz_file))
-        else:
-            log.ODM_WARNING("Found existing CSV file %s" % tree.odm_georeferencing_xyz_file)
+        def export_csv():
+            log.ODM_INFO("Creating CSV file (XYZ format)")
+            
+            if not io.file_exists(tree.odm_georeferencing_xyz_file) or rerun:
+                system.run("pdal translate -i \"{}\" "
+                    "-o \"{}\" "
+                    "--writers.text.format=csv "
+                    "--writers.text.order=\"X,Y,Z\" "
+                    "--writers.text.keep_unspecified=false ".format(
+                        tree.odm_georeferencing_model_laz,
+                        tree.odm_georeferencing_xyz_file))
+            else:
+                log.ODM_WARNING("Found existing CSV file %s" % tree.odm_georeferencing_xyz_file)
+
+        scheduler.add("csv", export_csv, requires=['point_cloud'], provides=['csv'])
 
     # LAS point cloud output
     if args.pc_las:
-        log.ODM_INFO("Creating LAS file")
-        
-        if not io.file_exists(tree.odm_georeferencing_model_las) or rerun:
-            system.run("pdal translate -i \"{}\" "
-                "-o \"{}\" ".format(
-                    tree.odm_georeferencing_model_laz,
-                    tree.odm_georeferencing_model_las))
-        else:
-            log.ODM_WARNING("Found existing LAS file %s" % tree.odm_georeferencing_xyz_file)
+        def export_las():
+            log.ODM_INFO("Creating LAS file")
+            
+            if not io.file_exists(tree.odm_georeferencing_model_las) or rerun:
+                system.run("pdal translate -i \"{}\" "
+                    "-o \"{}\" ".format(
+                        tree.odm_georeferencing_model_laz,
+                        tree.odm_georeferencing_model_las))
+            else:
+                log.ODM_WARNING("Found existing LAS file %s" % tree.odm_georeferencing_xyz_file)
+
+        scheduler.add("las", export_las, requires=['point_cloud'], provides=['las'])
 
     # EPT point cloud output
     if args.pc_ept:
-        log.ODM_INFO("Creating Entwine Point Tile output")
-        entwine.build([tree.odm_georeferencing_model_laz], tree.entwine_pointcloud, max_concurrency=args.max_concurrency, rerun=rerun)
+        def build_ept():
+            log.ODM_INFO("Creating Entwine Point Tile output")
+            entwine.build([tree.odm_georeferencing_model_laz], tree.entwine_pointcloud, max_concurrency=task_cpus(args.max_concurrency), rerun=rerun)
+
+        scheduler.add("ept", build_ept, requires=['point_cloud'], provides=['ept'], cpus=args.max_concurrency)
 
     # COPC point clouds
     if args.pc_copc:
-        log.ODM_INFO("Creating Cloud Optimized Point Cloud (COPC)")
+        def build_copc():
+            log.ODM_INFO("Creating Cloud Optimized Point Cloud (COPC)")
+
+            copc_output = io.related_file_path(tree.odm_georeferencing_model_laz, postfix=".copc")
+            entwine.build_copc([tree.odm_georeferencing_model_laz], copc_output, convert_rgb_8_to_16=True)
+
+        scheduler.add("copc", build_copc, requires=['point_cloud'], provides=['copc'])
 
-        copc_output = io.related_file_path(tree.odm_georeferencing_model_laz, postfix=".copc")
-        entwine.build_copc([tree.odm_georeferencing_model_laz], copc_output, convert_rgb_8_to_16=True)
\ No newline at end of file
+    scheduler.run()
@@ -0,0 +1,423 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from opendm import log
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def read_proc_stat(pid):
+    """
+    :return dict with ppid, cpu (seconds, including waited-for children),
+        rss (bytes) and threads of a process, or None if it cannot be read
+    """
+    try:
+        with open("/proc/%s/stat" % pid, "r") as f:
+            data = f.read()
+    except (IOError, OSError):
+        return None
+
+    # The command name is in parenthesis and can contain spaces
+    fields = data[data.rfind(")") + 2:].split()
+    ticks = float(CLOCK_TICKS)
+    return {
+        'ppid': int(fields[1]),
+        'cpu': (int(fields[11]) + int(fields[12]) + int(fields[13]) + int(fields[14])) / ticks,
+        'threads': int(fields[17]),
+        'rss': int(fields[21]) * PAGE_SIZE,
+    }
+
+def read_proc_io(pid):
+    """
+    :return (read bytes, written bytes) of a process, or None
+    """
+    try:
+        read_bytes = write_bytes = 0
+        with open("/proc/%s/io" % pid, "r") as f:
+            for line in f:
+                k, _, v = line.partition(":")
+                if k == "read_bytes":
+                    read_bytes = int(v)
+                elif k == "write_bytes":
+                    write_bytes = int(v)
+        return read_bytes, write_bytes
+    except (IOError, OSError, ValueError):
+        return None
+
+try:
+    CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+    PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError, OSError):
+    CLOCK_TICKS = 100
+    PAGE_SIZE = 4096
+
+HAS_PROC = os.path.isfile("/proc/self/stat")
+
+class ResourceSampler:
+    """
+    Samples CPU time, RSS, disk I/O and threads of this process
+    and all its descendants (external tools) from /proc
+    """
+    def __init__(self, pid=None):
+        self.pid = pid or os.getpid()
+        # Cumulative I/O of every process we've seen, so that
+        # the totals don't go down when a process exits
+        self.io_seen = {}
+        self.io_exited = [0, 0]
+
+    def descendants(self):
+        children = {}
+        try:
+            pids = [int(p) for p in os.listdir("/proc") if p.isdigit()]
+        except (IOError, OSError):
+            return {}
+
+        stats = {}
+        for pid in pids:
+            if pid == self.pid:
+                continue
+            st = read_proc_stat(pid)
+            if st is not None:
+                stats[pid] = st
+                children.setdefault(st['ppid'], []).append(pid)
+
+        result = {}
+        stack = list(children.get(self.pid, []))
+        while stack:
+            pid = stack.pop()
+            result[pid] = stats[pid]
+            stack.extend(children.get(pid, []))
+        return result
+
+    def sample(self):
+        """
+        :return dict with time, cpu (seconds, cumulative), rss (bytes),
+            read/write (bytes, cumulative) and threads of the process tree
+        """
+        now = time.time()
+        cpu = 0.0
+        if resource is not None:
+            for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]:
+                ru = resource.getrusage(who)
+                cpu += ru.ru_utime + ru.ru_stime
+        else:
+            cpu = time.process_time()
+
+        s = {'time': now, 'cpu': cpu, 'rss': 0, 'read': 0, 'write': 0, 'threads': threading.active_count()}
+        if not HAS_PROC:
+            return s
+
+        me = read_proc_stat(self.pid)
+        if me is not None:
+            s['rss'] = me['rss']
+            s['threads'] = me['threads']
+
+        tree = self.descendants()
+        for pid, st in tree.items():
+            # Waited-for children are already included in RUSAGE_CHILDREN
+            # (direct children) or in their parent's cutime (others)
+            cpu += st['cpu']
+            s['rss'] += st['rss']
+            s['threads'] += st['threads']
+        s['cpu'] = cpu
+
+        alive = set(tree.keys())
+        alive.add(self.pid)
+        for pid in alive:
+            io = read_proc_io(pid)
+            if io is not None:
+                self.io_seen[pid] = io
+        for pid in list(self.io_seen.keys()):
+            if pid not in alive:
+                r, w = self.io_seen.pop(pid)
+                self.io_exited[0] += r
+                self.io_exited[1] += w
+
+        s['read'] = self.io_exited[0] + sum(r for r, w in self.io_seen.values())
+        s['write'] = self.io_exited[1] + sum(w for r, w in self.io_seen.values())
+        return s
+
+class Span:
+    def __init__(self, profiler, name, category, parent, args):
+        self.profiler = profiler
+        self.name = name
+        self.category = category
+        self.parent = parent
+        self.path = (parent.path if parent is not None else ()) + (name,)
+        self.args = args
+        self.tid = threading.get_ident()
+        self.start = None
+        self.end = None
+        self.start_sample = None
+        self.end_sample = None
+        self.peak_rss = 0
+        self.max_threads = 0
+
+    def update(self, **kwargs):
+        """
+        Attach additional information to the span (shown in the trace)
+        """
+        self.args.update(kwargs)
+
+    def observe(self, sample):
+        self.peak_rss = max(self.peak_rss, sample['rss'])
+        self.max_threads = max(self.max_threads, sample['threads'])
+
+    def stats(self):
+        s, e = self.start_sample, self.end_sample
+        return {
+            'wall': self.end - self.start,
+            'cpu': e['cpu'] - s['cpu'],
+            'peak_rss': self.peak_rss,
+            'read': e['read'] - s['read'],
+            'write': e['write'] - s['write'],
+            'threads': self.max_threads,
+        }
+
+class Profiler:
+    """
+    Records nested spans (stage -> sub-step -> external tool) and a timeline
+    of resource usage sampled at a fixed interval. Results are written as a
+    Chrome trace (chrome://tracing or https://ui.perfetto.dev) and a summary table.
+    When not started, spans cost next to nothing.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.output_dir = None
+        self.interval = 1.0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.spans = []
+        self.open_spans = set()
+        self.samples = []
+        self.main_tid = None
+        self.sampler = None
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.start_time = None
+
+    def start(self, output_dir, interval=1.0):
+        if self.enabled:
+            return
+
+        self.output_dir = output_dir
+        self.interval = interval
+        self.sampler = ResourceSampler()
+        self.spans = []
+        self.samples = []
+        self.open_spans = set()
+        self.main_tid = threading.get_ident()
+        self.start_time = time.time()
+        self.stop_event.clear()
+        self.enabled = True
+
+        self.thread = threading.Thread(target=self._sample_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _sample(self):
+        sample = self.sampler.sample()
+        with self.lock:
+            self.samples.append(sample)
+            for span in self.open_spans:
+                span.observe(sample)
+        return sample
+
+    def _sample_loop(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self._sample()
+            except Exception as e:
+                log.ODM_WARNING("Profiler cannot sample resources: %s" % str(e))
+                return
+
+    def _stack(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def current(self):
+        """
+        :return the innermost open span of the current thread. Worker threads
+            inherit the innermost span of the thread that started the profiler
+        """
+        stack = self._stack()
+        if stack:
+            return stack[-1]
+
+        with self.lock:
+            candidates = [s for s in self.open_spans if s.tid == self.main_tid]
+        if candidates:
+            return max(candidates, key=lambda s: len(s.path))
+        return None
+
+    @contextmanager
+    def span(self, name, category="step", **args):
+        """
+        Record a span for the duration of the with block
+        :param name span name (e.g. stage name, sub-step or tool)
+        :param category stage, step or process
+        :param args additional information shown in the trace
+        """
+        if not self.enabled:
+            yield Span(self, name, category, None, args)
+            return
+
+        span = Span(self, name, category, self.current(), args)
+        sample = self._sample()
+        span.start = sample['time']
+        span.start_sample = sample
+        span.observe(sample)
+
+        stack = self._stack()
+        stack.append(span)
+        with self.lock:
+            self.open_spans.add(span)
+
+        try:
+            yield span
+        finally:
+            stack.pop()
+            with self.lock:
+                self.open_spans.discard(span)
+            if self.enabled:
+                sample = self.sampler.sample()
+                span.observe(sample)
+                span.end = sample['time']
+                span.end_sample = sample
+                with self.lock:
+                    self.samples.append(sample)
+                    self.spans.append(span)
+
+    def stop(self):
+        """
+        Stop sampling and write trace.json and summary.txt to the output directory
+        :return (trace file, summary file) or None if the profiler wasn't running
+        """
+        if not self.enabled:
+            return None
+
+        self.stop_event.set()
+        self.thread.join()
+        self.enabled = False
+
+        try:
+            if not os.path.isdir(self.output_dir):
+                os.makedirs(self.output_dir)
+            trace_file = os.path.join(self.output_dir, "trace.json")
+            summary_file = os.path.join(self.output_dir, "summary.txt")
+
+            with open(trace_file, "w") as f:
+                f.write(json.dumps(self.trace_events()))
+            with open(summary_file, "w") as f:
+                f.write(self.summary())
+
+            log.ODM_INFO("Wrote profile: %s, %s" % (trace_file, summary_file))
+            return trace_file, summary_file
+        except Exception as e:
+            log.ODM_WARNING("Cannot write profile: %s" % str(e))
+            return None
+
+    def trace_events(self):
+        """
+        :return Chrome trace-event JSON object
+        """
+        pid = os.getpid()
+        origin = self.start_time
+        us = lambda t: int((t - origin) * 1e6)
+
+        events = [{'ph': 'M', 'pid': pid, 'name': 'process_name', 'args': {'name': 'ODM'}}]
+        tids = {}
+        for span in sorted(self.spans, key=lambda s: s.start):
+            tid = tids.setdefault(span.tid, len(tids) + 1)
+            st = span.stats()
+            args = dict(span.args)
+            args.update({
+                'cpu_s': round(st['cpu'], 3),
+                'peak_rss_mb': round(st['peak_rss'] / 1024.0 / 1024.0, 1),
+                'read_mb': round(st['read'] / 1024.0 / 1024.0, 1),
+                'write_mb': round(st['write'] / 1024.0 / 1024.0, 1),
+                'threads': st['threads'],
+            })
+            events.append({
+                'ph': 'X', 'pid': pid, 'tid': tid,
+                'name': span.name, 'cat': span.category,
+                'ts': us(span.start), 'dur': max(1, us(span.end) - us(span.start)),
+                'args': args,
+            })
+        for tid, n in tids.items():
+            events.append({'ph': 'M', 'pid': pid, 'tid': n, 'name': 'thread_name',
+                           'args': {'name': 'main' if tid == self.main_tid else 'thread %s' % n}})
+
+        prev = None
+        for s in sorted(self.samples, key=lambda s: s['time']):
+            ts = us(s['time'])
+            events.append({'ph': 'C', 'pid': pid, 'name': 'memory', 'ts': ts,
+                           'args': {'rss_mb': round(s['rss'] / 1024.0 / 1024.0, 1)}})
+            events.append({'ph': 'C', 'pid': pid, 'name': 'threads', 'ts': ts,
+                           'args': {'threads': s['threads']}})
+            if prev is not None and s['time'] > prev['time']:
+                dt = s['time'] - prev['time']
+                events.append({'ph': 'C', 'pid': pid, 'name': 'cpu', 'ts': ts,
+                               'args': {'cores': round(max(0, s['cpu'] - prev['cpu']) / dt, 2)}})
+                events.append({'ph': 'C', 'pid': pid, 'name': 'disk', 'ts': ts,
+                               'args': {'read_mb_s': round(max(0, s['read'] - prev['read']) / dt / 1024.0 / 1024.0, 2),
+                                        'write_mb_s': round(max(0, s['write'] - prev['write']) / dt / 1024.0 / 1024.0, 2)}})
+            prev = s
+
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def summary(self):
+        """
+        :return text table with totals for each span path, nested by indentation
+        """
+        rows = {}
+        order = []
+        for span in sorted(self.spans, key=lambda s: s.start):
+            st = span.stats()
+            r = rows.get(span.path)
+            if r is None:
+                r = rows[span.path] = {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'peak_rss': 0, 'read': 0, 'write': 0, 'threads': 0}
+                order.append(span.path)
+            r['count'] += 1
+            r['wall'] += st['wall']
+            r['cpu'] += st['cpu']
+            r['peak_rss'] = max(r['peak_rss'], st['peak_rss'])
+            r['read'] += st['read']
+            r['write'] += st['write']
+            r['threads'] = max(r['threads'], st['threads'])
+
+        # Children right after their parent
+        first_seen = dict((path, i) for i, path in enumerate(order))
+        order.sort(key=lambda path: tuple(first_seen.get(path[:i + 1], -1) for i in range(len(path))))
+
+        mb = 1024.0 * 1024.0
+        lines = ["%-48s %6s %10s %10s %6s %10s %10s %10s %8s" % ("Span", "Count", "Wall (s)", "CPU (s)", "Cores",
+                                                              "Peak (MB)", "Read (MB)", "Write (MB)", "Threads")]
+        for path in order:
+            r = rows[path]
+            name = ("  " * (len(path) - 1) + path[-1])[:48]
+            lines.append("%-48s %6s %10.2f %10.2f %6.1f %10.1f %10.1f %10.1f %8s" % (
+                name, r['count'], r['wall'], r['cpu'], r['cpu'] / r['wall'] if r['wall'] > 0 else 0,
+                r['peak_rss'] / mb, r['read'] / mb, r['write'] / mb, r['threads']))
+        return "\n".join(lines) + "\n"
+
+profiler = Profiler()
+
+def _after_fork_in_child():
+    # The sampler thread doesn't exist in a forked process and the lock
+    # may have been held by another thread: spans are not recorded in children
+    profiler.enabled = False
+    profiler.lock = threading.Lock()
+    profiler.open_spans = set()
+    profiler.thread = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+span = profiler.span
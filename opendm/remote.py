@@ -4,7 +4,6 @@ import os
 import sys
 import threading
 import signal
-import zipfile
 import glob
 from opendm import log
 from opendm import system
@@ -13,6 +12,7 @@ from pyodm import Node, exceptions
 from pyodm.utils import AtomicCounter
 from pyodm.types import TaskStatus
 from opendm.osfm import OSFMContext, get_submodel_args_dict, get_submodel_argv
+from opendm.seedpayload import SeedPayload, DEFAULT_COMPRESSION_LEVEL, can_stream
 from opendm.utils import double_quote
 
 try:
@@ -252,6 +252,379 @@ class LocalRemoteExecutor:
                 raise nonloc.error
         
 
+# A task running remotely is taken back and processed locally
+# when it takes longer than this many times its expected duration
+STEAL_FACTOR = 2.0
+
+def estimate_cost(project_path):
+    """
+    :param project_path path to a submodel
+    :return estimated processing cost of the submodel (number of images)
+    """
+    try:
+        return max(1, len(os.listdir(os.path.join(project_path, "images"))))
+    except (IOError, OSError):
+        return 1
+
+class PoolWorker:
+    """
+    A local processing slot or a remote node, along with
+    what we learned about how fast it processes tasks
+    """
+    def __init__(self, name, node=None, slots=None):
+        """
+        :param name name used in log messages
+        :param node pyodm Node (None for a local slot)
+        :param slots maximum number of tasks to run at the same time (None until the node reports a limit)
+        """
+        self.name = name
+        self.node = node
+        self.slots = slots
+        self.running = 0
+        self.uploading = False
+        self.speed = None # cost units per second
+
+    def is_local(self):
+        return self.node is None
+
+    def is_idle(self):
+        return not self.uploading and (self.slots is None or self.running < self.slots)
+
+    def expected_duration(self, cost):
+        if self.speed:
+            return cost / self.speed
+
+    def learn(self, cost, seconds):
+        speed = cost / max(seconds, 1e-3)
+        self.speed = speed if self.speed is None else 0.5 * (self.speed + speed)
+
+    def __str__(self):
+        return self.name
+
+class PoolAttempt:
+    def __init__(self, task, worker, cost):
+        self.task = task
+        self.worker = worker
+        self.cost = cost
+        self.started = time.time()
+        self.uploaded = False
+        self.finished = False
+        self.stolen = False
+        self.remote_task = None
+        self.thread = None
+
+class LocalRemotePool:
+    """
+    Event-driven variant of LocalRemoteExecutor. Tasks run on N local slots and
+    on one or more remote nodes at the same time. Workers report their results to a
+    dispatcher through a condition variable (no sleep loops): the largest pending
+    submodels are assigned first, to the idle worker that has been the fastest so far.
+    When there's nothing left to assign, a task that is running on a remote node for
+    much longer than expected is canceled and processed by an idle local slot instead.
+    """
+    min_sample_seconds = 1.0
+
+    def __init__(self, nodes, local_slots=1, rolling_shutter=False, rerun=False, steal_factor=STEAL_FACTOR,
+                 seed_compression=DEFAULT_COMPRESSION_LEVEL, seed_workers=1):
+        """
+        :param nodes list of node URLs or pyodm Node objects
+        :param local_slots number of tasks to process locally at the same time
+        :param rolling_shutter rolling shutter correction
+        :param rerun reprocess tasks that have already completed
+        :param steal_factor a remote task is processed locally when it runs longer than steal_factor times its expected duration (0 to disable)
+        :param seed_compression compression level (0-9) of the files uploaded to the nodes
+        :param seed_workers number of threads compressing the files uploaded to the nodes
+        """
+        self.params = {
+            'tasks': [],
+            'threads': [],
+            'rolling_shutter': rolling_shutter,
+            'rerun': rerun,
+            'seed_compression': seed_compression,
+            'seed_workers': seed_workers
+        }
+        self.steal_factor = steal_factor
+        self.project_paths = []
+        self.workers = [PoolWorker("local #%s" % (i + 1), slots=1) for i in range(local_slots)]
+
+        for node in nodes:
+            if isinstance(node, str):
+                node = Node.from_url(node)
+            name = "%s:%s" % (node.host, node.port)
+            try:
+                info = node.info()
+                log.ODM_INFO("LRE: Node %s is online and running %s version %s" % (name, info.engine, info.engine_version))
+                self.workers.append(PoolWorker(name, node))
+            except exceptions.NodeConnectionError:
+                log.ODM_WARNING("LRE: Node %s seems to be offline, it will not be used" % name)
+            except Exception as e:
+                raise system.ExitException("LRE: An unexpected problem happened while opening the node connection: %s" % str(e))
+
+        if not self.workers:
+            raise system.ExitException("LRE: No local slots and no nodes are online, cannot process the dataset")
+
+    def set_projects(self, paths):
+        self.project_paths = paths
+
+    def run_reconstruction(self):
+        self.run(ReconstructionTask)
+
+    def run_toolchain(self):
+        self.run(ToolchainTask)
+
+    def run(self, taskClass):
+        if not self.project_paths:
+            return
+
+        cond = threading.Condition()
+        pending = []
+        attempts = []
+
+        class nonloc:
+            error = None
+            finished = 0
+
+        for pp in self.project_paths:
+            log.ODM_INFO("LRE: Adding to queue %s" % pp)
+            task = taskClass(pp, None, self.params)
+            task.cost = estimate_cost(pp)
+            pending.append(task)
+
+        def remove_task_safe(task):
+            try:
+                removed = task.remove()
+            except exceptions.OdmError:
+                removed = False
+            return removed
+
+        def cleanup_remote_tasks():
+            if self.params['tasks']:
+                log.ODM_WARNING("LRE: Attempting to cleanup remote tasks")
+            else:
+                log.ODM_INFO("LRE: No remote tasks left to cleanup")
+
+            for task in list(self.params['tasks']):
+                log.ODM_INFO("LRE: Removing remote task %s... %s" % (task.uuid, 'OK' if remove_task_safe(task) else 'NO'))
+
+        def cancel_remote(attempt):
+            remote_task = attempt.remote_task
+            if remote_task is None:
+                return
+            try:
+                remote_task.cancel()
+            except exceptions.OdmError:
+                pass
+            log.ODM_INFO("LRE: Removing remote task %s... %s" % (remote_task.uuid, 'OK' if remove_task_safe(remote_task) else 'NO'))
+            try:
+                self.params['tasks'].remove(remote_task)
+            except ValueError:
+                pass
+
+        def release(attempt):
+            # Called with the lock held
+            attempt.finished = True
+            attempt.worker.running -= 1
+            if not attempt.worker.is_local() and not attempt.uploaded:
+                attempt.worker.uploading = False
+            attempts.remove(attempt)
+            cond.notify_all()
+
+        def handle_result(attempt, error=None, partial=False):
+            task = attempt.task
+            worker = attempt.worker
+
+            with cond:
+                if attempt.finished:
+                    return
+                if not worker.is_local() and attempt.remote_task is None:
+                    attempt.remote_task = task.remote_task
+                if partial:
+                    attempt.uploaded = True
+                    worker.uploading = False
+                    cond.notify_all()
+                    return
+
+            # Cleanup the remote task (outside the lock, this is a network call)
+            if attempt.remote_task is not None:
+                with cond:
+                    stolen = attempt.stolen
+                if not stolen:
+                    log.ODM_INFO("LRE: Cleaning up remote task (%s)... %s" % (attempt.remote_task.uuid, 'OK' if remove_task_safe(attempt.remote_task) else 'NO'))
+                    try:
+                        self.params['tasks'].remove(attempt.remote_task)
+                    except ValueError:
+                        pass
+
+            with cond:
+                if attempt.finished:
+                    return
+                release(attempt)
+                if task.remote_task is attempt.remote_task:
+                    task.remote_task = None
+
+                if error is None:
+                    log.ODM_INFO("LRE: %s finished successfully on %s" % (task, worker))
+                    elapsed = time.time() - attempt.started
+                    if elapsed >= self.min_sample_seconds:
+                        worker.learn(attempt.cost, elapsed)
+                    nonloc.finished += 1
+                    return
+
+                log.ODM_WARNING("LRE: %s failed on %s with: %s" % (task, worker, str(error)))
+
+                # Special case in which the error is caused by a SIGTERM signal
+                # this means a local processing was terminated either by CTRL+C or
+                # by canceling the task.
+                if str(error) == "Child was terminated by signal 15":
+                    system.exit_gracefully()
+
+                task_limit_reached = isinstance(error, NodeTaskLimitReachedException)
+                if task_limit_reached:
+                    # The node can process as many tasks as are currently running on it
+                    worker.slots = max(1, worker.running)
+                    log.ODM_INFO("LRE: Node task limit reached. Setting max tasks for %s to %s" % (worker, worker.slots))
+
+                # Retry, but only if the error is not related to a task failure
+                if task.retries < task.max_retries and not isinstance(error, exceptions.TaskFailedError):
+                    # Don't increment the retry counter if this task simply reached the task
+                    # limit count.
+                    if not task_limit_reached:
+                        task.retries += 1
+                        task.wait_until = datetime.datetime.now() + datetime.timedelta(seconds=task.retries * task.retry_timeout)
+                    log.ODM_INFO("LRE: Re-queueing %s (retries: %s)" % (task, task.retries))
+                    pending.append(task)
+                elif nonloc.error is None:
+                    nonloc.error = error
+
+        def start(task, worker):
+            # Called with the lock held
+            attempt = PoolAttempt(task, worker, task.cost)
+            worker.running += 1
+            if not worker.is_local():
+                worker.uploading = True
+            attempts.append(attempt)
+
+            def done(error=None, partial=False):
+                handle_result(attempt, error, partial)
+
+            def process():
+                log.ODM_INFO("LRE: About to process %s on %s" % (task, worker))
+                if worker.is_local():
+                    task._process_local(done) # Block until complete
+                else:
+                    task.node = worker.node
+                    task._process_remote(done) # Block until upload is complete
+
+            attempt.thread = threading.Thread(target=process)
+            attempt.thread.start()
+            return attempt
+
+        def expected_duration(attempt):
+            # How long a task should take on its node, or locally
+            # if we don't know how fast the node is yet
+            for w in [attempt.worker] + [w for w in self.workers if w.is_local()]:
+                duration = w.expected_duration(attempt.cost)
+                if duration is not None:
+                    return duration
+
+        def dispatch(now):
+            """
+            Assign ready tasks to idle workers, steal overdue remote tasks.
+            Called with the lock held.
+            :return seconds until something might change other than a worker reporting (or None)
+            """
+            wakeup = []
+
+            ready = [t for t in pending if t.wait_until <= datetime.datetime.now()]
+            for t in pending:
+                if t not in ready:
+                    wakeup.append(max(0, (t.wait_until - datetime.datetime.now()).total_seconds()))
+
+            # Largest tasks first, to the fastest idle worker (local on ties, there's no upload)
+            ready.sort(key=lambda t: -t.cost)
+            for task in ready:
+                idle = [w for w in self.workers if w.is_idle()]
+                if not idle:
+                    break
+                idle.sort(key=lambda w: (-(w.speed or 0), not w.is_local()))
+                pending.remove(task)
+                start(task, idle[0])
+
+            # Work stealing
+            idle_local = [w for w in self.workers if w.is_local() and w.is_idle()]
+            if self.steal_factor > 0 and idle_local and not ready:
+                candidates = []
+                for a in attempts:
+                    if a.worker.is_local() or not a.uploaded:
+                        continue
+                    duration = expected_duration(a)
+                    if duration is None:
+                        continue
+                    overdue = now - a.started - duration * self.steal_factor
+                    if overdue >= 0:
+                        candidates.append((overdue, a))
+                    else:
+                        wakeup.append(-overdue)
+
+                candidates.sort(key=lambda c: -c[0])
+                for (_, a), worker in zip(candidates, idle_local):
+                    log.ODM_WARNING("LRE: %s is taking too long on %s, processing it locally" % (a.task, a.worker))
+                    a.stolen = True
+                    release(a)
+                    if a.task.remote_task is a.remote_task:
+                        a.task.remote_task = None
+                    t = threading.Thread(target=cancel_remote, args=(a, ))
+                    self.params['threads'].append(t)
+                    t.start()
+                    start(a.task, worker)
+
+            if wakeup:
+                return min(wakeup)
+
+        system.add_cleanup_callback(cleanup_remote_tasks)
+
+        # Block until all tasks are done (or CTRL+C)
+        try:
+            with cond:
+                while nonloc.finished < len(self.project_paths) and nonloc.error is None:
+                    timeout = dispatch(time.time())
+                    if nonloc.finished < len(self.project_paths) and nonloc.error is None:
+                        cond.wait(timeout)
+        except KeyboardInterrupt:
+            log.ODM_WARNING("LRE: CTRL+C")
+            system.exit_gracefully()
+
+        # Don't wait for remote tasks that will not be used
+        with cond:
+            abandoned = [a for a in attempts if not a.worker.is_local()]
+            for a in abandoned:
+                a.stolen = True
+                release(a)
+            threads = [a.thread for a in attempts] + [a.thread for a in abandoned]
+        for a in abandoned:
+            cancel_remote(a)
+
+        # Wait for local processing and uploads, then for all remaining threads
+        for t in threads:
+            t.join()
+        for a in abandoned:
+            if a.remote_task is None and a.task.remote_task is not None:
+                a.remote_task = a.task.remote_task
+                cancel_remote(a)
+        for t in self.params['threads']:
+            t.join()
+        self.params['threads'] = []
+
+        system.remove_cleanup_callback(cleanup_remote_tasks)
+        cleanup_remote_tasks()
+
+        if nonloc.error is not None:
+            # Try not to leak access token
+            if isinstance(nonloc.error, exceptions.NodeConnectionError):
+                raise exceptions.NodeConnectionError("A connection error happened. Check the connection to the processing node and try again.")
+            else:
+                raise nonloc.error
+
 class NodeTaskLimitReachedException(Exception):
     pass
 
@@ -293,25 +666,13 @@ class Task:
         with open(file, 'w') as fout:
             fout.write("Done!\n")
 
-    def create_seed_payload(self, paths, touch_files=[]):
-        paths = filter(os.path.exists, map(lambda p: self.path(p), paths))
-        outfile = self.path("seed.zip")
-
-        with zipfile.ZipFile(outfile, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
-            for p in paths:
-                if os.path.isdir(p):
-                    for root, _, filenames in os.walk(p):
-                        for filename in filenames:
-                            filename = os.path.join(root, filename)
-                            filename = os.path.normpath(filename)
-                            zf.write(filename, os.path.relpath(filename, self.project_path))
-                else:
-                    zf.write(p, os.path.relpath(p, self.project_path))
-
-            for tf in touch_files:
-                zf.writestr(tf, "")
+    def seed_payload(self, paths, touch_files=[]):
+        return SeedPayload(self.project_path, paths, touch_files,
+                           compression_level=self.params.get('seed_compression', DEFAULT_COMPRESSION_LEVEL),
+                           max_workers=self.params.get('seed_workers', 1))
 
-        return outfile
+    def create_seed_payload(self, paths, touch_files=[]):
+        return self.seed_payload(paths, touch_files).save(self.path("seed.zip"))
 
     def _process_local(self, done):
         try:
@@ -327,14 +688,18 @@ class Task:
         except Exception as e:
             done(e)
 
-    def execute_remote_task(self, done, seed_files = [], seed_touch_files = [], outputs = [], ):
+    def execute_remote_task(self, done, seed_files = [], seed_touch_files = [], outputs = [], options = None):
         """
         Run a task by creating a seed file with all files in seed_files, optionally
         creating empty files (for flag checks) specified in seed_touch_files
         and returning the results specified in outputs. Yeah it's pretty cool!
+        :param options processing options for the node (defaults to the submodel options)
         """
-        seed_file = self.create_seed_payload(seed_files, touch_files=seed_touch_files)
-        
+        if options is None:
+            options = get_submodel_args_dict(config.config())
+
+        payload = self.seed_payload(seed_files, touch_files=seed_touch_files)
+
         # Find all images
         images = glob.glob(self.path("images/**"))
 
@@ -346,9 +711,6 @@ class Task:
         if os.path.exists(self.path("geo.txt")):
             images.append(self.path("geo.txt"))
         
-        # Add seed file
-        images.append(seed_file)
-
         class nonloc:
             last_update = 0
 
@@ -358,16 +720,26 @@ class Task:
                 nonloc.last_update = time.time()
 
         # Upload task
-        task = self.node.create_task(images, 
-                get_submodel_args_dict(config.config()),
-                progress_callback=print_progress,
-                skip_post_processing=True,
-                outputs=outputs)
+        def create_task(seed):
+            return self.node.create_task(images + [seed],
+                    options,
+                    progress_callback=print_progress,
+                    skip_post_processing=True,
+                    outputs=outputs)
+
+        if self.params.get('seed_streaming', True) and can_stream():
+            # The node client fetches the seed file from a local server,
+            # it is never written to disk
+            with payload.serve() as server:
+                task = create_task(server.url())
+        else:
+            seed_file = payload.save(self.path("seed.zip"))
+            try:
+                task = create_task(seed_file)
+            finally:
+                os.remove(seed_file)
         self.remote_task = task
 
-        # Cleanup seed file
-        os.remove(seed_file)
-
         # Keep track of tasks for cleanup
         self.params['tasks'].append(task)
 
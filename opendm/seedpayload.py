@@ -0,0 +1,333 @@
+import os
+import time
+import zlib
+import uuid
+import struct
+import threading
+from opendm import log
+from opendm.concurrency import parallel_imap, TaskError
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from urllib.request import getproxies, proxy_bypass
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from urllib import getproxies, proxy_bypass
+
+DEFAULT_COMPRESSION_LEVEL = 6
+
+# Files that are already compressed are stored as they are
+STORE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.zip', '.gz', '.laz', '.tgz', '.bz2', '.xz')
+
+# Files larger than this are compressed while streaming instead of in memory by a worker
+MAX_BUFFERED_SIZE = 64 * 1024 * 1024
+
+CHUNK_SIZE = 1024 * 1024
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+def dos_datetime(timestamp):
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        return 0, (0 << 9) | (1 << 5) | 1
+    dostime = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dosdate = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dostime, dosdate
+
+class SeedEntry:
+    def __init__(self, arcname, path=None):
+        self.arcname = arcname
+        self.path = path
+        if path is not None:
+            st = os.stat(path)
+            self.size = st.st_size
+            self.mtime = st.st_mtime
+            self.mode = st.st_mode
+        else:
+            # Fixed date, so that the archive is the same every time it's generated
+            self.size = 0
+            self.mtime = 0
+            self.mode = 0o100644
+
+        # Filled as the entry is written
+        self.crc = 0
+        self.compressed_size = 0
+        self.offset = 0
+        self.method = ZIP_STORED
+        self.flags = 0
+        self.zip64 = False
+
+    def name_bytes(self):
+        try:
+            return self.arcname.encode('ascii'), 0
+        except UnicodeEncodeError:
+            return self.arcname.encode('utf-8'), 0x800
+
+class SeedPayload:
+    """
+    Zip archive of files from a submodel that is written as a stream of chunks,
+    without materializing it on disk. Files are compressed in parallel by a pool
+    of threads (zlib releases the GIL), already compressed files are stored.
+    """
+    def __init__(self, root, paths, touch_files=[], compression_level=DEFAULT_COMPRESSION_LEVEL,
+                 max_workers=1, store_extensions=STORE_EXTENSIONS, max_buffered_size=MAX_BUFFERED_SIZE):
+        """
+        :param root directory that archive names are relative to
+        :param paths files and directories (relative to root) to add. Paths that don't exist are skipped
+        :param touch_files names of empty files to add
+        :param compression_level 0 (store) to 9 (best compression)
+        :param max_workers number of threads compressing files
+        :param store_extensions extensions of files that are stored without compression
+        :param max_buffered_size files larger than this are compressed while streaming
+        """
+        self.root = root
+        self.compression_level = compression_level
+        self.max_workers = max_workers
+        self.store_extensions = tuple(e.lower() for e in store_extensions)
+        self.max_buffered_size = max_buffered_size
+
+        self.entries = []
+        for p in paths:
+            p = os.path.join(root, p)
+            if os.path.isdir(p):
+                for r, dirs, filenames in os.walk(p):
+                    dirs.sort()
+                    for filename in sorted(filenames):
+                        filename = os.path.normpath(os.path.join(r, filename))
+                        self.entries.append(SeedEntry(self.arcname(filename), filename))
+            elif os.path.exists(p):
+                self.entries.append(SeedEntry(self.arcname(p), p))
+
+        for tf in touch_files:
+            self.entries.append(SeedEntry(tf))
+
+    def arcname(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, "/")
+
+    def method(self, entry):
+        if self.compression_level <= 0 or entry.size == 0 or entry.arcname.lower().endswith(self.store_extensions):
+            return ZIP_STORED
+        return ZIP_DEFLATED
+
+    def compressor(self):
+        return zlib.compressobj(self.compression_level, zlib.DEFLATED, -15)
+
+    def compress(self, entry):
+        """
+        Compress an entry in memory (runs in a worker thread)
+        :return compressed data (None for entries that are compressed while streaming)
+        """
+        entry.method = self.method(entry)
+        if entry.path is None:
+            return b""
+        if entry.size > self.max_buffered_size:
+            return None
+
+        with open(entry.path, 'rb') as f:
+            data = f.read()
+        entry.size = len(data)
+        entry.crc = zlib.crc32(data) & 0xFFFFFFFF
+        if entry.method == ZIP_DEFLATED:
+            c = self.compressor()
+            data = c.compress(data) + c.flush()
+        entry.compressed_size = len(data)
+        return data
+
+    def local_header(self, entry, streamed):
+        name, flags = entry.name_bytes()
+        entry.flags = flags
+        extra = b""
+        crc, csize, usize = entry.crc, entry.compressed_size, entry.size
+        version = 20
+
+        if streamed:
+            entry.flags |= 0x08 # Sizes and CRC follow the data
+            crc, csize, usize = 0, 0, 0
+            if entry.zip64:
+                extra = struct.pack("<HHQQ", 1, 16, 0, 0)
+                csize = usize = ZIP64_LIMIT
+                version = 45
+
+        dostime, dosdate = dos_datetime(entry.mtime)
+        return struct.pack("<IHHHHHIIIHH", 0x04034b50, version, entry.flags, entry.method,
+                           dostime, dosdate, crc, csize, usize, len(name), len(extra)) + name + extra
+
+    def stream_entry(self, entry, chunk_size):
+        """
+        Compress a large file while reading it
+        """
+        # Compression can only make the size grow by a little
+        entry.zip64 = entry.size * 1.05 + 1024 >= ZIP64_LIMIT
+        yield self.local_header(entry, True)
+
+        crc = 0
+        size = 0
+        csize = 0
+        c = self.compressor() if entry.method == ZIP_DEFLATED else None
+        with open(entry.path, 'rb') as f:
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+                if c is not None:
+                    data = c.compress(data)
+                if data:
+                    csize += len(data)
+                    yield data
+        if c is not None:
+            data = c.flush()
+            csize += len(data)
+            yield data
+
+        entry.crc = crc & 0xFFFFFFFF
+        entry.size = size
+        entry.compressed_size = csize
+        if entry.zip64:
+            yield struct.pack("<IIQQ", 0x08074b50, entry.crc, csize, size)
+        else:
+            yield struct.pack("<IIII", 0x08074b50, entry.crc, csize, size)
+
+    def central_directory(self, offset):
+        records = []
+        for entry in self.entries:
+            name, _ = entry.name_bytes()
+            fields = []
+            usize, csize, header_offset = entry.size, entry.compressed_size, entry.offset
+            if usize >= ZIP64_LIMIT or entry.zip64:
+                fields.append(usize)
+                usize = ZIP64_LIMIT
+            if csize >= ZIP64_LIMIT or entry.zip64:
+                fields.append(csize)
+                csize = ZIP64_LIMIT
+            if header_offset >= ZIP64_LIMIT:
+                fields.append(header_offset)
+                header_offset = ZIP64_LIMIT
+
+            extra = b""
+            version = 20
+            if fields:
+                extra = struct.pack("<HH" + "Q" * len(fields), 1, 8 * len(fields), *fields)
+                version = 45
+
+            dostime, dosdate = dos_datetime(entry.mtime)
+            records.append(struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50, version | (3 << 8), version,
+                                       entry.flags, entry.method, dostime, dosdate, entry.crc,
+                                       csize, usize, len(name), len(extra), 0, 0, 0,
+                                       (entry.mode & 0xFFFF) << 16, header_offset) + name + extra)
+
+        cd = b"".join(records)
+        count = len(self.entries)
+        end = b""
+        if count >= ZIP64_COUNT_LIMIT or offset >= ZIP64_LIMIT or len(cd) >= ZIP64_LIMIT:
+            zip64_offset = offset + len(cd)
+            end += struct.pack("<IQHHIIQQQQ", 0x06064b50, 44, 45, 45, 0, 0, count, count, len(cd), offset)
+            end += struct.pack("<IIQI", 0x07064b50, 0, zip64_offset, 1)
+        end += struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, min(count, ZIP64_COUNT_LIMIT), min(count, ZIP64_COUNT_LIMIT),
+                           min(len(cd), ZIP64_LIMIT), min(offset, ZIP64_LIMIT), 0)
+        return cd + end
+
+    def chunks(self, chunk_size=CHUNK_SIZE):
+        """
+        Generate the archive
+        :param chunk_size size of the reads of files that are streamed
+        :return generator of bytes
+        """
+        offset = 0
+        buffered = parallel_imap(self.compress, self.entries, max_workers=self.max_workers,
+                                 memory_cost=lambda e: 2.0 * min(e.size, self.max_buffered_size) / 1024 / 1024,
+                                 max_in_flight=self.max_workers * 2)
+        try:
+            for entry, data in zip(self.entries, buffered):
+                entry.offset = offset
+                if data is None:
+                    for chunk in self.stream_entry(entry, chunk_size):
+                        offset += len(chunk)
+                        yield chunk
+                else:
+                    header = self.local_header(entry, False)
+                    offset += len(header) + len(data)
+                    yield header
+                    if data:
+                        yield data
+        except TaskError as e:
+            raise e.error
+        finally:
+            buffered.close()
+
+        yield self.central_directory(offset)
+
+    def write(self, fileobj, chunk_size=CHUNK_SIZE):
+        for chunk in self.chunks(chunk_size):
+            fileobj.write(chunk)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            self.write(f)
+        return path
+
+    def serve(self, filename="seed.zip"):
+        """
+        Serve the archive from a local HTTP server (127.0.0.1), generating it
+        on each request. Use as a context manager.
+        :return SeedPayloadServer
+        """
+        return SeedPayloadServer(self, filename)
+
+class SeedPayloadServer:
+    def __init__(self, payload, filename):
+        self.payload = payload
+        self.path = "/%s/%s" % (uuid.uuid4().hex, filename)
+        self.server = None
+        self.thread = None
+        self.requests = 0
+
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return "http://%s:%s%s" % (host, port, self.path)
+
+    def __enter__(self):
+        owner = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != owner.path:
+                    self.send_error(404)
+                    return
+
+                owner.requests += 1
+                self.send_response(200)
+                self.send_header("Content-Type", "application/zip")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                try:
+                    owner.payload.write(self.wfile)
+                except Exception as e:
+                    log.ODM_WARNING("Cannot stream seed payload: %s" % str(e))
+                self.close_connection = True
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = HTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.1})
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+def can_stream():
+    """
+    :return True if a payload served from 127.0.0.1 can be fetched without going through a proxy
+    """
+    proxies = getproxies()
+    return not (proxies.get('http') or proxies.get('all')) or bool(proxy_bypass("127.0.0.1"))
@@ -6,19 +6,18 @@ import os
 import onnxruntime as ort
 from .guidedfilter import guided_filter
 from opendm import log
-from threading import Lock
-
-mutex = Lock()
+from opendm.ai import SessionPool
 
 # Use GPU if it is available, otherwise CPU
 provider = "CUDAExecutionProvider" if "CUDAExecutionProvider" in ort.get_available_providers() else "CPUExecutionProvider"
 
 class SkyFilter():
 
-    def __init__(self, model, width = 384, height = 384):
+    def __init__(self, model, width = 384, height = 384, max_sessions = 1):
 
         self.model = model
         self.width, self.height = width, height
+        self.max_sessions = max_sessions
 
         log.ODM_INFO(' ?> Using provider %s' % provider)
         self.load_model()
@@ -26,7 +25,8 @@ class SkyFilter():
     
     def load_model(self):
         log.ODM_INFO(' -> Loading the model')
-        self.session = ort.InferenceSession(self.model, providers=[provider])     
+        self.session = SessionPool(self.model, providers=[provider], max_sessions=self.max_sessions)
+        self.input_name = self.session.get_inputs()[0].name
 
 
     def get_mask(self, img):
@@ -39,11 +39,10 @@ class SkyFilter():
 
         # Input vector for onnx model
         input_v = np.expand_dims(new_img.transpose((2, 0, 1)), axis=0)
-        ort_inputs = {self.session.get_inputs()[0].name: input_v}
+        ort_inputs = {self.input_name: input_v}
 
         # Run the model
-        with mutex:
-            ort_outs = self.session.run(None, ort_inputs)
+        ort_outs = self.session.run(None, ort_inputs)
 
         # Get the output
         output = np.array(ort_outs)
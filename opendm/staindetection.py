@@ -1,16 +1,28 @@
 import cv2
 import numpy as np
+import threading
+import time
 from opendm import log
-import onnxruntime as ort
+from opendm.ai import create_session
+
+try:
+    import Queue as queue
+except:
+    import queue
 
 class StainDetector:
     def __init__(self, model_path):
-        self.sess = ort.InferenceSession(model_path)
+        self.sess = create_session(model_path)
         self.input_name = self.sess.get_inputs()[0].name
         self.output_name = self.sess.get_outputs()[0].name
         input_shape = self.sess.get_inputs()[0].shape
         self.input_height, self.input_width = input_shape[2:]
 
+        # Models exported with a fixed batch dimension
+        # can only process one image at a time
+        batch_dim = input_shape[0]
+        self.max_batch_size = batch_dim if isinstance(batch_dim, int) and batch_dim > 0 else None
+
     def detect_and_overlay(self, input_image, output_image, mask_output=None, alpha=0.5):
         """
         Detect stains in the input image, create a transparent overlay, and optionally save the mask.
@@ -29,12 +41,119 @@ class StainDetector:
         preprocessed_image = self._preprocess(image)
         detections = self._detect_stains(preprocessed_image, original_height, original_width)
         
+        self.save_outputs(image, detections, output_image, mask_output, alpha)
+
+    def save_outputs(self, image, detections, output_image, mask_output=None, alpha=0.5):
+        """Write the overlay and (optionally) the mask for an image processed by the detector."""
         if mask_output:
             self._save_mask(detections, mask_output)
         
         overlay = self._create_overlay(image, detections, alpha)
         cv2.imwrite(output_image, overlay)
 
+    def detect_batch(self, input_images, batch_size=8, prefetch=None, loader_threads=1):
+        """
+        Detect stains in many images, batching them through the ONNX session.
+        Images are decoded and preprocessed ahead of time by background loader threads
+        into a bounded queue; the session consumes whatever is available (up to batch_size)
+        as a single NCHW batch.
+
+        Args:
+            input_images (list): Paths to the input image files.
+            batch_size (int): Maximum number of images per inference call.
+            prefetch (int, optional): Maximum number of decoded images waiting in the queue. Defaults to 2 * batch_size.
+            loader_threads (int): Number of threads decoding images.
+
+        Yields:
+            (input_image, image, mask) tuples in completion order. image and mask
+            are None if the input image could not be loaded.
+        """
+        if self.max_batch_size is not None:
+            batch_size = min(batch_size, self.max_batch_size)
+        batch_size = max(1, batch_size)
+        if prefetch is None:
+            prefetch = batch_size * 2
+        loader_threads = max(1, loader_threads)
+
+        pending = queue.Queue()
+        for f in input_images:
+            pending.put(f)
+
+        loaded = queue.Queue(maxsize=max(1, prefetch))
+        stop = threading.Event()
+
+        def put(item):
+            # Don't block forever if the consumer went away
+            while not stop.is_set():
+                try:
+                    loaded.put(item, timeout=0.5)
+                    return
+                except queue.Full:
+                    pass
+
+        def loader():
+            while not stop.is_set():
+                try:
+                    f = pending.get_nowait()
+                except queue.Empty:
+                    break
+
+                try:
+                    image = cv2.imread(f)
+                    if image is None:
+                        raise ValueError(f"Could not load image: {f}")
+                    put((f, image, self._preprocess(image)[0]))
+                except Exception as e:
+                    log.ODM_WARNING(str(e))
+                    put((f, None, None))
+            put(None)
+
+        threads = [threading.Thread(target=loader, daemon=True) for _ in range(loader_threads)]
+        for t in threads:
+            t.start()
+
+        running = len(threads)
+        batch_num = 0
+
+        try:
+            while running > 0:
+                # Block for the first item, then take
+                # whatever else is ready to fill the batch
+                batch = []
+                item = loaded.get()
+                while True:
+                    if item is None:
+                        running -= 1
+                    elif item[1] is None:
+                        yield item
+                    else:
+                        batch.append(item)
+
+                    if len(batch) >= batch_size or running == 0:
+                        break
+                    try:
+                        item = loaded.get_nowait()
+                    except queue.Empty:
+                        break
+
+                if not batch:
+                    continue
+
+                batch_num += 1
+                start = time.time()
+                masks = self._detect_stains_batch(np.stack([b[2] for b in batch]),
+                                                   [b[1].shape[:2] for b in batch])
+                elapsed = time.time() - start
+                log.ODM_INFO("Stain detection batch #%s: %s images in %.3fs (%.2f images/s)" %
+                             (batch_num, len(batch), elapsed, len(batch) / max(elapsed, 1e-6)))
+
+                for (f, image, _), mask in zip(batch, masks):
+                    yield f, image, mask
+        finally:
+            stop.set()
+            for t in threads:
+                t.join()
+
     def _preprocess(self, image):
         """Preprocess the input image for the ONNX model."""
         img = cv2.resize(image, (self.input_width, self.input_height))
@@ -49,18 +168,29 @@ class StainDetector:
         try:
             input_data = {self.input_name: preprocessed_image}
             out = self.sess.run([self.output_name], input_data)[0]
-            segm_mask = np.argmax(out, axis=1)
-            segm_mask = (segm_mask * 255 / segm_mask.max()).astype(np.uint8)
-            segm_mask = np.squeeze(segm_mask, axis=0)
-            
-            # Resize the mask to match the original image dimensions
-            resized_mask = cv2.resize(segm_mask, (original_width, original_height), interpolation=cv2.INTER_NEAREST)
-            
-            return resized_mask
+            return self._postprocess(out[0], original_height, original_width)
         except Exception as e:
             log.ODM_ERROR(f"Error during stain detection: {str(e)}")
             return np.zeros((original_height, original_width), dtype=np.uint8)
 
+    def _detect_stains_batch(self, preprocessed_batch, original_sizes):
+        """Detect stains on a NCHW batch, returning one mask per (height, width) in original_sizes."""
+        try:
+            input_data = {self.input_name: preprocessed_batch}
+            out = self.sess.run([self.output_name], input_data)[0]
+            return [self._postprocess(o, h, w) for o, (h, w) in zip(out, original_sizes)]
+        except Exception as e:
+            log.ODM_ERROR(f"Error during stain detection: {str(e)}")
+            return [np.zeros((h, w), dtype=np.uint8) for h, w in original_sizes]
+
+    def _postprocess(self, out, original_height, original_width):
+        """Turn the model output for a single image (CHW) into a mask of the original image size."""
+        segm_mask = np.argmax(out, axis=0)
+        segm_mask = (segm_mask * 255 / segm_mask.max()).astype(np.uint8)
+        
+        # Resize the mask to match the original image dimensions
+        return cv2.resize(segm_mask, (original_width, original_height), interpolation=cv2.INTER_NEAREST)
+
     def _create_overlay(self, original_image, segm_mask, alpha=0.5):
         """Create a transparent overlay of the original image with detected stains."""
         # Create a red color mask for stains
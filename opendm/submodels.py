@@ -0,0 +1,226 @@
+import os
+import json
+import threading
+from opendm import log
+from opendm import io
+from opendm.concurrency import parallel_imap
+from opendm.planner import ConcurrencyPlanner
+
+# Rough memory model of the ODM toolchain on a submodel
+SUBMODEL_BASE_MEMORY_MB = 2048
+SUBMODEL_MB_PER_MEGAPIXEL = 2.0
+
+# Number of times a failed submodel is retried (after the others are done)
+SUBMODEL_RETRIES = 1
+
+DONE_FILE = "submodel_done.txt"
+
+def submodel_memory_mb(image_sizes):
+    """
+    :param image_sizes list of (width, height) of the images in the submodel
+    :return estimated peak memory (MB) needed to process the submodel
+    """
+    megapixels = sum(float(w * h) for w, h in image_sizes) / 1000000.0
+    return SUBMODEL_BASE_MEMORY_MB + megapixels * SUBMODEL_MB_PER_MEGAPIXEL
+
+class Submodel:
+    def __init__(self, name, project_path, memory_mb=SUBMODEL_BASE_MEMORY_MB):
+        """
+        :param name submodel name (e.g. submodel_0000)
+        :param project_path ODM project directory of the submodel (the one that contains images/)
+        :param memory_mb estimated memory needed to process it
+        """
+        self.name = name
+        self.project_path = project_path
+        self.memory_mb = memory_mb
+        self.progress = 0.0
+        self.attempts = 0
+        self.error = None
+
+    def done_file(self):
+        return os.path.join(self.project_path, DONE_FILE)
+
+    def is_done(self):
+        return io.file_exists(self.done_file())
+
+    def __repr__(self):
+        return self.name
+
+class SubmodelProgress:
+    """
+    Follows the progress of a submodel's toolchain by
+    reading the events the toolchain appends to log.jsonl
+    """
+    def __init__(self, project_path, stages):
+        self.log_file = os.path.join(project_path, "log.jsonl")
+        self.stages = stages
+        # Skip events from previous runs (log.jsonl is append-only)
+        try:
+            self.offset = os.path.getsize(self.log_file)
+        except (IOError, OSError):
+            self.offset = 0
+        self.partial = b""
+        self.progress = 0.0
+
+    def update(self):
+        """
+        :return fraction of the toolchain that has been completed (0-1)
+        """
+        try:
+            size = os.path.getsize(self.log_file)
+            if size < self.offset:
+                # Rotated or recreated
+                self.offset = 0
+                self.partial = b""
+            if size == self.offset:
+                return self.progress
+
+            with open(self.log_file, "rb") as f:
+                f.seek(self.offset)
+                data = self.partial + f.read(size - self.offset)
+                self.offset = size
+        except (IOError, OSError):
+            return self.progress
+
+        lines = data.split(b"\n")
+        self.partial = lines.pop()
+        for line in lines:
+            try:
+                event = json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue
+
+            if event.get('event') == 'stage' and event.get('name') in self.stages:
+                self.progress = max(self.progress, float(self.stages.index(event['name'])) / len(self.stages))
+            elif event.get('event') == 'success':
+                self.progress = 1.0
+        return self.progress
+
+class SubmodelScheduler:
+    """
+    Runs the toolchain of several submodels at the same time, as many
+    as the estimated memory footprint of each submodel and the CPUs allow,
+    splitting --max-concurrency among them. A failed submodel doesn't stop
+    the others: it's retried once they are done, and submodels that have
+    completed are skipped when the stage is run again.
+    """
+    def __init__(self, max_concurrency, max_parallel=1, retries=SUBMODEL_RETRIES, planner=None):
+        """
+        :param max_concurrency number of CPUs to share among submodels
+        :param max_parallel maximum number of submodels processed at the same time (0 for no limit)
+        :param retries number of times a failed submodel is retried
+        :param planner ConcurrencyPlanner used to check the available memory
+        """
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_parallel = max_parallel if max_parallel > 0 else self.max_concurrency
+        self.retries = retries
+        self.planner = planner or ConcurrencyPlanner(min(self.max_parallel, self.max_concurrency))
+
+    def plan(self, submodels):
+        """
+        :return (number of submodels to process at the same time, CPUs for each)
+        """
+        if not submodels:
+            return 1, self.max_concurrency
+
+        workers = self.planner.plan(max(s.memory_mb for s in submodels), name="Submodels")
+        workers = max(1, min(workers, self.max_parallel, len(submodels)))
+        return workers, max(1, self.max_concurrency // workers)
+
+    def run(self, submodels, func, rerun=False, progress_callback=None, stages=None, poll_interval=2.0):
+        """
+        :param submodels list of Submodel
+        :param func function(submodel, cpus) that processes a submodel (raises on failure)
+        :param rerun process submodels that have already completed
+        :param progress_callback function(fraction) called as submodels make progress (0-1)
+        :param stages stage names used to estimate the progress of a submodel from its log.jsonl.
+            If None, progress is only updated when a submodel completes
+        :param poll_interval seconds between progress updates
+        :return list of submodels that failed (with their error set)
+        """
+        for s in submodels:
+            if rerun and s.is_done():
+                os.remove(s.done_file())
+            s.progress = 1.0 if s.is_done() else 0.0
+            s.attempts = 0
+            s.error = None
+
+        todo = [s for s in submodels if s.progress < 1.0]
+        for s in submodels:
+            if s.progress >= 1.0:
+                log.ODM_INFO("%s has already been processed" % s.name)
+
+        if not todo:
+            return []
+
+        workers, cpus = self.plan(todo)
+        log.ODM_INFO("Processing %s submodels, %s at a time with %s CPUs each" % (len(todo), workers, cpus))
+
+        lock = threading.Lock()
+        running = {}
+        stop = threading.Event()
+
+        def report():
+            if progress_callback is not None:
+                progress_callback(sum(s.progress for s in submodels) / len(submodels))
+
+        def monitor():
+            while not stop.wait(poll_interval):
+                with lock:
+                    for s, p in running.items():
+                        s.progress = max(s.progress, min(0.99, p.update()))
+                report()
+
+        def process(s, cpus=cpus):
+            with lock:
+                s.attempts += 1
+                if stages is not None:
+                    running[s] = SubmodelProgress(s.project_path, stages)
+            try:
+                func(s, cpus)
+                with open(s.done_file(), "w") as f:
+                    f.write("Attempts: %s\n" % s.attempts)
+                s.progress = 1.0
+            finally:
+                with lock:
+                    running.pop(s, None)
+                report()
+
+        thread = None
+        if progress_callback is not None and stages is not None:
+            thread = threading.Thread(target=monitor)
+            thread.daemon = True
+            thread.start()
+
+        failed = []
+        try:
+            for s, result in zip(todo, parallel_imap(process, todo, max_workers=workers,
+                                                     memory_cost=lambda s: s.memory_mb,
+                                                     max_memory_mb=self.planner.memory_budget_mb(),
+                                                     max_in_flight=workers, retries=0,
+                                                     return_exceptions=True)):
+                if isinstance(result, Exception):
+                    log.ODM_WARNING("%s failed: %s" % (s.name, str(result)))
+                    s.error = result
+                    failed.append(s)
+
+            # Retry failed submodels, one at a time with all CPUs
+            for attempt in range(self.retries):
+                if not failed:
+                    break
+                retry, failed = failed, []
+                for s in retry:
+                    log.ODM_INFO("Retrying %s (attempt %s)" % (s.name, s.attempts + 1))
+                    try:
+                        process(s, self.max_concurrency)
+                        s.error = None
+                    except Exception as e:
+                        log.ODM_WARNING("%s failed again: %s" % (s.name, str(e)))
+                        s.error = e
+                        failed.append(s)
+        finally:
+            stop.set()
+            if thread is not None:
+                thread.join()
+
+        return failed
@@ -6,12 +6,15 @@ import sys
 import subprocess
 import string
 import signal
-import io
 import shutil
-from collections import deque
+import gzip
+import re
+import time
+import threading
 
 from opendm import context
 from opendm import log
+from opendm.profiler import profiler
 
 class SubprocessException(Exception):
     def __init__(self, msg, errorCode):
@@ -66,8 +69,197 @@ def sighandler(signum, frame):
 signal.signal(signal.SIGINT, sighandler)
 signal.signal(signal.SIGTERM, sighandler)
 
+# Output of each process is read in chunks of this size
+OUTPUT_CHUNK_SIZE = 65536
+
+# Console echo is limited to this rate (bytes / second, with bursts up to ECHO_BURST),
+# the full output is always available in the process log
+ECHO_RATE = 1024 * 1024
+ECHO_BURST = 1024 * 1024
+
+# Number of output lines kept for log.json
+TAIL_LINES = 10
+TAIL_BYTES = 16384
+
+process_log_dir = None
+process_log_counter = 0
+process_log_lock = threading.Lock()
+
+# Number of runs whose process logs are kept
+PROCESS_LOG_RUNS = 5
+
+def set_process_log_dir(path, keep_runs=PROCESS_LOG_RUNS):
+    """
+    Write the full output of every process launched by run()
+    to a compressed file in a new subdirectory of path for this run
+    (None to disable). Only the logs of the last keep_runs runs are kept
+    :return the directory of this run, or None
+    """
+    global process_log_dir, process_log_counter
+
+    with process_log_lock:
+        process_log_counter = 0
+        if path is None:
+            process_log_dir = None
+            return None
+
+        mkdir_p(path)
+
+        # Timestamp first, so that runs sort chronologically
+        run_dir = os.path.join(path, "%s_%s" % (datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f"), os.getpid()))
+        mkdir_p(run_dir)
+        process_log_dir = run_dir
+
+        runs = sorted(d for d in os.listdir(path) if os.path.isdir(os.path.join(path, d)) and d != os.path.basename(run_dir))
+        for d in runs[:max(0, len(runs) - (keep_runs - 1))]:
+            shutil.rmtree(os.path.join(path, d), ignore_errors=True)
+
+        return run_dir
+
+def get_process_log_file(cmd):
+    global process_log_counter
+
+    if process_log_dir is None:
+        return None
+
+    with process_log_lock:
+        process_log_counter += 1
+        counter = process_log_counter
+
+    return os.path.join(process_log_dir, "%04d_%s.log.gz" % (counter, get_process_name(cmd)))
+
+def get_process_name(cmd):
+    """
+    :return name of the program launched by a command line (safe for use in filenames)
+    """
+    tokens = cmd.strip().split()
+    name = os.path.basename(tokens[0].strip("\"'")) if tokens else "process"
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", name)[:40]
+
+class OutputPump(threading.Thread):
+    """
+    Reads the output of a process in large chunks, echoes it
+    to the console (rate limited), writes it to a compressed log file
+    and keeps the last few lines
+    """
+    def __init__(self, stream, log_file=None, echo=True, echo_rate=None, echo_burst=None):
+        super(OutputPump, self).__init__()
+        self.daemon = True
+        self.fd = stream.fileno()
+        self.log_file = log_file
+        self.echo = echo
+        self.echo_rate = echo_rate or ECHO_RATE
+        self.echo_burst = echo_burst or ECHO_BURST
+        self.tokens = self.echo_burst
+        self.last_refill = time.time()
+        self.omitted = 0
+        self.total_bytes = 0
+        self.tail = b""
+        self.error = None
+
+    def run(self):
+        log_fh = None
+        try:
+            if self.log_file is not None:
+                log_fh = gzip.open(self.log_file, "wb", compresslevel=1)
+
+            while True:
+                chunk = os.read(self.fd, OUTPUT_CHUNK_SIZE)
+                if not chunk:
+                    break
+
+                self.total_bytes += len(chunk)
+                if log_fh is not None:
+                    log_fh.write(chunk)
+                self.tail = (self.tail + chunk)[-TAIL_BYTES:]
+                if self.echo:
+                    self._echo(chunk)
+        except Exception as e:
+            self.error = e
+        finally:
+            if log_fh is not None:
+                log_fh.close()
+
+        if self.echo and self.omitted > 0:
+            lines = self.tail_lines()
+            self._write(("\n[... %s bytes not shown%s ...]\n%s\n" % (self.omitted,
+                            ", see %s" % self.log_file if self.log_file else "",
+                            "\n".join(lines))).encode("utf-8"))
+
+    def _echo(self, chunk):
+        now = time.time()
+        self.tokens = min(self.echo_burst, self.tokens + (now - self.last_refill) * self.echo_rate)
+        self.last_refill = now
+
+        if len(chunk) > self.tokens:
+            self.omitted += len(chunk)
+            return
+
+        self.tokens -= len(chunk)
+        if self.omitted > 0:
+            # Resume at the start of a line
+            nl = chunk.find(b"\n")
+            if nl == -1:
+                self.omitted += len(chunk)
+                return
+
+            self.omitted += nl + 1
+            chunk = ("\n[... %s bytes not shown ...]\n" % self.omitted).encode("utf-8") + chunk[nl + 1:]
+            self.omitted = 0
+
+        self._write(chunk)
+
+    def _write(self, data):
+        with log.lock:
+            out = getattr(sys.stdout, "buffer", None)
+            if out is not None:
+                sys.stdout.flush()
+                out.write(data)
+                out.flush()
+            else:
+                sys.stdout.write(data.decode("utf-8", errors="replace"))
+                sys.stdout.flush()
+
+    def tail_lines(self):
+        lines = self.tail.decode("utf-8", errors="replace").splitlines()
+        if len(self.tail) == TAIL_BYTES and len(lines) > 1:
+            # First line is likely truncated
+            lines = lines[1:]
+        return [l.strip() for l in lines[-TAIL_LINES:]]
+
+def wait_process(p):
+    """
+    Wait for a process to terminate
+    :return (return code, resource usage or None if not available)
+    """
+    if not hasattr(os, "wait4"):
+        return p.wait(), None
+
+    while True:
+        try:
+            _, status, rusage = os.wait4(p.pid, 0)
+            break
+        except InterruptedError:
+            continue
+        except ChildProcessError:
+            # Already reaped
+            return p.wait(), None
+
+    if hasattr(os, "waitstatus_to_exitcode"):
+        p.returncode = os.waitstatus_to_exitcode(status)
+    elif os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
+    else:
+        p.returncode = os.WEXITSTATUS(status)
+
+    return p.returncode, rusage
+
 def run(cmd, env_paths=[context.superbuild_bin_path], env_vars={}, packages_paths=context.python_packages_paths, quiet=False):
-    """Run a system command"""
+    """
+    Run a system command
+    :return dict with the command's wall time, CPU time (seconds), peak RSS (bytes),
+        output size and path of the log file with its full output
+    """
     global running_subprocesses
 
     if not quiet:
@@ -90,20 +282,34 @@ def run(cmd, env_paths=[context.superbuild_bin_path], env_vars={}, packages_path
     for k in env_vars:
         env[k] = str(env_vars[k])
 
-    p = subprocess.Popen(cmd, shell=True, env=env, start_new_session=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    running_subprocesses.append(p)
-    lines = deque()
-    for line in io.TextIOWrapper(p.stdout):
-        print(line, end="")
-
-        lines.append(line.strip())
-        if len(lines) == 11:
-            lines.popleft()
-
-    retcode = p.wait()
+    with profiler.span(get_process_name(cmd), "process", command=cmd) as span:
+        start = time.time()
+        p = subprocess.Popen(cmd, shell=True, env=env, start_new_session=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        running_subprocesses.append(p)
+
+        pump = OutputPump(p.stdout, get_process_log_file(cmd))
+        pump.start()
+
+        retcode, rusage = wait_process(p)
+        pump.join()
+        p.stdout.close()
+        wall_time = time.time() - start
+        span.update(exitCode=retcode)
+
+    stats = {
+        'wallTime': round(wall_time, 3),
+        'outputBytes': pump.total_bytes,
+    }
+    if rusage is not None:
+        stats['userTime'] = round(rusage.ru_utime, 3)
+        stats['systemTime'] = round(rusage.ru_stime, 3)
+        # Kilobytes on Linux, bytes on macOS
+        stats['maxRss'] = rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    if pump.log_file is not None and pump.error is None:
+        stats['log'] = pump.log_file
 
     if not quiet:
-        log.logger.log_json_process(cmd, retcode, list(lines))
+        log.logger.log_json_process(cmd, retcode, pump.tail_lines(), stats)
 
     running_subprocesses.remove(p)
     if retcode < 0:
@@ -111,6 +317,8 @@ def run(cmd, env_paths=[context.superbuild_bin_path], env_vars={}, packages_path
     elif retcode > 0:
         raise SubprocessException("Child returned {}".format(retcode), retcode)
 
+    return stats
+
 
 def now():
     """Return the current time"""
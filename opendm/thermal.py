@@ -1,10 +1,19 @@
 import cv2
 import os
+import threading
+from collections import OrderedDict
+import numpy as np
 from opendm import log
 from opendm.thermal_tools import dji_unpack
-from opendm.exiftool import extract_raw_thermal_image_data
+from opendm.exiftool import extract_raw_thermal_images_data
 from opendm.thermal_tools.thermal_utils import sensor_vals_to_temp
 
+# Number of photos whose raw thermal data is extracted with a single exiftool invocation
+THERMAL_BATCH_SIZE = 32
+
+# Raw sensor values covered by the temperature lookup tables (16 bit)
+TEMPERATURE_LUT_SIZE = 65536
+
 def resize_to_match(image, match_photo = None):
     """
     Resize images to match the dimension of another photo
@@ -21,12 +30,168 @@ def resize_to_match(image, match_photo = None):
                     interpolation=cv2.INTER_LANCZOS4)
     return image
 
-def dn_to_temperature(photo, image, images_path):
+def has_raw_thermal_data(photo):
+    """
+    :return True if the temperatures of a thermal photo are computed from
+        the raw thermal image and parameters stored in its metadata (read with exiftool)
+    """
+    if not photo.is_thermal():
+        return False
+    if photo.camera_make == "MicaSense" and photo.camera_model[:5] == "Altum":
+        return False
+    if photo.camera_make == "DJI" and photo.camera_model in ["ZH20T", "MAVIC2-ENTERPRISE-ADVANCED"]:
+        return False
+    return True
+
+def temperature_lut(params, size=TEMPERATURE_LUT_SIZE):
+    """
+    Compute the temperatures of all raw sensor values
+    :param params temperature parameters (from exiftool.extract_temperature_params_from)
+    :param size number of raw values
+    :return float32 numpy array with the temperature (C) of each raw value, NaN for values that cannot be converted
+    """
+    with np.errstate(all='ignore'):
+        lut = sensor_vals_to_temp(np.arange(size, dtype=np.float64), strict=False, **params)
+    return lut.astype(np.float32)
+
+class ThermalEngine:
+    """
+    Converts the raw thermal images of cameras without a dedicated decoder to temperatures.
+    Raw images and parameters are extracted with one exiftool invocation for a batch of photos
+    (the requested photo and the next ones in processing order) and raw values are converted
+    with a lookup table computed once per camera serial and set of parameters.
+    """
+    def __init__(self, images_path, photos=[], batch_size=THERMAL_BATCH_SIZE, max_cached=None, exiftool_path="exiftool"):
+        """
+        :param images_path directory with the original images
+        :param photos list of ODM_Photo that will be converted, in processing order
+        :param batch_size number of photos extracted with each exiftool invocation
+        :param max_cached maximum number of extracted raw images waiting to be converted (default: 4 * batch_size)
+        :param exiftool_path path to the exiftool executable
+        """
+        self.images_path = images_path
+        self.batch_size = max(1, batch_size)
+        self.max_cached = max(self.batch_size, max_cached or 4 * self.batch_size)
+        self.exiftool_path = exiftool_path
+
+        # Photos not yet extracted, in processing order
+        self._queue = OrderedDict((p.filename, True) for p in photos if has_raw_thermal_data(p))
+        self._extracted = OrderedDict() # filename --> (params, image, serial)
+        self._pending = {} # filename --> threading.Event set when its batch is extracted
+        self.calibrations = {} # camera serial --> {params --> lookup table}
+        self.invocations = 0
+        self._lock = threading.Lock()
+
+    def raw_data(self, photo):
+        """
+        :return (params, raw image, serial number) of a photo
+        """
+        filename = photo.filename
+        while True:
+            with self._lock:
+                if filename in self._extracted:
+                    return self._extracted.pop(filename)
+
+                event = self._pending.get(filename)
+                if event is None:
+                    self._queue.pop(filename, None)
+                    batch = [filename]
+                    for f in self._queue:
+                        if len(batch) >= self.batch_size:
+                            break
+                        if f not in self._pending:
+                            batch.append(f)
+                    for f in batch[1:]:
+                        self._queue.pop(f)
+
+                    event = threading.Event()
+                    for f in batch:
+                        self._pending[f] = event
+                    self.invocations += 1
+                    break
+
+            # Being extracted by another thread (if that fails, we try on our own)
+            event.wait()
+
+        results = {}
+        try:
+            results = extract_raw_thermal_images_data([os.path.join(self.images_path, f) for f in batch], self.exiftool_path)
+        finally:
+            with self._lock:
+                for f in batch:
+                    del self._pending[f]
+                    r = results.get(os.path.join(self.images_path, f))
+                    if r is not None and f != filename:
+                        self._extracted[f] = r
+                while len(self._extracted) > self.max_cached:
+                    # Will be extracted again if requested
+                    self._extracted.popitem(last=False)
+            event.set()
+
+        r = results.get(os.path.join(self.images_path, filename))
+        if r is None:
+            raise Exception("Cannot extract raw thermal data")
+        return r
+
+    def lookup_table(self, serial, params):
+        """
+        :return temperature lookup table for the camera with the given serial number and parameters
+        """
+        key = tuple(sorted(params.items()))
+        with self._lock:
+            lut = self.calibrations.get(serial, {}).get(key)
+        if lut is None:
+            lut = temperature_lut(params)
+            with self._lock:
+                lut = self.calibrations.setdefault(serial, {}).setdefault(key, lut)
+        return lut
+
+    def to_temperature(self, raw, params, serial):
+        """
+        Convert raw sensor values to temperatures
+        :param raw numpy array with raw sensor values
+        :param params temperature parameters
+        :param serial camera serial number
+        :return float32 numpy array with temperature (C) values
+        """
+        if np.issubdtype(raw.dtype, np.unsignedinteger) and raw.dtype.itemsize <= 2:
+            image = np.take(self.lookup_table(serial, params), raw)
+            if np.isnan(image).any():
+                raise Exception("Image seems to be corrupted")
+            return image
+        else:
+            return sensor_vals_to_temp(raw, **params).astype("float32")
+
+    def dn_to_temperature(self, photo):
+        """
+        :param photo ODM_Photo
+        :return float32 numpy array with the temperature (C) values of the photo
+        """
+        params, raw, serial = self.raw_data(photo)
+        if serial is None:
+            serial = "%s %s" % (photo.camera_make, photo.camera_model)
+        return self.to_temperature(raw, params, serial)
+
+engines = {}
+engines_lock = threading.Lock()
+
+def get_engine(images_path):
+    """
+    :return the shared ThermalEngine for images_path, used when none is passed to dn_to_temperature
+    """
+    with engines_lock:
+        if images_path not in engines:
+            engines[images_path] = ThermalEngine(images_path)
+        return engines[images_path]
+
+def dn_to_temperature(photo, image, images_path, engine=None):
     """
     Convert Digital Number values to temperature (C) values
     :param photo ODM_Photo
     :param image numpy array containing image data
     :param images_path path to original source image to read data using PIL for DJI thermal photos
+    :param engine ThermalEngine used for cameras whose raw thermal data is read with exiftool.
+        If None, a shared engine without look-ahead is used (one exiftool invocation per photo)
     :return numpy array with temperature (C) image values
     """
 
@@ -56,8 +221,9 @@ def dn_to_temperature(photo, image, images_path):
             return image
         else:
             try:
-                params, image = extract_raw_thermal_image_data(os.path.join(images_path, photo.filename))
-                image = sensor_vals_to_temp(image, **params)
+                if engine is None:
+                    engine = get_engine(images_path)
+                image = engine.dn_to_temperature(photo)
             except Exception as e:
                 log.ODM_WARNING("Cannot radiometrically calibrate %s: %s" % (photo.filename, str(e)))
 
@@ -16,8 +16,10 @@ def sensor_vals_to_temp(
     PlanckF=1,
     PlanckO=-7340,
     PlanckR2=0.012545258,
+    strict=True,
     **kwargs,):
-    """Convert raw values from the thermographic sensor sensor to temperatures in °C. Tested for Flir and DJI cams."""
+    """Convert raw values from the thermographic sensor sensor to temperatures in °C. Tested for Flir and DJI cams.
+    If strict, raise an exception when some values cannot be converted, otherwise return NaN for them."""
     # this calculation has been ported to python from https://github.com/gtatters/Thermimage/blob/master/R/raw2temp.R
     # a detailed explanation of what is going on here can be found there
 
@@ -93,8 +95,11 @@ def sensor_vals_to_temp(
         - raw_refl2_attn
     )
     val_to_log = PlanckR1 / (PlanckR2 * (raw_obj + PlanckO)) + PlanckF
-    if any(val_to_log.ravel() < 0):
-        raise Exception("Image seems to be corrupted")
+    if strict:
+        if any(val_to_log.ravel() < 0):
+            raise Exception("Image seems to be corrupted")
+    else:
+        val_to_log = np.where(val_to_log < 0, np.nan, val_to_log)
     # temperature from radiance
     return PlanckB / np.log(val_to_log) - 273.15
 
@@ -16,7 +16,10 @@ from opendm import context
 from opendm import multispectral
 
 from opendm.progress import progressbc
+from opendm.profiler import profiler
+from opendm.manifest import manifest
 from opendm.photo import ODM_Photo
+from opendm.photoindex import PhotoIndex
 
 # Ignore warnings about proj information being lost
 warnings.filterwarnings("ignore")
@@ -30,6 +33,28 @@ class ODM_Reconstruction(object):
         self.multi_camera = self.detect_multi_camera()
         self.filter_photos()
 
+    @property
+    def photos(self):
+        return self._photos
+
+    @photos.setter
+    def photos(self, photos):
+        self._photos = photos
+        self._index = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = PhotoIndex(self._photos)
+        return self._index
+
+    def invalidate_index(self):
+        """
+        Must be called after modifying self.photos in place
+        (assigning a new list invalidates the index automatically)
+        """
+        self._index = None
+
     def detect_multi_camera(self):
         """
         Looks at the reconstruction photos and determines if this
@@ -88,19 +113,22 @@ class ODM_Reconstruction(object):
                 for filename in p2s:
                     max_files_per_band = max(max_files_per_band, len(p2s[filename]))
 
+                excluded = set()
                 for filename in p2s:
                     if len(p2s[filename]) < max_files_per_band:
                         photos_to_remove = p2s[filename] + [
-                            p for p in self.photos if p.filename == filename
+                            p for p in [self.get_photo(filename)] if p is not None
                         ]
                         for photo in photos_to_remove:
                             log.ODM_WARNING("Excluding %s" % photo.filename)
+                            excluded.add(id(photo))
 
-                            self.photos = [p for p in self.photos if p != photo]
-                            for i in range(len(mc)):
-                                mc[i]["photos"] = [
-                                    p for p in mc[i]["photos"] if p != photo
-                                ]
+                if excluded:
+                    self.photos = [p for p in self.photos if id(p) not in excluded]
+                    for i in range(len(mc)):
+                        mc[i]["photos"] = [
+                            p for p in mc[i]["photos"] if id(p) not in excluded
+                        ]
 
                 log.ODM_INFO("New image count: %s" % len(self.photos))
 
@@ -344,10 +372,25 @@ class ODM_Reconstruction(object):
         else:
             return (None, None)
 
-    def get_photo(self, filename):
+    def compact_photos(self, drop=()):
+        """
+        Release memory used by rarely needed photo attributes
+        :param drop attributes to reset to their default value (see photo.EXTENDED_ATTRIBUTES)
+        """
         for p in self.photos:
-            if p.filename == filename:
-                return p
+            p.compact(drop)
+
+    def get_photo(self, filename):
+        return self.index.get(filename)
+
+    def get_photos_by_band(self, band_name):
+        return self.index.by_band(band_name)
+
+    def get_photos_by_capture_id(self, capture_id):
+        return self.index.by_capture_id(capture_id)
+
+    def get_photos_in_bbox(self, min_lat, min_lon, max_lat, max_lon):
+        return self.index.in_bbox(min_lat, min_lon, max_lat, max_lon)
 
 
 class ODM_GeoRef(object):
@@ -416,6 +459,7 @@ class ODM_Tree(object):
         # benchmarking
         self.benchmarking = os.path.join(self.root_path, "benchmark.txt")
         self.dataset_list = os.path.join(self.root_path, "img_list.txt")
+        self.exif_cache = os.path.join(self.root_path, "exif_cache.json")
 
         # opensfm
         self.opensfm_image_list = os.path.join(self.opensfm, "image_list.txt")
@@ -522,6 +566,14 @@ class ODM_Tree(object):
 
 
 class ODM_Stage:
+    # What the stage reads and writes, used to run independent
+    # stages concurrently (--parallel-stages). Stages that don't declare
+    # their inputs run after all previous stages and before all following ones.
+    requires = None
+    provides = None
+    min_cpus = 1
+    memory_mb = 0
+
     def __init__(self, name, args, progress=0.0, **params):
         self.name = name
         self.args = args
@@ -531,6 +583,7 @@ class ODM_Stage:
             self.params = {}
         self.next_stage = None
         self.prev_stage = None
+        self.inputs_changed = False
 
     def connect(self, stage):
         self.next_stage = stage
@@ -545,15 +598,82 @@ class ODM_Stage:
             (self.args.rerun is not None and self.args.rerun == self.name)
             or (self.args.rerun_all)
             or (self.args.rerun_from is not None and self.name in self.args.rerun_from)
+            or self.inputs_changed
         )
 
+    def input_files(self, args, tree):
+        """
+        :return files and directories read by the stage, other than
+            the outputs of previous stages (used by --incremental-rerun)
+        """
+        return []
+
+    def output_files(self, args, tree):
+        """
+        :return files and directories written by the stage and read by
+            the following stages (used by --incremental-rerun). If a stage
+            declares its outputs, the following stages are not rerun
+            when an option change leaves the outputs unchanged
+        """
+        return []
+
+    def upstream_stages(self):
+        """
+        :return the previous stages this stage depends on (see requires/provides)
+        """
+        result = []
+        stage = self.prev_stage
+        while stage is not None:
+            if self.requires is None or stage.requires is None or \
+               set(self.requires) & set(stage.provides or []):
+                result.append(stage)
+            if stage.requires is None:
+                break
+            stage = stage.prev_stage
+        return result
+
+    def manifest_tree(self, outputs):
+        tree = outputs.get("tree")
+        if tree is None:
+            tree = ODM_Tree(self.args.project_path, self.args.gcp, self.args.geo, self.args.align)
+        return tree
+
     def run(self, outputs={}):
+        self.run_stage(outputs)
+
+        # Last stage?
+        if self.last_to_run():
+            log.ODM_INFO("No more stages to run")
+            return
+
+        # Run next stage?
+        elif self.next_stage is not None:
+            self.next_stage.run(outputs)
+
+    def last_to_run(self):
+        """
+        Is this the last stage to run (because of --end-with or --rerun)?
+        """
+        return self.args.end_with == self.name or self.args.rerun == self.name
+
+    def run_stage(self, outputs):
+        """
+        Run this stage only
+        """
         start_time = system.now_raw()
         log.logger.log_json_stage_run(self.name, start_time)
 
         log.ODM_INFO("Running %s stage" % self.name)
 
-        self.process(self.args, outputs)
+        if manifest.enabled:
+            self.inputs_changed = manifest.changed(self, [s.name for s in self.upstream_stages()],
+                                                   self.args, self.manifest_tree(outputs))
+
+        with profiler.span(self.name, "stage"):
+            self.process(self.args, outputs)
+
+        if manifest.enabled:
+            manifest.record(self, self.args, self.manifest_tree(outputs))
 
         # The tree variable should always be populated at this point
         if outputs.get("tree") is None:
@@ -569,15 +689,6 @@ class ODM_Stage:
         log.ODM_INFO("Finished %s stage" % self.name)
         self.update_progress_end()
 
-        # Last stage?
-        if self.args.end_with == self.name or self.args.rerun == self.name:
-            log.ODM_INFO("No more stages to run")
-            return
-
-        # Run next stage?
-        elif self.next_stage is not None:
-            self.next_stage.run(outputs)
-
     def delta_progress(self):
         if self.prev_stage:
             return max(0.0, self.progress - self.prev_stage.progress)
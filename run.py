@@ -14,6 +14,7 @@ from opendm import io
 from opendm.progress import progressbc
 from opendm.utils import get_processing_results_paths, rm_r
 from opendm.arghelpers import args_to_dict, save_opts, compare_args, find_rerun_stage
+from opendm.manifest import manifest
 
 from stages.odm_app import ODMApp
 
@@ -37,10 +38,18 @@ if __name__ == '__main__':
         exit(1)
 
     opts_json = os.path.join(args.project_path, "options.json")
+    has_manifest = False
+    if args.incremental_rerun:
+        has_manifest = manifest.load(os.path.join(args.project_path, "manifest.json"), args.project_path, config.rerun_stages)
+
     auto_rerun_stage, opts_diff = find_rerun_stage(opts_json, args, config.rerun_stages, config.processopts)
     if auto_rerun_stage is not None and len(auto_rerun_stage) > 0:
-        log.ODM_INFO("Rerunning from: %s" % auto_rerun_stage[0])
-        args.rerun_from = auto_rerun_stage
+        if has_manifest:
+            # Stages using the changed options will be rerun, following stages only if needed
+            log.ODM_INFO("Options have changed, using the manifest to decide which stages to rerun")
+        else:
+            log.ODM_INFO("Rerunning from: %s" % auto_rerun_stage[0])
+            args.rerun_from = auto_rerun_stage
 
     # Print args
     args_dict = args_to_dict(args)
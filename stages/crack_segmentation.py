@@ -104,8 +104,9 @@ class ODMCrackSegmentationStage(types.ODM_Stage):
                         )
 
         # Load crack detection model
+        # No public download location, the model is provided with ODM_MODEL_URL_CRACKDETECTION
         model = ai.get_model(
-            "crackdetection", "http://192.168.13.108:44289/config.json", "v1.0.0"
+            "crackdetection", None, "v1.0.0"
         )
         if model is None:
             log.ODM_WARNING(
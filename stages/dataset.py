@@ -4,7 +4,8 @@ import json
 from opendm import context
 from opendm import io
 from opendm import types
-from opendm.photo import PhotoCorruptedException
+from opendm.photo import PhotoCorruptedException, RADIOMETRIC_ATTRIBUTES
+from opendm.exifcache import ExifCache, parse_photos
 from opendm import log
 from opendm import system
 from opendm.geo import GeoFile
@@ -12,42 +13,51 @@ from shutil import copyfile
 from opendm import progress
 from opendm import boundary
 from opendm import ai
+from opendm import imagesdb
 from opendm.skyremoval.skyfilter import SkyFilter
 from opendm.bgfilter import BgFilter
 from opendm.concurrency import parallel_map
+from opendm.planner import ConcurrencyPlanner, photo_memory_mb
+from opendm.profiler import profiler
 from opendm.video.video2dataset import Parameters, Video2Dataset
 
 
-def save_images_database(photos, database_file):
-    with open(database_file, "w") as f:
-        f.write(json.dumps([p.__dict__ for p in photos]))
-
+def save_images_database(photos, database_file, json_file=None):
+    imagesdb.save_images_database(photos, database_file)
     log.ODM_INFO("Wrote images database: %s" % database_file)
 
+    # Keep a JSON copy for tools that read images.json
+    if json_file is not None:
+        with open(json_file, "w") as f:
+            f.write(json.dumps([p.to_dict() for p in photos]))
 
-def load_images_database(database_file):
-    # Empty is used to create types.ODM_Photo class
-    # instances without calling __init__
-    class Empty:
-        pass
 
-    result = []
+def load_json_images_database(json_file):
+    log.ODM_INFO("Loading images database: %s" % json_file)
+
+    with open(json_file, "r") as f:
+        return [types.ODM_Photo.from_dict(photo_json) for photo_json in json.load(f)]
 
-    log.ODM_INFO("Loading images database: %s" % database_file)
 
-    with open(database_file, "r") as f:
-        photos_json = json.load(f)
-        for photo_json in photos_json:
-            p = Empty()
-            for k in photo_json:
-                setattr(p, k, photo_json[k])
-            p.__class__ = types.ODM_Photo
-            result.append(p)
+def load_images_database(database_file, json_file=None):
+    # Migrate databases from previous versions
+    if not io.file_exists(database_file) and json_file is not None and io.file_exists(json_file):
+        log.ODM_INFO("Converting %s to %s" % (json_file, database_file))
+        imagesdb.save_images_database(load_json_images_database(json_file), database_file)
 
-    return result
+    log.ODM_INFO("Loading images database: %s" % database_file)
+    return imagesdb.load_images_database(database_file)
 
 
 class ODMLoadDatasetStage(types.ODM_Stage):
+    def input_files(self, args, tree):
+        files = [tree.odm_georeferencing_gcp, tree.odm_geo_file, tree.odm_align_file,
+                 os.path.join(args.project_path, "image_groups.txt")]
+        for f in [args.boundary, args.cameras]:
+            if isinstance(f, str) and os.path.isfile(f):
+                files.append(f)
+        return files
+
     def process(self, args, outputs):
         outputs["start_time"] = system.now_raw()
         tree = types.ODM_Tree(args.project_path, args.gcp, args.geo, args.align)
@@ -113,8 +123,9 @@ class ODMLoadDatasetStage(types.ODM_Stage):
         log.ODM_INFO("Loading dataset from: %s" % images_dir)
 
         # check if we rerun cell or not
-        images_database_file = os.path.join(tree.root_path, "images.json")
-        if not io.file_exists(images_database_file) or self.rerun():
+        images_database_file = os.path.join(tree.root_path, "images.npz")
+        images_json_file = os.path.join(tree.root_path, "images.json")
+        if not (io.file_exists(images_database_file) or io.file_exists(images_json_file)) or self.rerun():
             if not os.path.exists(images_dir):
                 raise system.ExitException(
                     "There are no images in %s! Make sure that your project path and dataset name is correct. The current is set to: %s"
@@ -193,17 +204,20 @@ class ODMLoadDatasetStage(types.ODM_Stage):
                 photos = []
                 with open(tree.dataset_list, "w") as dataset_list:
                     log.ODM_INFO("Loading %s images" % len(path_files))
-                    for f in path_files:
-                        try:
-                            p = types.ODM_Photo(f)
-                            p.set_mask(find_mask(f, masks))
-                            photos.append(p)
-                            dataset_list.write(photos[-1].filename + "\n")
-                        except PhotoCorruptedException:
+                    with profiler.span("parse exif", images=len(path_files)):
+                        parsed = parse_photos(path_files, max_workers=args.max_concurrency,
+                                              cache=ExifCache(tree.exif_cache))
+                    for f, p in zip(path_files, parsed):
+                        if isinstance(p, PhotoCorruptedException):
                             log.ODM_WARNING(
                                 "%s seems corrupted and will not be used"
                                 % os.path.basename(f)
                             )
+                            continue
+
+                        p.set_mask(find_mask(f, masks))
+                        photos.append(p)
+                        dataset_list.write(photos[-1].filename + "\n")
 
                 # Check if a geo file is available
                 if tree.odm_geo_file is not None and os.path.isfile(tree.odm_geo_file):
@@ -271,7 +285,16 @@ class ODMLoadDatasetStage(types.ODM_Stage):
                             "v1.0.5",
                         )
                         if model is not None:
-                            sf = SkyFilter(model=model)
+                            # Full resolution float32 RGB image + mask
+                            def sky_memory_cost(item):
+                                return photo_memory_mb(item["p"], bytes_per_pixel=4, copies=2)
+
+                            map_args = ConcurrencyPlanner(args.max_concurrency).map_args(
+                                max(sky_memory_cost(i) for i in sky_images),
+                                memory_cost=sky_memory_cost,
+                                name="Sky masks",
+                            )
+                            sf = SkyFilter(model=model, max_sessions=map_args["max_workers"])
 
                             def parallel_sky_filter(item):
                                 try:
@@ -295,11 +318,12 @@ class ODMLoadDatasetStage(types.ODM_Stage):
                                         % (img, str(e))
                                     )
 
-                            parallel_map(
-                                parallel_sky_filter,
-                                sky_images,
-                                max_workers=args.max_concurrency,
-                            )
+                            with profiler.span("sky masks", images=len(sky_images)):
+                                parallel_map(
+                                    parallel_sky_filter,
+                                    sky_images,
+                                    **map_args
+                                )
 
                             log.ODM_INFO("Sky masks generation completed!")
                         else:
@@ -338,7 +362,16 @@ class ODMLoadDatasetStage(types.ODM_Stage):
                             "v2.9.0",
                         )
                         if model is not None:
-                            bg = BgFilter(model=model)
+                            # Full resolution float32 RGB image + mask
+                            def bg_memory_cost(item):
+                                return photo_memory_mb(item["p"], bytes_per_pixel=4, copies=2)
+
+                            map_args = ConcurrencyPlanner(args.max_concurrency).map_args(
+                                max(bg_memory_cost(i) for i in bg_images),
+                                memory_cost=bg_memory_cost,
+                                name="Background masks",
+                            )
+                            bg = BgFilter(model=model, max_sessions=map_args["max_workers"])
 
                             def parallel_bg_filter(item):
                                 try:
@@ -362,11 +395,12 @@ class ODMLoadDatasetStage(types.ODM_Stage):
                                         % (img, str(e))
                                     )
 
-                            parallel_map(
-                                parallel_bg_filter,
-                                bg_images,
-                                max_workers=args.max_concurrency,
-                            )
+                            with profiler.span("background masks", images=len(bg_images)):
+                                parallel_map(
+                                    parallel_bg_filter,
+                                    bg_images,
+                                    **map_args
+                                )
 
                             log.ODM_INFO("Background masks generation completed!")
                         else:
@@ -381,14 +415,14 @@ class ODMLoadDatasetStage(types.ODM_Stage):
                 # End bg removal
 
                 # Save image database for faster restart
-                save_images_database(photos, images_database_file)
+                save_images_database(photos, images_database_file, images_json_file)
             else:
                 raise system.ExitException(
                     "Not enough supported images in %s" % images_dir
                 )
         else:
             # We have an images database, just load it
-            photos = load_images_database(images_database_file)
+            photos = load_images_database(images_database_file, images_json_file)
 
         log.ODM_INFO("Found %s usable images" % len(photos))
         log.logger.log_json_images(len(photos))
@@ -396,6 +430,12 @@ class ODMLoadDatasetStage(types.ODM_Stage):
         # Create reconstruction object
         reconstruction = types.ODM_Reconstruction(photos)
 
+        # Radiometric fields are only needed for radiometric calibration
+        if args.radiometric_calibration == "none":
+            reconstruction.compact_photos(drop=RADIOMETRIC_ATTRIBUTES)
+        else:
+            reconstruction.compact_photos()
+
         if tree.odm_georeferencing_gcp and not args.use_exif:
             reconstruction.georeference_with_gcp(
                 tree.odm_georeferencing_gcp,
@@ -5,6 +5,8 @@ from opendm import types
 from opendm import io
 from opendm import system
 from opendm import log
+from opendm import dag
+from opendm.profiler import profiler
 
 # Import the new crack segmentation stage
 from stages.crack_segmentation import ODMCrackSegmentationStage
@@ -29,6 +31,7 @@ class ODMApp:
         """
         Initializes the application and defines the ODM application pipeline stages
         """
+        self.args = args
         json_log_paths = [os.path.join(args.project_path, "log.json")]
 
         if args.copy_to:
@@ -36,6 +39,12 @@ class ODMApp:
 
         log.logger.init_json_output(json_log_paths, args)
 
+        # Full output of external tools (compressed, one file per invocation, one directory per run)
+        system.set_process_log_dir(os.path.join(args.project_path, "process_logs"))
+
+        if args.profile:
+            profiler.start(os.path.join(args.project_path, "profile"))
+
         # Add the new crack segmentation stage
         crack_segmentation = ODMCrackSegmentationStage(
             "crack_segmentation", args, progress=2.5
@@ -90,7 +99,10 @@ class ODMApp:
 
     def execute(self):
         try:
-            self.first_stage.run()
+            if self.args.parallel_stages:
+                dag.run_stages(self.first_stage, {})
+            else:
+                self.first_stage.run()
             log.logger.log_json_success()
             return 0
         except system.SubprocessException as e:
@@ -140,4 +152,5 @@ class ODMApp:
             log.logger.log_json_stage_error(str(e), 1, traceback.format_exc())
             raise e
         finally:
+            profiler.stop()
             log.logger.close()
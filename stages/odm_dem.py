@@ -6,6 +6,7 @@ from opendm import log
 from opendm import system
 from opendm import context
 from opendm import types
+from opendm import dag
 from opendm import gsd
 from opendm.dem import commands, utils
 from opendm.cropper import Cropper
@@ -14,6 +15,12 @@ from opendm.tiles.tiler import generate_dem_tiles
 from opendm.cogeo import convert_to_cogeo
 
 class ODMDEMStage(types.ODM_Stage):
+    requires = ['georeferenced_point_cloud', 'bounds', 'reconstruction']
+    provides = ['dem']
+
+    def output_files(self, args, tree):
+        return [tree.path('odm_dem', 'dsm.tif'), tree.path('odm_dem', 'dtm.tif')]
+
     def process(self, args, outputs):
         tree = outputs['tree']
         reconstruction = outputs['reconstruction']
@@ -61,8 +68,10 @@ class ODMDEMStage(types.ODM_Stage):
                 if args.dtm: products.append('dtm')
 
                 radius_steps = commands.get_dem_radius_steps(tree.filtered_point_cloud_stats, args.dem_gapfill_steps, resolution)
+                finished = []
 
-                for product in products:
+                def create_product(product):
+                    max_workers = dag.task_cpus(args.max_concurrency)
                     commands.create_dem(
                             dem_input,
                             product,
@@ -72,9 +81,10 @@ class ODMDEMStage(types.ODM_Stage):
                             outdir=odm_dem_root,
                             resolution=resolution / 100.0,
                             decimation=args.dem_decimation,
-                            max_workers=args.max_concurrency,
+                            max_workers=max_workers,
                             with_euclidean_map=args.dem_euclidean_map,
-                            max_tiles=None if reconstruction.has_geotagged_photos() else math.ceil(len(reconstruction.photos) / 2)
+                            max_tiles=None if reconstruction.has_geotagged_photos() else math.ceil(len(reconstruction.photos) / 2),
+                            tmpdir=os.path.join(odm_dem_root, "%s_tiles_tmp" % product) if args.parallel_stages else None
                         )
 
                     dem_geotiff_path = os.path.join(odm_dem_root, "{}.tif".format(product))
@@ -88,13 +98,21 @@ class ODMDEMStage(types.ODM_Stage):
                         pseudogeo.add_pseudo_georeferencing(dem_geotiff_path)
 
                     if args.tiles:
-                        generate_dem_tiles(dem_geotiff_path, tree.path("%s_tiles" % product), args.max_concurrency, resolution)
+                        generate_dem_tiles(dem_geotiff_path, tree.path("%s_tiles" % product), max_workers, resolution)
                     
                     if args.cog:
-                        convert_to_cogeo(dem_geotiff_path, max_workers=args.max_concurrency)
+                        convert_to_cogeo(dem_geotiff_path, max_workers=max_workers)
 
-                    progress += 40
-                    self.update_progress(progress)
+                    finished.append(product)
+                    self.update_progress(progress + 40 * len(finished))
+
+                # DSM and DTM are independent
+                scheduler = dag.DAGScheduler(parallel=args.parallel_stages, max_cpus=dag.task_cpus(args.max_concurrency))
+                for product in products:
+                    scheduler.add(product, (lambda p: lambda: create_product(p))(product),
+                                  requires=['georeferenced_point_cloud'], provides=[product],
+                                  cpus=args.max_concurrency)
+                scheduler.run()
             else:
                 log.ODM_WARNING('Found existing outputs in: %s' % odm_dem_root)
         else:
@@ -5,6 +5,7 @@ from opendm import log
 from opendm import system
 from opendm import context
 from opendm import types
+from opendm import dag
 from opendm import gsd
 from opendm import orthophoto
 from opendm.osfm import is_submodel
@@ -16,6 +17,12 @@ from opendm.multispectral import get_primary_band_name
 
 
 class ODMOrthoPhotoStage(types.ODM_Stage):
+    requires = ['textured_model', 'bounds', 'reconstruction']
+    provides = ['orthophoto']
+
+    def output_files(self, args, tree):
+        return [tree.odm_orthophoto_tif]
+
     def process(self, args, outputs):
         tree = outputs['tree']
         reconstruction = outputs['reconstruction']
@@ -107,7 +114,7 @@ class ODMOrthoPhotoStage(types.ODM_Stage):
             system.run('"{odm_ortho_bin}" -inputFiles {models} '
                        '-logFile "{log}" -outputFile "{ortho}" -resolution {res} -verbose '
                        '-outputCornerFile "{corners}" {bands} {depth_idx} {inpaint} '
-                       '{utm_offsets} {a_srs} {vars} {gdal_configs} '.format(**kwargs), env_vars={'OMP_NUM_THREADS': args.max_concurrency})
+                       '{utm_offsets} {a_srs} {vars} {gdal_configs} '.format(**kwargs), env_vars={'OMP_NUM_THREADS': dag.task_cpus(args.max_concurrency)})
 
             # Create georeferenced GeoTiff
             if reconstruction.is_georeferenced():
@@ -122,7 +129,7 @@ class ODMOrthoPhotoStage(types.ODM_Stage):
                     compute_cutline(tree.odm_orthophoto_tif, 
                                     bounds_file_path,
                                     cutline_file,
-                                    args.max_concurrency,
+                                    dag.task_cpus(args.max_concurrency),
                                     scale=0.25)
                     
                     if submodel_run:
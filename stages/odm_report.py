@@ -37,6 +37,9 @@ def generate_point_cloud_stats(input_point_cloud, pc_info_file, rerun=False):
             return json.loads(f.read())
 
 class ODMReport(types.ODM_Stage):
+    requires = ['georeferenced_point_cloud', 'dem', 'orthophoto', 'reconstruction']
+    provides = ['report']
+
     def process(self, args, outputs):
         tree = outputs['tree']
         reconstruction = outputs['reconstruction']
@@ -16,6 +16,7 @@ from opendm import multispectral
 from opendm import thermal
 from opendm import nvm
 from opendm.photo import find_largest_photo
+from opendm.imagefilter import UndistortFilter
 
 from opensfm.undistort import add_image_format_extension
 
@@ -36,7 +37,11 @@ class ODMOpenSfMStage(types.ODM_Stage):
             args, tree.stain_overlay, reconstruction=reconstruction, rerun=self.rerun()
         )
         octx.photos_to_metadata(
-            photos, args.rolling_shutter, args.rolling_shutter_readout, self.rerun()
+            photos,
+            args.rolling_shutter,
+            args.rolling_shutter_readout,
+            self.rerun(),
+            archive=args.sfm_metadata_archive,
         )
         self.update_progress(20)
         octx.feature_matching(self.rerun())
@@ -132,61 +137,47 @@ class ODMOpenSfMStage(types.ODM_Stage):
 
         alignment_info = None
         primary_band_name = None
-        largest_photo = None
-        undistort_pipeline = []
-
-        def undistort_callback(shot_id, image):
-            for func in undistort_pipeline:
-                image = func(shot_id, image)
-            return image
 
-        def resize_thermal_images(shot_id, image):
-            photo = reconstruction.get_photo(shot_id)
-            if photo.is_thermal():
-                return thermal.resize_to_match(image, largest_photo)
-            else:
-                return image
+        # Raw thermal data is extracted in batches, following the order of the photos
+        thermal_engine = thermal.ThermalEngine(tree.stain_overlay, photos)
 
-        def radiometric_calibrate(shot_id, image):
-            photo = reconstruction.get_photo(shot_id)
+        def radiometric_calibrate(photo, image, out):
             if photo.is_thermal():
-                return thermal.dn_to_temperature(photo, image, tree.stain_overlay)
+                return thermal.dn_to_temperature(photo, image, tree.stain_overlay, engine=thermal_engine)
             else:
                 return multispectral.dn_to_reflectance(
                     photo,
                     image,
                     use_sun_sensor=args.radiometric_calibration == "camera+sun",
+                    out=out,
                 )
 
-        def align_to_primary_band(shot_id, image):
-            photo = reconstruction.get_photo(shot_id)
-
+        def band_alignment(band_name):
             # No need to align if requested by user
             if args.skip_band_alignment:
-                return image
+                return None
 
             # No need to align primary
-            if photo.band_name == primary_band_name:
-                return image
+            if band_name == primary_band_name:
+                return None
 
-            ainfo = alignment_info.get(photo.band_name)
-            if ainfo is not None:
-                return multispectral.align_image(
-                    image, ainfo["warp_matrix"], ainfo["dimension"]
-                )
-            else:
+            ainfo = (alignment_info or {}).get(band_name)
+            if ainfo is None:
                 log.ODM_WARNING(
-                    "Cannot align %s, no alignment matrix could be computed. Band alignment quality might be affected."
-                    % (shot_id)
+                    "Cannot align %s band, no alignment matrix could be computed. Band alignment quality might be affected."
+                    % (band_name)
                 )
-                return image
+            return ainfo
+
+        # Calibration, resizing and alignment are planned once per band
+        # and applied in a single pass on each image
+        undistort_filter = UndistortFilter(reconstruction.get_photo)
 
         if reconstruction.multi_camera:
-            largest_photo = find_largest_photo([p for p in photos])
-            undistort_pipeline.append(resize_thermal_images)
+            undistort_filter.resize_to = find_largest_photo([p for p in photos])
 
         if args.radiometric_calibration != "none":
-            undistort_pipeline.append(radiometric_calibrate)
+            undistort_filter.calibrate = radiometric_calibrate
 
         image_list_override = None
 
@@ -224,6 +215,7 @@ class ODMOpenSfMStage(types.ODM_Stage):
                         s2p,
                         p2s,
                         max_concurrency=args.max_concurrency,
+                        adaptive=args.band_alignment == "adaptive",
                     )
                 else:
                     log.ODM_WARNING("Skipping band alignment")
@@ -235,10 +227,10 @@ class ODMOpenSfMStage(types.ODM_Stage):
                 octx.add_shots_to_reconstruction(p2s)
                 octx.touch(added_shots_file)
 
-            undistort_pipeline.append(align_to_primary_band)
+            undistort_filter.alignment = band_alignment
 
         octx.convert_and_undistort(
-            self.rerun(), undistort_callback, image_list_override
+            self.rerun(), undistort_filter, image_list_override
         )
 
         self.update_progress(95)
@@ -249,7 +241,7 @@ class ODMOpenSfMStage(types.ODM_Stage):
             # Undistort primary band and write undistorted
             # reconstruction.json, tracks.csv
             octx.convert_and_undistort(
-                self.rerun(), undistort_callback, runId="primary"
+                self.rerun(), undistort_filter, runId="primary"
             )
 
         if not io.file_exists(tree.opensfm_reconstruction_nvm) or self.rerun():
@@ -1,4 +1,5 @@
 import os
+import copy
 import shutil
 import json
 import yaml
@@ -18,8 +19,10 @@ from opendm.dem import pdal, utils
 from opendm.dem.merge import euclidean_merge_dems
 from opensfm.large import metadataset
 from opendm.cropper import Cropper
-from opendm.concurrency import get_max_memory
-from opendm.remote import LocalRemoteExecutor
+from opendm.concurrency import get_max_memory, parallel_imap
+from opendm.submodels import Submodel, SubmodelScheduler, submodel_memory_mb
+from opendm.config import processopts
+from opendm.remote import LocalRemotePool
 from opendm.shots import merge_geojson_shots
 from opendm import point_cloud
 from opendm.utils import double_quote
@@ -28,6 +31,25 @@ from opendm.cogeo import convert_to_cogeo
 from opendm import multispectral
 
 
+def get_submodels(submodel_paths, reconstruction):
+    """
+    :param submodel_paths paths to the OpenSfM directories of the submodels
+    :param reconstruction ODM_Reconstruction of the whole dataset
+    :return list of Submodel, with memory estimated from the size of their images
+    """
+    submodels = []
+    for sp in submodel_paths:
+        project_path = os.path.abspath(os.path.join(sp, ".."))
+        images_dir = os.path.join(project_path, "images")
+        sizes = []
+        if os.path.isdir(images_dir):
+            for filename in os.listdir(images_dir):
+                p = reconstruction.get_photo(filename)
+                sizes.append((p.width or 4000, p.height or 3000) if p is not None else (4000, 3000))
+        submodels.append(Submodel(os.path.basename(project_path), project_path, submodel_memory_mb(sizes)))
+    return submodels
+
+
 class ODMSplitStage(types.ODM_Stage):
     def process(self, args, outputs):
         tree = outputs["tree"]
@@ -100,6 +122,7 @@ class ODMSplitStage(types.ODM_Stage):
                     args.rolling_shutter,
                     args.rolling_shutter_readout,
                     self.rerun(),
+                    archive=args.sfm_metadata_archive,
                 )
 
                 self.update_progress(5)
@@ -191,16 +214,42 @@ class ODMSplitStage(types.ODM_Stage):
                 self.update_progress(25)
 
                 if local_workflow:
-                    for sp in submodel_paths:
+                    scheduler = SubmodelScheduler(args.max_concurrency, args.sm_parallel)
+                    workers, cpus = scheduler.plan(
+                        get_submodels(submodel_paths, reconstruction)
+                    )
+
+                    def reconstruct_submodel(sp):
                         log.ODM_INFO("Reconstructing %s" % sp)
                         local_sp_octx = OSFMContext(sp)
+                        # Always write the planned value (args.max_concurrency when there's a
+                        # single worker) so that a config left by a previous run is not reused
+                        local_sp_octx.update_config({"processes": cpus})
                         local_sp_octx.create_tracks(self.rerun())
                         local_sp_octx.reconstruct(
                             args.rolling_shutter, not args.sfm_no_partial, self.rerun()
                         )
+
+                    done = 0
+                    for result in parallel_imap(
+                        reconstruct_submodel,
+                        submodel_paths,
+                        max_workers=workers,
+                        ordered=False,
+                        return_exceptions=True,
+                    ):
+                        if isinstance(result, Exception):
+                            raise result
+                        done += 1
+                        self.update_progress(25 + 25.0 * done / len(submodel_paths))
                 else:
-                    lre = LocalRemoteExecutor(
-                        args.sm_cluster, args.rolling_shutter, self.rerun()
+                    lre = LocalRemotePool(
+                        [args.sm_cluster],
+                        local_slots=max(1, args.sm_parallel),
+                        rolling_shutter=args.rolling_shutter,
+                        rerun=self.rerun(),
+                        seed_compression=args.sm_seed_compression,
+                        seed_workers=args.max_concurrency,
                     )
                     lre.set_projects(
                         [os.path.abspath(os.path.join(p, "..")) for p in submodel_paths]
@@ -257,15 +306,20 @@ class ODMSplitStage(types.ODM_Stage):
 
                 # Run ODM toolchain for each submodel
                 if local_workflow:
-                    for sp in submodel_paths:
-                        sp_octx = OSFMContext(sp)
 
+                    def run_toolchain(submodel, cpus):
                         log.ODM_INFO("========================")
-                        log.ODM_INFO("Processing %s" % sp_octx.name())
+                        log.ODM_INFO("Processing %s" % submodel.name)
                         log.ODM_INFO("========================")
 
+                        sm_args = args
+                        if cpus != args.max_concurrency:
+                            sm_args = copy.copy(args)
+                            sm_args.max_concurrency = cpus
+                            sm_args.max_concurrency_is_set = True
+
                         argv = get_submodel_argv(
-                            args, tree.submodels_path, sp_octx.name()
+                            sm_args, tree.submodels_path, submodel.name
                         )
 
                         # Re-run the ODM toolchain on the submodel
@@ -273,6 +327,21 @@ class ODMSplitStage(types.ODM_Stage):
                             " ".join(map(double_quote, map(str, argv))),
                             env_vars=os.environ.copy(),
                         )
+
+                    failed = scheduler.run(
+                        get_submodels(submodel_paths, reconstruction),
+                        run_toolchain,
+                        rerun=self.rerun(),
+                        progress_callback=lambda p: self.update_progress(55 + 45.0 * p),
+                        stages=processopts,
+                    )
+                    if failed:
+                        log.ODM_WARNING(
+                            "%s submodels failed: %s. Run the task again to retry them "
+                            "(submodels that have completed will not be processed again)."
+                            % (len(failed), ", ".join(s.name for s in failed))
+                        )
+                        raise failed[0].error
                 else:
                     lre.set_projects(
                         [os.path.abspath(os.path.join(p, "..")) for p in submodel_paths]
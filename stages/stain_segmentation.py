@@ -7,12 +7,19 @@ from opendm import types
 from opendm import log
 from opendm import system
 import os
+import time
 
 from opendm import context
 from opendm.photo import PhotoCorruptedException
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from opendm.exifcache import ExifCache, parse_photos
+from opendm.planner import ConcurrencyPlanner, photo_memory_mb
+from opendm.profiler import profiler
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
 class ODMStainSegmentationStage(types.ODM_Stage):
+    def input_files(self, args, tree):
+        return [tree.dataset_raw]
+
     def process(self, args, outputs):
         log.ODM_INFO("Running stain detection on images")
 
@@ -83,20 +90,24 @@ class ODMStainSegmentationStage(types.ODM_Stage):
             photos = []
             with open(tree.dataset_list, "w") as dataset_list:
                 log.ODM_INFO("Loading %s images" % len(path_files))
-                for f in path_files:
-                    try:
-                        p = types.ODM_Photo(f)
-                        p.set_mask(find_mask(f, masks))
-                        photos.append(p)
-                        dataset_list.write(photos[-1].filename + "\n")
-                    except PhotoCorruptedException:
+                with profiler.span("parse exif", images=len(path_files)):
+                    parsed = parse_photos(path_files, max_workers=args.max_concurrency,
+                                          cache=ExifCache(tree.exif_cache))
+                for f, p in zip(path_files, parsed):
+                    if isinstance(p, PhotoCorruptedException):
                         log.ODM_WARNING(
                             "%s seems corrupted and will not be used"
                             % os.path.basename(f)
                         )
+                        continue
+
+                    p.set_mask(find_mask(f, masks))
+                    photos.append(p)
+                    dataset_list.write(photos[-1].filename + "\n")
 
+        # No public download location, the model is provided with ODM_MODEL_URL_STAINDETECTION
         model = ai.get_model(
-            "staindetection", "http://192.168.13.108:44289/config.json", "v1.0.0"
+            "staindetection", None, "v1.0.0"
         )
         if model is None:
             log.ODM_WARNING(
@@ -107,13 +118,21 @@ class ODMStainSegmentationStage(types.ODM_Stage):
         stain_detector = StainDetector(model_path=model)
         geo_copier = GeolocationProcessor()
 
-        def process_image(photo):
-            input_image = os.path.join(images_dir, photo.filename)
+        def output_paths(photo):
             output_overlay = os.path.join(stain_overlay_dir, photo.filename)
             output_mask = os.path.join(stain_mask_dir, os.path.splitext(photo.filename)[0] + "_mask.png")
+            return output_overlay, output_mask
+
+        def process_image(photo, detection=None):
+            input_image = os.path.join(images_dir, photo.filename)
+            output_overlay, output_mask = output_paths(photo)
 
             try:
-                stain_detector.detect_and_overlay(input_image, output_overlay, output_mask)
+                if detection is None:
+                    stain_detector.detect_and_overlay(input_image, output_overlay, output_mask)
+                else:
+                    image, mask = detection
+                    stain_detector.save_outputs(image, mask, output_overlay, output_mask)
                 log.ODM_INFO(f"Generated stain overlay and mask for {photo.filename}")
                 geo_copier.process_image(input_image, output_overlay)
                 return output_overlay, output_mask
@@ -132,9 +151,61 @@ class ODMStainSegmentationStage(types.ODM_Stage):
                     except Exception as e:
                         log.ODM_ERROR(f"Error processing {futures[future]}: {e}")
 
-        results = list(
-            parallel_map(process_image, photos, max_workers=args.max_concurrency)
-        )
+        def batched_map(max_workers=None):
+            # Inference runs on this thread in batches, while decoding
+            # happens ahead of it on loader threads and writing the results
+            # (overlay, mask, geotags) happens on a thread pool
+            max_workers = max(1, max_workers or 1)
+            photos_by_path = {os.path.join(images_dir, p.filename): p for p in photos}
+            start = time.time()
+
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {}
+
+                def collect(done):
+                    for future in done:
+                        try:
+                            yield future.result()
+                        except Exception as e:
+                            log.ODM_ERROR(f"Error processing {futures[future]}: {e}")
+                        del futures[future]
+
+                for input_image, image, mask in stain_detector.detect_batch(list(photos_by_path.keys()),
+                                                                            batch_size=args.stain_batch_size,
+                                                                            loader_threads=max(1, max_workers // 2)):
+                    photo = photos_by_path[input_image]
+                    if image is None:
+                        log.ODM_ERROR(f"Error processing {photo}: Could not load image: {input_image}")
+                        continue
+                    futures[executor.submit(process_image, photo, (image, mask))] = photo
+
+                    # Don't keep too many decoded images in memory
+                    if len(futures) >= max_workers * 2:
+                        done, _ = wait(list(futures.keys()), return_when=FIRST_COMPLETED)
+                        yield from collect(done)
+
+                yield from collect(list(as_completed(list(futures.keys()))))
+
+            elapsed = time.time() - start
+            log.ODM_INFO("Stain detection throughput: %.2f images/s" % (len(photos) / max(elapsed, 1e-6)))
+
+        # Decoded RGB image, overlay and mask of the largest photo
+        largest = max(photos, key=lambda p: (p.width or 0) * (p.height or 0)) if photos else None
+        max_workers = args.max_concurrency
+        if largest is not None:
+            max_workers = ConcurrencyPlanner(args.max_concurrency).plan(
+                photo_memory_mb(largest, copies=3), name="Stain detection")
+
+        try:
+            with profiler.span("stain detection", images=len(photos)):
+                if args.stain_batch_size > 1:
+                    results = list(batched_map(max_workers=max_workers))
+                else:
+                    results = list(
+                        parallel_map(process_image, photos, max_workers=max_workers)
+                    )
+        finally:
+            geo_copier.close()
 
         overlay_images = [result[0] for result in results if result is not None]
         mask_images = [result[1] for result in results if result is not None]
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# Minimal stand-in for exiftool, speaking the same command line and
+# -stay_open protocol. Tags are stored in a <file>.tags.json sidecar.
+import json
+import os
+import sys
+
+
+def load_tags(f):
+    sidecar = f + ".tags.json"
+    if os.path.isfile(sidecar):
+        with open(sidecar) as fin:
+            return json.load(fin)
+    return {}
+
+
+def run(args):
+    tags = [a[1:] for a in args if a.startswith("-") and "=" not in a and a not in ("-json", "-overwrite_original")]
+    writes = dict(a[1:].split("=", 1) for a in args if a.startswith("-") and "=" in a)
+    files = [a for a in args if not a.startswith("-")]
+
+    if writes:
+        updated = 0
+        for f in files:
+            if os.path.isfile(f):
+                t = load_tags(f)
+                t.update(writes)
+                with open(f + ".tags.json", "w") as fout:
+                    json.dump(t, fout)
+                updated += 1
+        return "    %s image files updated\n" % updated
+    else:
+        out = []
+        for f in files:
+            if os.path.isfile(f):
+                t = load_tags(f)
+                d = {"SourceFile": f}
+                for k in tags:
+                    if k in t:
+                        d[k] = t[k]
+                out.append(d)
+        return json.dumps(out, indent=4) + "\n"
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    if argv[:4] == ["-stay_open", "True", "-@", "-"]:
+        args = []
+        stay_open = False
+        for line in sys.stdin:
+            line = line.rstrip("\n")
+            if stay_open:
+                if line == "False":
+                    break
+                stay_open = False
+            elif line == "-stay_open":
+                stay_open = True
+            elif line.startswith("-execute"):
+                sys.stdout.write(run(args))
+                sys.stdout.write("{ready%s}\n" % line[len("-execute"):])
+                sys.stdout.flush()
+                args = []
+            else:
+                args.append(line)
+    else:
+        sys.stdout.write(run(argv))
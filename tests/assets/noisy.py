@@ -0,0 +1,18 @@
+# Prints a lot of short lines, like chatty command line tools do
+# Usage: python noisy.py <lines> [exit code] [megabytes to allocate]
+import sys
+
+lines = int(sys.argv[1])
+code = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+alloc = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+
+buf = bytearray(alloc * 1024 * 1024)
+for i in range(0, len(buf), 4096):
+    buf[i] = 1
+
+out = sys.stdout
+for i in range(lines):
+    out.write("Processing item %s of %s... done\n" % (i + 1, lines))
+out.write("Last line\n")
+out.flush()
+sys.exit(code)
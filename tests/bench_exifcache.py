@@ -0,0 +1,44 @@
+# Compares sequential EXIF parsing against opendm.exifcache.parse_photos
+# (parallel, cold cache) and a warm cache rerun, on synthetic JPEGs with EXIF/XMP.
+# Usage: python3 -m tests.bench_exifcache [--images N] [--workers N]
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from opendm import context
+from opendm.photo import ODM_Photo
+from opendm.exifcache import ExifCache, parse_photos
+from tests.test_exifcache import create_image
+
+
+def timed(label, func, count):
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    print("%-28s %8.2fs %10.1f images/s" % (label, elapsed, count / elapsed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="EXIF parsing benchmark")
+    parser.add_argument("--images", type=int, default=3000)
+    parser.add_argument("--workers", type=int, default=context.num_cores)
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        files = []
+        for i in range(args.images):
+            f = os.path.join(tmp_dir, "IMG_%05d.JPG" % i)
+            create_image(f, i)
+            files.append(f)
+        cache_file = os.path.join(tmp_dir, "exif_cache.json")
+
+        print("Images: %s, workers: %s" % (args.images, args.workers))
+        timed("sequential (no cache)", lambda: [ODM_Photo(f) for f in files], args.images)
+        timed("parallel (cold cache)", lambda: parse_photos(files, max_workers=args.workers, cache=ExifCache(cache_file)), args.images)
+        timed("parallel (warm cache)", lambda: parse_photos(files, max_workers=args.workers, cache=ExifCache(cache_file)), args.images)
+    finally:
+        shutil.rmtree(tmp_dir)
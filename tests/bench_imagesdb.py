@@ -0,0 +1,78 @@
+# Compares load time and peak RSS of images.json against the columnar images.npz database.
+# Usage: python3 -m tests.bench_imagesdb [--images N]
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+
+from tests import benchutil
+
+
+def synthetic_photo(i):
+    return {
+        'filename': 'DJI_%05d.JPG' % i, 'mask': None, 'width': 5472, 'height': 3648,
+        'camera_make': 'DJI', 'camera_model': 'FC6310', 'orientation': 1,
+        'latitude': 46.842 + i * 1e-6, 'longitude': -91.994 + i * 1e-6, 'altitude': 198.2 + (i % 50),
+        'band_name': 'RGB', 'band_index': 0, 'capture_uuid': 'c%s' % i,
+        'fnumber': 2.8, 'radiometric_calibration': None, 'black_level': None, 'gain': None, 'gain_adjustment': None,
+        'exposure_time': 0.001, 'iso_speed': 100, 'bits_per_sample': None,
+        'vignetting_center': None, 'vignetting_polynomial': None, 'spectral_irradiance': None,
+        'horizontal_irradiance': None, 'irradiance_scale_to_si': None, 'utc_time': 1571316712000.0 + i * 2000,
+        'yaw': 12.5, 'pitch': 0.1, 'roll': 0.0, 'omega': 0.1, 'phi': -0.2, 'kappa': 12.5,
+        'sun_sensor': None, 'dls_yaw': None, 'dls_pitch': None, 'dls_roll': None,
+        'speed_x': 1.2, 'speed_y': -3.1, 'speed_z': 0.0, 'exif_width': 5472, 'exif_height': 3648,
+        'gps_xy_stddev': None, 'gps_z_stddev': None, 'camera_projection': 'brown', 'focal_ratio': 0.7,
+    }
+
+
+LOADERS = {
+    'json': "photos = [ODM_Photo.from_dict(d) for d in json.load(open(db_file))]",
+    'npz (lazy)': "from opendm.imagesdb import load_images_database as load; photos = load(db_file)",
+    'npz (materialized)': "from opendm.imagesdb import load_images_database as load; photos = list(load(db_file))",
+}
+
+
+def measure(loader, db_file):
+    code = """
+import time
+db_file = sys.argv[1]
+from opendm.photo import ODM_Photo
+from opendm.imagesdb import load_images_database
+
+reset_peak_rss()
+base = status("VmRSS")
+start = time.time()
+%s
+elapsed = time.time() - start
+report(time=elapsed, rss=status("VmRSS") - base, peak=status("VmHWM") - base, count=len(photos))
+""" % loader
+    return benchutil.measure(code, db_file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Images database benchmark")
+    parser.add_argument("--images", type=int, default=20000)
+    args = parser.parse_args()
+
+    from opendm.photo import ODM_Photo
+    from opendm.imagesdb import save_images_database
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        photos = [ODM_Photo.from_dict(synthetic_photo(i)) for i in range(args.images)]
+        npz_file = os.path.join(tmp_dir, "images.npz")
+        json_file = os.path.join(tmp_dir, "images.json")
+        save_images_database(photos, npz_file)
+        with open(json_file, "w") as f:
+            f.write(json.dumps([p.to_dict() for p in photos]))
+
+        print("Images: %s" % args.images)
+        print("images.json: %.1f MB, images.npz: %.1f MB" % (os.path.getsize(json_file) / 1024 / 1024, os.path.getsize(npz_file) / 1024 / 1024))
+        print("%-20s %10s %14s %14s" % ("loader", "time (s)", "RSS (MB)", "peak RSS (MB)"))
+        for name, loader in LOADERS.items():
+            r = measure(loader, json_file if name == 'json' else npz_file)
+            print("%-20s %10.3f %14.1f %14.1f" % (name, r['time'], r['rss'] / 1024, r['peak'] / 1024))
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,67 @@
+# Logging throughput and memory of ODMLogger with millions of messages:
+# previous behavior (every message kept in memory until close) against
+# the streamed log.jsonl. Console output goes to /dev/null.
+# Usage: python3 -m tests.bench_log [--messages N]
+
+import argparse
+import tempfile
+
+from tests import benchutil
+
+CODE = """
+import os, time
+from argparse import Namespace
+from opendm import log
+
+class LegacyLogger(log.ODMLogger):
+    def log(self, startc, msg, level_name):
+        level = ("[" + level_name + "]").ljust(9)
+        with log.lock:
+            print("%s%s %s%s" % (startc, level, msg, log.ENDC))
+            sys.stdout.flush()
+            if self.json is not None:
+                self.json['stages'][-1]['messages'].append({
+                    'message': msg,
+                    'type': level_name.lower()
+                })
+
+mode, count, outdir = sys.argv[1], int(sys.argv[2]), sys.argv[3]
+sys.stdout = open(os.devnull, "w")
+
+logger = LegacyLogger() if mode == 'legacy' else log.ODMLogger()
+logger.init_json_output([os.path.join(outdir, "log.json")], Namespace(project_path=outdir))
+if mode == 'legacy':
+    # Legacy logger didn't stream
+    logger.jsonl.close()
+    logger.jsonl = None
+logger.log_json_stage_run("dataset", logger.start_time)
+if mode == 'legacy':
+    logger.json['stages'][-1]['messages'] = []
+
+reset_peak_rss()
+base = status("VmRSS")
+
+start = time.time()
+for i in range(count):
+    logger.info("Processing image %s: found 12345 features" % i)
+elapsed = time.time() - start
+rss = status("VmRSS") - base
+
+logger.close()
+total = time.time() - start
+
+report(elapsed=elapsed, total=total, rss=rss, peak=status("VmHWM") - base)
+"""
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ODMLogger benchmark")
+    parser.add_argument("--messages", type=int, default=2000000)
+    args = parser.parse_args()
+
+    print("Messages: %s" % args.messages)
+    print("%-22s %12s %12s %12s %14s" % ("logger", "msg/s", "incl. close", "RSS (MB)", "peak RSS (MB)"))
+    for mode, label in [('legacy', 'in memory (previous)'), ('streaming', 'streamed log.jsonl')]:
+        with tempfile.TemporaryDirectory() as outdir:
+            r = benchutil.measure(CODE, mode, args.messages, outdir)
+            print("%-22s %12.0f %12.0f %12.1f %14.1f" % (label, args.messages / r['elapsed'], args.messages / r['total'],
+                                                        r['rss'] / 1024, r['peak'] / 1024))
@@ -0,0 +1,76 @@
+# Measures model loading in opendm.ai: session creation from the ONNX model,
+# from its optimized ORT copy and from shared ORT bytes, and the cost of
+# verifying a cached model directory.
+# Usage: python3 -m tests.bench_models [model.onnx] [--sessions N]
+# If no model is given, a synthetic convolutional model is generated (requires onnx).
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from opendm import ai
+from opendm.net import sha256sum
+from tests.bench_sessionpool import create_model
+
+
+def timed(func, repeat=1):
+    start = time.time()
+    for _ in range(repeat):
+        func()
+    return (time.time() - start) / repeat
+
+
+def bench(model, sessions):
+    import onnxruntime as ort
+
+    ort_model = model[:-len(".onnx")] + ".ort"
+    if os.path.isfile(ort_model):
+        os.remove(ort_model)
+
+    results = []
+    results.append(("session from .onnx", timed(lambda: ort.InferenceSession(model, providers=["CPUExecutionProvider"]), sessions)))
+    results.append(("create .ort (once)", timed(lambda: ai.optimized_model(model))))
+    results.append(("session from .ort", timed(lambda: ai.create_session(model, providers=["CPUExecutionProvider"]), sessions)))
+
+    with open(ort_model, 'rb') as f:
+        model_bytes = f.read()
+    results.append(("session from shared bytes", timed(lambda: ai.create_session(model, providers=["CPUExecutionProvider"], model_bytes=model_bytes), sessions)))
+    return results
+
+
+def bench_verify(model):
+    model_dir = tempfile.mkdtemp()
+    try:
+        shutil.copy(model, model_dir)
+        ai.verify_model_dir(model_dir)
+        return [
+            ("verify (cached stat)", timed(lambda: ai.verify_model_dir(model_dir), 10)),
+            ("full sha256", timed(lambda: sha256sum(os.path.join(model_dir, os.path.basename(model))), 10)),
+        ]
+    finally:
+        shutil.rmtree(model_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Model loading benchmark")
+    parser.add_argument("model", nargs="?", default=None)
+    parser.add_argument("--sessions", type=int, default=5)
+    parser.add_argument("--size", type=int, default=256)
+    args = parser.parse_args()
+
+    model = args.model
+    if model is None:
+        model = os.path.join(tempfile.mkdtemp(), "bench.onnx")
+        create_model(model, args.size)
+    else:
+        # Don't write next to the user's model
+        tmp = os.path.join(tempfile.mkdtemp(), os.path.basename(model))
+        shutil.copy(model, tmp)
+        model = tmp
+
+    print("Model: %s (%.1f MB)" % (model, os.path.getsize(model) / 1024.0 / 1024.0))
+    print("%28s %12s" % ("", "ms"))
+    for name, seconds in bench(model, args.sessions) + bench_verify(model):
+        print("%28s %12.2f" % (name, seconds * 1000))
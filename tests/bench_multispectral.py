@@ -0,0 +1,50 @@
+# Compares per-image latency and peak memory of multispectral.dn_to_radiance
+# with the previous implementation (full-resolution float64 fields for every image)
+# over a synthetic 5-band capture set.
+# Usage: python3 -m tests.bench_multispectral [--captures N] [--width W] [--height H]
+
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+from opendm import multispectral
+from tests.test_multispectral import band_photo, legacy_dn_to_radiance
+
+BANDS = ["Blue", "Green", "Red", "NIR", "RedEdge"]
+
+
+def bench(name, func, captures, width, height):
+    rng = np.random.default_rng(0)
+    photos = [band_photo(b, width=width, height=height, exposure_time=0.001 * (1 + (i % 3)))
+              for i in range(captures) for b in BANDS]
+    image = rng.integers(4000, 65535, (height, width, 1)).astype(np.uint16)
+    multispectral.correction_fields.clear()
+
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    latencies = []
+    for p in photos:
+        start = time.time()
+        func(p, image)
+        latencies.append(time.time() - start)
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+
+    latencies = np.array(latencies) * 1000
+    print("%12s %10.2f %10.2f %10.2f %12.1f" % (name, latencies[0], np.median(latencies),
+                                                 latencies.mean(), peak / 1024.0 / 1024.0))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Radiometric calibration benchmark")
+    parser.add_argument("--captures", type=int, default=20)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=960)
+    args = parser.parse_args()
+
+    print("%s captures x %s bands, %sx%s" % (args.captures, len(BANDS), args.width, args.height))
+    print("%12s %10s %10s %10s %12s" % ("", "first ms", "median ms", "mean ms", "peak MB"))
+    bench("legacy", legacy_dn_to_radiance, args.captures, args.width, args.height)
+    bench("cached", multispectral.dn_to_radiance, args.captures, args.width, args.height)
@@ -0,0 +1,56 @@
+# Compares peak RSS of 50k photos stored as plain per-object __dict__
+# (the previous ODM_Photo layout) against the slotted ODM_Photo,
+# before and after dropping radiometric fields.
+# Usage: python3 -m tests.bench_photo [--photos N]
+
+import argparse
+
+from tests import benchutil
+
+CODE = """
+from opendm.photo import ODM_Photo, RADIOMETRIC_ATTRIBUTES
+from tests.bench_imagesdb import synthetic_photo
+
+class LegacyPhoto:
+    pass
+
+def legacy(d):
+    p = LegacyPhoto()
+    for k, v in d.items():
+        setattr(p, k, v)
+    return p
+
+mode, count = sys.argv[1], int(sys.argv[2])
+dicts = [synthetic_photo(i) for i in range(1000)]
+# Radiometric fields, as found in a multispectral dataset
+for d in dicts:
+    d['black_level'] = '4800 4800 4800 4800'
+    d['radiometric_calibration'] = '0.00013 1.2e-07 1.5e-05'
+    d['vignetting_center'] = '640.1 480.7'
+    d['dls_yaw'] = 0.1
+    d['speed_x'] = d['speed_y'] = d['speed_z'] = None
+
+reset_peak_rss()
+base = status("VmRSS")
+
+if mode == 'legacy':
+    photos = [legacy(dicts[i % 1000]) for i in range(count)]
+else:
+    photos = [ODM_Photo.from_dict(dicts[i % 1000]) for i in range(count)]
+    if mode == 'compact':
+        for p in photos:
+            p.compact(drop=RADIOMETRIC_ATTRIBUTES)
+
+report(rss=status("VmRSS") - base, peak=status("VmHWM") - base)
+"""
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ODM_Photo memory benchmark")
+    parser.add_argument("--photos", type=int, default=50000)
+    args = parser.parse_args()
+
+    print("Photos: %s" % args.photos)
+    print("%-28s %14s %14s" % ("layout", "RSS (MB)", "peak RSS (MB)"))
+    for mode, label in [('legacy', '__dict__ (previous)'), ('slots', 'slots'), ('compact', 'slots + compact()')]:
+        r = benchutil.measure(CODE, mode, args.photos)
+        print("%-28s %14.1f %14.1f" % (label, r['rss'] / 1024, r['peak'] / 1024))
@@ -0,0 +1,78 @@
+# Compares a linear scan over the photo list (the previous
+# ODM_Reconstruction.get_photo) against PhotoIndex lookups,
+# for a per-shot loop over every photo and for GPS bounding box queries.
+# Usage: python3 -m tests.bench_photoindex [--photos N] [--queries N]
+
+import argparse
+import random
+import time
+from opendm.photoindex import PhotoIndex
+
+class PhotoMock:
+    __slots__ = ('filename', 'band_name', 'latitude', 'longitude', 'capture_id')
+
+    def __init__(self, i, bands):
+        self.filename = "IMG_%06d_%s.tif" % (i // bands, i % bands)
+        self.band_name = "band%s" % (i % bands)
+        self.capture_id = i // bands
+        self.latitude = 40.0 + (i // bands % 200) * 1e-4
+        self.longitude = -74.0 + (i // bands // 200) * 1e-4
+
+    def get_capture_id(self):
+        return self.capture_id
+
+def linear_get(photos, filename):
+    for p in photos:
+        if p.filename == filename:
+            return p
+
+def linear_bbox(photos, min_lat, min_lon, max_lat, max_lon):
+    return [p for p in photos if p.latitude is not None and p.longitude is not None and
+            min_lat <= p.latitude <= max_lat and min_lon <= p.longitude <= max_lon]
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Photo lookup benchmark")
+    parser.add_argument("--photos", type=int, default=20000)
+    parser.add_argument("--bands", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--linear-shots", type=int, default=2000,
+                        help="Number of shots to time with the linear scan (extrapolated to all photos)")
+    args = parser.parse_args()
+
+    photos = [PhotoMock(i, args.bands) for i in range(args.photos)]
+    filenames = [p.filename for p in photos]
+    random.seed(1)
+    random.shuffle(filenames)
+
+    print("Photos: %s" % args.photos)
+
+    sample = filenames[:args.linear_shots]
+    _, t = timed(lambda: [linear_get(photos, f) for f in sample])
+    linear_total = t * len(filenames) / len(sample)
+    print("%-40s %10.3fs (extrapolated from %s shots)" % ("per-shot get_photo, linear scan", linear_total, len(sample)))
+
+    index = PhotoIndex(photos)
+    _, build = timed(lambda: index.get(filenames[0]))
+    _, t = timed(lambda: [index.get(f) for f in filenames])
+    print("%-40s %10.3fs (+ %.3fs index build)" % ("per-shot get_photo, index", t, build))
+    print("%-40s %10.1fx" % ("speedup", linear_total / (t + build)))
+
+    boxes = []
+    for _ in range(args.queries):
+        lat, lon = photos[random.randrange(len(photos))].latitude, photos[random.randrange(len(photos))].longitude
+        boxes.append((lat - 2e-4, lon - 2e-4, lat + 2e-4, lon + 2e-4))
+
+    expected, t_linear = timed(lambda: [linear_bbox(photos, *b) for b in boxes])
+    _, build = timed(lambda: index.in_bbox(0, 0, 0, 0))
+    result, t_index = timed(lambda: [index.in_bbox(*b) for b in boxes])
+    assert [sorted(p.filename for p in r) for r in result] == [sorted(p.filename for p in r) for r in expected]
+    print("%-40s %10.3fs" % ("%s bbox queries, linear scan" % args.queries, t_linear))
+    print("%-40s %10.3fs (+ %.3fs index build)" % ("%s bbox queries, index" % args.queries, t_index, build))
+
+    _, t = timed(lambda: [index.by_band("band%s" % (i % args.bands)) for i in range(args.queries)])
+    print("%-40s %10.3fs" % ("%s band queries, index" % args.queries, t))
@@ -0,0 +1,91 @@
+# Measures inference throughput of opendm.ai.SessionPool as sessions are added.
+# Usage: python3 -m tests.bench_sessionpool [model.onnx] [--images N]
+# If no model is given, a synthetic convolutional model is generated (requires onnx).
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from opendm import ai
+from opendm import context
+
+
+def create_model(path, size):
+    import onnx
+    from onnx import helper, TensorProto
+
+    rng = np.random.default_rng(0)
+    nodes, inits = [], []
+    prev = "input"
+    for i in range(4):
+        w = rng.standard_normal((3, 3, 3, 3)).astype(np.float32) * 0.1
+        inits.append(helper.make_tensor("w%s" % i, TensorProto.FLOAT, w.shape, w.flatten().tolist()))
+        nodes.append(helper.make_node("Conv", [prev, "w%s" % i], ["c%s" % i], pads=[1, 1, 1, 1]))
+        nodes.append(helper.make_node("Relu", ["c%s" % i], ["r%s" % i]))
+        prev = "r%s" % i
+    nodes.append(helper.make_node("Identity", [prev], ["output"]))
+
+    graph = helper.make_graph(nodes, "bench",
+        [helper.make_tensor_value_info("input", TensorProto.FLOAT, [1, 3, size, size])],
+        [helper.make_tensor_value_info("output", TensorProto.FLOAT, [1, 3, size, size])], inits)
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8
+    onnx.save(model, path)
+
+
+def bench(model, sessions, images):
+    threads_per_session = max(1, context.num_cores // sessions)
+    pool = ai.SessionPool(model, max_sessions=sessions, intra_op_num_threads=threads_per_session, memory_per_session=1)
+    inp = pool.get_inputs()[0]
+    shape = [d if isinstance(d, int) else 1 for d in inp.shape]
+    x = np.random.random(shape).astype(np.float32)
+
+    # Warm up every session
+    for _ in range(pool.size):
+        pool.run(None, {inp.name: x})
+
+    remaining = [images]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            pool.run(None, {inp.name: x})
+
+    start = time.time()
+    workers = [threading.Thread(target=worker) for _ in range(context.num_cores)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.time() - start
+
+    return pool.size, threads_per_session, images / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SessionPool throughput benchmark")
+    parser.add_argument("model", nargs="?", default=None)
+    parser.add_argument("--images", type=int, default=200)
+    parser.add_argument("--size", type=int, default=256)
+    args = parser.parse_args()
+
+    model = args.model
+    if model is None:
+        model = os.path.join(tempfile.mkdtemp(), "bench.onnx")
+        create_model(model, args.size)
+
+    print("Cores: %s" % context.num_cores)
+    print("%10s %10s %12s" % ("sessions", "threads", "images/s"))
+    sessions = 1
+    while sessions <= context.num_cores:
+        size, threads, ips = bench(model, sessions, args.images)
+        print("%10s %10s %12.2f" % (size, threads, ips))
+        sessions *= 2
@@ -0,0 +1,99 @@
+# Compares writing and reading the OpenSfM image metadata of a synthetic dataset
+# as one exif/<image>.exif file per image (previous implementation) and as a single
+# metadata archive (opendm.exifarchive), read through the DataSet adapter.
+# A latency shim adds a fixed delay to every file open, to simulate the per-file
+# round trips of a network file system.
+# Usage: python3 -m tests.bench_sfm_metadata [--images N] [--latency MS [MS ...]]
+
+import argparse
+import builtins
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from opendm import exifarchive
+from opendm.photo import ODM_Photo
+from tests.bench_imagesdb import synthetic_photo
+from tests.test_exifarchive import FileDataSet
+
+
+class ArchiveDataSet(FileDataSet):
+    pass
+
+exifarchive.install(ArchiveDataSet)
+
+
+class LatencyShim:
+    def __init__(self, latency):
+        self.latency = latency
+        self.open = builtins.open
+
+    def __enter__(self):
+        def slow_open(*args, **kwargs):
+            time.sleep(self.latency)
+            return self.open(*args, **kwargs)
+        if self.latency > 0:
+            builtins.open = slow_open
+
+    def __exit__(self, *args):
+        builtins.open = self.open
+
+
+def write_files(exif_dir, metadata):
+    # Same as OSFMContext.photos_to_metadata
+    for image, d in metadata:
+        with open(os.path.join(exif_dir, "%s.exif" % image), 'w') as f:
+            f.write(json.dumps(d, indent=4))
+
+
+def write_archive(exif_dir, metadata):
+    exifarchive.write_archive(exifarchive.archive_path(exif_dir), metadata)
+
+
+def read_all(dataset_class, path, images):
+    ds = dataset_class(path)
+    for image in images:
+        ds.load_exif(image)
+
+
+def bench(name, write, dataset_class, metadata, latency):
+    path = tempfile.mkdtemp()
+    try:
+        exif_dir = os.path.join(path, "exif")
+        os.makedirs(exif_dir)
+        images = [m[0] for m in metadata]
+
+        with LatencyShim(latency):
+            start = time.time()
+            write(exif_dir, metadata)
+            write_time = time.time() - start
+
+            exifarchive.invalidate(exifarchive.archive_path(exif_dir))
+            start = time.time()
+            read_all(dataset_class, path, images)
+            read_time = time.time() - start
+
+        files = len(os.listdir(exif_dir))
+        size = sum(os.path.getsize(os.path.join(exif_dir, f)) for f in os.listdir(exif_dir))
+        exifarchive.invalidate(exifarchive.archive_path(exif_dir))
+
+        print("%8s %12.1f %10.2f %10.2f %8s %10.1f" % (name, latency * 1000, write_time, read_time, files, size / 1024.0 / 1024.0))
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenSfM metadata store benchmark")
+    parser.add_argument("--images", type=int, default=20000)
+    parser.add_argument("--latency", type=float, nargs="+", default=[0, 1])
+    args = parser.parse_args()
+
+    metadata = [("IMG_%06d.JPG" % i, ODM_Photo.from_dict(synthetic_photo(i)).to_opensfm_exif()) for i in range(args.images)]
+
+    print("%s images" % args.images)
+    print("%8s %12s %10s %10s %8s %10s" % ("", "latency ms", "write s", "read s", "files", "MB"))
+    for latency in args.latency:
+        bench("files", write_files, FileDataSet, metadata, latency / 1000.0)
+        bench("archive", write_archive, ArchiveDataSet, metadata, latency / 1000.0)
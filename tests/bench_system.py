@@ -0,0 +1,63 @@
+# Compares the CPU time spent in ODM's process (reading, echoing and logging the output)
+# when running a chatty command: line by line reading (previous system.run) against
+# the chunked reader with a compressed log of system.run. The child's own runtime is
+# the same for both. Console output goes to /dev/null.
+# Usage: python3 -m tests.bench_system [--lines N]
+
+import argparse
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from collections import deque
+
+from opendm import system
+from tests.test_system import noisy_cmd
+
+
+def legacy_run(cmd):
+    # Line by line reading, as system.run used to do
+    p = subprocess.Popen(cmd, shell=True, start_new_session=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    lines = deque()
+    for line in io.TextIOWrapper(p.stdout):
+        print(line, end="")
+
+        lines.append(line.strip())
+        if len(lines) == 11:
+            lines.popleft()
+    return p.wait()
+
+
+def measure(func):
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        start = os.times()
+        func()
+        end = os.times()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return (end.user - start.user) + (end.system - start.system), end.elapsed - start.elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="system.run output handling benchmark")
+    parser.add_argument("--lines", type=int, default=300000)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        system.set_process_log_dir(tmp)
+
+        print("Lines: %s" % args.lines)
+        print("%-30s %10s %10s" % ("", "CPU s", "wall s"))
+        for name, func in [("line by line (previous)", lambda: legacy_run(noisy_cmd(args.lines))),
+                           ("chunked + compressed log", lambda: system.run(noisy_cmd(args.lines), quiet=True))]:
+            cpu, wall = measure(func)
+            print("%-30s %10.2f %10.2f" % (name, cpu, wall))
+    finally:
+        system.set_process_log_dir(None)
+        shutil.rmtree(tmp)
@@ -0,0 +1,66 @@
+# Compares thermal.dn_to_temperature for cameras decoded with exiftool: one exiftool
+# invocation and a float64 conversion per image (previous implementation) against the
+# batched ThermalEngine (one invocation per batch, float32 lookup table per camera).
+# Uses tests/assets/exiftool_stub.py with canned output, so the exiftool process cost is the
+# start-up of a Python interpreter (the real exiftool, a Perl program, starts slower).
+# Usage: python3 -m tests.bench_thermal [--images N] [--width W] [--height H] [--batch-size N]
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from opendm import thermal
+from opendm.exiftool import TEMPERATURE_PARAMS, extract_raw_thermal_image_data
+from opendm.thermal_tools.thermal_utils import sensor_vals_to_temp
+from tests.test_multispectral import band_photo
+from tests.test_thermal import PARAMS, STUB, encode_raw_thermal_image
+
+
+def legacy(photos, images_path):
+    # One exiftool invocation + sensor_vals_to_temp per image
+    for p in photos:
+        params, image = extract_raw_thermal_image_data(os.path.join(images_path, p.filename), STUB)
+        sensor_vals_to_temp(image, **params).astype("float32")
+
+
+def batched(photos, images_path, batch_size):
+    engine = thermal.ThermalEngine(images_path, photos, batch_size=batch_size, exiftool_path=STUB)
+    for p in photos:
+        thermal.dn_to_temperature(p, None, images_path, engine=engine)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Thermal calibration benchmark")
+    parser.add_argument("--images", type=int, default=64)
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=512)
+    parser.add_argument("--batch-size", type=int, default=thermal.THERMAL_BATCH_SIZE)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        photos = []
+        for i in range(args.images):
+            p = band_photo("LWIR", make="DJI", filename="IMG_%04d_T.JPG" % i, width=args.width, height=args.height)
+            raw = np.random.default_rng(i).integers(20000, 30000, (args.height, args.width)).astype(np.uint16)
+            with open(os.path.join(tmp, p.filename), "w") as f:
+                f.write("x")
+            with open(os.path.join(tmp, p.filename + ".tags.json"), "w") as f:
+                json.dump(dict(PARAMS, RawThermalImage=encode_raw_thermal_image(raw), SerialNumber="S1"), f)
+            photos.append(p)
+
+        print("%s images, %sx%s, %s tags" % (args.images, args.width, args.height, len(TEMPERATURE_PARAMS)))
+        print("%10s %12s %10s" % ("", "images/s", "total s"))
+        for name, func in [("legacy", lambda: legacy(photos, tmp)),
+                           ("batched", lambda: batched(photos, tmp, args.batch_size))]:
+            start = time.time()
+            func()
+            elapsed = time.time() - start
+            print("%10s %12.1f %10.2f" % (name, args.images / elapsed, elapsed))
+    finally:
+        shutil.rmtree(tmp)
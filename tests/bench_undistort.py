@@ -0,0 +1,103 @@
+# Compares the undistort image filter of run_opensfm (calibration, thermal resize
+# and band alignment) as a chain of separate steps (previous implementation)
+# against the fused UndistortFilter, on synthetic multispectral captures.
+# Reports images/second and peak RSS.
+# Usage: python3 -m tests.bench_undistort [--captures N] [--threads N]
+
+import argparse
+
+from tests import benchutil
+
+CODE = """
+import time, threading
+import numpy as np
+from opendm import multispectral, thermal
+from opendm.imagefilter import UndistortFilter
+from tests.test_multispectral import band_photo, rotation
+
+mode, captures, threads, width, height = sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4]), int(sys.argv[5])
+
+bands = ["Blue", "Green", "Red", "NIR", "RedEdge"]
+photos = {}
+for i in range(captures):
+    for b in bands:
+        photos["%s_%s.tif" % (i, b)] = band_photo(b, filename="%s_%s.tif" % (i, b), width=width, height=height, horizontal_irradiance=1.0)
+    photos["%s_LWIR.tif" % i] = band_photo("LWIR", filename="%s_LWIR.tif" % i, width=width // 8, height=height // 8)
+largest = band_photo("Blue", width=width, height=height)
+
+alignment_info = dict((b, {'warp_matrix': rotation(0.3, 4.2, -2.5), 'dimension': (width, height)}) for b in bands[1:] + ["LWIR"])
+images = {
+    (width, height): np.random.default_rng(0).integers(5000, 60000, (height, width, 1)).astype(np.uint16),
+    (width // 8, height // 8): np.random.default_rng(0).integers(5000, 60000, (height // 8, width // 8, 1)).astype(np.uint16),
+}
+
+def calibrate(photo, image, out):
+    if photo.is_thermal():
+        return image.astype("float32")
+    return multispectral.dn_to_reflectance(photo, image, out=out)
+
+if mode == "chain":
+    def resize_thermal_images(shot_id, image):
+        photo = photos[shot_id]
+        if photo.is_thermal():
+            return thermal.resize_to_match(image, largest)
+        return image
+
+    def radiometric_calibrate(shot_id, image):
+        return calibrate(photos[shot_id], image, None)
+
+    def align_to_primary_band(shot_id, image):
+        ainfo = alignment_info.get(photos[shot_id].band_name)
+        if ainfo is not None:
+            return multispectral.align_image(image, ainfo["warp_matrix"], ainfo["dimension"])
+        return image
+
+    pipeline = [resize_thermal_images, radiometric_calibrate, align_to_primary_band]
+    def image_filter(shot_id, image):
+        for func in pipeline:
+            image = func(shot_id, image)
+        return image
+else:
+    image_filter = UndistortFilter(photos.get, calibrate=calibrate, resize_to=largest, alignment=alignment_info.get)
+
+shot_ids = list(photos.keys())
+lock = threading.Lock()
+
+def worker():
+    while True:
+        with lock:
+            if not shot_ids:
+                return
+            shot_id = shot_ids.pop()
+        p = photos[shot_id]
+        image_filter(shot_id, images[(p.width, p.height)])
+
+start = time.time()
+workers = [threading.Thread(target=worker) for _ in range(threads)]
+for t in workers:
+    t.start()
+for t in workers:
+    t.join()
+elapsed = time.time() - start
+
+report(images_per_second=len(photos) / elapsed, peak_rss_mb=status("VmHWM") / 1024.0)
+"""
+
+
+def measure(mode, args):
+    return benchutil.measure(CODE, mode, args.captures, args.threads, args.width, args.height)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Undistort image filter benchmark")
+    parser.add_argument("--captures", type=int, default=40)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=960)
+    args = parser.parse_args()
+
+    print("%s captures x 6 bands (5 x %sx%s + thermal), %s threads" % (args.captures, args.width, args.height, args.threads))
+    print("%8s %12s %14s" % ("", "images/s", "peak RSS MB"))
+    for mode in ["chain", "fused"]:
+        r = measure(mode, args)
+        print("%8s %12.1f %14.1f" % (mode, r['images_per_second'], r['peak_rss_mb']))
@@ -0,0 +1,41 @@
+# Memory measurement harness shared by the benchmarks.
+# Each measurement runs a snippet of code in a separate Python process, so that its
+# RSS is not affected by previous measurements (Linux only, reads /proc/self/status).
+
+import json
+import subprocess
+import sys
+
+# Helpers available to measured code
+PRELUDE = """
+import sys, json
+
+def status(field):
+    # Value in kB of a field of /proc/self/status (e.g. VmRSS, VmHWM)
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+
+def reset_peak_rss():
+    # Reset VmHWM to the current RSS
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+
+def report(**values):
+    # Result of the measurement (written to the original stdout, in case the code redirects it)
+    sys.__stdout__.write(json.dumps(values) + "\\n")
+    sys.__stdout__.flush()
+"""
+
+
+def measure(code, *args):
+    """
+    Run code in a separate process, with the helpers of PRELUDE defined
+    :param code Python code that calls report() once done
+    :param args command line arguments of the process (sys.argv[1:])
+    :return dictionary of the values passed to report()
+    """
+    out = subprocess.run([sys.executable, "-c", PRELUDE + code] + [str(a) for a in args],
+                         stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    return json.loads(out.strip().split("\n")[-1])
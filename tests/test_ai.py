@@ -0,0 +1,216 @@
+import unittest
+import os
+import shutil
+import hashlib
+import zipfile
+import tempfile
+import threading
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from functools import partial
+
+import numpy as np
+
+try:
+    import onnx
+    from onnx import helper, TensorProto
+except ImportError:
+    onnx = None
+
+from opendm import ai
+
+
+def create_model(path):
+    graph = helper.make_graph(
+        [helper.make_node("Relu", ["input"], ["output"])],
+        "relu",
+        [helper.make_tensor_value_info("input", TensorProto.FLOAT, [1, 4])],
+        [helper.make_tensor_value_info("output", TensorProto.FLOAT, [1, 4])],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8
+    onnx.save(model, path)
+
+
+class TestAi(unittest.TestCase):
+    def test_session_pool_size(self):
+        self.assertEqual(ai.get_session_pool_size(8, 1, gpu=True), 1)
+        self.assertEqual(ai.get_session_pool_size(0, 1), 1)
+        self.assertTrue(ai.get_session_pool_size(2, 1) <= 2)
+
+        # Not enough memory for more than one session
+        self.assertEqual(ai.get_session_pool_size(8, 1024 ** 5), 1)
+
+    @unittest.skipIf(onnx is None, "onnx is not installed")
+    def test_session_pool(self):
+        output_dir = "tests/assets/output/ai"
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
+        os.makedirs(output_dir)
+
+        try:
+            model = os.path.join(output_dir, "model.onnx")
+            create_model(model)
+
+            pool = ai.SessionPool(model, max_sessions=2, intra_op_num_threads=1, memory_per_session=1)
+            self.assertEqual(pool.size, min(2, ai.get_session_pool_size(2, 1)))
+            self.assertEqual(pool.get_inputs()[0].name, "input")
+
+            x = np.array([[-1, 2, -3, 4]], dtype=np.float32)
+            self.assertTrue(np.array_equal(pool.run(None, {"input": x})[0], [[0, 2, 0, 4]]))
+
+            # Concurrent leases get distinct sessions
+            if pool.size == 2:
+                with pool.session() as a:
+                    with pool.session() as b:
+                        self.assertIsNot(a, b)
+
+            errors = []
+            def worker():
+                try:
+                    for _ in range(20):
+                        pool.run(None, {"input": x})
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=worker) for _ in range(6)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            self.assertEqual(errors, [])
+            self.assertTrue(pool._created <= pool.size)
+        finally:
+            shutil.rmtree(output_dir)
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class TestModelRegistry(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.storage = os.path.join(self.tmp, "models")
+        self.models_dir = ai.models_dir
+        ai.models_dir = lambda: self.storage
+
+        # Model archive served by a local server
+        self.www = os.path.join(self.tmp, "www")
+        os.makedirs(self.www)
+        self.archive = os.path.join(self.www, "model.zip")
+        with zipfile.ZipFile(self.archive, "w") as z:
+            z.writestr("model.onnx", b"weights" * 1000)
+            z.writestr("labels.txt", b"a,b,c")
+        with open(self.archive, "rb") as f:
+            self.sha256 = hashlib.sha256(f.read()).hexdigest()
+
+        self.requests = []
+        owner = self
+
+        class Handler(SimpleHTTPRequestHandler):
+            def do_GET(self):
+                owner.requests.append(self.path)
+                return SimpleHTTPRequestHandler.do_GET(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), partial(Handler, directory=self.www))
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.1})
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = "http://127.0.0.1:%s/model.zip" % self.server.server_address[1]
+
+    def tearDown(self):
+        ai.models_dir = self.models_dir
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.tmp)
+
+    def test_get_model(self):
+        model = ai.get_model("test", self.url, "v1.0", sha256=self.sha256)
+        self.assertEqual(model, os.path.join(self.storage, "test", "v1_0", "model.onnx"))
+        with open(model, "rb") as f:
+            self.assertEqual(f.read(), b"weights" * 1000)
+        self.assertFalse(os.path.exists(os.path.join(self.storage, "test", "v1_0.download")))
+
+        manifest = ai.read_manifest(os.path.dirname(model))
+        self.assertEqual(manifest['sha256'], self.sha256)
+        self.assertEqual(sorted(manifest['files'].keys()), ["labels.txt", "model.onnx"])
+
+        # Cached
+        downloads = len(self.requests)
+        self.assertEqual(ai.get_model("test", self.url, "v1.0"), model)
+        self.assertEqual(len(self.requests), downloads)
+
+        # Touched, but not changed
+        os.utime(model, (0, 0))
+        self.assertEqual(ai.get_model("test", self.url, "v1.0"), model)
+        self.assertEqual(len(self.requests), downloads)
+
+        # Corrupted
+        with open(os.path.join(os.path.dirname(model), "labels.txt"), "wb") as f:
+            f.write(b"x,y,z")
+        self.assertEqual(ai.get_model("test", self.url, "v1.0"), model)
+        self.assertGreater(len(self.requests), downloads)
+        self.assertTrue(ai.verify_model_dir(os.path.dirname(model)))
+
+    def test_checksum_mismatch(self):
+        self.assertIsNone(ai.get_model("test", self.url, "v1.0", sha256="0" * 64))
+        self.assertFalse(os.path.exists(os.path.join(self.storage, "test", "v1_0", "model.onnx")))
+
+    def test_url_override(self):
+        self.assertIsNone(ai.get_model("private", None, "v1.0"))
+
+        os.environ["ODM_MODEL_URL_PRIVATE"] = self.archive
+        try:
+            model = ai.get_model("private", None, "v1.0")
+        finally:
+            del os.environ["ODM_MODEL_URL_PRIVATE"]
+        self.assertTrue(os.path.isfile(model))
+        self.assertEqual(self.requests, [])
+
+    def test_concurrent(self):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(ai.get_model("test", self.url, "v1.0"))) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(set(results)), 1)
+        self.assertTrue(os.path.isfile(results[0]))
+        # Downloaded only once
+        self.assertEqual(self.requests, ["/model.zip"])
+
+    @unittest.skipIf(onnx is None, "onnx is not installed")
+    def test_optimized_model(self):
+        model = os.path.join(self.tmp, "model.onnx")
+        create_model(model)
+
+        ort_model = ai.optimized_model(model)
+        self.assertEqual(ort_model, os.path.join(self.tmp, "model.ort"))
+        self.assertTrue(os.path.isfile(ort_model))
+        mtime = os.path.getmtime(ort_model)
+        self.assertEqual(ai.optimized_model(model), ort_model)
+        self.assertEqual(os.path.getmtime(ort_model), mtime)
+
+        x = np.array([[-1, 2, -3, 4]], dtype=np.float32)
+        session = ai.create_session(model)
+        self.assertTrue(np.array_equal(session.run(None, {"input": x})[0], [[0, 2, 0, 4]]))
+
+        # Sessions of a pool share the same model bytes
+        pool = ai.SessionPool(model, max_sessions=2, intra_op_num_threads=1, memory_per_session=1)
+        self.assertIsNotNone(pool._model_bytes)
+        self.assertTrue(np.array_equal(pool.run(None, {"input": x})[0], [[0, 2, 0, 4]]))
+
+        # A broken optimized model falls back to the original
+        with open(ort_model, "wb") as f:
+            f.write(b"broken")
+        os.utime(ort_model, (mtime + 10, mtime + 10))
+        session = ai.create_session(model)
+        self.assertTrue(np.array_equal(session.run(None, {"input": x})[0], [[0, 2, 0, 4]]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,281 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import numpy as np
+from concurrent.futures import CancelledError
+from opendm import concurrency, log
+from opendm.concurrency import parallel_map, parallel_imap, process_map, process_imap, CancelToken, TaskError, SharedArray
+from opendm.system import SubprocessException
+
+class TestConcurrency(unittest.TestCase):
+    def test_ordered_results(self):
+        def slow_first(i):
+            time.sleep(0.05 if i == 0 else 0)
+            return i * 2
+
+        self.assertEqual(list(parallel_imap(slow_first, range(20), max_workers=4)), [i * 2 for i in range(20)])
+        self.assertEqual(parallel_map(slow_first, range(20), max_workers=4), [i * 2 for i in range(20)])
+        self.assertEqual(parallel_map(slow_first, range(20), max_workers=1), [i * 2 for i in range(20)])
+
+        # Completion order
+        results = list(parallel_imap(slow_first, range(20), max_workers=4, ordered=False))
+        self.assertEqual(sorted(results), [i * 2 for i in range(20)])
+        self.assertEqual(results[-1], 0)
+
+    def test_exceptions(self):
+        def fail_on_three(i):
+            if i == 3:
+                raise ValueError("three")
+            return i
+
+        for workers in [1, 4]:
+            with self.assertRaises(TaskError) as cm:
+                list(parallel_imap(fail_on_three, range(10), max_workers=workers))
+            self.assertEqual(cm.exception.index, 3)
+            self.assertTrue(isinstance(cm.exception.error, ValueError))
+
+            results = list(parallel_imap(fail_on_three, range(10), max_workers=workers, return_exceptions=True))
+            self.assertTrue(isinstance(results[3], ValueError))
+            self.assertEqual(results[4], 4)
+
+        # Errors are ignored without fallback
+        self.assertEqual(parallel_map(fail_on_three, range(5), max_workers=4, single_thread_fallback=False), [0, 1, 2, None, 4])
+
+        # With a single worker, the original exception is raised
+        def fail(i):
+            raise SubprocessException("boom", 137)
+        for map_func in [parallel_map, process_map]:
+            with self.assertRaises(SubprocessException) as cm:
+                map_func(fail, [1], max_workers=1)
+            self.assertEqual(cm.exception.errorCode, 137)
+
+    def test_retries(self):
+        attempts = {}
+        lock = threading.Lock()
+
+        def flaky(i):
+            with lock:
+                attempts[i] = attempts.get(i, 0) + 1
+                count = attempts[i]
+            if i % 3 == 0 and count < 3:
+                raise IOError("flaky")
+            return i
+
+        for workers in [1, 4]:
+            attempts.clear()
+            self.assertEqual(list(parallel_imap(flaky, range(9), max_workers=workers, retries=2)), list(range(9)))
+            # Only failing items are rerun
+            self.assertEqual(attempts, {i: 3 if i % 3 == 0 else 1 for i in range(9)})
+
+        # Fallback retries only the failed items
+        attempts.clear()
+        self.assertEqual(parallel_map(flaky, range(9), max_workers=4, retries=1), list(range(9)))
+        self.assertEqual(sum(attempts.values()), 9 + 3 * 2)
+
+    def test_memory_budget(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0}
+
+        def task(cost):
+            with lock:
+                state['running'] += cost
+                state['peak'] = max(state['peak'], state['running'])
+            time.sleep(0.01)
+            with lock:
+                state['running'] -= cost
+            return cost
+
+        costs = [300, 300, 300, 300, 900, 100, 100, 100]
+        results = list(parallel_imap(task, costs, max_workers=8, memory_cost=lambda c: c, max_memory_mb=1000))
+        self.assertEqual(results, costs)
+        # Items larger than the budget still run (alone)
+        self.assertTrue(state['peak'] <= 1000)
+
+        # Unconsumed results count against the budget
+        gen = parallel_imap(task, [400] * 10, max_workers=8, memory_cost=lambda c: c, max_memory_mb=1000)
+        next(gen)
+        time.sleep(0.1)
+        self.assertTrue(state['peak'] <= 1000)
+        gen.close()
+
+    def test_lazy_and_close(self):
+        started = []
+
+        def task(i):
+            started.append(i)
+            return i
+
+        def source():
+            for i in range(1000):
+                yield i
+
+        gen = parallel_imap(task, source(), max_workers=2, max_in_flight=4)
+        self.assertEqual([next(gen) for _ in range(3)], [0, 1, 2])
+        gen.close()
+        self.assertTrue(len(started) < 10)
+
+    def test_cancellation(self):
+        started = []
+
+        for workers in [1, 4]:
+            token = CancelToken()
+            del started[:]
+
+            def task(i):
+                started.append(i)
+                if i == 5:
+                    token.cancel()
+                time.sleep(0.01)
+                return i
+
+            with self.assertRaises(CancelledError):
+                for _ in parallel_imap(task, range(1000), max_workers=workers, cancel_token=token):
+                    pass
+            self.assertTrue(len(started) < 20)
+
+        # Cancel while the consumer is waiting
+        token = CancelToken()
+        threading.Timer(0.05, token.cancel).start()
+        start = time.time()
+        with self.assertRaises(CancelledError):
+            list(parallel_imap(lambda i: time.sleep(0.02), range(1000), max_workers=2, cancel_token=token))
+        self.assertTrue(time.time() - start < 1)
+
+    def test_cancel_token_param(self):
+        token = CancelToken()
+        token.cancel()
+        with self.assertRaises(CancelledError):
+            list(parallel_imap(lambda i: i, range(10), max_workers=2, cancel_token=token))
+
+    def test_short_tasks_latency(self):
+        # The previous implementation polled every 0.5 seconds
+        start = time.time()
+        results = parallel_map(lambda i: i + 1, range(2000), max_workers=4)
+        elapsed = time.time() - start
+        self.assertEqual(results, list(range(1, 2001)))
+        self.assertTrue(elapsed < 0.5, "took %.3fs" % elapsed)
+
+def shm_files():
+    if os.path.isdir("/dev/shm"):
+        return set(os.listdir("/dev/shm"))
+    return set()
+
+@unittest.skipIf(not hasattr(os, 'fork'), "fork is not available")
+class TestProcessBackend(unittest.TestCase):
+    def setUp(self):
+        self.shm_before = shm_files()
+
+    def tearDown(self):
+        # Nothing is left behind in shared memory
+        self.assertEqual(shm_files() - self.shm_before, set())
+
+    def test_results(self):
+        offset = 3
+        # Closures work (fork)
+        self.assertEqual(process_map(lambda i: (os.getpid(), i + offset), range(20), max_workers=2)[5][1], 8)
+        pids = set(pid for pid, _ in process_map(lambda i: (os.getpid(), time.sleep(0.01)), range(20), max_workers=2))
+        self.assertFalse(os.getpid() in pids)
+
+        results = list(process_imap(lambda i: i * 2, range(50), max_workers=3, ordered=False))
+        self.assertEqual(sorted(results), [i * 2 for i in range(50)])
+
+    def test_shared_arrays(self):
+        images = [np.full((512, 512, 3), i, dtype=np.uint16) for i in range(6)]
+
+        def process(args):
+            image, scale = args
+            # Large inputs arrive as views on shared memory
+            assert not image.flags['OWNDATA']
+            return {'image': (image * scale).astype(np.float32), 'mean': float(image.mean())}
+
+        results = process_map(process, [(img, 2) for img in images], max_workers=2)
+        for i, r in enumerate(results):
+            self.assertEqual(r['mean'], i)
+            self.assertEqual(r['image'].dtype, np.float32)
+            self.assertEqual(r['image'].shape, (512, 512, 3))
+            self.assertTrue(np.all(r['image'] == i * 2))
+
+        # Explicitly shared array
+        sa = SharedArray.create(images[3])
+        try:
+            self.assertEqual(process_map(lambda k: int(sa.array[0, 0, 0]) + k, [1, 2], max_workers=2), [4, 5])
+        finally:
+            sa.unlink()
+
+    def test_exceptions_and_retries(self):
+        def fail_on_three(i):
+            if i == 3:
+                raise ValueError("three")
+            return i
+
+        with self.assertRaises(TaskError) as cm:
+            list(process_imap(fail_on_three, range(10), max_workers=2))
+        self.assertEqual(cm.exception.index, 3)
+        self.assertTrue(isinstance(cm.exception.error, ValueError))
+        self.assertEqual(process_map(fail_on_three, range(5), max_workers=2, single_thread_fallback=False), [0, 1, 2, None, 4])
+
+        # Side effects are not shared between processes, use a file to count attempts
+        counter = os.path.join(os.path.dirname(__file__), "assets", ".process_attempts")
+        if os.path.exists(counter):
+            os.unlink(counter)
+        def crash_once(i):
+            if i == 2 and not os.path.exists(counter):
+                open(counter, 'w').close()
+                os._exit(1)
+            return i
+        try:
+            self.assertEqual(list(process_imap(crash_once, range(6), max_workers=2, retries=2)), list(range(6)))
+        finally:
+            if os.path.exists(counter):
+                os.unlink(counter)
+
+    def test_logging(self):
+        tmp = tempfile.mkdtemp()
+        jsonl, json_log = log.logger.jsonl, log.logger.json
+        log.logger.jsonl = log.JsonLinesWriter(os.path.join(tmp, "log.jsonl"))
+        log.logger.json = {'stages': [{'name': 'test', 'messages': []}], 'processes': []}
+        try:
+            def work(i):
+                log.ODM_INFO("child %s" % i)
+                if i == 3:
+                    raise ValueError("three")
+                return i
+
+            log.ODM_INFO("parent")
+            self.assertEqual(process_map(work, range(4), max_workers=2, single_thread_fallback=False), [0, 1, 2, None])
+            log.logger.jsonl.close()
+
+            with open(os.path.join(tmp, "log.jsonl")) as f:
+                messages = [json.loads(line)['message'] for line in f if '"message"' in line]
+            self.assertEqual(sorted(m for m in messages if m.startswith("child")), ["child %s" % i for i in range(4)])
+            self.assertIn("parent", messages)
+            self.assertEqual(len([m for m in log.logger.json['stages'][0]['messages'] if m['message'].startswith("child")]), 4)
+        finally:
+            log.logger.jsonl, log.logger.json = jsonl, json_log
+            shutil.rmtree(tmp)
+
+    def test_cancellation(self):
+        token = CancelToken()
+        threading.Timer(0.2, token.cancel).start()
+        start = time.time()
+        with self.assertRaises(CancelledError):
+            list(process_imap(lambda i: time.sleep(0.05), range(1000), max_workers=2, cancel_token=token))
+        self.assertTrue(time.time() - start < 2)
+
+        # Closing early leaves nothing behind
+        gen = process_imap(lambda i: np.zeros((1024, 1024)), range(20), max_workers=2)
+        next(gen)
+        gen.close()
+
+    def test_backends(self):
+        self.assertTrue(concurrency.get_parallel_map('io') is parallel_map)
+        self.assertTrue(concurrency.get_parallel_map('python') is process_map)
+        self.assertTrue(concurrency.get_parallel_imap('python') is process_imap)
+        self.assertRaises(ValueError, concurrency.get_parallel_map, 'invalid')
+
+if __name__ == '__main__':
+    unittest.main()
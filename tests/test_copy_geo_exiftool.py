@@ -0,0 +1,127 @@
+import unittest
+import os
+import shutil
+import threading
+
+from opendm.copy_geo_exiftool import GeolocationProcessor, ExifToolSession
+
+STUB = os.path.abspath("tests/assets/exiftool_stub.py")
+GEO = ("40 deg 26' 46.30\" N", "79 deg 58' 56.00\" W", "312.5 m Above Sea Level", "North", "West")
+
+
+class TestCopyGeoExiftool(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = "tests/assets/output/copy_geo"
+        if os.path.exists(self.output_dir):
+            shutil.rmtree(self.output_dir)
+        os.makedirs(self.output_dir)
+
+        self.sources = []
+        self.dests = []
+        for i in range(10):
+            src = os.path.join(self.output_dir, "src_%s.jpg" % i)
+            dst = os.path.join(self.output_dir, "dst_%s.jpg" % i)
+            for f in [src, dst]:
+                with open(f, "w") as fout:
+                    fout.write("x")
+            self.sources.append(src)
+            self.dests.append(dst)
+
+        per_call = GeolocationProcessor(STUB, stay_open=False)
+        for src in self.sources:
+            per_call.write_geolocation(src, *GEO)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_identical_tags(self):
+        per_call = GeolocationProcessor(STUB, stay_open=False)
+        gp = GeolocationProcessor(STUB)
+        self.assertIsNotNone(gp.session)
+
+        try:
+            for src in self.sources:
+                self.assertEqual(gp.get_geolocation(src), per_call.get_geolocation(src))
+
+            # Copy from many threads at once
+            threads = [threading.Thread(target=gp.process_image, args=(s, d)) for s, d in zip(self.sources, self.dests)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            for dst in self.dests:
+                self.assertEqual(per_call.get_geolocation(dst), GEO)
+        finally:
+            gp.close()
+
+    def test_crash_recovery(self):
+        with ExifToolSession(STUB) as session:
+            self.assertIn("SourceFile", session.execute("-json", self.sources[0]))
+
+            session.process.kill()
+            session.process.wait()
+
+            self.assertIn("SourceFile", session.execute("-json", self.sources[0]))
+            self.assertEqual(session.restarts, 1)
+
+            self.assertRaises(ValueError, session.execute, "-json", "a\nb")
+
+    def test_fallback(self):
+        gp = GeolocationProcessor(STUB)
+
+        # Exhaust restarts, then check that we fall back to per-call mode
+        gp.session.max_restarts = 0
+        gp.session.process.kill()
+        gp.session.process.wait()
+
+        self.assertEqual(gp.get_geolocation(self.sources[0]), GEO)
+        self.assertIsNone(gp.session)
+
+        gp = GeolocationProcessor(os.path.join(self.output_dir, "nonexistent"))
+        self.assertIsNone(gp.session)
+
+    def test_concurrent_fallback(self):
+        # The session fails while several threads are using it
+        gp = GeolocationProcessor(STUB)
+        gp.session.max_restarts = 0
+        gp.session.process.kill()
+        gp.session.process.wait()
+
+        results = []
+        errors = []
+        def worker():
+            try:
+                for src in self.sources:
+                    results.append(gp.get_geolocation(src))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(results, [GEO] * 40)
+        self.assertIsNone(gp.session)
+        gp.close()
+
+    @unittest.skipIf(shutil.which("exiftool") is None, "exiftool is not installed")
+    def test_exiftool(self):
+        src = "tests/assets/images/DJI_0002.JPG"
+        dst = os.path.join(self.output_dir, "DJI_0002.JPG")
+        shutil.copy(src, dst)
+
+        per_call = GeolocationProcessor(stay_open=False)
+        gp = GeolocationProcessor()
+        try:
+            self.assertEqual(gp.get_geolocation(src), per_call.get_geolocation(src))
+            gp.process_image(src, dst)
+            self.assertEqual(per_call.get_geolocation(dst), per_call.get_geolocation(src))
+        finally:
+            gp.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,265 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from argparse import Namespace
+from opendm import dag, types
+from opendm.dag import DAGScheduler
+
+class FakeTree:
+    def __init__(self, root):
+        self.benchmarking = os.path.join(root, "benchmark.txt")
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+        self.cpus = {}
+
+    def task(self, name, duration=0.1, error=None, barrier=None):
+        def run():
+            with self.lock:
+                self.events.append(("start", name, time.time()))
+                self.cpus[name] = dag.task_cpus(100)
+            time.sleep(duration)
+            if barrier is not None:
+                # Wait for the other tasks sharing the barrier to be running
+                barrier.wait(timeout=10)
+            with self.lock:
+                self.events.append(("end", name, time.time()))
+            if error is not None:
+                raise error
+        return run
+
+    def order(self, kind):
+        return [name for k, name, _ in self.events if k == kind]
+
+    def time(self, kind, name):
+        for k, n, t in self.events:
+            if k == kind and n == name:
+                return t
+
+    def overlap(self, a, b):
+        return self.time("start", a) < self.time("end", b) and self.time("start", b) < self.time("end", a)
+
+    def before(self, a, b):
+        return self.time("end", a) <= self.time("start", b)
+
+class DummyStage(types.ODM_Stage):
+    def process(self, args, outputs):
+        recorder = self.params['recorder']
+        recorder.task(self.name, self.params.get('duration', 0.1))()
+        if outputs.get('tree') is None:
+            outputs['tree'] = FakeTree(self.params['root'])
+        outputs.setdefault('rerun', {})[self.name] = self.rerun()
+
+def stage_class(requires, provides):
+    return type("Stage", (DummyStage, ), {'requires': requires, 'provides': provides})
+
+def make_args(**kwargs):
+    args = {
+        'rerun': None,
+        'rerun_all': False,
+        'rerun_from': None,
+        'end_with': 'report',
+        'max_concurrency': 4,
+    }
+    args.update(kwargs)
+    return Namespace(**args)
+
+class TestDAG(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_independent_tasks(self):
+        r = Recorder()
+        s = DAGScheduler(max_cpus=4, max_memory_mb=1000)
+        s.add("a", r.task("a"), requires=[], provides=["x"], cpus=2)
+        s.add("b", r.task("b"), requires=[], provides=["y"], cpus=2)
+        s.add("c", r.task("c"), requires=["x", "y"], provides=["z"], cpus=2)
+        s.run()
+
+        self.assertTrue(r.overlap("a", "b"))
+        self.assertTrue(r.before("a", "c"))
+        self.assertTrue(r.before("b", "c"))
+        self.assertEqual(r.cpus, {'a': 2, 'b': 2, 'c': 2})
+
+    def test_hazards(self):
+        r = Recorder()
+        s = DAGScheduler(max_cpus=4, max_memory_mb=1000)
+        s.add("read", r.task("read"), requires=["x"], provides=["y"])
+        # Writes something that "read" reads
+        s.add("write", r.task("write"), requires=[], provides=["x"])
+        # Writes the same thing
+        s.add("rewrite", r.task("rewrite"), requires=[], provides=["x"])
+        s.run()
+
+        self.assertEqual(r.order("start"), ["read", "write", "rewrite"])
+        self.assertTrue(r.before("read", "write"))
+        self.assertTrue(r.before("write", "rewrite"))
+
+    def test_barrier(self):
+        r = Recorder()
+        s = DAGScheduler(max_cpus=4, max_memory_mb=1000)
+        s.add("a", r.task("a"), requires=[], provides=["x"])
+        s.add("barrier", r.task("barrier"))
+        s.add("b", r.task("b"), requires=[], provides=["y"])
+        s.add("c", r.task("c"), requires=[], provides=["z"])
+        s.run()
+
+        self.assertTrue(r.before("a", "barrier"))
+        self.assertTrue(r.before("barrier", "b"))
+        self.assertTrue(r.before("barrier", "c"))
+        self.assertTrue(r.overlap("b", "c"))
+
+    def test_cpu_budget(self):
+        r = Recorder()
+        barrier = threading.Barrier(2)
+        s = DAGScheduler(max_cpus=4, max_memory_mb=1000)
+        s.add("a", r.task("a", barrier=barrier), requires=[], provides=["a"], cpus=8, min_cpus=2)
+        s.add("b", r.task("b", barrier=barrier), requires=[], provides=["b"], cpus=8, min_cpus=2)
+        s.add("c", r.task("c"), requires=[], provides=["c"], cpus=8, min_cpus=2)
+        s.run()
+
+        # Two tasks fit, sharing the CPUs, the third waits
+        self.assertTrue(r.overlap("a", "b"))
+        self.assertEqual(r.cpus['a'], 2)
+        self.assertEqual(r.cpus['b'], 2)
+        self.assertEqual(r.order("start")[2], "c")
+        self.assertTrue(r.before("a", "c") or r.before("b", "c"))
+
+        # It gets what's free when it starts (a and b end at about the same time)
+        self.assertGreaterEqual(r.cpus['c'], 2)
+        self.assertLessEqual(r.cpus['c'], 4)
+
+        # Tasks that need more than the budget still run (alone)
+        r = Recorder()
+        s = DAGScheduler(max_cpus=2, max_memory_mb=1000)
+        s.add("a", r.task("a"), requires=[], provides=["a"], cpus=8, min_cpus=8)
+        s.add("b", r.task("b"), requires=[], provides=["b"], cpus=8, min_cpus=8)
+        s.run()
+        self.assertTrue(r.before("a", "b"))
+        self.assertEqual(r.cpus, {'a': 2, 'b': 2})
+
+    def test_memory_budget(self):
+        r = Recorder()
+        s = DAGScheduler(max_cpus=8, max_memory_mb=1000)
+        s.add("a", r.task("a"), requires=[], provides=["a"], memory_mb=600)
+        s.add("b", r.task("b"), requires=[], provides=["b"], memory_mb=600)
+        s.add("c", r.task("c"), requires=[], provides=["c"], memory_mb=300)
+        s.run()
+
+        self.assertTrue(r.before("a", "b"))
+        self.assertTrue(r.overlap("b", "c"))
+
+        # Too much memory: runs alone
+        r = Recorder()
+        s = DAGScheduler(max_cpus=8, max_memory_mb=100)
+        s.add("a", r.task("a"), requires=[], provides=["a"], memory_mb=600)
+        s.run()
+        self.assertEqual(r.order("end"), ["a"])
+
+    def test_nested(self):
+        r = Recorder()
+        outer = DAGScheduler(max_cpus=8, max_memory_mb=1000)
+
+        def nested(name):
+            def run():
+                inner = DAGScheduler()
+                inner.add(name + "1", r.task(name + "1"), requires=[], provides=["1"], cpus=8)
+                inner.add(name + "2", r.task(name + "2"), requires=[], provides=["2"], cpus=8)
+                inner.run()
+            return run
+
+        outer.add("a", nested("a"), requires=[], provides=["a"], cpus=8)
+        outer.add("b", nested("b"), requires=[], provides=["b"], cpus=8)
+        outer.run()
+
+        # 8 CPUs -> 4 for each outer task -> 2 for each inner task
+        self.assertEqual(r.cpus, {'a1': 2, 'a2': 2, 'b1': 2, 'b2': 2})
+        self.assertTrue(r.overlap("a1", "b2"))
+
+    def test_serial(self):
+        r = Recorder()
+        s = DAGScheduler(parallel=False, max_cpus=4)
+        s.add("a", r.task("a", 0.01), requires=[], provides=["x"])
+        s.add("b", r.task("b", 0.01), requires=[], provides=["y"])
+        s.run()
+
+        self.assertEqual(r.order("start"), ["a", "b"])
+        self.assertTrue(r.before("a", "b"))
+        self.assertEqual(r.cpus, {'a': 100, 'b': 100})
+
+    def test_errors(self):
+        r = Recorder()
+        s = DAGScheduler(max_cpus=4, max_memory_mb=1000)
+        s.add("a", r.task("a", 0.05, error=ValueError("a failed")), requires=[], provides=["x"])
+        s.add("b", r.task("b", 0.2), requires=[], provides=["y"])
+        s.add("c", r.task("c"), requires=["x"], provides=["z"])
+        s.add("d", r.task("d"), requires=["y"], provides=["w"])
+
+        with self.assertRaises(ValueError):
+            s.run()
+
+        # Running tasks finish, tasks not started are skipped
+        self.assertEqual(sorted(r.order("end")), ["a", "b"])
+        self.assertNotIn("c", r.order("start"))
+        self.assertNotIn("d", r.order("start"))
+
+    def pipeline(self, recorder, args):
+        # dataset -> georef -> {dem, ortho} -> report
+        dataset = stage_class(None, None)("dataset", args, progress=10, recorder=recorder, root=self.tmp)
+        georef = stage_class(None, None)("georef", args, progress=50, recorder=recorder, root=self.tmp)
+        dem = stage_class(["point_cloud"], ["dem"])("dem", args, progress=70, recorder=recorder, root=self.tmp, duration=0.3)
+        ortho = stage_class(["model"], ["orthophoto"])("ortho", args, progress=90, recorder=recorder, root=self.tmp, duration=0.3)
+        report = stage_class(["dem", "orthophoto"], ["report"])("report", args, progress=100, recorder=recorder, root=self.tmp)
+        dataset.connect(georef).connect(dem).connect(ortho).connect(report)
+        return dataset
+
+    def test_stages(self):
+        r = Recorder()
+        args = make_args()
+        outputs = {}
+        dag.run_stages(self.pipeline(r, args), outputs)
+
+        self.assertEqual(r.order("end")[:2], ["dataset", "georef"])
+        self.assertTrue(r.overlap("dem", "ortho"))
+        self.assertTrue(r.before("dem", "report"))
+        self.assertTrue(r.before("ortho", "report"))
+        self.assertEqual(r.cpus['dem'], 2)
+        self.assertEqual(r.cpus['ortho'], 2)
+        self.assertEqual(r.cpus['report'], 4)
+        self.assertTrue(os.path.isfile(outputs['tree'].benchmarking))
+
+        # Same stages as the linked list
+        r2 = Recorder()
+        self.pipeline(r2, args).run({})
+        self.assertEqual(sorted(r.order("end")), sorted(r2.order("end")))
+
+    def test_stages_rerun(self):
+        # --end-with
+        r = Recorder()
+        dag.run_stages(self.pipeline(r, make_args(end_with="dem")), {})
+        self.assertEqual(sorted(r.order("end")), ["dataset", "dem", "georef"])
+
+        # --rerun stops at the stage
+        r = Recorder()
+        outputs = {}
+        dag.run_stages(self.pipeline(r, make_args(rerun="georef")), outputs)
+        self.assertEqual(r.order("end"), ["dataset", "georef"])
+        self.assertEqual(outputs['rerun'], {'dataset': False, 'georef': True})
+
+        # --rerun-from
+        r = Recorder()
+        outputs = {}
+        dag.run_stages(self.pipeline(r, make_args(rerun_from=["dem", "ortho", "report"])), outputs)
+        self.assertEqual(len(r.order("end")), 5)
+        self.assertEqual(outputs['rerun'], {'dataset': False, 'georef': False, 'dem': True, 'ortho': True, 'report': True})
+
+if __name__ == '__main__':
+    unittest.main()
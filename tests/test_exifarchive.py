@@ -0,0 +1,133 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+from opendm import exifarchive
+from opendm.exifarchive import MetadataArchive, MetadataArchiveError, write_archive
+from opendm.photo import ODM_Photo
+from tests.bench_imagesdb import synthetic_photo
+
+class FileDataSet:
+    # Per-image reads, as done by OpenSfM's DataSet
+    def __init__(self, data_path):
+        self.data_path = data_path
+
+    def _exif_path(self):
+        return os.path.join(self.data_path, "exif")
+
+    def load_exif(self, image):
+        with open(os.path.join(self._exif_path(), image + ".exif")) as f:
+            return json.load(f)
+
+    def exif_exists(self, image):
+        return os.path.isfile(os.path.join(self._exif_path(), image + ".exif"))
+
+class TestExifArchive(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.exif_dir = os.path.join(self.tmp, "exif")
+        os.makedirs(self.exif_dir)
+        self.archive_file = exifarchive.archive_path(self.exif_dir)
+
+    def tearDown(self):
+        exifarchive.invalidate(self.archive_file)
+        shutil.rmtree(self.tmp)
+
+    def metadata(self, count):
+        return [("IMG_%04d.JPG" % i, ODM_Photo.from_dict(synthetic_photo(i)).to_opensfm_exif()) for i in range(count)]
+
+    def test_write_read(self):
+        metadata = self.metadata(50)
+        self.assertEqual(write_archive(self.archive_file, metadata), 50)
+        self.assertFalse(os.path.exists(self.archive_file + ".tmp"))
+
+        archive = MetadataArchive(self.archive_file)
+        self.assertEqual(len(archive), 50)
+        self.assertEqual(archive.images(), [m[0] for m in metadata])
+        for image, d in metadata:
+            self.assertIn(image, archive)
+            self.assertEqual(archive.load(image), json.loads(json.dumps(d)))
+        self.assertNotIn("missing.JPG", archive)
+        with self.assertRaises(KeyError):
+            archive.load("missing.JPG")
+        archive.close()
+
+        # Empty
+        write_archive(self.archive_file, [])
+        archive = MetadataArchive(self.archive_file)
+        self.assertEqual(len(archive), 0)
+        archive.close()
+
+    def test_invalid(self):
+        for content in [b"", b"not an archive", exifarchive.MAGIC + b"{}" + exifarchive.FOOTER.pack(8) + exifarchive.MAGIC]:
+            with open(self.archive_file, "wb") as f:
+                f.write(content)
+            with self.assertRaises(MetadataArchiveError):
+                MetadataArchive(self.archive_file)
+
+    def test_adapter(self):
+        class DataSet(FileDataSet):
+            pass
+
+        self.assertTrue(exifarchive.install(DataSet))
+        self.assertTrue(exifarchive.install(DataSet))
+        self.assertFalse(exifarchive.install(type("Empty", (), {})))
+
+        # Per-image files
+        ds = DataSet(self.tmp)
+        with open(os.path.join(self.exif_dir, "file.JPG.exif"), "w") as f:
+            json.dump({"make": "file"}, f)
+        self.assertEqual(ds.load_exif("file.JPG"), {"make": "file"})
+        self.assertFalse(ds.exif_exists("IMG_0001.JPG"))
+
+        # Archive
+        metadata = self.metadata(5)
+        write_archive(self.archive_file, metadata)
+        self.assertTrue(ds.exif_exists("IMG_0001.JPG"))
+        self.assertEqual(ds.load_exif("IMG_0001.JPG"), json.loads(json.dumps(metadata[1][1])))
+        self.assertEqual(ds.load_exif("file.JPG"), {"make": "file"})
+        self.assertFalse(ds.exif_exists("missing.JPG"))
+        archive = exifarchive.get_archive(self.exif_dir)
+        self.assertIs(exifarchive.get_archive(self.exif_dir), archive)
+
+        # Rewritten
+        write_archive(self.archive_file, [("IMG_0001.JPG", {"make": "new"})])
+        self.assertEqual(ds.load_exif("IMG_0001.JPG"), {"make": "new"})
+        self.assertFalse(ds.exif_exists("IMG_0002.JPG"))
+
+    def test_concurrent(self):
+        metadata = self.metadata(200)
+        write_archive(self.archive_file, metadata)
+        expected = dict((image, json.loads(json.dumps(d))) for image, d in metadata)
+        errors = []
+
+        def worker():
+            for image in expected:
+                if exifarchive.get_archive(self.exif_dir).load(image) != expected[image]:
+                    errors.append(image)
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+
+    def test_run_script(self):
+        script = os.path.join(self.tmp, "bin", "main.py")
+        os.makedirs(os.path.dirname(script))
+        with open(script, "w") as f:
+            f.write("import sys, json\n"
+                    "if __name__ == '__main__':\n"
+                    "    print(json.dumps(sys.argv[1:]))\n")
+
+        out = subprocess.check_output([sys.executable, "-m", "opendm.exifarchive", script, "reconstruct", "/data/opensfm"])
+        self.assertEqual(json.loads(out.decode("utf-8").strip().split("\n")[-1]), ["reconstruct", "/data/opensfm"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import unittest
+import os
+import shutil
+import struct
+
+from PIL import Image
+
+from opendm.photo import ODM_Photo, PhotoCorruptedException
+from opendm.exifcache import ExifCache, parse_photos
+
+XMP = """<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+<rdf:Description rdf:about="" xmlns:drone-dji="http://www.dji.com/drone-dji/1.0/" 
+drone-dji:GimbalPitchDegree="-90.0" drone-dji:GimbalRollDegree="0.0" drone-dji:FlightYawDegree="{yaw}" 
+drone-dji:CaptureUUID="{uuid}"/></rdf:RDF></x:xmpmeta>"""
+
+def create_image(path, index):
+    """Write a small JPEG with GPS EXIF tags and DJI-like XMP tags"""
+    img = Image.new("RGB", (64, 48), (index % 255, 100, 50))
+    exif = Image.Exif()
+    exif[0x010F] = "DJI"
+    exif[0x0110] = "FC6310"
+    gps = exif.get_ifd(0x8825)
+    gps[1] = "N"
+    gps[2] = (46.0, 50.0, float(index % 60))
+    gps[3] = "E"
+    gps[4] = (9.0, 30.0, 15.5)
+    gps[6] = 1200.0 + index
+    img.save(path, "JPEG", exif=exif.tobytes())
+
+    # Insert XMP as an APP1 segment right after SOI
+    xmp = b"http://ns.adobe.com/xap/1.0/\x00" + XMP.format(yaw=index % 360, uuid="capture%s" % index).encode("utf8")
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "wb") as f:
+        f.write(data[:2] + b"\xff\xe1" + struct.pack(">H", len(xmp) + 2) + xmp + data[2:])
+
+
+class TestExifCache(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = "tests/assets/output/exifcache"
+        if os.path.exists(self.output_dir):
+            shutil.rmtree(self.output_dir)
+        os.makedirs(self.output_dir)
+
+        self.images = []
+        for i in range(8):
+            f = os.path.join(self.output_dir, "IMG_%04d.JPG" % i)
+            create_image(f, i)
+            self.images.append(f)
+
+        self.corrupted = os.path.join(self.output_dir, "corrupted.JPG")
+        with open(self.corrupted, "w") as f:
+            f.write("not an image")
+
+        self.cache_file = os.path.join(self.output_dir, "exif_cache.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_parse_photos(self):
+        expected = [ODM_Photo(f).to_dict() for f in self.images]
+        self.assertEqual(expected[3]['capture_uuid'], 'capture3')
+        self.assertIsNotNone(expected[3]['latitude'])
+
+        files = self.images + [self.corrupted]
+
+        for workers in [1, 2]:
+            if os.path.exists(self.cache_file):
+                os.remove(self.cache_file)
+
+            cache = ExifCache(self.cache_file)
+            photos = parse_photos(files, max_workers=workers, cache=cache)
+            self.assertEqual([p.to_dict() for p in photos[:-1]], expected)
+            self.assertIsInstance(photos[-1], PhotoCorruptedException)
+            self.assertEqual(cache.misses, len(files))
+            self.assertTrue(os.path.isfile(self.cache_file))
+
+        # Second run hits the cache
+        cache = ExifCache(self.cache_file)
+        photos = parse_photos(files, max_workers=2, cache=cache)
+        self.assertEqual(cache.hits, len(self.images))
+        self.assertEqual([p.to_dict() for p in photos[:-1]], expected)
+
+    def test_invalidation(self):
+        cache = ExifCache(self.cache_file)
+        parse_photos(self.images, cache=cache)
+        self.assertEqual(len(cache.entries), len(self.images))
+
+        # Changed image
+        create_image(self.images[0], 100)
+        st = os.stat(self.images[0])
+        os.utime(self.images[0], ns=(st.st_atime_ns, st.st_mtime_ns + 1000000))
+        # Removed image
+        os.remove(self.images[1])
+
+        cache = ExifCache(self.cache_file)
+        photos = parse_photos(self.images[:1] + self.images[2:], cache=cache)
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(photos[0].capture_uuid, "capture100")
+
+        # Stale entries are pruned on save
+        self.assertEqual(len(ExifCache(self.cache_file).entries), len(self.images) - 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+
+import cv2
+import numpy as np
+
+from opendm import multispectral
+from opendm.imagefilter import UndistortFilter, warp_image
+from tests.test_multispectral import band_photo, rotation
+
+def smooth_image(width, height, channels=1):
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    image = np.sin(x / 17.0) * np.cos(y / 23.0) + 0.001 * x
+    return np.repeat(image[:, :, np.newaxis], channels, axis=2)
+
+class TestImageFilter(unittest.TestCase):
+    def test_warp_image(self):
+        h = rotation(0.7, 5.5, -3.2)
+
+        # Thermal image resized to match, then aligned
+        image = smooth_image(160, 120)
+        expected = multispectral.align_image(cv2.resize(image, None, fx=4, fy=4, interpolation=cv2.INTER_LANCZOS4), h, (640, 480))
+        result = warp_image(image, (640, 480), h, (640, 480))
+        self.assertEqual(result.shape, expected.shape)
+        self.assertEqual(result.dtype, np.float32)
+        inner = (slice(20, -20), slice(20, -20))
+        self.assertLess(np.abs(result[inner] - expected[inner]).max(), 0.02)
+
+        # Same size: same as align_image
+        image = smooth_image(640, 480)
+        self.assertTrue(np.allclose(warp_image(image, None, h, (640, 480)), multispectral.align_image(image, h, (640, 480)), atol=1e-4))
+        self.assertTrue(np.allclose(warp_image(image, None, h[:2], (640, 480)), multispectral.align_image(image, h[:2], (640, 480)), atol=1e-4))
+
+        # Downsampling is not fused
+        self.assertTrue(np.array_equal(warp_image(image, None, h, (320, 240)), multispectral.align_image(image, h, (320, 240))))
+
+        # Resize only
+        self.assertEqual(warp_image(smooth_image(160, 120), (640, 480)).shape, (480, 640))
+        self.assertIs(warp_image(image), image)
+
+    def test_undistort_filter(self):
+        photos = {
+            'blue.tif': band_photo("Blue", filename="blue.tif", width=64, height=48),
+            'nir.tif': band_photo("NIR", filename="nir.tif", width=64, height=48),
+            'nir2.tif': band_photo("NIR", filename="nir2.tif", width=64, height=48),
+        }
+        alignment = {
+            'NIR': {'warp_matrix': rotation(0, 2, 1), 'dimension': (64, 48),
+                    'captures': {'nir2.tif': rotation(0, -1, 3)}}
+        }
+        planned = []
+        outs = []
+
+        def calibrate(photo, image, out):
+            outs.append(out)
+            return multispectral.dn_to_reflectance(photo, image, out=out)
+
+        def band_alignment(band_name):
+            planned.append(band_name)
+            return alignment.get(band_name)
+
+        f = UndistortFilter(photos.get, calibrate=calibrate, alignment=band_alignment)
+        image = np.random.default_rng(0).integers(5000, 60000, (48, 64, 1)).astype(np.uint16)
+
+        for shot_id in ['blue.tif', 'nir.tif', 'nir2.tif', 'blue.tif', 'nir.tif']:
+            result = f(shot_id, image)
+            self.assertEqual(result.dtype, np.float32)
+
+            reflectance = multispectral.dn_to_reflectance(photos[shot_id], image)
+            if shot_id == 'blue.tif':
+                expected = reflectance
+            else:
+                expected = multispectral.align_image(reflectance, multispectral.get_warp_matrix(alignment['NIR'], shot_id), (64, 48))
+            self.assertTrue(np.allclose(result.reshape(expected.shape), expected, rtol=1e-5))
+
+        # Planned once per band
+        self.assertEqual(planned, ["Blue", "NIR"])
+
+        # Calibration of aligned bands goes to the same buffer
+        self.assertEqual([o is None for o in outs], [True, False, False, True, False])
+        self.assertIs(outs[1], outs[2])
+        self.assertIs(outs[2], outs[4])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+import os
+import json
+import shutil
+
+from opendm.photo import ODM_Photo
+from opendm import imagesdb
+
+
+def make_photos():
+    photos = []
+    for i in range(20):
+        d = {
+            'filename': 'IMG_%04d_%s.tif' % (i // 5, i % 5 + 1),
+            'mask': None if i % 3 else 'IMG_%04d_mask.png' % i,
+            'width': 1280,
+            'height': 960,
+            'camera_make': 'MicaSense',
+            'camera_model': 'RedEdge-M',
+            'latitude': 46.84 + i * 1e-5 if i != 7 else None,
+            'longitude': -91.99 - i * 1e-5,
+            'altitude': 300.25,
+            'band_name': ['Blue', 'Green', 'Red', 'NIR', 'RedEdge'][i % 5],
+            'band_index': i % 5,
+            'utc_time': 1571316712000.0 + i,
+            'black_level': '4800 4800 4800 4800',
+            'vignetting_polynomial': None,
+            'focal_ratio': 0.85 if i % 2 else 1,  # mixed int/float
+            'speed': [1.0, 2.0, i],
+            'thermal': i % 2 == 0,
+            'name': 'Ünïcødé %s' % i,
+        }
+        if i % 4 == 0:
+            d['capture_uuid'] = 'uuid%s' % (i // 5)
+        photos.append(ODM_Photo.from_dict(d))
+    return photos
+
+
+class TestImagesDb(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = "tests/assets/output/imagesdb"
+        if os.path.exists(self.output_dir):
+            shutil.rmtree(self.output_dir)
+        os.makedirs(self.output_dir)
+        self.db_file = os.path.join(self.output_dir, "images.npz")
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_roundtrip(self):
+        photos = make_photos()
+        imagesdb.save_images_database(photos, self.db_file)
+        table = imagesdb.load_images_database(self.db_file)
+
+        self.assertEqual(len(table), len(photos))
+        for a, b in zip(photos, table):
+            self.assertIsInstance(b, ODM_Photo)
+            self.assertEqual(a.to_dict(), b.to_dict())
+            for k in a.to_dict():
+                self.assertIs(type(getattr(a, k)), type(getattr(b, k)))
+
+        # Missing attributes stay missing
+        self.assertFalse(hasattr(table[1], 'capture_uuid'))
+        self.assertEqual(table[4].capture_uuid, 'uuid0')
+
+        # Materialized photos are reused
+        table[2].mask = 'changed'
+        self.assertEqual(table[2].mask, 'changed')
+        self.assertEqual(table.column('mask')[2], 'changed')
+        self.assertEqual(table.column('band_index'), [p.band_index for p in photos])
+
+        self.assertEqual(table[-1].filename, photos[-1].filename)
+        self.assertEqual([p.filename for p in table[2:5]], [p.filename for p in photos[2:5]])
+        self.assertRaises(IndexError, lambda: table[len(photos)])
+
+    def test_json_roundtrip(self):
+        # Values loaded from images.json must match
+        photos = [ODM_Photo.from_dict(d) for d in json.loads(json.dumps([p.to_dict() for p in make_photos()]))]
+        imagesdb.save_images_database(photos, self.db_file)
+        table = imagesdb.load_images_database(self.db_file)
+        self.assertEqual([p.to_dict() for p in photos], [p.to_dict() for p in table])
+
+    def test_empty(self):
+        imagesdb.save_images_database([], self.db_file)
+        self.assertEqual(len(imagesdb.load_images_database(self.db_file)), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from argparse import Namespace
+from opendm import log
+from opendm.concurrency import parallel_map
+from opendm.dag import DAGScheduler
+from opendm.log import JsonLinesWriter, ODMLogger
+
+def read_lines(path):
+    with open(path, "r") as f:
+        return [json.loads(l) for l in f]
+
+class TestLog(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_writer(self):
+        path = os.path.join(self.tmp, "log.jsonl")
+        w = JsonLinesWriter(path, max_queue=10)
+
+        def producer(n):
+            for i in range(1000):
+                w.write({'producer': n, 'i': i})
+
+        threads = [threading.Thread(target=producer, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        w.close()
+
+        records = read_lines(path)
+        self.assertEqual(len(records), 4000)
+        self.assertEqual(w.written, 4000)
+        # Order is kept for each producer
+        for n in range(4):
+            self.assertEqual([r['i'] for r in records if r['producer'] == n], list(range(1000)))
+        # Always synced on close
+        self.assertTrue(w.fsyncs >= 1)
+
+        # Appends
+        w = JsonLinesWriter(path)
+        w.write({'last': True})
+        w.close()
+        self.assertEqual(len(read_lines(path)), 4001)
+
+        # Writing after close is a no-op
+        w.write({'ignored': True})
+        self.assertEqual(len(read_lines(path)), 4001)
+
+    def test_rotation(self):
+        path = os.path.join(self.tmp, "log.jsonl")
+        w = JsonLinesWriter(path, max_bytes=1000, backup_count=2)
+        for i in range(200):
+            w.write({'i': i, 'pad': 'x' * 20})
+        w.close()
+
+        self.assertTrue(w.rotations > 2)
+        self.assertTrue(os.path.isfile(path + ".1"))
+        self.assertTrue(os.path.isfile(path + ".2"))
+        self.assertFalse(os.path.isfile(path + ".3"))
+        for p in [path, path + ".1", path + ".2"]:
+            self.assertTrue(os.path.getsize(p) <= 1000)
+
+        # Newest records are in the main file, rotated files are in order
+        records = read_lines(path + ".2") + read_lines(path + ".1") + read_lines(path)
+        self.assertEqual(records[-1]['i'], 199)
+        ids = [r['i'] for r in records]
+        self.assertEqual(ids, list(range(ids[0], 200)))
+
+    def test_periodic_fsync(self):
+        path = os.path.join(self.tmp, "log.jsonl")
+        w = JsonLinesWriter(path, fsync_interval=0.05)
+        w.write({'a': 1})
+        # Written and synced without closing
+        for _ in range(100):
+            if w.fsyncs > 0:
+                break
+            threading.Event().wait(0.02)
+        self.assertTrue(w.fsyncs > 0)
+        self.assertEqual(read_lines(path), [{'a': 1}])
+        w.close()
+
+    def test_logger(self):
+        logger = ODMLogger()
+        logger.init_json_output([os.path.join(self.tmp, "log.json")], Namespace(project_path=self.tmp))
+        logger.log_json_stage_run("dataset", logger.start_time)
+
+        for i in range(log.JSON_MAX_STAGE_MESSAGES + 10):
+            logger.log("", "message %s" % i, "INFO")
+        logger.log_json_process("echo", 0, ["hi"], {'wallTime': 1})
+        logger.log_json_success()
+        logger.close()
+
+        # Streamed log has everything
+        records = read_lines(os.path.join(self.tmp, "log.jsonl"))
+        self.assertEqual(records[0]['event'], 'start')
+        self.assertEqual(records[1]['event'], 'stage')
+        messages = [r for r in records if r['event'] == 'message']
+        self.assertEqual(len(messages), log.JSON_MAX_STAGE_MESSAGES + 10)
+        self.assertEqual(messages[0]['message'], "message 0")
+        self.assertEqual(records[-2]['event'], 'process')
+        self.assertEqual(records[-2]['wallTime'], 1)
+        self.assertEqual(records[-1]['event'], 'success')
+
+        # Summary keeps the most recent messages
+        with open(os.path.join(self.tmp, "log.json")) as f:
+            summary = json.loads(f.read())
+        self.assertTrue(summary['success'])
+        self.assertEqual(len(summary['stages'][0]['messages']), log.JSON_MAX_STAGE_MESSAGES)
+        self.assertEqual(summary['stages'][0]['messages'][-1]['message'], "message %s" % (log.JSON_MAX_STAGE_MESSAGES + 9))
+        self.assertEqual(summary['processes'][0]['command'], "echo")
+
+    def test_concurrent_stages(self):
+        json_summary = log.logger.json
+        log_stage = log.logger.current_stage()
+        log.logger.json = {'stages': [], 'processes': []}
+        barrier = threading.Barrier(2)
+
+        def stage(name):
+            def run():
+                log.logger.log_json_stage_run(name, log.logger.start_time)
+                barrier.wait(timeout=10)
+                log.ODM_INFO("%s started" % name)
+                # Messages of worker threads go to the stage that started them
+                parallel_map(lambda i: log.ODM_INFO("%s item %s" % (name, i)), range(10), max_workers=2)
+            return run
+
+        try:
+            s = DAGScheduler(max_cpus=4, max_memory_mb=1000)
+            s.add("dem", stage("dem"), requires=[], provides=["dem"])
+            s.add("orthophoto", stage("orthophoto"), requires=[], provides=["orthophoto"])
+            s.run()
+
+            stages = dict((st['name'], [m['message'] for m in st['messages']]) for st in log.logger.json['stages'])
+            self.assertEqual(sorted(stages.keys()), ["dem", "orthophoto"])
+            for name, other in [("dem", "orthophoto"), ("orthophoto", "dem")]:
+                self.assertEqual(len([m for m in stages[name] if m.startswith(name + " ")]), 11)
+                self.assertFalse(any(m.startswith(other + " ") for m in stages[name]))
+        finally:
+            log.logger.json = json_summary
+            log.logger.set_stage(log_stage)
+
+if __name__ == '__main__':
+    unittest.main()
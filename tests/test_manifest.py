@@ -0,0 +1,210 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from argparse import Namespace
+from opendm import types
+from opendm.manifest import manifest, Manifest
+
+RERUN_STAGES = {
+    'resize': 'resize',
+    'precision': 'resize',
+    'scale': 'stats',
+}
+
+class DummyStage(types.ODM_Stage):
+    def process(self, args, outputs):
+        outputs['tree'] = types.ODM_Tree(args.project_path)
+        out = self.output_path(args)
+        if not os.path.isfile(out) or self.rerun():
+            self.params['runs'].append(self.name)
+            with open(out, "w") as f:
+                f.write(self.compute(args))
+
+    def output_path(self, args):
+        return os.path.join(args.project_path, "%s.txt" % self.name)
+
+class LoadStage(DummyStage):
+    # Reads the images, no declared outputs
+    def input_files(self, args, tree):
+        return [tree.dataset_raw]
+
+    def output_path(self, args):
+        return os.path.join(args.project_path, "load.txt")
+
+    def compute(self, args):
+        images = os.path.join(args.project_path, "images")
+        return ",".join(sorted(os.listdir(images)))
+
+class ResizeStage(DummyStage):
+    def output_files(self, args, tree):
+        return [self.output_path(args)]
+
+    def compute(self, args):
+        # Precision doesn't change the result
+        return str(args.resize)
+
+class StatsStage(DummyStage):
+    def output_files(self, args, tree):
+        return [self.output_path(args)]
+
+    def compute(self, args):
+        with open(os.path.join(args.project_path, "resize.txt")) as f:
+            return str(float(f.read()) * args.scale)
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tmp, "images"))
+        for i in range(3):
+            self.write_image("%s.jpg" % i, "image %s" % i)
+
+    def tearDown(self):
+        manifest.enabled = False
+        shutil.rmtree(self.tmp)
+
+    def write_image(self, name, content):
+        with open(os.path.join(self.tmp, "images", name), "w") as f:
+            f.write(content)
+
+    def run_pipeline(self, incremental=True, **kwargs):
+        opts = {
+            'rerun': None,
+            'rerun_all': False,
+            'rerun_from': None,
+            'end_with': 'stats',
+            'project_path': self.tmp,
+            'gcp': None,
+            'geo': None,
+            'align': None,
+            'resize': 100,
+            'precision': 1,
+            'scale': 2.0,
+        }
+        opts.update(kwargs)
+        args = Namespace(**opts)
+
+        if incremental:
+            manifest.load(os.path.join(self.tmp, "manifest.json"), self.tmp, RERUN_STAGES)
+        else:
+            manifest.enabled = False
+        runs = []
+        load = LoadStage("load", args, runs=runs)
+        resize = ResizeStage("resize", args, runs=runs)
+        stats = StatsStage("stats", args, runs=runs)
+        load.connect(resize).connect(stats)
+        load.run({})
+        return runs
+
+    def test_unchanged(self):
+        self.assertEqual(self.run_pipeline(), ["load", "resize", "stats"])
+        self.assertEqual(self.run_pipeline(), [])
+
+        with open(os.path.join(self.tmp, "manifest.json")) as f:
+            data = json.loads(f.read())
+        self.assertEqual(sorted(data['stages'].keys()), ["load", "resize", "stats"])
+        self.assertIn(os.path.join("images", "0.jpg"), data['files'])
+
+    def test_enable_on_finished_project(self):
+        self.assertEqual(self.run_pipeline(incremental=False), ["load", "resize", "stats"])
+
+        # The first run with a manifest records a baseline, completed stages don't rerun
+        self.assertEqual(self.run_pipeline(), [])
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp, "manifest.json")))
+        self.assertEqual(self.run_pipeline(), [])
+
+        self.write_image("0.jpg", "changed")
+        self.assertEqual(self.run_pipeline(), ["load", "resize", "stats"])
+
+        # Stages without a record once the manifest exists
+        with open(os.path.join(self.tmp, "manifest.json")) as f:
+            data = json.loads(f.read())
+        del data['stages']['stats']
+        with open(os.path.join(self.tmp, "manifest.json"), "w") as f:
+            f.write(json.dumps(data))
+        self.assertEqual(self.run_pipeline(), ["stats"])
+
+    def test_changed_image(self):
+        self.run_pipeline()
+
+        # Same content, different modification time
+        self.write_image("0.jpg", "image 0")
+        self.assertEqual(self.run_pipeline(), [])
+
+        self.write_image("0.jpg", "changed")
+        self.assertEqual(self.run_pipeline(), ["load", "resize", "stats"])
+        self.assertEqual(self.run_pipeline(), [])
+
+        self.write_image("new.jpg", "new image")
+        self.assertEqual(self.run_pipeline(), ["load", "resize", "stats"])
+
+        os.remove(os.path.join(self.tmp, "images", "new.jpg"))
+        self.assertEqual(self.run_pipeline(), ["load", "resize", "stats"])
+
+    def test_changed_option(self):
+        self.run_pipeline()
+
+        # Option used by the last stage only
+        self.assertEqual(self.run_pipeline(scale=3.0), ["stats"])
+        self.assertEqual(self.run_pipeline(scale=3.0), [])
+
+        # Option changes the output of resize, stats must rerun too
+        self.assertEqual(self.run_pipeline(resize=50, scale=3.0), ["resize", "stats"])
+
+        # Option that leaves the output of resize unchanged
+        self.assertEqual(self.run_pipeline(resize=50, scale=3.0, precision=2), ["resize"])
+
+        # Options not used by any stage
+        self.assertEqual(self.run_pipeline(resize=50, scale=3.0, precision=2, unrelated=True), [])
+
+    def test_modified_output(self):
+        self.run_pipeline()
+
+        with open(os.path.join(self.tmp, "resize.txt"), "w") as f:
+            f.write("1")
+        self.assertEqual(self.run_pipeline(), ["resize"])
+
+        os.remove(os.path.join(self.tmp, "stats.txt"))
+        self.assertEqual(self.run_pipeline(), ["stats"])
+
+    def test_rerun_from(self):
+        self.run_pipeline()
+        self.assertEqual(self.run_pipeline(rerun_from=["resize", "stats"]), ["resize", "stats"])
+        self.assertEqual(self.run_pipeline(), [])
+
+    def test_failure(self):
+        self.run_pipeline()
+        self.write_image("0.jpg", "changed")
+
+        # A stage that fails is not recorded and will run again
+        def fail(args):
+            raise IOError("failed")
+
+        original = StatsStage.compute
+        StatsStage.compute = lambda self, args: fail(args)
+        try:
+            with self.assertRaises(IOError):
+                self.run_pipeline()
+        finally:
+            StatsStage.compute = original
+
+        self.assertEqual(self.run_pipeline(), ["stats"])
+
+    def test_hash_cache(self):
+        m = Manifest()
+        m.load(os.path.join(self.tmp, "manifest.json"), self.tmp, {})
+        image = os.path.join(self.tmp, "images", "0.jpg")
+        h = m.hash_path(image)
+        self.assertEqual(h, m.hash_path(image))
+
+        # Cached by size and modification time
+        key = os.path.join("images", "0.jpg")
+        m.data['files'][key][2] = "cached"
+        self.assertEqual(m.hash_path(image), "cached")
+
+        self.assertIsNone(m.hash_path(os.path.join(self.tmp, "missing")))
+        self.assertNotEqual(m.hash_path(os.path.join(self.tmp, "images")), h)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,273 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import cv2
+import numpy as np
+
+from opendm import multispectral
+from opendm.multispectral import CorrectionFieldCache, dn_to_radiance
+from opendm.photo import ODM_Photo
+from tests.bench_imagesdb import synthetic_photo
+
+def band_photo(band, make="MicaSense", width=64, height=48, **kwargs):
+    d = synthetic_photo(0)
+    d.update({
+        'filename': 'IMG_0001_%s.tif' % band, 'camera_make': make, 'camera_model': 'RedEdge-M',
+        'band_name': band, 'width': width, 'height': height, 'bits_per_sample': 16,
+        'black_level': '4800 4800 4800 4800', 'radiometric_calibration': '0.00013 1.2e-07 1.5e-05',
+        'vignetting_center': '%s %s' % (width / 2.0 + 1.3, height / 2.0 - 2.1),
+        'vignetting_polynomial': '-1.5e-06 1.2e-08 -5.1e-11 7.3e-14 -4.2e-17 8.9e-21',
+        'exposure_time': 0.0012, 'gain': 1.0, 'gain_adjustment': 1.1,
+    })
+    d.update(kwargs)
+    return ODM_Photo.from_dict(d)
+
+def legacy_vignette_map(photo):
+    # Previous implementation (full-resolution float64 grids)
+    x_vc, y_vc = photo.get_vignetting_center()
+    polynomial = photo.get_vignetting_polynomial()
+
+    if x_vc and polynomial:
+        # append 1., so that we can call with numpy polyval
+        vignette_poly = np.array(polynomial + [1.0])
+
+        x, y = np.meshgrid(np.arange(photo.width), np.arange(photo.height))
+        vignette = np.polyval(vignette_poly, np.hypot((x - x_vc), (y - y_vc)))
+
+        # DJI is special apparently
+        if photo.camera_make != "DJI":
+            vignette = 1.0 / vignette
+
+        return vignette, x, y
+
+    return None, None, None
+
+def legacy_dn_to_radiance(photo, image):
+    # Previous implementation (full-resolution float64 grids)
+    image = image.astype("float32")
+    a1, a2, a3 = photo.get_radiometric_calibration()
+    dark_level = photo.get_dark_level()
+    exposure_time = photo.exposure_time
+    gain = photo.get_gain()
+    gain_adjustment = photo.gain_adjustment
+    photometric_exp = photo.get_photometric_exposure()
+    if a1 is None:
+        a1 = photometric_exp
+
+    V, x, y = legacy_vignette_map(photo)
+    if x is None:
+        x, y = np.meshgrid(np.arange(photo.width), np.arange(photo.height))
+    if dark_level is not None:
+        image -= dark_level
+    bit_depth_max = photo.get_bit_depth_max()
+    if bit_depth_max:
+        image /= bit_depth_max
+    if V is not None:
+        image *= np.repeat(V[:, :, np.newaxis], image.shape[2], axis=2)
+    if exposure_time and a2 is not None and a3 is not None:
+        R = 1.0 / (1.0 + a2 * y / exposure_time - a3 * y)
+        image *= np.repeat(R[:, :, np.newaxis], image.shape[2], axis=2)
+    if dark_level is not None:
+        image[image < 0] = 0
+    if gain is not None and exposure_time is not None:
+        image /= (gain * exposure_time)
+    image *= a1
+    if gain_adjustment is not None:
+        image *= gain_adjustment
+    return image
+
+def textured_image(width, height, seed=0):
+    rng = np.random.default_rng(seed)
+    im = np.zeros((height, width), dtype=np.float32)
+    for s in [64, 16, 4]:
+        im += cv2.resize(rng.random((height // s + 1, width // s + 1)).astype(np.float32), (width, height), interpolation=cv2.INTER_CUBIC)
+    for i in range(80):
+        cv2.circle(im, (int(rng.integers(0, width)), int(rng.integers(0, height))), int(rng.integers(5, 40)), float(rng.random() * 3), -1)
+    im -= im.min()
+    im /= im.max()
+    return (im * 255).astype(np.uint8)
+
+def band_image(primary, warp_matrix, gamma=1.4):
+    # Band pixels x map to primary pixels warp_matrix * x, with a different response
+    h, w = primary.shape
+    band = cv2.warpPerspective(primary, warp_matrix, (w, h), flags=cv2.WARP_INVERSE_MAP | cv2.INTER_LINEAR)
+    return (255 * (band / 255.0) ** gamma).astype(np.uint8)
+
+def rotation(degrees, tx, ty):
+    a = np.deg2rad(degrees)
+    return np.array([[np.cos(a), -np.sin(a), tx], [np.sin(a), np.cos(a), ty], [0, 0, 1]])
+
+class TestMultispectral(unittest.TestCase):
+    def setUp(self):
+        multispectral.correction_fields.clear()
+        self.rng = np.random.default_rng(0)
+
+    def image(self, photo):
+        return self.rng.integers(4000, 65535, (photo.height, photo.width, 1)).astype(np.uint16)
+
+    def test_dn_to_radiance(self):
+        photos = [
+            band_photo("Blue"),
+            band_photo("Green", make="DJI"),
+            band_photo("Red", black_level=None),
+            band_photo("NIR", vignetting_center=None),
+            band_photo("RedEdge", radiometric_calibration=None, fnumber=2.8),
+            band_photo("Wide", width=1000, height=700),
+        ]
+        for p in photos:
+            image = self.image(p)
+            expected = legacy_dn_to_radiance(p, image)
+            result = dn_to_radiance(p, image)
+            self.assertEqual(result.dtype, np.float32)
+            self.assertTrue(np.allclose(result, expected, rtol=1e-5, atol=1e-7), p.band_name)
+
+        # Input is not modified
+        image = self.image(photos[0])
+        copy = image.copy()
+        dn_to_radiance(photos[0], image)
+        self.assertTrue(np.array_equal(image, copy))
+
+    def test_cache(self):
+        cache = multispectral.correction_fields
+        for i in range(3):
+            for band in ["Blue", "Green", "Red"]:
+                p = band_photo(band, exposure_time=0.001 * (i + 1))
+                dn_to_radiance(p, self.image(p))
+        self.assertEqual(cache.misses, 3)
+        self.assertEqual(cache.hits, 6)
+        self.assertEqual(len(cache), 3)
+
+        # Different vignetting parameters
+        p = band_photo("Blue", vignetting_center="10 10")
+        dn_to_radiance(p, self.image(p))
+        self.assertEqual(cache.misses, 4)
+
+    def test_eviction(self):
+        field = np.zeros((10, 10), dtype=np.float32) # 400 bytes
+        cache = CorrectionFieldCache(max_bytes=1000)
+        cache.get("a", field.copy)
+        cache.get("b", field.copy)
+        cache.get("a", field.copy)
+        cache.get("c", field.copy)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.nbytes, 800)
+
+        # "b" was the least recently used
+        cache.get("a", field.copy)
+        cache.get("c", field.copy)
+        self.assertEqual(cache.misses, 3)
+        cache.get("b", field.copy)
+        self.assertEqual(cache.misses, 4)
+
+        # Too large to be cached
+        cache.get("large", lambda: np.zeros(1000, dtype=np.float32))
+        self.assertNotIn("large", cache._fields)
+        self.assertLessEqual(cache.nbytes, 1000)
+
+        with self.assertRaises(ValueError):
+            cache.get("a", field.copy)[0, 0] = 1
+
+    def test_concurrent(self):
+        cache = CorrectionFieldCache()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            return np.ones(10, dtype=np.float32)
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get("key", compute))) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(r is results[0] for r in results))
+
+class TestBandAlignment(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.imread = multispectral.imread
+        multispectral.imread = lambda path, unchanged=True, anydepth=True: cv2.imread(path, cv2.IMREAD_UNCHANGED)[:, :, np.newaxis]
+
+    def tearDown(self):
+        multispectral.imread = self.imread
+        shutil.rmtree(self.tmp)
+
+    def dataset(self, captures, warp_matrix, width=1280, height=960, outliers={}):
+        primary_photos, band_photos, s2p = [], [], {}
+        for i in range(captures):
+            primary = textured_image(width, height, seed=i)
+            p = band_photo("Green", filename="IMG_%04d_1.png" % i)
+            b = band_photo("NIR", filename="IMG_%04d_2.png" % i)
+            cv2.imwrite(os.path.join(self.tmp, p.filename), primary)
+            cv2.imwrite(os.path.join(self.tmp, b.filename), band_image(primary, outliers.get(i, warp_matrix)))
+            primary_photos.append(p)
+            band_photos.append(b)
+            s2p[p.filename] = p
+            s2p[b.filename] = p
+
+        multi_camera = [{'name': 'Green', 'photos': primary_photos}, {'name': 'NIR', 'photos': band_photos}]
+        return multi_camera, s2p
+
+    def test_pyramid_homography(self):
+        primary = textured_image(1280, 960)
+        for h in [rotation(0, 12.3, -7.6), rotation(1.2, -20, 15), rotation(-0.5, 3, 4) @ np.diag([1.01, 1.01, 1])]:
+            band = band_image(primary, h)
+            estimate = multispectral.find_pyramid_homography(band, primary)
+            self.assertLess(multispectral.corner_distance(estimate, h, (1280, 960)), 0.5)
+
+            # Residuals
+            self.assertLess(multispectral.alignment_residual(band, primary, estimate), 0.1)
+            self.assertGreater(multispectral.alignment_residual(band, primary, np.eye(3)), 0.2)
+
+            # Refined from an initial estimate
+            estimate = multispectral.find_pyramid_homography(band, primary, warp_matrix=h @ rotation(0, 2, -2))
+            self.assertLess(multispectral.corner_distance(estimate, h, (1280, 960)), 0.5)
+
+    def test_compute_alignment_matrices(self):
+        h = rotation(0.8, 12.3, -7.6)
+        multi_camera, s2p = self.dataset(12, h, outliers={3: rotation(0.8, 16.3, -4.6)})
+
+        start = time.time()
+        fixed = multispectral.compute_alignment_matrices(multi_camera, "Green", self.tmp, s2p, {}, max_samples=12)
+        fixed_time = time.time() - start
+
+        start = time.time()
+        adaptive = multispectral.compute_alignment_matrices(multi_camera, "Green", self.tmp, s2p, {}, max_samples=12, adaptive=True)
+        adaptive_time = time.time() - start
+
+        self.assertEqual(list(adaptive.keys()), ["NIR"])
+        info = adaptive["NIR"]
+        self.assertEqual(info['dimension'], (1280, 960))
+        self.assertLess(multispectral.corner_distance(info['warp_matrix'], h, (1280, 960)), 0.5)
+        self.assertLess(adaptive_time, fixed_time)
+
+        # Only the misaligned capture (which was not sampled) gets its own matrix
+        self.assertEqual(list(info['captures'].keys()), ["IMG_0003_2.png"])
+        self.assertLess(multispectral.corner_distance(info['captures']["IMG_0003_2.png"], rotation(0.8, 16.3, -4.6), (1280, 960)), 0.5)
+        self.assertIs(multispectral.get_warp_matrix(info, "IMG_0001_2.png"), info['warp_matrix'])
+        self.assertNotIn('captures', fixed["NIR"])
+
+    def test_convergence(self):
+        matrices = [{'warp_matrix': rotation(0, 10 + 0.1 * i, 5), 'dimension': (1000, 800)} for i in range(4)]
+        self.assertFalse(multispectral.alignment_converged(matrices, 5, 1.0))
+        matrices.append({'warp_matrix': rotation(0, 10, 5), 'dimension': (1000, 800)})
+        self.assertTrue(multispectral.alignment_converged(matrices, 5, 1.0))
+        matrices.append({'warp_matrix': rotation(0, 30, 5), 'dimension': (1000, 800)})
+        self.assertFalse(multispectral.alignment_converged(matrices, 5, 1.0))
+
+    def test_spread_order(self):
+        order = multispectral.spread_order(list(range(100)))
+        self.assertEqual(sorted(order), list(range(100)))
+        # The first samples cover the whole range
+        self.assertLess(max(np.diff(sorted(order[:10]))), 20)
+
+if __name__ == '__main__':
+    unittest.main()
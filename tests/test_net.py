@@ -0,0 +1,237 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from opendm import net
+from opendm.net import download, PartScheduler, add_range, missing_ranges
+from pyodm.exceptions import OdmError
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class FileServer:
+    """
+    Serves a blob with HTTP range support. Connections can be dropped
+    after a number of bytes to simulate disconnects
+    """
+    def __init__(self, data, ranges=True, etag="v1", honor_ranges=True):
+        self.data = data
+        self.ranges = ranges
+        self.honor_ranges = honor_ranges # if False, send Accept-Ranges but answer range requests with 200
+        self.etag = etag
+        self.lock = threading.Lock()
+        self.drops = 0 # number of responses to cut short
+        self.drop_after = 1000
+        self.fail = False # drop all range responses right away
+        self.served = 0
+        self.requests = []
+        owner = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                data = owner.data
+                start, end = 0, len(data) - 1
+                status = 200
+                m = re.match(r"bytes=(\d+)-(\d+)", self.headers.get('Range', ''))
+                if m and owner.ranges and owner.honor_ranges:
+                    start, end = int(m.group(1)), int(m.group(2))
+                    status = 206
+
+                with owner.lock:
+                    owner.requests.append((start, end) if status == 206 else None)
+                    drop = None
+                    if status == 206 and owner.fail:
+                        drop = 0
+                    elif status == 206 and owner.drops > 0:
+                        owner.drops -= 1
+                        drop = owner.drop_after
+
+                self.send_response(status)
+                self.send_header("Content-Length", str(end - start + 1))
+                if owner.ranges:
+                    self.send_header("Accept-Ranges", "bytes")
+                if owner.etag is not None:
+                    self.send_header("ETag", owner.etag)
+                self.end_headers()
+
+                body = data[start:end + 1]
+                if drop is not None:
+                    body = body[:drop]
+                    self.close_connection = True
+                try:
+                    self.wfile.write(body)
+                    self.wfile.flush()
+                except (IOError, OSError):
+                    return
+                if status == 206:
+                    with owner.lock:
+                        owner.served += len(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.1})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, name="file.bin"):
+        return "http://127.0.0.1:%s/%s" % (self.server.server_address[1], name)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+class TestNet(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.data = os.urandom(3 * 1024 * 1024 + 123)
+        self.sha256 = hashlib.sha256(self.data).hexdigest()
+        self.server = FileServer(self.data)
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.tmp)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def leftovers(self):
+        return [f for f in os.listdir(self.tmp) if f != "file.bin"]
+
+    def test_parallel(self):
+        progress = []
+        path = download(self.server.url(), self.tmp, progress_callback=progress.append,
+                        parallel_downloads=4, parallel_chunks_size=0.5, sha256=self.sha256)
+        self.assertEqual(path, os.path.join(self.tmp, "file.bin"))
+        self.assertEqual(self.read(path), self.data)
+        self.assertEqual(self.leftovers(), [])
+        self.assertGreater(len([r for r in self.server.requests if r is not None]), 1)
+        self.assertEqual(progress[-1], 100.0)
+
+        # Already there
+        count = len(self.server.requests)
+        download(self.server.url(), self.tmp, sha256=self.sha256)
+        self.assertEqual(len(self.server.requests), count)
+
+    def test_disconnects(self):
+        self.server.drops = 5
+        self.server.drop_after = 100000
+        path = download(self.server.url(), self.tmp, parallel_downloads=3, parallel_chunks_size=0.5, sha256=self.sha256)
+        self.assertEqual(self.read(path), self.data)
+        self.assertEqual(self.server.drops, 0)
+
+        # Resumed parts start where the dropped response stopped
+        starts = [r[0] for r in self.server.requests if r is not None]
+        self.assertTrue(any(s % (512 * 1024) != 0 for s in starts))
+
+    def test_resume(self):
+        # The connection drops and keeps failing
+        self.server.drops = 1
+        self.server.drop_after = 1024 * 1024
+        self.server.fail = False
+
+        def fail_after_drop(progress):
+            if self.server.drops == 0:
+                self.server.fail = True
+
+        with self.assertRaises(OdmError):
+            download(self.server.url(), self.tmp, progress_callback=fail_after_drop, parallel_downloads=1,
+                     parallel_chunks_size=4, sha256=self.sha256, max_retries=1)
+
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, "file.bin")))
+        with open(os.path.join(self.tmp, "file.bin.download.json")) as f:
+            state = json.loads(f.read())
+        self.assertEqual(state['ranges'], [[0, 1024 * 1024]])
+
+        # Only the rest is downloaded
+        self.server.fail = False
+        self.server.served = 0
+        path = download(self.server.url(), self.tmp, sha256=self.sha256)
+        self.assertEqual(self.read(path), self.data)
+        self.assertLessEqual(self.server.served, len(self.data) - 1024 * 1024 + 1024)
+        self.assertEqual(self.leftovers(), [])
+
+    def test_changed_file(self):
+        self.server.drops = 1
+        self.server.fail = False
+        self.server.drop_after = 1024 * 1024
+
+        def fail_after_drop(progress):
+            if self.server.drops == 0:
+                self.server.fail = True
+
+        with self.assertRaises(OdmError):
+            download(self.server.url(), self.tmp, progress_callback=fail_after_drop, parallel_downloads=1,
+                     parallel_chunks_size=4, max_retries=0)
+
+        # A new version of the file is downloaded from scratch
+        self.server.fail = False
+        self.server.data = os.urandom(len(self.data))
+        self.server.etag = "v2"
+        path = download(self.server.url(), self.tmp, sha256=hashlib.sha256(self.server.data).hexdigest())
+        self.assertEqual(self.read(path), self.server.data)
+
+    def test_checksum_mismatch(self):
+        with self.assertRaises(OdmError):
+            download(self.server.url(), self.tmp, sha256="0" * 64)
+        self.assertEqual(os.listdir(self.tmp), [])
+
+    def test_no_ranges(self):
+        self.server.ranges = False
+        path = download(self.server.url(), self.tmp, sha256=self.sha256)
+        self.assertEqual(self.read(path), self.data)
+        self.assertEqual(self.server.requests, [None])
+
+    def test_ranges_ignored(self):
+        # Accept-Ranges is sent, but range requests get the whole file
+        self.server.honor_ranges = False
+        progress = []
+        path = download(self.server.url(), self.tmp, progress_callback=progress.append,
+                        parallel_downloads=4, parallel_chunks_size=0.5, sha256=self.sha256, max_retries=5)
+        self.assertEqual(self.read(path), self.data)
+        self.assertEqual(self.leftovers(), [])
+        self.assertEqual(progress[-1], 100.0)
+
+        # Workers stop at the first 200, then one single-connection download
+        self.assertTrue(all(r is None for r in self.server.requests))
+        self.assertLessEqual(len(self.server.requests), 2 + 4)
+
+    def test_part_scheduler(self):
+        s = PartScheduler([[0, 1000], [2000, 2500]], 300, min_part_size=100, max_part_size=1000)
+        self.assertEqual(s.next(), [0, 300])
+        s.give_back(100, 300)
+        self.assertEqual(s.next(), [100, 400])
+
+        # Slow connection: smaller parts
+        s.observe(100, net.TARGET_PART_SECONDS * 4)
+        self.assertEqual(s.part_size, 100)
+        self.assertEqual(s.next(), [400, 500])
+
+        # Fast connection: larger parts, up to the end of the missing range
+        s.observe(10000, 1)
+        self.assertEqual(s.part_size, 1000)
+        self.assertEqual(s.next(), [500, 1000])
+        self.assertEqual(s.next(), [2000, 2500])
+        self.assertIsNone(s.next())
+
+    def test_ranges(self):
+        r = add_range([], 10, 20)
+        r = add_range(r, 30, 40)
+        r = add_range(r, 20, 30)
+        self.assertEqual(r, [[10, 40]])
+        self.assertEqual(missing_ranges(r, 50), [[0, 10], [40, 50]])
+        self.assertEqual(missing_ranges([[0, 50]], 50), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+import pickle
+
+from opendm.photo import ODM_Photo, CORE_ATTRIBUTES, EXTENDED_ATTRIBUTES, RADIOMETRIC_ATTRIBUTES
+
+
+class TestPhoto(unittest.TestCase):
+    def test_compact_photo(self):
+        d = {k: None for k in CORE_ATTRIBUTES + EXTENDED_ATTRIBUTES}
+        d.update({
+            'filename': 'IMG_0001_1.tif',
+            'band_name': 'Red',
+            'exposure_time': 0.002,
+            'speed_x': 1.5,
+            'custom': [1, 2],
+        })
+        p = ODM_Photo.from_dict(d)
+
+        self.assertEqual(p.to_dict(), d)
+        self.assertEqual(p.band_name, 'Red')
+        self.assertIsNone(p.dls_yaw)
+
+        # Extended attributes with default values don't use space
+        self.assertEqual(set(p.__dict__.keys()), {'exposure_time', 'speed_x', 'custom'})
+
+        p.dls_yaw = None
+        p.compact()
+        self.assertNotIn('dls_yaw', p.__dict__)
+        self.assertEqual(p.exposure_time, 0.002)
+
+        p.compact(drop=RADIOMETRIC_ATTRIBUTES)
+        self.assertIsNone(p.exposure_time)
+        self.assertEqual(p.speed_x, 1.5)
+        self.assertEqual(p.custom, [1, 2])
+
+        # Class defaults are not affected
+        self.assertIsNone(ODM_Photo.exposure_time)
+
+        # Pickles (used by process pools)
+        p2 = pickle.loads(pickle.dumps(p))
+        self.assertEqual(p2.to_dict(), p.to_dict())
+
+    def test_missing_attributes(self):
+        p = ODM_Photo.from_dict({'filename': 'a.jpg'})
+        self.assertFalse(hasattr(p, 'latitude'))
+        self.assertEqual(p.to_dict()['filename'], 'a.jpg')
+        self.assertNotIn('latitude', p.to_dict())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+from opendm.photoindex import PhotoIndex
+
+class PhotoMock:
+    def __init__(self, filename, band_name="RGB", capture_id=None, latitude=None, longitude=None):
+        self.filename = filename
+        self.band_name = band_name
+        self.capture_id = capture_id
+        self.latitude = latitude
+        self.longitude = longitude
+
+    def get_capture_id(self):
+        return self.capture_id
+
+class TestPhotoIndex(unittest.TestCase):
+    def setUp(self):
+        self.photos = [
+            PhotoMock("a_1.tif", "Red", "c1", 40.0, -74.0),
+            PhotoMock("a_2.tif", "Green", "c1", 40.0, -74.0),
+            PhotoMock("b_1.tif", "Red", "c2", 40.5, -73.5),
+            PhotoMock("b_2.tif", "Green", "c2", 40.5, -73.5),
+            PhotoMock("c_1.tif", "Red", None, None, None),
+        ]
+        self.index = PhotoIndex(self.photos)
+
+    def test_get(self):
+        self.assertIs(self.index.get("b_1.tif"), self.photos[2])
+        self.assertIsNone(self.index.get("missing.tif"))
+
+        # Duplicates resolve to the first photo
+        dup = PhotoMock("a_1.tif")
+        self.assertIs(PhotoIndex(self.photos + [dup]).get("a_1.tif"), self.photos[0])
+
+    def test_groups(self):
+        self.assertEqual([p.filename for p in self.index.by_band("Red")], ["a_1.tif", "b_1.tif", "c_1.tif"])
+        self.assertEqual(self.index.by_band("NIR"), [])
+        self.assertEqual(sorted(self.index.band_names()), ["Green", "Red"])
+
+        self.assertEqual([p.filename for p in self.index.by_capture_id("c2")], ["b_1.tif", "b_2.tif"])
+        self.assertEqual(self.index.by_capture_id(None), [])
+
+        # Results are copies
+        self.index.by_band("Red").clear()
+        self.assertEqual(len(self.index.by_band("Red")), 3)
+
+    def test_bbox(self):
+        self.assertEqual(len(self.index.in_bbox(39, -75, 41, -73)), 4)
+        self.assertEqual([p.filename for p in self.index.in_bbox(40.4, -73.6, 40.6, -73.4)], ["b_1.tif", "b_2.tif"])
+
+        # Latitude excludes even when longitude matches
+        self.assertEqual(self.index.in_bbox(41, -75, 42, -73), [])
+
+        # Bounds are inclusive
+        self.assertEqual(len(self.index.in_bbox(40.0, -74.0, 40.0, -74.0)), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+import os
+import shutil
+import tempfile
+import unittest
+from collections import namedtuple
+from opendm import planner
+from opendm.planner import CGroup, ConcurrencyPlanner
+
+MB = 1024 * 1024
+VirtualMemory = namedtuple("VirtualMemory", ["total", "available"])
+
+def write(root, path, content):
+    path = os.path.join(root, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+class FakeCGroup:
+    def __init__(self, memory_limit=None, memory_usage=None, cpu_limit=None):
+        self._memory_limit = memory_limit
+        self._memory_usage = memory_usage
+        self._cpu_limit = cpu_limit
+
+    def memory_limit(self):
+        return self._memory_limit
+
+    def memory_usage(self):
+        return self._memory_usage
+
+    def cpu_limit(self):
+        return self._cpu_limit
+
+class TestPlanner(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.virtual_memory = planner.virtual_memory
+        self.sched_getaffinity = getattr(os, 'sched_getaffinity', None)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        planner.virtual_memory = self.virtual_memory
+        if self.sched_getaffinity is not None:
+            os.sched_getaffinity = self.sched_getaffinity
+
+    def fake_system(self, total_mb, available_mb, cpus):
+        planner.virtual_memory = lambda: VirtualMemory(total_mb * MB, available_mb * MB)
+        os.sched_getaffinity = lambda pid: set(range(cpus))
+
+    def cgroup(self, files, proc_cgroup):
+        root = os.path.join(self.tmp, "sys")
+        for path, content in files.items():
+            write(root, path, content)
+        write(self.tmp, "proc_cgroup", proc_cgroup)
+        return CGroup(root, os.path.join(self.tmp, "proc_cgroup"))
+
+    def test_cgroup_v2(self):
+        cg = self.cgroup({
+            "cgroup.controllers": "cpu memory",
+            "memory.max": "max",
+            "cpu.max": "max 100000",
+            "odm/memory.max": str(2048 * MB),
+            "odm/memory.current": str(1024 * MB),
+            "odm/memory.stat": "anon 1000\ninactive_file %s\nactive_file 10\n" % (512 * MB),
+            "odm/cpu.max": "250000 100000",
+            # Child groups are more restrictive, unless the parent is
+            "odm/job/memory.max": str(4096 * MB),
+            "odm/job/memory.current": str(1024 * MB),
+            "odm/job/cpu.max": "max 100000",
+        }, "0::/odm/job\n")
+
+        self.assertEqual(cg.version, 2)
+        self.assertEqual(cg.memory_limit(), 2048 * MB)
+        self.assertEqual(cg.cpu_limit(), 2.5)
+        self.assertEqual(cg.memory_usage(), 1024 * MB)
+
+        # Page cache is reclaimable
+        cg = self.cgroup({}, "0::/odm\n")
+        self.assertEqual(cg.memory_usage(), 512 * MB)
+
+    def test_cgroup_v2_namespace(self):
+        # Inside a container the process' cgroup path is not mounted
+        cg = self.cgroup({
+            "cgroup.controllers": "cpu memory",
+            "memory.max": str(1024 * MB),
+            "cpu.max": "50000 100000",
+        }, "0::/docker/abcdef\n")
+        self.assertEqual(cg.memory_limit(), 1024 * MB)
+        self.assertEqual(cg.cpu_limit(), 0.5)
+
+    def test_cgroup_v1(self):
+        cg = self.cgroup({
+            "memory/memory.limit_in_bytes": str(9223372036854771712),
+            "memory/docker/abc/memory.limit_in_bytes": str(3072 * MB),
+            "memory/docker/abc/memory.usage_in_bytes": str(2048 * MB),
+            "memory/docker/abc/memory.stat": "cache 10\ntotal_inactive_file %s\n" % (1024 * MB),
+            "cpu,cpuacct/docker/abc/cpu.cfs_quota_us": "400000",
+            "cpu,cpuacct/docker/abc/cpu.cfs_period_us": "100000",
+        }, "12:memory:/docker/abc\n4:cpu,cpuacct:/docker/abc\n1:name=systemd:/docker/abc\n")
+
+        self.assertEqual(cg.version, 1)
+        self.assertEqual(cg.memory_limit(), 3072 * MB)
+        self.assertEqual(cg.memory_usage(), 1024 * MB)
+        self.assertEqual(cg.cpu_limit(), 4)
+
+        # No limits
+        cg = self.cgroup({
+            "memory/memory.limit_in_bytes": str(9223372036854771712),
+            "cpu/cpu.cfs_quota_us": "-1",
+            "cpu/cpu.cfs_period_us": "100000",
+        }, "12:memory:/\n4:cpu:/\n")
+        self.assertIsNone(cg.memory_limit())
+        self.assertIsNone(cg.cpu_limit())
+
+    def test_no_cgroup(self):
+        cg = CGroup(os.path.join(self.tmp, "missing"), os.path.join(self.tmp, "missing_proc"))
+        self.assertIsNone(cg.version)
+        self.assertIsNone(cg.memory_limit())
+        self.assertIsNone(cg.memory_usage())
+        self.assertIsNone(cg.cpu_limit())
+
+    def test_memory_info(self):
+        self.fake_system(16000, 12000, 8)
+
+        self.assertEqual(planner.get_memory_info(FakeCGroup()), (16000 * MB, 12000 * MB))
+
+        # Container limit
+        self.assertEqual(planner.get_memory_info(FakeCGroup(4000 * MB, 1000 * MB)), (4000 * MB, 3000 * MB))
+        self.assertEqual(planner.get_memory_info(FakeCGroup(4000 * MB)), (4000 * MB, 4000 * MB))
+
+        # Limit larger than the machine
+        self.assertEqual(planner.get_memory_info(FakeCGroup(64000 * MB, 1000 * MB)), (16000 * MB, 12000 * MB))
+
+    def test_cpus(self):
+        self.fake_system(16000, 12000, 8)
+        self.assertEqual(planner.get_available_cpus(FakeCGroup()), 8)
+        self.assertEqual(planner.get_available_cpus(FakeCGroup(cpu_limit=2.5)), 3)
+        self.assertEqual(planner.get_available_cpus(FakeCGroup(cpu_limit=0.5)), 1)
+        self.assertEqual(planner.get_available_cpus(FakeCGroup(cpu_limit=32)), 8)
+
+    def test_plan(self):
+        self.fake_system(16000, 12000, 8)
+
+        # CPU bound
+        p = ConcurrencyPlanner(cgroup=FakeCGroup())
+        self.assertEqual(p.memory_budget_mb(), 6000)
+        self.assertEqual(p.plan(100), 8)
+        self.assertEqual(p.plan(100, cpus_per_task=4), 2)
+
+        # Memory bound
+        self.assertEqual(p.plan(2000), 3)
+        self.assertEqual(p.plan(planner.image_memory_mb(6000, 4000, bands=3, bytes_per_pixel=4, copies=4)), 5)
+
+        # Never less than 1
+        self.assertEqual(p.plan(100000), 1)
+
+        # User limit
+        self.assertEqual(ConcurrencyPlanner(max_concurrency=2, cgroup=FakeCGroup()).plan(100), 2)
+
+        # Container limits
+        p = ConcurrencyPlanner(cgroup=FakeCGroup(4000 * MB, 2000 * MB, 2))
+        self.assertEqual(p.plan(100), 2)
+        self.assertEqual(p.plan(500), 2)
+        self.assertEqual(p.plan(400, cpus_per_task=1), 2)
+        p = ConcurrencyPlanner(use_at_most=1, cgroup=FakeCGroup(4000 * MB, 2000 * MB, 8))
+        self.assertEqual(p.plan(400), 5)
+
+    def test_plan_adjusts(self):
+        self.fake_system(16000, 12000, 8)
+        cg = FakeCGroup(8000 * MB, 0, None)
+        p = ConcurrencyPlanner(use_at_most=1, cgroup=cg)
+        self.assertEqual(p.plan(2000), 4)
+
+        # Memory is freed as tasks finish
+        cg._memory_usage = 6000 * MB
+        self.assertEqual(p.plan(2000), 1)
+        cg._memory_usage = 2000 * MB
+        self.assertEqual(p.plan(2000), 3)
+
+    def test_map_args(self):
+        self.fake_system(16000, 12000, 8)
+        p = ConcurrencyPlanner(cgroup=FakeCGroup())
+        args = p.map_args(1000, memory_cost=lambda item: item)
+        self.assertEqual(args['max_workers'], 6)
+        self.assertEqual(args['max_memory_mb'], 6000)
+        self.assertEqual(args['memory_cost'](123), 123)
+        self.assertEqual(p.map_args(1000)['memory_cost'](123), 1000)
+
+    def test_photo_memory(self):
+        class Photo:
+            width = 4000
+            height = 3000
+        self.assertAlmostEqual(planner.photo_memory_mb(Photo()), 4000 * 3000 * 3 / MB)
+        Photo.width = None
+        self.assertAlmostEqual(planner.photo_memory_mb(Photo(), bands=1, bytes_per_pixel=2), 4000 * 3000 * 2 / MB)
+
+if __name__ == '__main__':
+    unittest.main()
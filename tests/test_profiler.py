@@ -0,0 +1,113 @@
+import json
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from opendm import system
+from opendm.profiler import Profiler, ResourceSampler, HAS_PROC
+
+NOISY = os.path.join(os.path.dirname(__file__), "assets", "noisy.py")
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_disabled(self):
+        p = Profiler()
+        with p.span("stage") as s:
+            s.update(a=1)
+        self.assertEqual(p.spans, [])
+        self.assertIsNone(p.stop())
+
+    def test_spans(self):
+        p = Profiler()
+        p.start(self.tmp, interval=0.02)
+
+        with p.span("dataset", "stage"):
+            with p.span("parse exif", images=3):
+                sum(range(2000000))
+
+            def worker():
+                with p.span("worker step"):
+                    time.sleep(0.05)
+            t = threading.Thread(target=worker)
+            t.start()
+            t.join()
+
+            with p.span("python", "process") as s:
+                # Child process using memory and CPU
+                os.system('"%s" "%s" 200000 0 128 > /dev/null' % (sys.executable, NOISY))
+                s.update(exitCode=0)
+
+        with p.span("opensfm", "stage"):
+            with p.span("parse exif"):
+                pass
+
+        trace_file, summary_file = p.stop()
+
+        with open(trace_file) as f:
+            trace = json.loads(f.read())
+        spans = {e['name']: e for e in trace['traceEvents'] if e['ph'] == 'X'}
+        self.assertEqual(len([e for e in trace['traceEvents'] if e['ph'] == 'X']), 6)
+
+        # Children are within their parents
+        stage = spans['dataset']
+        for name in ['worker step', 'python']:
+            self.assertTrue(spans[name]['ts'] >= stage['ts'])
+            self.assertTrue(spans[name]['ts'] + spans[name]['dur'] <= stage['ts'] + stage['dur'])
+        self.assertEqual(spans['dataset']['cat'], 'stage')
+        self.assertEqual(spans['python']['args']['exitCode'], 0)
+        self.assertNotEqual(spans['worker step']['tid'], spans['dataset']['tid'])
+
+        # Resources of external programs are included
+        self.assertTrue(spans['python']['args']['cpu_s'] > 0)
+        if HAS_PROC:
+            self.assertTrue(spans['python']['args']['peak_rss_mb'] > 100)
+            self.assertTrue(spans['dataset']['args']['peak_rss_mb'] >= spans['python']['args']['peak_rss_mb'])
+            counters = set(e['name'] for e in trace['traceEvents'] if e['ph'] == 'C')
+            self.assertEqual(counters, set(['memory', 'threads', 'cpu', 'disk']))
+
+        with open(summary_file) as f:
+            summary = f.read().split("\n")
+        names = [l[:48].rstrip() for l in summary[1:] if l]
+        # Worker thread spans are nested under the current stage
+        self.assertEqual(names, ['dataset', '  parse exif', '  worker step', '  python', 'opensfm', '  parse exif'])
+
+    def test_system_run(self):
+        from opendm.profiler import profiler
+        profiler.start(self.tmp, interval=0.05)
+        try:
+            with profiler.span("stage", "stage"):
+                system.run('"%s" "%s" 10' % (sys.executable, NOISY), quiet=True)
+        finally:
+            trace_file, _ = profiler.stop()
+
+        with open(trace_file) as f:
+            trace = json.loads(f.read())
+        proc = [e for e in trace['traceEvents'] if e['ph'] == 'X' and e['cat'] == 'process']
+        self.assertEqual(len(proc), 1)
+        self.assertEqual(proc[0]['name'], os.path.basename(sys.executable).replace('"', ''))
+        self.assertEqual(proc[0]['args']['exitCode'], 0)
+
+    @unittest.skipIf(not HAS_PROC, "/proc is not available")
+    def test_sampler(self):
+        sampler = ResourceSampler()
+        s1 = sampler.sample()
+        # Fresh pages (the allocator could reuse memory that is already resident)
+        buf = mmap.mmap(-1, 64 * 1024 * 1024)
+        for i in range(0, len(buf), 4096):
+            buf[i] = 1
+        s2 = sampler.sample()
+        self.assertTrue(s2['rss'] - s1['rss'] > 32 * 1024 * 1024)
+        self.assertTrue(s2['cpu'] >= s1['cpu'])
+        self.assertTrue(s2['threads'] >= 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,237 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import threading
+from opendm.remote import LocalRemotePool, Task, estimate_cost
+from pyodm import exceptions
+from pyodm.types import TaskStatus
+
+class FakeInfo:
+    def __init__(self, status):
+        self.status = status
+        self.processing_time = 1
+        self.output = []
+        self.engine = "odm"
+        self.engine_version = "fake"
+
+class FakeRemoteTask:
+    def __init__(self, node, name, status):
+        self.node = node
+        self.name = name
+        self.uuid = "uuid-%s" % name
+        self.status = status
+        self.canceled = threading.Event()
+        self.removed = False
+
+    def info(self, with_output=None):
+        return FakeInfo(self.status)
+
+    def wait_for_completion(self, status_callback=None, interval=3):
+        deadline = time.time() + self.node.latency
+        while time.time() < deadline:
+            if self.canceled.wait(min(0.05, max(0, deadline - time.time()))):
+                raise exceptions.TaskFailedError("canceled")
+            if status_callback is not None:
+                status_callback(self.info())
+        if self.name in self.node.fail:
+            raise exceptions.TaskFailedError("%s failed" % self.name)
+
+    def download_assets(self, destination, progress_callback=None):
+        with open(os.path.join(destination, "result.txt"), "w") as f:
+            f.write(self.node.name)
+
+    def output(self, line=0):
+        return ["processing %s" % self.name, "error"]
+
+    def cancel(self):
+        self.canceled.set()
+        return True
+
+    def remove(self):
+        self.canceled.set()
+        self.removed = True
+        with self.node.lock:
+            if self in self.node.active:
+                self.node.active.remove(self)
+        return True
+
+class FakeNode:
+    """
+    In-process stand-in for a pyodm Node, with a task limit,
+    a processing latency and failures
+    """
+    def __init__(self, name, latency=0.2, limit=None, fail=[], connection_errors=0):
+        self.host = name
+        self.port = 3000
+        self.name = name
+        self.latency = latency
+        self.limit = limit
+        self.fail = fail
+        self.connection_errors = connection_errors
+        self.lock = threading.Lock()
+        self.active = []
+        self.created = []
+        self.max_active = 0
+
+    def info(self):
+        return FakeInfo(None)
+
+    def create_task(self, files, options={}, name=None, progress_callback=None, skip_post_processing=False, outputs=[]):
+        project = os.path.basename(os.path.dirname(os.path.dirname(files[0]))) # images/0.jpg
+        time.sleep(0.01) # upload
+        if progress_callback is not None:
+            progress_callback(100)
+
+        with self.lock:
+            if self.connection_errors > 0:
+                self.connection_errors -= 1
+                raise exceptions.NodeConnectionError("connection reset")
+
+            running = self.limit is None or len(self.active) < self.limit
+            task = FakeRemoteTask(self, project, TaskStatus.RUNNING if running else TaskStatus.QUEUED)
+            self.created.append(task)
+            if running:
+                self.active.append(task)
+                self.max_active = max(self.max_active, len(self.active))
+        return task
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = []
+
+def task_class(recorder, local_duration=0.2):
+    class FakeTask(Task):
+        def __init__(self, project_path, node, params):
+            super().__init__(project_path, node, params, max_retries=3, retry_timeout=0.1)
+
+        def process_local(self):
+            with recorder.lock:
+                recorder.local.append(str(self))
+            time.sleep(local_duration * estimate_cost(self.project_path))
+            with open(self.path("result.txt"), "w") as f:
+                f.write("local")
+
+        def process_remote(self, done):
+            self.execute_remote_task(done, seed_files=["opensfm/reconstruction.json"],
+                                     seed_touch_files=["opensfm/features/empty"],
+                                     outputs=["result.txt"], options={})
+    return FakeTask
+
+class TestRemotePool(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def projects(self, count, images=1):
+        paths = []
+        for i in range(count):
+            path = os.path.join(self.tmp, "submodel_%04d" % i)
+            os.makedirs(os.path.join(path, "images"))
+            os.makedirs(os.path.join(path, "opensfm"))
+            with open(os.path.join(path, "opensfm", "reconstruction.json"), "w") as f:
+                f.write("[]")
+            n = images[i] if isinstance(images, list) else images
+            for j in range(n):
+                with open(os.path.join(path, "images", "%s.jpg" % j), "w") as f:
+                    f.write("image")
+            paths.append(path)
+        return paths
+
+    def results(self, paths):
+        results = []
+        for p in paths:
+            with open(os.path.join(p, "result.txt")) as f:
+                results.append(f.read())
+        return results
+
+    def test_local_and_remote(self):
+        paths = self.projects(8)
+        nodes = [FakeNode("node1", 0.2), FakeNode("node2", 0.2)]
+        recorder = Recorder()
+        pool = LocalRemotePool(nodes, local_slots=2)
+        pool.set_projects(paths)
+        pool.run(task_class(recorder))
+
+        results = self.results(paths)
+        self.assertIn("local", results)
+        self.assertIn("node1", results)
+        self.assertIn("node2", results)
+        self.assertEqual(results.count("local"), len(recorder.local))
+
+        # Remote tasks are cleaned up
+        for n in nodes:
+            self.assertTrue(all(t.removed for t in n.created))
+        self.assertEqual(pool.params['tasks'], [])
+
+    def test_cost_order(self):
+        paths = self.projects(4, images=[1, 3, 2, 4])
+        recorder = Recorder()
+        pool = LocalRemotePool([], local_slots=1)
+        pool.set_projects(paths)
+        pool.run(task_class(recorder, 0.01))
+        self.assertEqual(recorder.local, ["submodel_0003", "submodel_0001", "submodel_0002", "submodel_0000"])
+
+    def test_task_limit(self):
+        paths = self.projects(6)
+        node = FakeNode("node1", 1.0, limit=2)
+        recorder = Recorder()
+        pool = LocalRemotePool([node], local_slots=0)
+        pool.set_projects(paths)
+        pool.run(task_class(recorder, 0.3))
+
+        self.assertEqual(self.results(paths), ["node1"] * 6)
+        self.assertEqual(node.max_active, 2)
+
+        # The node was asked for a third task only once
+        queued = [t for t in node.created if t.status == TaskStatus.QUEUED]
+        self.assertEqual(len(queued), 1)
+
+    def test_failures(self):
+        # Connection errors are retried
+        paths = self.projects(2)
+        node = FakeNode("node1", 0.1, connection_errors=1)
+        recorder = Recorder()
+        pool = LocalRemotePool([node], local_slots=0)
+        pool.set_projects(paths)
+        pool.run(task_class(recorder))
+        self.assertEqual(self.results(paths), ["node1", "node1"])
+        self.assertEqual(len(node.created), 2)
+
+        # A task failure is not
+        shutil.rmtree(self.tmp)
+        self.tmp = tempfile.mkdtemp()
+        paths = self.projects(3)
+        node = FakeNode("node1", 0.1, fail=["submodel_0001"])
+        pool = LocalRemotePool([node], local_slots=0)
+        pool.set_projects(paths)
+        with self.assertRaises(exceptions.TaskFailedError):
+            pool.run(task_class(recorder))
+        self.assertTrue(os.path.isfile(os.path.join(paths[1], "error.log")))
+        self.assertTrue(all(t.removed for t in node.created))
+
+    def test_work_stealing(self):
+        paths = self.projects(2)
+        node = FakeNode("slow", 30)
+        recorder = Recorder()
+        pool = LocalRemotePool([node], local_slots=1)
+        pool.min_sample_seconds = 0
+        pool.set_projects(paths)
+
+        start = time.time()
+        pool.run(task_class(recorder, 0.2))
+
+        # The second task was taken back from the slow node
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(self.results(paths), ["local", "local"])
+        self.assertEqual(len(recorder.local), 2)
+        self.assertEqual(len(node.created), 1)
+        self.assertTrue(node.created[0].canceled.is_set())
+        self.assertTrue(node.created[0].removed)
+
+if __name__ == '__main__':
+    unittest.main()
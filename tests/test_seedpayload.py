@@ -0,0 +1,179 @@
+import os
+import io
+import json
+import shutil
+import zipfile
+import tempfile
+import threading
+import unittest
+from email.parser import BytesParser
+from email import policy
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from opendm.seedpayload import SeedPayload, can_stream
+from opendm.remote import Task
+from pyodm import Node
+
+class FakeNodeODM:
+    """
+    Minimal NodeODM API on a local HTTP server: accepts a task,
+    keeps the uploaded files and returns a small all.zip
+    """
+    def __init__(self, project_path):
+        self.project_path = project_path
+        self.uploads = {}
+        self.seed_on_disk = []
+        owner = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def reply(self, body, content_type="application/json"):
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                if path == "/info":
+                    self.reply({'version': '2.2.0', 'engine': 'odm', 'engineVersion': '3.0.0'})
+                elif path == "/task/uuid1/info":
+                    self.reply({'uuid': 'uuid1', 'name': 'test', 'dateCreated': 0, 'processingTime': 1,
+                                'status': {'code': 40}, 'options': [], 'imagesCount': len(owner.uploads)})
+                elif path == "/task/uuid1/download/all.zip":
+                    buf = io.BytesIO()
+                    with zipfile.ZipFile(buf, "w") as zf:
+                        zf.writestr("odm_report/report.txt", "done")
+                    self.reply(buf.getvalue(), "application/zip")
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                if self.path == "/task/new/init" or self.path == "/task/new/commit/uuid1":
+                    self.reply({'uuid': 'uuid1'})
+                elif self.path == "/task/new/upload/uuid1":
+                    msg = BytesParser(policy=policy.default).parsebytes(
+                        b"Content-Type: " + self.headers['Content-Type'].encode('utf-8') + b"\r\n\r\n" + body)
+                    for part in msg.iter_parts():
+                        name = part.get_filename()
+                        owner.uploads[name] = part.get_payload(decode=True)
+                        if name == "seed.zip":
+                            owner.seed_on_disk.append(os.path.exists(os.path.join(owner.project_path, "seed.zip")))
+                    self.reply({'success': True})
+                else:
+                    self.send_error(404)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = HTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def node(self):
+        return Node("127.0.0.1", self.server.server_address[1])
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+class SeedTask(Task):
+    def process_remote(self, done):
+        self.execute_remote_task(done, seed_files=["opensfm/reconstruction.json", "opensfm/exif"],
+                                 seed_touch_files=["opensfm/features/empty"],
+                                 outputs=["odm_report"], options={})
+
+class TestSeedPayload(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.files = {
+            "opensfm/reconstruction.json": json.dumps([{"shots": list(range(5000))}]).encode('utf-8'),
+            "opensfm/exif/a.jpg.exif": b'{"make": "test"}' * 100,
+            "opensfm/exif/b.jpg.exif": b'{"make": "other"}' * 100,
+            "opensfm/exif/empty.exif": b"",
+            "opensfm/exif/nested/été.exif": b"unicode name",
+            "images/1.jpg": os.urandom(200000),
+        }
+        for name, data in self.files.items():
+            path = os.path.join(self.tmp, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "wb") as f:
+                f.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def check_archive(self, data, expected):
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(sorted(zf.namelist()), sorted(expected))
+            for name in expected:
+                self.assertEqual(zf.read(name), self.files.get(name, b""))
+            return dict((i.filename, i.compress_type) for i in zf.infolist())
+
+    def build(self, **kwargs):
+        payload = SeedPayload(self.tmp, ["opensfm", "images/1.jpg", "missing.txt"], ["opensfm/features/empty"], **kwargs)
+        buf = io.BytesIO()
+        payload.write(buf)
+        return buf.getvalue()
+
+    def test_archive(self):
+        expected = list(self.files.keys()) + ["opensfm/features/empty"]
+        types = self.check_archive(self.build(), expected)
+        self.assertEqual(types["opensfm/reconstruction.json"], zipfile.ZIP_DEFLATED)
+        self.assertEqual(types["images/1.jpg"], zipfile.ZIP_STORED)
+
+        # Store only
+        types = self.check_archive(self.build(compression_level=0), expected)
+        self.assertTrue(all(t == zipfile.ZIP_STORED for t in types.values()))
+
+        # Same bytes regardless of the number of workers
+        self.assertEqual(self.build(max_workers=4), self.build())
+
+        # Large files are compressed while streaming
+        data = self.build(max_buffered_size=100)
+        self.check_archive(data, expected)
+        self.assertLess(len(data), len(self.build(compression_level=0)))
+
+    def test_save(self):
+        path = SeedPayload(self.tmp, ["opensfm"], max_workers=2).save(os.path.join(self.tmp, "seed.zip"))
+        with open(path, "rb") as f:
+            self.check_archive(f.read(), [n for n in self.files if n.startswith("opensfm")])
+
+    def test_serve(self):
+        payload = SeedPayload(self.tmp, ["opensfm/exif"])
+        import requests
+        with payload.serve() as server:
+            first = requests.get(server.url()).content
+            second = requests.get(server.url()).content
+            self.assertEqual(requests.get(server.url() + "x").status_code, 404)
+        self.assertEqual(first, second)
+        self.check_archive(first, [n for n in self.files if n.startswith("opensfm/exif")])
+
+    @unittest.skipUnless(can_stream(), "Requests to 127.0.0.1 go through a proxy")
+    def test_upload(self):
+        fake = FakeNodeODM(self.tmp)
+        try:
+            params = {'tasks': [], 'threads': [], 'seed_compression': 9, 'seed_workers': 2}
+            task = SeedTask(self.tmp, fake.node(), params)
+            results = []
+            task.process(False, lambda t, local, error=None, partial=False: results.append((error, partial)))
+            for t in params['threads']:
+                t.join()
+        finally:
+            fake.close()
+
+        self.assertEqual(results, [(None, True), (None, False)])
+        self.assertEqual(fake.seed_on_disk, [False])
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, "seed.zip")))
+        self.assertEqual(fake.uploads["1.jpg"], self.files["images/1.jpg"])
+        self.check_archive(fake.uploads["seed.zip"], [n for n in self.files if n.startswith("opensfm")] + ["opensfm/features/empty"])
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp, "odm_report", "report.txt")))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+import os
+import shutil
+
+import cv2
+import numpy as np
+
+try:
+    import onnx
+    from onnx import helper, TensorProto
+except ImportError:
+    onnx = None
+
+from opendm.staindetection import StainDetector
+
+
+def create_model(path, size=32):
+    # 1x1 convolution producing 2 classes, with a dynamic batch dimension
+    w = np.array([[[[1.0]], [[-1.0]], [[0.0]]], [[[-1.0]], [[1.0]], [[0.0]]]], dtype=np.float32)
+    graph = helper.make_graph(
+        [helper.make_node("Conv", ["input", "w"], ["output"])],
+        "stains",
+        [helper.make_tensor_value_info("input", TensorProto.FLOAT, ["N", 3, size, size])],
+        [helper.make_tensor_value_info("output", TensorProto.FLOAT, ["N", 2, size, size])],
+        [helper.make_tensor("w", TensorProto.FLOAT, w.shape, w.flatten().tolist())],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8
+    onnx.save(model, path)
+
+
+@unittest.skipIf(onnx is None, "onnx is not installed")
+class TestStainDetection(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = "tests/assets/output/staindetection"
+        if os.path.exists(self.output_dir):
+            shutil.rmtree(self.output_dir)
+        os.makedirs(self.output_dir)
+
+        self.model = os.path.join(self.output_dir, "model.onnx")
+        create_model(self.model)
+
+        rng = np.random.default_rng(42)
+        self.images = []
+        for i in range(11):
+            img = rng.integers(0, 255, (40 + i, 60, 3), dtype=np.uint8)
+            f = os.path.join(self.output_dir, "img_%s.png" % i)
+            cv2.imwrite(f, img)
+            self.images.append(f)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_batch_matches_single(self):
+        detector = StainDetector(self.model)
+        self.assertIsNone(detector.max_batch_size)
+
+        single = {}
+        for f in self.images:
+            image = cv2.imread(f)
+            h, w = image.shape[:2]
+            single[f] = detector._detect_stains(detector._preprocess(image), h, w)
+
+        missing = os.path.join(self.output_dir, "missing.png")
+        results = list(detector.detect_batch(self.images + [missing], batch_size=4, prefetch=3, loader_threads=2))
+        self.assertEqual(len(results), len(self.images) + 1)
+
+        for f, image, mask in results:
+            if f == missing:
+                self.assertIsNone(image)
+                self.assertIsNone(mask)
+            else:
+                self.assertEqual(mask.shape, image.shape[:2])
+                self.assertTrue(np.array_equal(mask, single[f]))
+
+    def test_early_exit(self):
+        detector = StainDetector(self.model)
+        gen = detector.detect_batch(self.images, batch_size=2, prefetch=1)
+        next(gen)
+        # Loader threads should be stopped without deadlocking
+        gen.close()
+
+if __name__ == '__main__':
+    unittest.main()
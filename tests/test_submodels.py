@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from opendm.submodels import Submodel, SubmodelScheduler, SubmodelProgress, submodel_memory_mb, SUBMODEL_BASE_MEMORY_MB
+
+class FakePlanner:
+    def __init__(self, budget_mb, cpus):
+        self.budget_mb = budget_mb
+        self.cpus = cpus
+
+    def memory_budget_mb(self):
+        return self.budget_mb
+
+    def plan(self, task_memory_mb, cpus_per_task=1, name=None):
+        return max(1, min(self.cpus, int(self.budget_mb // task_memory_mb)))
+
+class Toolchain:
+    def __init__(self, duration=0.1, failures={}):
+        self.lock = threading.Lock()
+        self.duration = duration
+        self.failures = dict(failures)
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+
+    def __call__(self, submodel, cpus):
+        with self.lock:
+            self.calls.append((submodel.name, cpus))
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            time.sleep(self.duration)
+            with self.lock:
+                if self.failures.get(submodel.name, 0) > 0:
+                    self.failures[submodel.name] -= 1
+                    raise IOError("%s failed" % submodel.name)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+class TestSubmodels(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def submodels(self, count, memory_mb=1000, start=0):
+        result = []
+        for i in range(start, start + count):
+            name = "submodel_%04d" % i
+            path = os.path.join(self.tmp, name)
+            os.makedirs(path)
+            result.append(Submodel(name, path, memory_mb))
+        return result
+
+    def test_memory_model(self):
+        self.assertEqual(submodel_memory_mb([]), SUBMODEL_BASE_MEMORY_MB)
+        small = submodel_memory_mb([(4000, 3000)] * 100)
+        large = submodel_memory_mb([(8000, 6000)] * 100)
+        self.assertTrue(SUBMODEL_BASE_MEMORY_MB < small < large)
+
+    def test_plan(self):
+        submodels = self.submodels(4)
+        s = SubmodelScheduler(8, max_parallel=0, planner=FakePlanner(10000, 8))
+        self.assertEqual(s.plan(submodels), (4, 2))
+
+        # Limited by memory
+        s = SubmodelScheduler(8, max_parallel=0, planner=FakePlanner(2500, 8))
+        self.assertEqual(s.plan(submodels), (2, 4))
+
+        # Not more workers than submodels
+        self.assertEqual(s.plan(submodels[:1]), (1, 8))
+
+    def test_parallel(self):
+        submodels = self.submodels(4)
+        toolchain = Toolchain()
+        s = SubmodelScheduler(8, max_parallel=2, planner=FakePlanner(10000, 2))
+        self.assertEqual(s.run(submodels, toolchain), [])
+
+        self.assertEqual(toolchain.max_running, 2)
+        self.assertEqual(sorted(toolchain.calls), [(sm.name, 4) for sm in submodels])
+        for sm in submodels:
+            self.assertTrue(sm.is_done())
+
+        # Completed submodels are skipped
+        toolchain = Toolchain()
+        self.assertEqual(s.run(submodels, toolchain), [])
+        self.assertEqual(toolchain.calls, [])
+
+        # Unless rerun is set
+        self.assertEqual(s.run(submodels, toolchain, rerun=True), [])
+        self.assertEqual(len(toolchain.calls), 4)
+
+    def test_memory_budget(self):
+        # Submodels of different sizes, the budget only fits the large one alone
+        submodels = self.submodels(3, 1000)
+        submodels[0].memory_mb = 2500
+        toolchain = Toolchain()
+        s = SubmodelScheduler(4, max_parallel=0, planner=FakePlanner(3000, 4))
+        self.assertEqual(s.run(submodels, toolchain), [])
+        self.assertEqual(len(toolchain.calls), 3)
+
+    def test_failure_isolation(self):
+        submodels = self.submodels(3)
+
+        # Fails once, the retry succeeds
+        toolchain = Toolchain(failures={'submodel_0001': 1})
+        s = SubmodelScheduler(4, max_parallel=2, planner=FakePlanner(10000, 4))
+        self.assertEqual(s.run(submodels, toolchain), [])
+        names = [name for name, cpus in toolchain.calls]
+        self.assertEqual(sorted(names), ['submodel_0000', 'submodel_0001', 'submodel_0001', 'submodel_0002'])
+        # Retries run alone, with all CPUs
+        self.assertEqual(toolchain.calls[-1], ('submodel_0001', 4))
+        self.assertEqual(submodels[1].attempts, 2)
+
+        # Keeps failing
+        submodels = self.submodels(3, start=3)
+        toolchain = Toolchain(failures={'submodel_0004': 5})
+        failed = s.run(submodels, toolchain)
+        self.assertEqual([f.name for f in failed], ['submodel_0004'])
+        self.assertIsInstance(failed[0].error, IOError)
+        self.assertTrue(submodels[0].is_done())
+        self.assertFalse(submodels[1].is_done())
+        self.assertTrue(submodels[2].is_done())
+
+        # Running again only processes the failed submodel
+        toolchain = Toolchain()
+        self.assertEqual(s.run(submodels, toolchain), [])
+        self.assertEqual([name for name, cpus in toolchain.calls], ['submodel_0004'])
+
+    def test_progress(self):
+        stages = ['dataset', 'opensfm', 'odm_orthophoto']
+        submodels = self.submodels(2)
+
+        # Previous runs are ignored
+        with open(os.path.join(submodels[0].project_path, "log.jsonl"), "w") as f:
+            f.write(json.dumps({'event': 'success'}) + "\n")
+
+        def toolchain(submodel, cpus):
+            with open(os.path.join(submodel.project_path, "log.jsonl"), "a") as f:
+                for stage in stages:
+                    f.write(json.dumps({'event': 'stage', 'name': stage}) + "\n")
+                    f.flush()
+                    time.sleep(0.1)
+                f.write(json.dumps({'event': 'success'}) + "\n")
+
+        updates = []
+        s = SubmodelScheduler(2, max_parallel=1, planner=FakePlanner(10000, 1))
+        s.run(submodels, toolchain, progress_callback=updates.append, stages=stages, poll_interval=0.02)
+
+        self.assertEqual(updates[-1], 1.0)
+        self.assertEqual(updates, sorted(updates))
+        # Partial progress was reported while submodels were running
+        self.assertTrue(any(0 < u < 0.5 for u in updates))
+        self.assertTrue(any(0.5 < u < 1.0 for u in updates))
+
+    def test_progress_reader(self):
+        path = os.path.join(self.tmp, "sm")
+        os.makedirs(path)
+        p = SubmodelProgress(path, ['a', 'b', 'c', 'd'])
+        self.assertEqual(p.update(), 0)
+
+        with open(os.path.join(path, "log.jsonl"), "w") as f:
+            f.write(json.dumps({'event': 'stage', 'name': 'c'}) + "\n")
+            f.write('{"event": "stage", "na')
+        self.assertEqual(p.update(), 0.5)
+
+        with open(os.path.join(path, "log.jsonl"), "a") as f:
+            f.write('me": "d"}\n')
+        self.assertEqual(p.update(), 0.75)
+
+if __name__ == '__main__':
+    unittest.main()
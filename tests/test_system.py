@@ -0,0 +1,117 @@
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from opendm import system
+from opendm import log
+
+NOISY = os.path.join(os.path.dirname(__file__), "assets", "noisy.py")
+
+def noisy_cmd(*args):
+    return '"%s" "%s" %s' % (sys.executable, NOISY, " ".join(str(a) for a in args))
+
+class TestSystem(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.json = log.logger.json
+        log.logger.json = {'processes': [], 'stages': [{'messages': []}]}
+        self.log_dir = system.set_process_log_dir(os.path.join(self.tmp, "logs"))
+
+    def tearDown(self):
+        system.set_process_log_dir(None)
+        log.logger.json = self.json
+        shutil.rmtree(self.tmp)
+
+    def test_run(self):
+        stats = system.run(noisy_cmd(1000, 0, 64))
+
+        # Full output is in the log
+        self.assertEqual(os.path.dirname(stats['log']), self.log_dir)
+        self.assertTrue(os.path.basename(stats['log']).startswith("0"))
+        self.assertTrue(stats['log'].endswith(".log.gz"))
+        with gzip.open(stats['log'], "rt") as f:
+            lines = f.read().split("\n")
+        self.assertEqual(lines[0], "Processing item 1 of 1000... done")
+        self.assertEqual(lines[-2], "Last line")
+        self.assertEqual(len(lines), 1002)
+        self.assertEqual(stats['outputBytes'], len("\n".join(lines)))
+
+        # Resource usage
+        self.assertTrue(stats['wallTime'] > 0)
+        if hasattr(os, "wait4"):
+            self.assertTrue(stats['userTime'] + stats['systemTime'] > 0)
+            self.assertTrue(stats['maxRss'] > 64 * 1024 * 1024)
+
+        p = log.logger.json['processes'][-1]
+        self.assertEqual(p['exitCode'], 0)
+        self.assertEqual(len(p['output']), 10)
+        self.assertEqual(p['output'][-1], "Last line")
+        self.assertEqual(p['output'][-2], "Processing item 1000 of 1000... done")
+        self.assertEqual(p['log'], stats['log'])
+
+    def test_process_log_runs(self):
+        path = os.path.join(self.tmp, "runs")
+        run_dirs = []
+        for i in range(4):
+            run_dirs.append(system.set_process_log_dir(path, keep_runs=2))
+            system.run(noisy_cmd(1, 0))
+
+        # Every run writes to its own directory, numbering starts over
+        self.assertEqual(len(set(run_dirs)), 4)
+        self.assertEqual(sorted(os.listdir(path)), [os.path.basename(d) for d in run_dirs[2:]])
+        self.assertTrue(os.listdir(run_dirs[-1])[0].startswith("0001_"))
+
+    def test_failure(self):
+        with self.assertRaises(system.SubprocessException) as cm:
+            system.run(noisy_cmd(5, 3))
+        self.assertEqual(cm.exception.errorCode, 3)
+        p = log.logger.json['processes'][-1]
+        self.assertEqual(p['exitCode'], 3)
+        self.assertEqual(p['output'][-1], "Last line")
+
+        with self.assertRaises(system.SubprocessException):
+            system.run("kill -9 $$")
+
+        # Log file names are unique
+        logs = os.listdir(self.log_dir)
+        self.assertEqual(len(logs), 2)
+
+    def test_echo_rate_limit(self):
+        r, w = os.pipe()
+        data = b"".join(b"line %d\n" % i for i in range(100000))
+
+        reader = os.fdopen(r, "rb")
+        pump = system.OutputPump(reader, os.path.join(self.tmp, "out.gz"), echo_rate=1, echo_burst=10000)
+        echoed = []
+        pump._write = echoed.append
+        pump.start()
+        with os.fdopen(w, "wb") as f:
+            f.write(data)
+        pump.join()
+        reader.close()
+
+        echoed = b"".join(echoed)
+        self.assertTrue(len(echoed) < 20000)
+        self.assertTrue(b"bytes not shown" in echoed)
+        # The end of the output is always visible
+        self.assertTrue(echoed.endswith(b"line 99999\n"))
+        self.assertEqual(pump.total_bytes, len(data))
+        with gzip.open(os.path.join(self.tmp, "out.gz"), "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_quiet(self):
+        processes = len(log.logger.json['processes'])
+        stats = system.run(noisy_cmd(20000), quiet=True)
+
+        # Not in log.json, but the full output is still in the log file
+        self.assertEqual(len(log.logger.json['processes']), processes)
+        with gzip.open(stats['log'], "rt") as f:
+            lines = f.read().split("\n")
+        self.assertEqual(len(lines), 20002)
+        self.assertEqual(lines[-3], "Processing item 20000 of 20000... done")
+        self.assertEqual(stats['outputBytes'], len("\n".join(lines)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+import base64
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+from rasterio.io import MemoryFile
+
+from opendm import thermal
+from opendm.exiftool import extract_raw_thermal_image_data, extract_raw_thermal_images_data, extract_temperature_params_from
+from opendm.thermal_tools.thermal_utils import sensor_vals_to_temp
+from tests.test_multispectral import band_photo
+
+STUB = os.path.abspath("tests/assets/exiftool_stub.py")
+
+PARAMS = {
+    "Emissivity": 0.95, "ObjectDistance": "5.0 m", "AtmosphericTemperature": "25.0 C",
+    "ReflectedApparentTemperature": "23.0 C", "IRWindowTemperature": "20.0 C", "IRWindowTransmission": 1.0,
+    "RelativeHumidity": "60.0 %", "PlanckR1": 21106.77, "PlanckB": 1501.0, "PlanckF": 1.0,
+    "PlanckO": -7340.0, "PlanckR2": 0.012545258,
+}
+
+def raw_thermal_image(width=64, height=48, seed=0):
+    return np.random.default_rng(seed).integers(20000, 30000, (height, width)).astype(np.uint16)
+
+def encode_raw_thermal_image(raw):
+    # Same as exiftool -b -j
+    height, width = raw.shape
+    with MemoryFile() as memfile:
+        with memfile.open(driver='GTiff', width=width, height=height, count=1, dtype=raw.dtype) as dataset:
+            dataset.write(raw, 1)
+        return "base64:" + base64.b64encode(memfile.read()).decode('ascii')
+
+class TestThermal(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.extract = thermal.extract_raw_thermal_images_data
+        self.batches = []
+
+        def extract(image_paths, exiftool_path="exiftool"):
+            self.batches.append([os.path.basename(p) for p in image_paths])
+            return self.extract(image_paths, exiftool_path)
+        thermal.extract_raw_thermal_images_data = extract
+
+    def tearDown(self):
+        thermal.extract_raw_thermal_images_data = self.extract
+        shutil.rmtree(self.tmp)
+
+    def dataset(self, count, serials=["S1"], **params):
+        # Thermal photos with canned exiftool output (see tests/assets/exiftool_stub.py)
+        photos, raws = [], []
+        for i in range(count):
+            p = band_photo("LWIR", make="DJI", filename="IMG_%04d_T.JPG" % i)
+            raw = raw_thermal_image(seed=i)
+            with open(os.path.join(self.tmp, p.filename), "w") as f:
+                f.write("x")
+
+            tags = dict(PARAMS)
+            tags.update(params)
+            tags["RawThermalImage"] = encode_raw_thermal_image(raw)
+            serial = serials[i % len(serials)]
+            if serial is not None:
+                tags["SerialNumber"] = serial
+            with open(os.path.join(self.tmp, p.filename + ".tags.json"), "w") as f:
+                json.dump(tags, f)
+
+            photos.append(p)
+            raws.append(raw)
+        return photos, raws
+
+    def expected(self, raw, **params):
+        tags = dict(PARAMS)
+        tags.update(params)
+        return sensor_vals_to_temp(raw.astype(np.float64), **extract_temperature_params_from(tags))
+
+    def test_temperature_lut(self):
+        params = extract_temperature_params_from(PARAMS)
+        lut = thermal.temperature_lut(params)
+        self.assertEqual(lut.dtype, np.float32)
+        self.assertEqual(len(lut), 65536)
+
+        valid = np.arange(8119, 65536)
+        self.assertLess(np.abs(lut[valid] - sensor_vals_to_temp(valid.astype(np.float64), **params)).max(), 1e-3)
+
+        # Values that cannot be converted
+        self.assertTrue(np.isnan(lut[:8119]).all())
+        with self.assertRaises(Exception):
+            sensor_vals_to_temp(np.array([8118.0]), **params)
+
+    def test_extract_batch(self):
+        photos, raws = self.dataset(3)
+        paths = [os.path.join(self.tmp, p.filename) for p in photos] + [os.path.join(self.tmp, "missing.JPG")]
+        results = extract_raw_thermal_images_data(paths, STUB)
+
+        self.assertEqual(sorted(results.keys()), sorted(paths[:3]))
+        params, raw, serial = results[paths[1]]
+        self.assertEqual(serial, "S1")
+        self.assertEqual(params["ObjectDistance"], 5.0)
+        self.assertEqual(raw.shape, (48, 64, 1))
+        self.assertTrue(np.array_equal(raw[:, :, 0], raws[1]))
+
+        # Single file
+        single_params, single_raw = extract_raw_thermal_image_data(paths[1], STUB)
+        self.assertEqual(single_params, params)
+        self.assertTrue(np.array_equal(single_raw, raw))
+        self.assertEqual(extract_raw_thermal_image_data(paths[3], STUB), ({}, None))
+
+    def test_engine(self):
+        photos, raws = self.dataset(10)
+        engine = thermal.ThermalEngine(self.tmp, photos, batch_size=4, exiftool_path=STUB)
+
+        for p, raw in zip(photos, raws):
+            image = thermal.dn_to_temperature(p, None, self.tmp, engine=engine)
+            self.assertEqual(image.dtype, np.float32)
+            self.assertEqual(image.shape, (48, 64, 1))
+            self.assertLess(np.abs(image[:, :, 0] - self.expected(raw)).max(), 1e-3)
+
+        # One exiftool invocation per batch, one lookup table
+        self.assertEqual(self.batches, [["IMG_%04d_T.JPG" % i for i in range(0, 4)],
+                                        ["IMG_%04d_T.JPG" % i for i in range(4, 8)],
+                                        ["IMG_%04d_T.JPG" % i for i in range(8, 10)]])
+        self.assertEqual(list(engine.calibrations.keys()), ["S1"])
+        self.assertEqual(len(engine._extracted), 0)
+
+        # Out of order
+        self.batches = []
+        engine = thermal.ThermalEngine(self.tmp, photos, batch_size=4, exiftool_path=STUB)
+        for i in [5, 0, 1, 2, 6]:
+            engine.dn_to_temperature(photos[i])
+        self.assertEqual(self.batches, [["IMG_0005_T.JPG", "IMG_0000_T.JPG", "IMG_0001_T.JPG", "IMG_0002_T.JPG"],
+                                        ["IMG_0006_T.JPG", "IMG_0003_T.JPG", "IMG_0004_T.JPG", "IMG_0007_T.JPG"]])
+
+    def test_calibrations(self):
+        photos, raws = self.dataset(6, serials=["S1", "S2", None])
+        engine = thermal.ThermalEngine(self.tmp, photos, exiftool_path=STUB)
+        for p in photos:
+            engine.dn_to_temperature(p)
+
+        self.assertEqual(len(self.batches), 1)
+        self.assertEqual(sorted(engine.calibrations.keys()), ["DJI RedEdge-M", "S1", "S2"])
+        self.assertTrue(all(len(c) == 1 for c in engine.calibrations.values()))
+
+        # Different parameters for the same camera
+        shutil.rmtree(self.tmp)
+        os.makedirs(self.tmp)
+        photos, raws = self.dataset(2, Emissivity=0.9)
+        engine.images_path = self.tmp
+        image = engine.dn_to_temperature(photos[1])
+        self.assertEqual(len(engine.calibrations["S1"]), 2)
+        self.assertLess(np.abs(image[:, :, 0] - self.expected(raws[1], Emissivity=0.9)).max(), 1e-3)
+
+    def test_concurrent(self):
+        photos, raws = self.dataset(12)
+        engine = thermal.ThermalEngine(self.tmp, photos, batch_size=4, exiftool_path=STUB)
+        results = {}
+
+        def worker(offset):
+            for p in photos[offset::3]:
+                results[p.filename] = engine.dn_to_temperature(p)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(results), 12)
+        for p, raw in zip(photos, raws):
+            self.assertLess(np.abs(results[p.filename][:, :, 0] - self.expected(raw)).max(), 1e-3)
+
+        # Each photo is extracted once
+        extracted = sum(self.batches, [])
+        self.assertEqual(sorted(extracted), sorted(p.filename for p in photos))
+
+    def test_fallback(self):
+        photos, raws = self.dataset(2)
+        os.remove(os.path.join(self.tmp, photos[0].filename + ".tags.json"))
+        with open(os.path.join(self.tmp, photos[1].filename + ".tags.json"), "w") as f:
+            json.dump(dict(PARAMS, RawThermalImage=encode_raw_thermal_image(np.full((48, 64), 100, dtype=np.uint16))), f)
+        engine = thermal.ThermalEngine(self.tmp, photos, exiftool_path=STUB)
+
+        image = np.full((48, 64, 1), 100, dtype=np.uint16)
+        result = thermal.dn_to_temperature(photos[0], image, self.tmp, engine=engine)
+        self.assertEqual(result.dtype, np.float32)
+        self.assertTrue(np.array_equal(result, image))
+
+        # Raw values that cannot be converted
+        with self.assertRaises(Exception):
+            engine.dn_to_temperature(photos[1])
+
+if __name__ == '__main__':
+    unittest.main()
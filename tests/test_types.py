@@ -2,10 +2,16 @@ import unittest
 from opendm import types
 
 class ODMPhotoMock:
-    def __init__(self, filename, band_name, band_index):
+    def __init__(self, filename, band_name, band_index, latitude=None, longitude=None, capture_id=None):
         self.filename = filename
         self.band_name = band_name
         self.band_index = band_index
+        self.latitude = latitude
+        self.longitude = longitude
+        self.capture_id = capture_id
+    
+    def get_capture_id(self):
+        return self.capture_id
     
     def __str__(self):
         return "%s (%s)" % (self.filename, self.band_name)
@@ -46,5 +52,29 @@ class TestTypes(unittest.TestCase):
         recon = types.ODM_Reconstruction(photos)
         self.assertTrue(recon.multi_camera is None)
 
+    def test_reconstruction_index(self):
+        files = [('IMG_0298_1.tif', 'Red', 1), ('IMG_0298_2.tif', 'Green', 2), ('IMG_0298_3.tif', 'Blue', 3), ('IMG_0298_4.tif', 'RGB', 0),
+                 ('IMG_0299_1.tif', 'Red', 1), ('IMG_0299_2.tif', 'Green', 2), ('IMG_0299_3.tif', 'Blue', 3), ('IMG_0299_4.tif', 'RGB', 0)]
+        photos = [ODMPhotoMock(f, b, i, 40 + n, -74 + n, f.split('_')[1]) for n, (f, b, i) in enumerate(files)]
+        recon = types.ODM_Reconstruction(photos)
+
+        # The RGB band is dropped by filter_photos, the index must reflect that
+        self.assertEqual(len(recon.photos), 6)
+        self.assertIsNone(recon.get_photo('IMG_0298_4.tif'))
+        self.assertEqual(recon.get_photos_by_band('RGB'), [])
+        self.assertEqual(recon.get_photo('IMG_0299_2.tif').band_name, 'Green')
+        self.assertEqual(len(recon.get_photos_by_band('Red')), 2)
+        self.assertEqual([p.filename for p in recon.get_photos_by_capture_id('0299')], ['IMG_0299_1.tif', 'IMG_0299_2.tif', 'IMG_0299_3.tif'])
+        self.assertEqual([p.filename for p in recon.get_photos_in_bbox(40, -74, 41.5, -72.5)], ['IMG_0298_1.tif', 'IMG_0298_2.tif'])
+
+        # Assigning a new list invalidates the index
+        recon.photos = recon.photos[:1]
+        self.assertIsNone(recon.get_photo('IMG_0299_2.tif'))
+
+        # In place modifications require an explicit invalidation
+        recon.photos.append(photos[-1])
+        recon.invalidate_index()
+        self.assertIsNotNone(recon.get_photo('IMG_0299_4.tif'))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file